@@ -0,0 +1,160 @@
+#!/usr/bin/python2.7
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Benchmarks for the QA package.
+
+Usage: bench.py [-n <results>]
+
+The database report benchmark uses SQLite databases in a temporary directory.
+
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import sys
+import os
+import getopt
+import shutil
+import tempfile
+from datetime import datetime
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.dialects.postgresql import INTERVAL
+
+from pycopia.timelib import now
+from pycopia.db import tables
+from pycopia.db import models
+from pycopia.db import types
+from pycopia.reports import database
+
+RESULT_TABLES = (tables.projects, tables.project_versions, tables.test_cases,
+        tables.test_suites, tables.test_results, tables.test_results_data)
+
+
+# test_cases.time_estimate is a PostgreSQL INTERVAL. It is not used here.
+@compiles(INTERVAL, "sqlite")
+def _compile_interval(element, compiler, **kw):
+    return "TEXT"
+
+
+def sqlite_engine(dirname):
+    def attach(dbapi_conn, record):
+        dbapi_conn.execute("ATTACH DATABASE '{}' AS public".format(
+                os.path.join(dirname, "public.db")))
+    engine = create_engine("sqlite:///" + os.path.join(dirname, "main.db"))
+    event.listen(engine, "connect", attach)
+    return engine
+
+
+def make_database(dirname, suites, tests):
+    """The tables results refer to, with a project, and suites and test
+    cases for the results of make_results."""
+    engine = sqlite_engine(dirname)
+    for table in RESULT_TABLES:
+        table.create(engine)
+    session = sessionmaker(bind=engine, autoflush=False)()
+    session.add(models.create(models.Project, name="pycopia", description="bench"))
+    for i in range(suites):
+        session.add(models.create(models.TestSuite, name="suite%d" % i,
+                suiteimplementation="bench.suite%d" % i))
+        for j in range(tests):
+            session.add(models.create(models.TestCase, name="test%d.%d" % (i, j),
+                    testimplementation="bench.suite%d.Test%d" % (i, j)))
+    session.commit()
+    session.close()
+    return engine
+
+
+def make_results(suites, tests):
+    """A result tree like DatabaseReport builds: a runner, with suites of
+    tests, each test with one data point."""
+    start = datetime.now()
+    root = database.ResultHolder()
+    root.set("objecttype", types.OBJECTTYPES[database.RUNNER])
+    root.set("starttime", start)
+    root.set("build", "pycopia 1.0.0-%d" % os.getpid())
+    for i in range(suites):
+        suite = root.get_result()
+        root.append(suite)
+        suite.set("objecttype", types.OBJECTTYPES[database.SUITE])
+        suite.set("testimplementation", "bench.suite%d" % i)
+        suite.set("build", root.get("build"))
+        suite.set("starttime", start)
+        suite.set("result", database.PASSED)
+        for j in range(tests):
+            test = suite.get_result()
+            suite.append(test)
+            test.set("objecttype", types.OBJECTTYPES[database.TEST])
+            test.set("testimplementation", "bench.suite%d.Test%d" % (i, j))
+            test.set("build", root.get("build"))
+            test.set("starttime", start)
+            test.set("endtime", start)
+            test.set("result", database.PASSED)
+            test.set("diagnostic", "passed message")
+            test._datapoints.append(database.DataHolder({"value": j}, "measured"))
+    return root
+
+
+def _one_by_one(session, root):
+    root.commit(session)
+    session.commit()
+
+
+def _bulk(session, root):
+    database.commit_results(session, root)
+    session.commit()
+
+
+def bench_results(count):
+    suites = max(1, count // 100)
+    tests = count // suites
+    print("{} suites of {} test results, each with a data point".format(suites, tests))
+    for name, func in (
+            ("one by one", _one_by_one),
+            ("bulk", _bulk),
+            ):
+        dirname = tempfile.mkdtemp()
+        try:
+            engine = make_database(dirname, suites, tests)
+            session = sessionmaker(bind=engine, autoflush=False)()
+            root = make_results(suites, tests)
+            start = now()
+            func(session, root)
+            elapsed = now() - start
+            written = session.query(models.TestResult).count()
+            print("{:>16s}: {:8.3f} s, {:8.0f} results/s".format(name, elapsed,
+                    written / elapsed))
+            session.close()
+            engine.dispose()
+        finally:
+            shutil.rmtree(dirname)
+
+
+def main(argv):
+    count = 10000
+    opts, args = getopt.getopt(argv[1:], "n:")
+    for opt, optarg in opts:
+        if opt == "-n":
+            count = int(optarg)
+    bench_results(count)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
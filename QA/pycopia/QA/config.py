@@ -29,7 +29,6 @@ from pycopia import logging
 from sqlalchemy import and_
 
 from pycopia import dictlib
-from pycopia import aid
 from pycopia import scheduler
 
 from pycopia.db import models
@@ -73,14 +72,8 @@ class RootContainer(config.Container):
         try:
             return super(RootContainer, self).__getattribute__(key)
         except AttributeError:
-            node = self.__dict__["node"]
-            session = self.__dict__["session"]
             try:
-                item = config.get_item(session, node, key)
-                if item.value is aid.NULL:
-                    return config.Container(session, item)
-                else:
-                    return item.value
+                return self._get_attribute_item(key)
             except config.NoResultFound as err:
                 raise AttributeError("RootContainer: No attribute or key '%s' found: %s" % (key, err))
 
@@ -12,6 +12,11 @@ The table schema is hierarchical, and some records will hold different set
 of data from another. The entire set is obtained by custom query in the
 model object.
 
+The results are written when the report is finalized, in one transaction. The
+test cases, suites and builds they refer to are looked up with a few queries
+for all of them, and the result rows are inserted together with ids taken
+ahead of time, so that children can refer to their parents.
+
 """
 
 
@@ -24,9 +29,10 @@ from pycopia import passwd
 from pycopia import reports
 
 from sqlalchemy.orm.exc import NoResultFound
-from sqlalchemy import and_
+from sqlalchemy import and_, func, text
 
 from pycopia.db import models
+from pycopia.db import tables
 from pycopia.db import types
 
 
@@ -36,6 +42,9 @@ from pycopia.db import types
 
 PROJECT_RE = re.compile(r"(\w+)[ \-.:](\d+)\.(\d+)\.(\d+)[\.\-](\d+)")
 
+# Most values in one IN clause.
+INCHUNK = 500
+
 _COLUMNS = {
     "testcase": None,           # test case record
     "environment": None,        # from config
@@ -94,19 +103,23 @@ class ResultHolder(object):
     def get(self, cname):
         return self._data[cname]
 
-    def commit(self, dbsession, parentrecord=None):
-        self._data["parent"] = parentrecord
-        if self._data["objecttype"] == TEST:
-            self.resolve_testcase(dbsession)
-        if self._data["objecttype"] == SUITE:
-            self.resolve_testsuite(dbsession)
-        self.resolve_build(dbsession)
-        tr = models.create(models.TestResult, **self._data)
-        dbsession.add(tr)
-        if self._data["objecttype"] == TEST:
-            self.resolve_data(dbsession, tr)
-        for child in self._children:
-            child.commit(dbsession, tr)
+    def commit(self, dbsession):
+        """Add this result, and all below it, to the session. The caller
+        commits."""
+        commit_results(dbsession, self)
+
+    def walk(self):
+        """Yield this result and all below it, parents before children, as
+        (result, parent index) pairs. The index is into the sequence yielded,
+        and is None for this one."""
+        stack = [(self, None)]
+        index = 0
+        while stack:
+            holder, parent = stack.pop()
+            yield holder, parent
+            for child in reversed(holder._children):
+                stack.append((child, index))
+            index += 1
 
     def emit(self, fo, level=0):
         fo.write("    "*level)
@@ -115,72 +128,141 @@ class ResultHolder(object):
         for child in self._children:
             child.emit(fo, level+1)
 
-    def resolve_testcase(self, dbsession):
-        ti = self._data.get("testimplementation")
-        if ti:
-            try:
-                tc = dbsession.query(
-                        models.TestCase).filter(models.TestCase.testimplementation==ti).one()
-            except NoResultFound:
-                pass
-            else:
-                self._data["testcase"] = tc
-
-    def resolve_testsuite(self, dbsession):
-        ti = self._data.get("testimplementation")
-        if ti:
-            try:
-                ts = dbsession.query(models.TestSuite).filter(models.TestSuite.suiteimplementation==ti).one()
-            except NoResultFound:
-                pass
-            else:
-                self._data["testsuite"] = ts
-
-    def resolve_build(self, dbsession):
-        buildstring = self._data.get("build")
-        if buildstring is None:
-            return
-        mo = PROJECT_RE.search(buildstring)
-        if mo:
-            try:
-                pname, major, minor, sub, build = mo.groups()
-                major = int(major); minor = int(minor); sub = int(sub); build = int(build)
-            except ValueError:
-                self._data["build"] = None
-                return
-            try:
-                proj = dbsession.query(models.Project).filter(models.Project.name==pname).one()
-            except NoResultFound:
-                self._data["build"] = None
-                return
-            try:
-                projectversion = dbsession.query(models.ProjectVersion).filter(and_(
-                        models.ProjectVersion.project==proj,
-                        models.ProjectVersion.valid==True,
-                        models.ProjectVersion.major==major,
-                        models.ProjectVersion.minor==minor,
-                        models.ProjectVersion.subminor==sub,
-                        models.ProjectVersion.build==build)
-                        ).one()
-            except NoResultFound:
-                projectversion = models.create(
-                        models.ProjectVersion, project=proj, valid=True,
-                        major=major, minor=minor, subminor=sub, build=build)
-                dbsession.add(projectversion)
-                dbsession.commit()
-            self._data["build"] = projectversion
-        else:
-            self._data["build"] = None
 
-    def resolve_data(self, dbsession, testrecord):
-        dp = self._datapoints
-        if dp:
-            tdl = [models.create(models.TestResultData, data=hldr.data, note=hldr.note, testresult=testrecord)
-                    for hldr in dp]
-            for tr in tdl:
-                dbsession.add(tr)
-            testrecord.data = tdl
-        self._datapoints = None
+def _parse_build(buildstring):
+    mo = PROJECT_RE.search(buildstring)
+    if mo:
+        pname, major, minor, sub, build = mo.groups()
+        try:
+            return pname, (int(major), int(minor), int(sub), int(build))
+        except ValueError:
+            pass
+    return None, None
+
+
+def _chunks(values):
+    values = list(values)
+    for i in range(0, len(values), INCHUNK):
+        yield values[i:i+INCHUNK]
+
+
+def _lookup_unique(dbsession, keycol, idcol, keys):
+    """Map each key to the id of the one row having it. Keys with no row, or
+    more than one, are left out."""
+    found = {}
+    for chunk in _chunks(keys):
+        for key, rowid in dbsession.query(keycol, idcol).filter(keycol.in_(chunk)):
+            found.setdefault(key, []).append(rowid)
+    return dict((key, ids[0]) for key, ids in found.items() if len(ids) == 1)
+
+
+def _resolve_builds(dbsession, buildstrings):
+    """Map build strings to ProjectVersion ids, adding the versions that are
+    not in the database yet. Strings that don't name a known project are
+    left out."""
+    parsed = dict((bs, _parse_build(bs)) for bs in buildstrings)
+    projects = _lookup_unique(dbsession, models.Project.name, models.Project.id,
+            set(pname for pname, version in parsed.values() if pname))
+    versions = {}
+    for chunk in _chunks(set(projects.values())):
+        for pv in dbsession.query(models.ProjectVersion).filter(and_(
+                models.ProjectVersion.project_id.in_(chunk),
+                models.ProjectVersion.valid==True)):
+            versions[(pv.project_id, (pv.major, pv.minor, pv.subminor, pv.build))] = pv
+    new = []
+    rv = {}
+    for bs, (pname, version) in parsed.items():
+        projid = projects.get(pname)
+        if projid is None:
+            continue
+        pv = versions.get((projid, version))
+        if pv is None:
+            major, minor, sub, build = version
+            pv = models.create(models.ProjectVersion, project_id=projid, valid=True,
+                    major=major, minor=minor, subminor=sub, build=build)
+            versions[(projid, version)] = pv
+            new.append(pv)
+        rv[bs] = pv
+    if new:
+        dbsession.add_all(new)
+        dbsession.flush()
+    return dict((bs, pv.id) for bs, pv in rv.items())
+
+
+def _reserve_ids(dbsession, table, count):
+    """Return count unused primary key values for the table. On PostgreSQL
+    they are taken from its sequence. Otherwise they follow the largest in
+    use, so only one writer may add rows at a time."""
+    if count == 0:
+        return []
+    if dbsession.get_bind().dialect.name == "postgresql":
+        return [rowid for rowid, in dbsession.execute(text(
+                "SELECT nextval(pg_get_serial_sequence(:table, 'id')) "
+                "FROM generate_series(1, :count)"),
+                {"table": table.fullname, "count": count})]
+    start = (dbsession.query(func.max(table.c.id)).scalar() or 0) + 1
+    return range(start, start + count)
+
+
+def _id_of(obj):
+    return obj.id if obj is not None else None
+
+
+def commit_results(dbsession, root):
+    """Add the result tree under root to the session, in bulk. The caller
+    commits."""
+    results = list(root.walk())
+    testimpls = set()
+    suiteimpls = set()
+    buildstrings = set()
+    for holder, parent in results:
+        d = holder._data
+        if d["testimplementation"]:
+            if d["objecttype"] == TEST:
+                testimpls.add(d["testimplementation"])
+            elif d["objecttype"] == SUITE:
+                suiteimpls.add(d["testimplementation"])
+        if d["build"] is not None:
+            buildstrings.add(d["build"])
+    testcases = _lookup_unique(dbsession, models.TestCase.testimplementation,
+            models.TestCase.id, testimpls)
+    testsuites = _lookup_unique(dbsession, models.TestSuite.suiteimplementation,
+            models.TestSuite.id, suiteimpls)
+    builds = _resolve_builds(dbsession, buildstrings)
+    ids = _reserve_ids(dbsession, tables.test_results, len(results))
+    rows = []
+    datarows = []
+    for (holder, parent), rowid in zip(results, ids):
+        d = holder._data
+        impl = d["testimplementation"]
+        rows.append({
+            "id": rowid,
+            "parent_id": ids[parent] if parent is not None else None,
+            "testcase_id": testcases.get(impl) if d["objecttype"] == TEST else None,
+            "testsuite_id": testsuites.get(impl) if d["objecttype"] == SUITE else None,
+            "build_id": builds.get(d["build"]) if d["build"] is not None else None,
+            "tester_id": _id_of(d["tester"]),
+            "environment_id": _id_of(d["environment"]),
+            "testimplementation": impl,
+            "testversion": d["testversion"],
+            "objecttype": d["objecttype"],
+            "starttime": d["starttime"],
+            "endtime": d["endtime"],
+            "arguments": d["arguments"],
+            "result": d["result"],
+            "diagnostic": d["diagnostic"],
+            "resultslocation": d["resultslocation"],
+            "reportfilename": d["reportfilename"],
+            "note": d["note"],
+            "valid": d["valid"],
+        })
+        if d["objecttype"] == TEST:
+            for hldr in holder._datapoints or ():
+                datarows.append({"data": hldr.data, "note": hldr.note,
+                        "test_results_id": rowid})
+    dbsession.execute(tables.test_results.insert(), rows)
+    if datarows:
+        dbsession.execute(tables.test_results_data.insert(), datarows)
 
 
 class DataHolder(object):
@@ -245,7 +327,7 @@ class DatabaseReport(reports.NullReport):
             sys.stderr.write("\nReport structure:\n")
             root.emit(sys.stdout)
         else:
-            root.commit(self._dbsession)
+            commit_results(self._dbsession, root)
             self._dbsession.commit()
         root.destroy()
 
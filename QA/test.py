@@ -7,8 +7,14 @@
 
 """
 
+import os
+import shutil
+import tempfile
 import unittest
 
+from sqlalchemy import create_engine, event, select
+from sqlalchemy.orm import sessionmaker
+
 from pycopia import QA
 from pycopia.QA import core
 from pycopia.QA import testrunner
@@ -23,6 +29,8 @@ from pycopia import datafile
 from pycopia import dataset
 
 from pycopia import reports
+from pycopia.reports import database
+from pycopia.db import tables
 from pycopia import remote
 from pycopia import smartbits
 
@@ -72,6 +80,93 @@ class QATests(unittest.TestCase):
         rpt.finalize()
 
 
+    def test_database_result_walk(self):
+        """Test the result tree order used to write results in bulk."""
+        root = database.ResultHolder()
+        for name in ("suite1", "suite2"):
+            suite = root.get_result()
+            suite.set("testimplementation", name)
+            root.append(suite)
+            for tname in ("test1", "test2"):
+                test = suite.get_result()
+                test.set("testimplementation", name + "." + tname)
+                suite.append(test)
+        results = list(root.walk())
+        names = [holder.get("testimplementation") for holder, parent in results]
+        self.assertEqual(names, [None, "suite1", "suite1.test1", "suite1.test2",
+                "suite2", "suite2.test1", "suite2.test2"])
+        self.assertEqual([parent for holder, parent in results], [None, 0, 1, 1, 0, 4, 4])
+
+    def test_database_commit_results(self):
+        """Test writing a result tree to an SQLite database."""
+        dirname = tempfile.mkdtemp()
+        try:
+            self._commit_results(dirname)
+        finally:
+            shutil.rmtree(dirname)
+
+    def _commit_results(self, dirname):
+        def attach(dbapi_conn, record):
+            dbapi_conn.execute("ATTACH DATABASE '{}' AS public".format(
+                    os.path.join(dirname, "public.db")))
+        engine = create_engine("sqlite:///" + os.path.join(dirname, "main.db"))
+        event.listen(engine, "connect", attach)
+        for table in (tables.test_suites, tables.projects, tables.project_versions,
+                tables.test_results, tables.test_results_data):
+            table.create(engine)
+        # Only the columns looked up, the others have PostgreSQL types.
+        engine.execute("CREATE TABLE public.test_cases (id INTEGER PRIMARY KEY, "
+                "name VARCHAR(255), testimplementation VARCHAR(255))")
+        session = sessionmaker(bind=engine)()
+        engine.execute("INSERT INTO public.test_cases VALUES (1, 'test1', 'suite1.test1'), "
+                "(2, 'dup1', 'suite1.dup'), (3, 'dup2', 'suite1.dup')")
+        session.execute(tables.test_suites.insert(), [
+                {"name": "suite1", "suiteimplementation": "suite1"}])
+        session.execute(tables.projects.insert(), [{"name": "pycopia", "description": ""}])
+        session.execute(tables.project_versions.insert(), [
+                {"project_id": 1, "major": 1, "minor": 0, "subminor": 0, "build": 1}])
+        # An earlier run, so new ids must follow it.
+        session.execute(tables.test_results.insert(), [
+                {"id": 1, "objecttype": database.RUNNER, "result": database.NA, "valid": True}])
+        root = database.ResultHolder()
+        root.set("objecttype", database.RUNNER)
+        suite = root.get_result()
+        suite.set("objecttype", database.SUITE)
+        suite.set("testimplementation", "suite1")
+        suite.set("build", "pycopia 1.0.0.1")
+        root.append(suite)
+        for impl, build in (("suite1.test1", "pycopia 1.0.0.1"),
+                ("suite1.dup", "pycopia-1.0.0.2"), ("suite1.other", "nosuch 1.2.3.4")):
+            test = suite.get_result()
+            test.set("objecttype", database.TEST)
+            test.set("testimplementation", impl)
+            test.set("build", build)
+            test.set("result", database.PASSED)
+            suite.append(test)
+        suite._children[0]._datapoints = [database.DataHolder({"volts": 2.5}, "first")]
+        suite._children[2]._datapoints = [database.DataHolder([1, 2], "second")]
+        root.commit(session)
+        session.commit()
+        tr = tables.test_results
+        rows = session.execute(select([tr.c.id, tr.c.parent_id, tr.c.testimplementation,
+                tr.c.testcase_id, tr.c.testsuite_id, tr.c.build_id, tr.c.objecttype,
+                tr.c.result]).order_by(tr.c.id)).fetchall()
+        self.assertEqual([tuple(row) for row in rows[1:]], [
+                (2, None, None, None, None, None, database.RUNNER, database.NA),
+                (3, 2, "suite1", None, 1, 1, database.SUITE, database.NA),
+                (4, 3, "suite1.test1", 1, None, 1, database.TEST, database.PASSED),
+                (5, 3, "suite1.dup", None, None, 2, database.TEST, database.PASSED),
+                (6, 3, "suite1.other", None, None, None, database.TEST, database.PASSED)])
+        pv = tables.project_versions
+        self.assertEqual([tuple(row) for row in session.execute(
+                select([pv.c.id, pv.c.project_id, pv.c.major, pv.c.minor, pv.c.subminor,
+                pv.c.build]).order_by(pv.c.id))], [(1, 1, 1, 0, 0, 1), (2, 1, 1, 0, 0, 2)])
+        trd = tables.test_results_data
+        self.assertEqual([tuple(row) for row in session.execute(
+                select([trd.c.test_results_id, trd.c.data, trd.c.note]).order_by(trd.c.id))],
+                [(4, {"volts": 2.5}, "first"), (6, [1, 2], "second")])
+        session.close()
+
     def test_datafile(self):
         metadata = datafile.DataFileData()
         metadata.name = "test_datafile"
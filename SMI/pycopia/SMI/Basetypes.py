@@ -29,7 +29,7 @@ from functools import reduce
 from pycopia import ipv4
 from pycopia.aid import unsigned, unsigned64, IF, Enum
 
-from pycopia.SMI import OIDMAP
+from pycopia.SMI import OIDTRIE
 
 class Range(object):
     def __init__(self, minValue=-2147483647, maxValue=2147483647):
@@ -60,58 +60,68 @@ class Ranges(list):
 
 
 # This object is the interface to the pysmi module.
-class OID(list):
-    def __init__(self, oid):
+class OID(tuple):
+    """An immutable, hashable object identifier.
+
+    Ordering is lexicographic by sub-identifier, so OIDs sort in MIB walk
+    order and may be used with bisect and as dictionary keys. The string
+    form is computed once.
+    """
+    def __new__(cls, oid=()):
         if type(oid) is str:
             # filter out empty members (leading dot causes this)
-            list(map(self.append, list(map(int, list(filter(len, oid.split('.')))))))
-        elif isinstance(oid, list):
-            self.extend( oid )
-        else:
-            raise ValueError("OID must be initialized with OID string, or list. ")
+            oid = [int(x) for x in oid.split('.') if x]
+        elif isinstance(oid, (int, long)):
+            raise ValueError("OID must be initialized with OID string, or sequence.")
+        return tuple.__new__(cls, oid)
 
     def __str__(self):
-        return ".".join(['%lu' % x for x in self])
+        try:
+            return self.__dict__["_str"]
+        except KeyError:
+            s = self.__dict__["_str"] = ".".join(['%lu' % x for x in self])
+            return s
 
     def __repr__(self):
         cl = self.__class__
-        return "%s.%s(%s)" % (cl.__module__, cl.__name__, super(OID, self).__repr__())
-
-    def __cmp__(self, other):
-        if not other:
-            return -1
-        # self can only be greater than other if prefixes match.
-        cv = cmp(len(self), len(other))
-        if cv < 0: # then self is shorter than other, defined as less
-            return -1
-        elif cv == 0: # then self is same size as other
-            if self == other:
-                return 0
-            else:
-                return -1
-        else: # then self is longer than other
-            if self[:len(other)] == other:
-                return 1
-            else:
-                return -1
+        return "%s.%s(%r)" % (cl.__module__, cl.__name__, list(self))
+
+    __hash__ = tuple.__hash__
+
+    # Plain lists still compare equal, as they did when OID was a list.
+    def __eq__(self, other):
+        if type(other) is list:
+            other = tuple(other)
+        return tuple.__eq__(self, other)
+
+    def __ne__(self, other):
+        if type(other) is list:
+            other = tuple(other)
+        return tuple.__ne__(self, other)
+
+    def startswith(self, prefix):
+        """True if this OID begins with, or is equal to, prefix."""
+        n = len(prefix)
+        return len(self) >= n and tuple.__getslice__(self, 0, n) == tuple(prefix)
 
     # subtracting one oid from another removes any common prefix
     # (considered to be the difference).
     def __sub__(self, other):
         i = 0
-        for s, o in map(None, self, list(other)):
+        for s, o in zip(self, other):
             if s != o:
                 break
             i += 1
-        return self.__class__(self[i:])
+        return self.__class__(tuple.__getslice__(self, i, len(self)))
 
     def __getslice__(self, i, j):
-        cl = self.__class__
-        return cl(list.__getslice__(self, i,j))
+        return self.__class__(tuple.__getslice__(self, i, j))
 
     def __add__(self, other):
-        cl = self.__class__
-        return cl(list.__add__(self, other))
+        return self.__class__(tuple.__add__(self, tuple(other)))
+
+    def __radd__(self, other):
+        return self.__class__(tuple(other) + tuple(self))
 
 # Abstract base classes for SNMP objects
 class ObjectSyntax(object):
@@ -352,12 +362,13 @@ def bits_factory(basename, enums):
 class ObjectIdentifier(OID, SimpleSyntax):
     "OBJECT IDENTIFIER"
     _ber_tag = '\x06'
-    def __init__(self, init=[], implied=False):
-        self.implied = bool(implied)
-        super(ObjectIdentifier, self).__init__(init)
-    def __repr__(self):
-        cl = self.__class__
-        return "%s.%s(%s)" % (cl.__module__, cl.__name__, list.__repr__(self))
+    implied = False
+    def __new__(cls, init=(), implied=False):
+        return OID.__new__(cls, init)
+    def __init__(self, init=(), implied=False):
+        # only stored when set, most OIDs never carry an instance dict.
+        if implied:
+            self.implied = True
     def _ber_(self):
         index = 0
         # skip leading empty oid
@@ -406,7 +417,7 @@ class ObjectIdentifier(OID, SimpleSyntax):
             l = []
         else:
             l = [len(self)]
-        return ObjectIdentifier(l+self)
+        return ObjectIdentifier(l+list(self))
 
     def oid_decode(self, oid):
         if not self.implied:
@@ -421,12 +432,7 @@ class ObjectIdentifier(OID, SimpleSyntax):
 
     def get_object(self):
         """Returns the object class this OID refers to, or None if it is not imported."""
-        oidmap = OIDMAP
-        for i in range(len(self)+1, 4, -1):
-            obj = oidmap.get(str(self[:i]), None)
-            if obj:
-                return obj
-        return None
+        return OIDTRIE.find(self, 5)
 
 OBJECT_IDENTIFIER = ObjectIdentifier
 
@@ -436,6 +442,8 @@ class IpAddress(ipv4.IPv4, ApplicationSyntax):
     "IMPLICIT OCTET STRING (SIZE (4))"
     _ber_tag = '\x40'
     ranges = Ranges(Range(4, 4))
+    def __init__(self, address=0, mask=None): # default, for index decoding
+        ipv4.IPv4.__init__(self, address, mask)
     def _ber_(self):
         result = pack("!l", self._address)
         return self._ber_tag + "\x04" + result
@@ -449,6 +457,7 @@ class IpAddress(ipv4.IPv4, ApplicationSyntax):
         self._address = (oid[0]<<24) | (oid[1]<<16) | (oid[2]<<8) | oid[3]
         self._mask = 0xffffffff # XXX ?
         del oid[0:4]
+        return self
 
 def combine_ipaddress(addr_part, mask_part):
     """
@@ -513,7 +522,7 @@ class _VarBindException(object):
     def __long__(self):
         return long(ord(self._ber_tag))
     def _ber_(self):
-        return self._ber_tag # XXX
+        return self._ber_tag + '\x00' # NULL contents
 
 class noSuchObject(_VarBindException):
     _ber_tag = '\x80'
@@ -607,7 +616,8 @@ class _RequestId(Integer32):
 _current_request_id = 0
 def get_RequestId():
     global _current_request_id
-    _current_request_id += 1
+    # wrap, since long running pollers would overflow the Integer32.
+    _current_request_id = _current_request_id % 2147483647 + 1
     return _RequestId(_current_request_id)
 
 class VarBind(SequenceOf):
@@ -30,6 +30,7 @@ import py_compile
 
 from pycopia import textutils
 from pycopia.SMI import SMI, Basetypes, Objects
+from pycopia.SMI import build_oid_index
 
 USERMIBPATH = os.environ.get("USERMIBPATH", os.path.join("/", "var", "tmp", "mibs"))
 
@@ -411,7 +412,7 @@ def _compile_module(smimodule):
     else:
         print ("    +++ file %r exists, skipping." % (fname, ))
 
-def compile_module(modname, preload=None, all=False):
+def compile_module(modname, preload=None, all=False, index=True):
     if preload:
         for pm in preload:
             SMI.load_module(pm)
@@ -423,6 +424,14 @@ def compile_module(modname, preload=None, all=False):
         for dep in _get_dependents(smimodule):
             _compile_module(SMI.get_module(dep))
     _compile_module(smimodule)
+    if index:
+        compile_oid_index()
+
+def compile_oid_index(mibdir=USERMIBPATH):
+    """Regenerate the OID index, used to find and import MIB modules as
+    their objects are looked up, for all modules in mibdir."""
+    fname = build_oid_index(mibdir)
+    print ("Wrote OID index", fname)
 
 def _get_dependents(module, hash=None):
     h = hash or {}
@@ -441,13 +450,14 @@ def compile_everything(all=False):
             if os.path.isfile(modpath):
                 print ("Found module", modname, "compiling...")
                 try:
-                    compile_module(modname, None, all)
+                    compile_module(modname, None, all, index=False)
                 except SMI.SmiError as err:
                     print ("***[", err, "]***")
                 count += 1
             SMI.clear() # clear out mememory
             SMI.init()
     print ("Found and compiled %d MIBS." % (count, ))
+    compile_oid_index()
 
 
 if __name__ == "__main__":
@@ -41,11 +41,11 @@ class Index(list):
         lv = super(Index, self).__repr__()
         return "%s.%s(%s, %r)" % (self.__class__.__module__, self.__class__.__name__, lv, self.implied)
     def _oid_(self):
-        new = Basetypes.ObjectIdentifier()
+        new = []
         self[-1].implied = self.implied
         for obj in self:
             new.extend(Basetypes.oid(obj))
-        return new
+        return Basetypes.ObjectIdentifier(new)
 
 # SMI module uses this to create index object reference list
 class IndexObjects(list):
@@ -125,7 +125,7 @@ class RowObject(object):
 
     def _make_index_oid(self, indexargs):
         assert len(indexargs) == len(self.index)
-        indexoid = Basetypes.ObjectIdentifier()
+        indexoid = []
         i = 0
         for idx in indexargs[:-1]:
             indexoid.extend(Basetypes.oid(self.index[i].syntaxobject(idx)))
@@ -133,16 +133,17 @@ class RowObject(object):
         end = self.index[i].syntaxobject(indexargs[-1])
         end.implied = self.index.implied
         indexoid.extend(Basetypes.oid(end))
-        return indexoid
+        return Basetypes.ObjectIdentifier(indexoid)
 
     def __cmp__(self, other):
         return cmp(self.__class__.OID+self.indexoid, other.__class__.OID+other.indexoid)
 
     def _decode_index_oid(self, oid):
         indexinst = map(lambda o: o.syntaxobject(), self.index)
-        map (lambda o, oid=oid: o.oid_decode(oid, 0), indexinst[:-1])
-        indexinst[-1].oid_decode(oid, self.index.implied)
-        return tuple(indexinst)
+        values = [o.oid_decode(oid) for o in indexinst[:-1]]
+        indexinst[-1].implied = self.index.implied
+        values.append(indexinst[-1].oid_decode(oid))
+        return tuple(values)
 
     def __getattr__(self, key):
         if self.session and self.indexoid:
@@ -182,9 +183,9 @@ class RowObject(object):
         return "%s(%r)" % (self.__class__.__name__, self.indexoid)
 
     def get_indexvalue(self):
-        return self._decode_index_oid(self.indexoid[:])[0]
+        return self._decode_index_oid(list(self.indexoid))[0]
     def get_indexvalues(self):
-        return self._decode_index_oid(self.indexoid[:])
+        return self._decode_index_oid(list(self.indexoid))
 
     def add_column(self, colobj):
         self.COLUMNS[colobj.__class__.__name__] = colobj
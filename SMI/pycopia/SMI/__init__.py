@@ -30,16 +30,365 @@ from __future__ import print_function
 from __future__ import division
 
 import sys
+import os
+import re
+import mmap
+import struct
 
 
-# "global" OIDMAP contains reverse OID for all imported MIBS.
-OIDMAP = {}
+class OIDTrie(object):
+    """Maps OIDs, as sequences of integers, to MIB objects.
+
+    An integer prefix trie, so the object an OID belongs to is found by its
+    longest registered prefix in one walk. Matches that end at a leaf (a
+    column or scalar, typically) are memoized, since table walks resolve
+    many OIDs under the same few columns.
+
+    The optional loader is called as loader(oid, minlen) when a lookup may
+    be answered by objects not yet added, and returns True if it added some
+    (by importing a MIB module, for OIDTRIE). The optional haschildren is
+    called as haschildren(oid) before a leaf is memoized, and returns True if
+    objects not yet added may be found below it. Such a leaf is not memoized.
+    """
+    def __init__(self, loader=None, haschildren=None):
+        self._root = {}
+        self._count = 0
+        self._leafcache = {}
+        self._leaflengths = ()
+        self._loader = loader
+        self._haschildren = haschildren
+
+    def __len__(self):
+        return self._count
+
+    def add(self, oid, obj):
+        node = self._root
+        for subid in oid:
+            node = node.setdefault(subid, {})
+        if None not in node:
+            self._count += 1
+        node[None] = obj # the None key holds the object for this node.
+        self._leafcache.clear()
+        self._leaflengths = ()
+
+    def update(self, oidmap):
+        """Add all entries of a mapping of dotted OID strings to objects."""
+        for soid, obj in oidmap.items():
+            self.add([int(s) for s in soid.split(".") if s], obj)
+
+    def get(self, oid, default=None):
+        """Exact lookup."""
+        node = self._root
+        for subid in oid:
+            node = node.get(subid)
+            if node is None:
+                break
+        else:
+            if None in node:
+                return node[None]
+        if self._loader is not None and self._loader(oid, len(oid)):
+            return self.get(oid, default)
+        return default
+
+    def longest_match(self, oid, minlen=1):
+        """Return (object, length) for the longest registered prefix of oid.
+
+        Returns (None, 0) if there is no match of at least minlen.
+        """
+        cache = self._leafcache
+        if cache:
+            for length in self._leaflengths:
+                if length >= minlen:
+                    obj = cache.get(tuple(oid[:length]))
+                    if obj is not None:
+                        return obj, length
+        node = self._root
+        best = None
+        bestlen = 0
+        leaf = False
+        depth = 0
+        for subid in oid:
+            node = node.get(subid)
+            if node is None:
+                break
+            depth += 1
+            obj = node.get(None)
+            if obj is not None:
+                best = obj
+                bestlen = depth
+                leaf = len(node) == 1
+        if self._loader is not None and self._loader(oid, max(bestlen + 1, minlen)):
+            return self.longest_match(oid, minlen)
+        if bestlen < minlen:
+            return None, 0
+        if leaf and (self._haschildren is None or not self._haschildren(oid[:bestlen])):
+            # nothing longer can match under it.
+            cache[tuple(oid[:bestlen])] = best
+            if bestlen not in self._leaflengths:
+                self._leaflengths = tuple(sorted(self._leaflengths + (bestlen,), reverse=True))
+        return best, bestlen
+
+    def find(self, oid, minlen=1):
+        """Return the object for the longest prefix of oid, or None."""
+        return self.longest_match(oid, minlen)[0]
+
+
+OIDINDEX_NAME = "OIDINDEX"
+
+_MAGIC = b"PYOIDX01"
+_HEADER = struct.Struct(">8sII") # magic, count, maximum OID length
+_RECORD = struct.Struct(">IIHH") # key offset, name offset, key length, name length
+
+
+def write_oid_index(fname, entries):
+    """Write an OID index file.
+
+    The entries are (oid, module name, object name) tuples. When an OID is
+    given more than once the first entry is kept.
+    """
+    byoid = {}
+    for oid, modname, name in entries:
+        byoid.setdefault(tuple(oid), "%s.%s" % (modname, name))
+    oids = sorted(byoid)
+    keys = []
+    names = []
+    records = []
+    offset = _HEADER.size + _RECORD.size * len(oids)
+    nameoffset = offset + sum(4 * len(oid) for oid in oids)
+    for oid in oids:
+        name = byoid[oid]
+        records.append(_RECORD.pack(offset, nameoffset, len(oid), len(name)))
+        keys.append(struct.pack(">%dI" % len(oid), *oid))
+        names.append(name)
+        offset += 4 * len(oid)
+        nameoffset += len(name)
+    tmpname = fname + ".new"
+    with open(tmpname, "wb") as fo:
+        fo.write(_HEADER.pack(_MAGIC, len(oids), max([len(oid) for oid in oids] or [0])))
+        fo.write(b"".join(records))
+        fo.write(b"".join(keys))
+        fo.write(b"".join(names))
+    os.rename(tmpname, fname)
+
+
+_OIDLINE_RE = re.compile(r"^'([0-9.]+)': (\w+)\.(\w+),$", re.M)
+
+def build_oid_index(mibdir):
+    """Write the OID index for the generated *_OID.py modules in mibdir."""
+    entries = []
+    for fname in sorted(os.listdir(mibdir)):
+        if fname.endswith("_OID.py"):
+            with open(os.path.join(mibdir, fname)) as fo:
+                for soid, modname, name in _OIDLINE_RE.findall(fo.read()):
+                    entries.append(([int(s) for s in soid.split(".")], modname, name))
+    fname = os.path.join(mibdir, OIDINDEX_NAME)
+    write_oid_index(fname, entries)
+    return fname
+
+
+class OIDIndex(object):
+    """A memory mapped OID index file, as written by write_oid_index.
+
+    Maps OIDs to the (module name, object name) of the MIB object they
+    name. OIDs are stored as big-endian 32 bit sub-identifiers, so byte order
+    is OID order, and a lookup is a binary search of the mapped file.
+    """
+    def __init__(self, fname):
+        fo = open(fname, "rb")
+        try:
+            self._map = mmap.mmap(fo.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            fo.close()
+        magic, self._count, self.maxlen = _HEADER.unpack_from(self._map, 0)
+        if magic != _MAGIC:
+            self._map.close()
+            raise ValueError("%r is not an OID index file." % (fname,))
+        self.filename = fname
+
+    def __len__(self):
+        return self._count
+
+    def close(self):
+        self._map.close()
+
+    def _key(self, i):
+        keyoff, nameoff, keylen, namelen = _RECORD.unpack_from(self._map,
+                _HEADER.size + i * _RECORD.size)
+        return self._map[keyoff:keyoff + 4 * keylen]
+
+    def _search(self, key):
+        data = self._map
+        unpack = _RECORD.unpack_from
+        rsize = _RECORD.size
+        lo = 0
+        hi = self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            keyoff, nameoff, keylen, namelen = unpack(data, _HEADER.size + mid * rsize)
+            cv = cmp(data[keyoff:keyoff + 4 * keylen], key)
+            if cv < 0:
+                lo = mid + 1
+            elif cv > 0:
+                hi = mid
+            else:
+                return tuple(data[nameoff:nameoff + namelen].split(".", 1))
+        return lo
+
+    def prefix_length(self, oid):
+        """Return the length of the longest prefix of oid that some OID in
+        the index begins with."""
+        key = struct.pack(">%dI" % len(oid), *oid)
+        pos = self._search(key)
+        if isinstance(pos, tuple): # oid itself is in the index
+            return len(oid)
+        # The OID sharing the longest prefix sorts next to where oid would.
+        best = 0
+        for i in (pos - 1, pos):
+            if 0 <= i < self._count:
+                other = self._key(i)
+                n = 0
+                limit = min(len(key), len(other))
+                while n < limit and key[n:n + 4] == other[n:n + 4]:
+                    n += 4
+                best = max(best, n // 4)
+        return best
+
+    def has_children(self, oid):
+        """Return True if the index has an OID longer than oid that begins
+        with it."""
+        key = struct.pack(">%dI" % len(oid), *oid)
+        # The first such OID would be the first at or after oid + [0].
+        pos = self._search(key + b"\0\0\0\0")
+        if isinstance(pos, tuple):
+            return True
+        return pos < self._count and self._key(pos).startswith(key)
+
+    def get(self, oid, default=None):
+        """Return (module name, object name) for oid."""
+        if len(oid) > self.maxlen:
+            return default
+        entry = self._search(struct.pack(">%dI" % len(oid), *oid))
+        return entry if isinstance(entry, tuple) else default
+
+    def longest_match(self, oid, minlen=1):
+        """Return ((module name, object name), length) for the longest
+        prefix of oid in the index, or (None, 0) if none of at least minlen.
+        """
+        key = struct.pack(">%dI" % len(oid), *oid)
+        for length in range(min(len(oid), self.maxlen), minlen - 1, -1):
+            entry = self._search(key[:4 * length])
+            if isinstance(entry, tuple):
+                return entry, length
+        return None, 0
+
+
+_indexes = None
+_imported = set()
+# Loader misses, by (OID prefix, minlen). The prefix is as long as needed
+# for any OID starting with it to miss as well, so instances of an unknown
+# column share one entry.
+_indexmisses = {}
+_misslengths = ()
+
+def get_oid_indexes():
+    """The OID indexes found in the directories MIB modules are imported from."""
+    global _indexes
+    if _indexes is None:
+        _indexes = []
+        try:
+            import pycopia.mibs
+        except ImportError:
+            return _indexes
+        for mibdir in pycopia.mibs.__path__:
+            fname = os.path.join(mibdir, OIDINDEX_NAME)
+            if os.path.isfile(fname):
+                try:
+                    _indexes.append(OIDIndex(fname))
+                except (ValueError, EnvironmentError, struct.error):
+                    pass
+    return _indexes
+
+def import_mib(modname):
+    """Import a MIB module by name, if it is not already.
+
+    Returns True if it was imported now.
+    """
+    fullname = "pycopia.mibs." + modname
+    if modname in _imported or fullname in sys.modules:
+        return False
+    _imported.add(modname)
+    try:
+        __import__(fullname)
+    except ImportError:
+        return False
+    return True
+
+def _index_loader(oid, minlen):
+    """Import the MIB module defining the longest prefix of oid, of at
+    least minlen, if there is one in the indexes.
+    """
+    global _misslengths
+    for length in _misslengths:
+        if length <= len(oid) and (tuple(oid[:length]), minlen) in _indexmisses:
+            return False
+    indexes = get_oid_indexes()
+    for index in indexes:
+        entry, length = index.longest_match(oid, minlen)
+        if entry is not None and import_mib(entry[0]):
+            _indexmisses.clear()
+            _misslengths = ()
+            return True
+    # No index OID goes past this prefix, so OIDs starting with it can only
+    # match the same, shorter, prefixes that just missed.
+    length = min(len(oid), max([index.prefix_length(oid) for index in indexes] or [-1]) + 1)
+    if len(_indexmisses) > 10000:
+        _indexmisses.clear()
+        _misslengths = ()
+    _indexmisses[(tuple(oid[:length]), minlen)] = True
+    if length not in _misslengths:
+        _misslengths = tuple(sorted(_misslengths + (length,)))
+    return False
+
+def _index_has_children(oid):
+    return any(index.has_children(oid) for index in get_oid_indexes())
+
+
+class OIDMap(dict):
+    """Maps dotted OID strings to MIB objects.
+
+    Entries are added as MIB modules are imported. An OID that is not here
+    yet is looked up in the OID indexes, and the module defining it imported.
+    """
+    def __missing__(self, key):
+        if isinstance(key, basestring):
+            oid = [int(s) for s in key.split(".") if s]
+            for index in get_oid_indexes():
+                entry = index.get(oid)
+                if entry is not None and import_mib(entry[0]):
+                    return self[key]
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+
+# "global" OIDMAP contains reverse OID for all MIBS, importing them as needed.
+OIDMAP = OIDMap()
+# and the same, for prefix lookups.
+OIDTRIE = OIDTrie(_index_loader, _index_has_children)
 
 def update_oidmap(basemodname):
     modname = "%s_OID" % basemodname
     __import__(modname)
     oidmod = sys.modules[modname]
     OIDMAP.update(oidmod.OIDMAP)
+    OIDTRIE.update(oidmod.OIDMAP)
     # clean up extra references
     delattr(oidmod, "OIDMAP")
     del sys.modules[modname]
@@ -0,0 +1,398 @@
+#!/usr/bin/python2.7
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Benchmarks for the SNMP package. SimpleAgents run in child processes on the
+loopback interface.
+
+Usage: bench.py [-n <requests>] [-w <window>] [-d <agent delay ms>]
+                [-D <devices>] [-i <poll interval>] [-t <poll duration>]
+                [-r <table rows>]
+
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import sys
+import os
+import getopt
+import signal
+
+from pycopia import asyncio
+from pycopia.timelib import now
+from pycopia.SMI.Basetypes import (Counter32, Integer32, TimeTicks, OctetString,
+        GetBulkRequestPDU, ber)
+from pycopia.SMI.Basetypes import ObjectIdentifier
+from pycopia.SMI.Objects import RowObject, ColumnObject
+from pycopia.SNMP import SNMP
+from pycopia.SNMP import Agent
+from pycopia.SNMP import BER_decode
+from pycopia.SNMP import Poller
+from pycopia.mibs import SNMPv2_MIB
+
+IFTABLE = [1, 3, 6, 1, 2, 1, 2, 2, 1]
+
+
+def make_values(rows):
+    values = {}
+    for i in range(1, rows + 1):
+        values[tuple(IFTABLE + [1, i])] = Integer32(i)
+        values[tuple(IFTABLE + [10, i])] = Counter32(i * 1000)
+        values[tuple(IFTABLE + [16, i])] = Counter32(i * 2000)
+    return values
+
+
+def start_farm(values, count, delay=0.0):
+    """Fork a process running count agents. Return (pid, ports).
+
+    Only a single agent may have a response delay.
+    """
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(rfd)
+        poller = asyncio.Poll()
+        agents = [Agent.SimpleAgent(values, delay=delay, poller=poller)
+                for i in range(count)]
+        os.write(wfd, " ".join(str(agent.address[1]) for agent in agents))
+        os.close(wfd)
+        if count == 1:
+            agents[0].run()
+        while True: # a farm answers immediately
+            poller.poll(-1)
+    os.close(wfd)
+    data = []
+    while True:
+        chunk = os.read(rfd, 65536)
+        if not chunk:
+            break
+        data.append(chunk)
+    os.close(rfd)
+    return pid, [int(port) for port in "".join(data).split()]
+
+
+def start_agent(values, delay):
+    """Fork a process running one agent. Return (pid, port)."""
+    pid, ports = start_farm(values, 1, delay)
+    return pid, ports[0]
+
+
+def stop_agent(pid):
+    os.kill(pid, signal.SIGTERM)
+    os.waitpid(pid, 0)
+
+
+def _sessiondata(port):
+    sd = SNMP.sessionData("127.0.0.1", port=port, timeout=2.0, retries=3)
+    sd.add_community("public", SNMP.RO)
+    return sd
+
+
+def bench_sync(port, count, rows):
+    session = SNMP.new_session(_sessiondata(port))
+    start = now()
+    for i in range(count):
+        session.get(IFTABLE + [10, i % rows + 1])
+    return now() - start
+
+
+def bench_async(port, count, rows, window):
+    session = SNMP.new_async_session(_sessiondata(port), SNMP.AsyncDispatcher())
+    state = {"sent": 0, "done": 0, "errors": 0}
+
+    def _next(future=None):
+        if future is not None:
+            state["done"] += 1
+            if future.exception() is not None:
+                state["errors"] += 1
+        if state["sent"] < count:
+            i = state["sent"]
+            state["sent"] += 1
+            session.get(IFTABLE + [10, i % rows + 1]).add_done_callback(_next)
+
+    start = now()
+    for i in range(min(window, count)):
+        _next()
+    session.dispatcher.loop()
+    elapsed = now() - start
+    session.dispatcher.close()
+    if state["errors"]:
+        print("   {} requests failed".format(state["errors"]))
+    return elapsed
+
+
+def bench_poller(devices, interval, duration, farms=4):
+    values = make_values(20)
+    values[tuple(SNMPv2_MIB.sysUpTime.OID + [0])] = TimeTicks(100)
+    farm = []
+    ports = []
+    for i in range(farms):
+        pid, fports = start_farm(values, devices // farms)
+        farm.append(pid)
+        ports.extend(fports)
+    results = []
+    ifEntry = type("ifEntry", (RowObject,), {"OID": IFTABLE})
+    poller = Poller.Poller(results.append, concurrency=100)
+    try:
+        for port in ports:
+            sd = _sessiondata(port)
+            poller.add_device(sd, [SNMPv2_MIB.sysUpTime, ifEntry], interval)
+        start = now()
+        cpu = os.times()
+        poller.run(duration)
+        elapsed = now() - start
+        cpu = sum(os.times()[:2]) - sum(cpu[:2])
+    finally:
+        poller.close()
+        for pid in farm:
+            stop_agent(pid)
+    latencies = sorted(r.latency for r in results)
+    lateness = sorted(r.start - r.scheduled for r in results)
+    count = len(results)
+    print("{:>24s}: {} devices, {} s interval, {} polls in {:.1f} s ({:.1f} polls/s)".format(
+            "poller", len(ports), interval, count, elapsed, count / elapsed))
+    print("{:>24s}: {:.1f} s CPU, {} timeouts, {} varbinds per poll".format(
+            "", cpu, sum(r.timeouts for r in results), len(results[0].varbinds)))
+    print("{:>24s}: latency p50 {:.1f} ms, p99 {:.1f} ms; start lateness p50 {:.1f} ms, p99 {:.1f} ms".format(
+            "", latencies[count // 2] * 1000, latencies[count * 99 // 100] * 1000,
+            lateness[count // 2] * 1000, lateness[count * 99 // 100] * 1000))
+
+
+def record_getbulk(repetitions):
+    """Return the datagram an agent sends for a GetBulk of an ifTable like table."""
+    values = make_values(repetitions)
+    for i in range(1, repetitions + 1):
+        values[tuple(IFTABLE + [2, i])] = OctetString("GigabitEthernet0/%d" % i)
+    agent = Agent.SimpleAgent(values, maxsize=30000, poller=asyncio.Poll())
+    bpdu = GetBulkRequestPDU()
+    for col in (1, 2, 10, 16):
+        bpdu.add_repeater(IFTABLE + [col])
+    bpdu.set_max_repetitions(repetitions)
+    resp = agent.handle(bpdu)
+    agent.close()
+    return ber(SNMP.CommunityBasedMessage("public", resp, 1))
+
+
+def _tlv_all(msg):
+    version, community, pdu = BER_decode.get_tlv(msg).decode()
+    for vb in pdu.varbinds:
+        vb.value
+
+def _offset_all(msg):
+    version, community, pdu = BER_decode.decode(msg)
+    for vb in pdu.varbinds:
+        vb.value
+
+def _offset_oids(msg):
+    version, community, pdu = BER_decode.decode(msg)
+    for vb in pdu.varbinds:
+        vb.oid
+
+
+def bench_decode(count=200):
+    for repetitions in (10, 50, 200):
+        msg = record_getbulk(repetitions)
+        nvb = repetitions * 4
+        for name, func in (("TLV.decode", _tlv_all), ("decode, all values", _offset_all),
+                            ("decode, only OIDs", _offset_oids)):
+            n = max(1, count * 10 // repetitions)
+            start = now()
+            for i in range(n):
+                func(msg)
+            elapsed = (now() - start) / n
+            print("{:>24s}: {:4d} varbinds, {:6d} bytes, {:8.3f} ms, {:6.1f} us/varbind".format(
+                    name, nvb, len(msg), elapsed * 1000, elapsed / nvb * 1e6))
+
+
+class _ListOID(list):
+    """The previous, list based, ObjectIdentifier, for comparison."""
+    def __init__(self, init=[], implied=False):
+        self.implied = bool(implied)
+        list.__init__(self, init)
+    def __str__(self):
+        return ".".join(['%lu' % x for x in self])
+    def __getslice__(self, i, j):
+        return self.__class__(list.__getslice__(self, i, j))
+    def __add__(self, other):
+        return self.__class__(list.__add__(self, other))
+
+
+def _sizeof(obj):
+    size = sys.getsizeof(obj)
+    if getattr(obj, "__dict__", None):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+
+def _oid_ops(cls, subids, prefix):
+    """Work a manager or agent does with OIDs. Returns per-operation times."""
+    times = []
+    start = now()
+    oids = [cls(s) for s in subids]
+    times.append(now() - start)
+    start = now()
+    table = {}
+    for oid in oids:
+        table[oid if cls is ObjectIdentifier else tuple(oid)] = None
+    for oid in oids:
+        table[oid if cls is ObjectIdentifier else tuple(oid)]
+    times.append(now() - start)
+    start = now()
+    plen = len(prefix)
+    if cls is ObjectIdentifier:
+        for oid in oids:
+            oid.startswith(prefix)
+    else:
+        for oid in oids:
+            oid[:plen] == prefix
+    times.append(now() - start)
+    size = sum(_sizeof(oid) for oid in oids)
+    start = now()
+    for oid in oids:
+        str(oid)
+        str(oid)
+    times.append(now() - start)
+    return oids, size, times
+
+
+def bench_oid(count=100000):
+    subids = [IFTABLE + [col, i, 0] for col in (1, 2, 10, 16) for i in range(1, count // 4 + 1)]
+    prefix = ObjectIdentifier(IFTABLE + [10])
+    for cls in (_ListOID, ObjectIdentifier):
+        oids, size, times = _oid_ops(cls, subids, cls(prefix))
+        strsize = sum(_sizeof(oid) for oid in oids)
+        print("{:>24s}: {} OIDs, {:.0f} bytes/OID ({:.0f} after str); {}".format(cls.__name__,
+                len(oids), size / len(oids), strsize / len(oids),
+                ", ".join("{} {:.2f} us".format(name, t / len(oids) * 1e6) for name, t in
+                zip(("create", "dict", "prefix", "str x2"), times))))
+    start = now()
+    oids.sort()
+    print("{:>24s}: sort {:.2f} us/OID".format("ObjectIdentifier", (now() - start) / len(oids) * 1e6))
+
+
+_MIBLOAD = """from __future__ import print_function
+import sys, os, resource
+from pycopia.timelib import now
+start = now()
+from pycopia import SMI
+import pycopia.mibs
+if %r:
+    for fname in sorted(os.listdir(os.path.dirname(pycopia.mibs.__file__))):
+        if fname.endswith(".py") and not fname.endswith("_OID.py") and fname != "__init__.py":
+            try:
+                __import__("pycopia.mibs." + fname[:-3])
+            except ImportError:
+                pass
+for oid in ([1, 3, 6, 1, 2, 1, 1, 3, 0], [1, 3, 6, 1, 6, 3, 1, 1, 4, 1, 0]):
+    assert SMI.OIDTRIE.find(oid) is not None
+print(now() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        len([m for m in sys.modules if m.startswith("pycopia.mibs.")]))
+"""
+
+def bench_mibload(count=10):
+    """Start up and resolve a trap's OIDs, importing all MIBs or on demand."""
+    import subprocess
+    for name, eager in (("import all MIBs", True), ("OID index", False)):
+        times = []
+        for i in range(count):
+            out = subprocess.check_output([sys.executable, "-c", _MIBLOAD % (eager,)])
+            elapsed, maxrss, modules = out.split()
+            times.append(float(elapsed))
+        print("{:>24s}: {:7.1f} ms, max RSS {} KB, {} modules".format(
+                name, min(times) * 1000, maxrss, modules))
+
+
+class ifEntry(RowObject):
+    OID = ObjectIdentifier(IFTABLE)
+    columns = dict((name, type(name, (ColumnObject,), {"OID": ObjectIdentifier(IFTABLE + [col]), "access": 4}))
+            for name, col in (("ifIndex", 1), ("ifInOctets", 10), ("ifOutOctets", 16)))
+
+
+def bench_table(rows, delay):
+    """Walk a large table, the old way and with walk_table."""
+    pid, port = start_agent(make_values(rows), delay)
+    try:
+        sd = _sessiondata(port)
+        sd.timeout = 10.0
+        for name, method in (("get_table_with_bulk", "get_table_with_bulk"),
+                             ("walk_table", "walk_table")):
+            session = SNMP.new_session(sd)
+            requests = [0]
+            def _count(msgobj, sendrecv=session._send_and_receive):
+                requests[0] += 1
+                return sendrecv(msgobj)
+            session._send_and_receive = _count
+            received = []
+            start = now()
+            getattr(session, method)(ifEntry, received.append)
+            elapsed = now() - start
+            session.close()
+            print("{:>24s}: {} rows, {} varbinds, {} requests in {:.2f} s, {:.0f} varbinds/s".format(
+                    name, rows, len(received), requests[0], elapsed, len(received) / elapsed))
+    finally:
+        stop_agent(pid)
+
+
+def report(name, count, elapsed):
+    print("{:>24s}: {:7d} requests in {:7.3f} s, {:9.1f} req/s".format(
+            name, count, elapsed, count / elapsed))
+
+
+def main(argv):
+    count = 20000
+    window = 64
+    rows = 1000
+    delay = 0.002
+    devices = 1000
+    interval = 10.0
+    duration = 30.0
+    tablerows = 100000
+    opts, args = getopt.getopt(argv[1:], "n:w:d:D:i:t:r:")
+    for opt, optarg in opts:
+        if opt == "-n":
+            count = int(optarg)
+        elif opt == "-w":
+            window = int(optarg)
+        elif opt == "-d":
+            delay = float(optarg) / 1000
+        elif opt == "-D":
+            devices = int(optarg)
+        elif opt == "-i":
+            interval = float(optarg)
+        elif opt == "-t":
+            duration = float(optarg)
+        elif opt == "-r":
+            tablerows = int(optarg)
+    bench_mibload()
+    bench_oid()
+    bench_decode()
+    print("agent response delay {} ms".format(delay * 1000))
+    pid, port = start_agent(make_values(rows), delay)
+    try:
+        report("blocking session", count // 10, bench_sync(port, count // 10, rows))
+        report("async, window 1", count // 10, bench_async(port, count // 10, rows, 1))
+        report("async, window {}".format(window), count,
+                bench_async(port, count, rows, window))
+    finally:
+        stop_agent(pid)
+    bench_poller(devices, interval, duration)
+    bench_table(tablerows, delay)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
+
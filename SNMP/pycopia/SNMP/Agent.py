@@ -23,6 +23,17 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import division
 
+import bisect
+from errno import EAGAIN, EINTR
+from collections import deque
+
+from pycopia import socket
+from pycopia import asyncio
+from pycopia.timelib import now
+from pycopia.SMI.Basetypes import *
+from pycopia.SNMP import SNMP
+from pycopia.SNMP import BER_decode
+
 class Agent(object):
     """
 An instance of this class will act as an SNMP agent. This is a generic base
@@ -47,3 +58,150 @@ a specific Agent.
 
 
 
+
+
+class SimpleAgent(asyncio.PollerInterface):
+    """A minimal community based agent serving a table of values from memory.
+
+    The values are a mapping of OID (any sequence of integers) to a Basetypes
+    value object. Answers get, getnext, getbulk, and set requests on a UDP
+    socket registered with an asyncio Poll object. Useful as a fake device
+    when testing managers over the loopback interface. Set delay to hold each
+    response for that many seconds, as a distant or slow device would. Delayed
+    responses are sent by the run() loop.
+    """
+    def __init__(self, values, community="public", address=("127.0.0.1", 0),
+            maxsize=8192, delay=0.0, poller=None):
+        self.community = community
+        self.maxsize = maxsize
+        self.delay = delay
+        self.requests = 0
+        self._pending = deque()
+        self._values = {}
+        self._oids = []
+        self.update(values)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(address)
+        self.socket.setblocking(0)
+        self.address = self.socket.getsockname()
+        self._poller = asyncio.poller if poller is None else poller
+        self._poller.register(self)
+
+    def __repr__(self):
+        return "%s(%d values at %s:%d)" % (self.__class__.__name__,
+                len(self._oids), self.address[0], self.address[1])
+
+    def update(self, values):
+        for oid, value in values.items():
+            self._values[tuple(oid)] = value
+        self._oids = sorted(self._values)
+
+    def close(self):
+        if self.socket is not None:
+            self._poller.unregister(self)
+            self.socket.close()
+            self.socket = None
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def readable(self):
+        return True
+
+    def read_handler(self):
+        while True:
+            try:
+                data, addr = self.socket.recvfrom(65536)
+            except socket.error as err:
+                if err.errno in (EAGAIN, EINTR):
+                    return
+                raise
+            try:
+                version, community, pdu = BER_decode.decode(data)
+            except Exception: # not SNMP
+                continue
+            if str(community) != self.community:
+                continue
+            self.requests += 1
+            resp = self.handle(pdu)
+            if resp is not None:
+                msg = ber(SNMP.CommunityBasedMessage(community, resp, version))
+                if self.delay:
+                    self._pending.append((now() + self.delay, msg, addr))
+                else:
+                    self._sendto(msg, addr)
+
+    def _sendto(self, msg, addr):
+        try:
+            self.socket.sendto(msg, addr)
+        except socket.error: # client went away, as UDP allows.
+            pass
+
+    def send_pending(self):
+        """Send the delayed responses that are due."""
+        pending = self._pending
+        t = now()
+        while pending and pending[0][0] <= t:
+            due, msg, addr = pending.popleft()
+            self._sendto(msg, addr)
+
+    def run(self):
+        """Serve requests until closed."""
+        while self.socket is not None:
+            if self._pending:
+                self._poller.poll(max(0.0, self._pending[0][0] - now()))
+            else:
+                self._poller.poll(-1)
+            self.send_pending()
+
+    def handle(self, pdu):
+        """Return the ResponsePDU for a request PDU."""
+        if isinstance(pdu, GetBulkRequestPDU):
+            return self._getbulk(pdu)
+        if isinstance(pdu, GetNextRequestPDU):
+            vbl = VarBindList([self._next(vb.oid) for vb in pdu.varbinds])
+        elif isinstance(pdu, GetRequestPDU):
+            vbl = VarBindList([self._get(vb.oid) for vb in pdu.varbinds])
+        elif isinstance(pdu, SetRequestPDU):
+            for vb in pdu.varbinds:
+                self._values[tuple(vb.oid)] = vb.value
+            self._oids = sorted(self._values)
+            vbl = pdu.varbinds
+        else:
+            return None
+        resp = ResponsePDU(pdu.request_id, INTEGER(0), INTEGER(0), vbl)
+        if len(ber(resp)) > self.maxsize:
+            resp = ResponsePDU(pdu.request_id, INTEGER(1), INTEGER(0), VarBindList())
+        return resp
+
+    def _get(self, oid):
+        value = self._values.get(tuple(oid))
+        if value is None:
+            value = noSuchInstance()
+        return VarBind(oid, value)
+
+    def _next(self, oid):
+        i = bisect.bisect_right(self._oids, tuple(oid))
+        if i < len(self._oids):
+            noid = self._oids[i]
+            return VarBind(ObjectIdentifier(noid), self._values[noid])
+        return VarBind(oid, endOfMibView())
+
+    def _getbulk(self, pdu):
+        nonrep = int(pdu.non_repeaters)
+        varbinds = pdu.varbinds
+        vbl = VarBindList([self._next(vb.oid) for vb in varbinds[:nonrep]])
+        last = [vb.oid for vb in varbinds[nonrep:]]
+        if last:
+            size = len(ber(vbl))
+            for rep in range(int(pdu.max_repetitions)):
+                row = [self._next(oid) for oid in last]
+                size += len(ber(VarBindList(row)))
+                if size > self.maxsize - 64: # room for the message wrapper
+                    break
+                vbl.extend(row)
+                last = [vb.oid for vb in row]
+                if all(isinstance(vb.value, endOfMibView) for vb in row):
+                    break
+        return ResponsePDU(pdu.request_id, INTEGER(0), INTEGER(0), vbl)
+
@@ -27,9 +27,10 @@ from struct import pack, unpack
 
 from pycopia.aid import str2hex
 from pycopia.SMI import Basetypes
-from pycopia.SMI import OIDMAP
+from pycopia.SMI import OIDTRIE
 
 from pycopia.SNMP import BER_tags
+from pycopia.SNMP import BERUnknownTag, BERBadArgument
 
 # BER decoders
 
@@ -189,12 +190,7 @@ def decode_unsigned32(length, message):
 # PDU decoders
 
 def _find_object(oid):
-    oidmap = OIDMAP
-    for i in range(len(oid), 6, -1):
-        obj = oidmap.get(str(oid[:i]), None)
-        if obj:
-            return obj
-    return None
+    return OIDTRIE.find(oid, 7)
 
 def _decode_a_varbindlist(vbl_tuple):
     vbl = Basetypes.VarBindList()
@@ -202,8 +198,8 @@ def _decode_a_varbindlist(vbl_tuple):
         obj = _find_object(oid)
         if obj is not None:
             if value is not None:
-                if (isinstance(value, Basetypes.noSuchInstance) or
-                            isinstance(value, Basetypes.noSuchObject)):
+                if isinstance(value, (Basetypes.noSuchInstance,
+                            Basetypes.noSuchObject, Basetypes.endOfMibView)):
                     vbl.append(Basetypes.VarBind(oid, value))
                     continue
                 if obj.syntaxobject:
@@ -277,3 +273,256 @@ DECODE_METHODS[chr(BER_tags.NOSUCHOBJECT)] = decode_nosuchobject
 DECODE_METHODS[chr(BER_tags.NOSUCHINSTANCE)] = decode_nosuchinstance
 DECODE_METHODS[chr(BER_tags.ENDOFMIBVIEW)] = decode_endofmibview
 
+
+
+### Offset based decoder.
+# The decoders above slice the message at every element, so decoding a large
+# message is quadratic. These walk a single bytearray (integer indexing, no
+# per element copies) with explicit offsets. Varbinds in PDUs are decoded
+# lazily: only their positions are found up front, and the OID and value are
+# turned into Basetypes objects when first used. The results are the same as
+# TLV.decode gives.
+
+def decode(message):
+    """Decode a complete BER message (str, bytearray, or memoryview)."""
+    if not isinstance(message, bytearray):
+        message = bytearray(message)
+    if len(message) < 2:
+        raise BERBadArgument("BER_decode.decode: message too small")
+    return decode_at(message, 0)[0]
+
+def decode_at(data, offset):
+    """Decode the TLV at offset in bytearray data.
+
+    Returns the object and the offset of the next TLV.
+    """
+    tag = data[offset]
+    start, end = _tlv_bounds(data, offset)
+    try:
+        decoder = _OFFSET_DECODERS[tag]
+    except KeyError:
+        raise BERUnknownTag("decode_at: tag %r is unknown" % (hex(tag),))
+    return decoder(data, start, end), end
+
+def _tlv_bounds(data, offset):
+    """Return the start and end offsets of the value of the TLV at offset."""
+    length = data[offset+1]
+    if length & 0x80:
+        size = length & 0x7F
+        start = offset + 2 + size
+        length = 0
+        for i in range(offset+2, start):
+            length = (length << 8) | data[i]
+    else:
+        start = offset + 2
+    end = start + length
+    if end > len(data):
+        raise BERBadArgument("TLV at %d runs past end of message" % (offset,))
+    return start, end
+
+def _signed_at(data, start, end):
+    val = -1 if data[start] & 0x80 else 0
+    for i in range(start, end):
+        val = (val << 8) | data[i]
+    return val
+
+def _unsigned_at(data, start, end):
+    val = 0
+    for i in range(start, end):
+        val = (val << 8) | data[i]
+    return val
+
+def _oid_at(data, start, end):
+    subid = data[start]
+    oid = [subid // 40, subid % 40]
+    append = oid.append
+    subid = 0
+    for i in range(start+1, end):
+        c = data[i]
+        subid = (subid << 7) | (c & 0x7F)
+        if not c & 0x80:
+            append(subid)
+            subid = 0
+    return Basetypes.OBJECT_IDENTIFIER(oid)
+
+def _sequence_at(data, start, end):
+    sequence = []
+    offset = start
+    while offset < end:
+        obj, offset = decode_at(data, offset)
+        sequence.append(obj)
+    return sequence
+
+def _varbindlist_at(data, start, end):
+    vbl = Basetypes.VarBindList()
+    offset = start
+    while offset < end:
+        vbstart, vbend = _tlv_bounds(data, offset)
+        valueoffset = _tlv_bounds(data, vbstart)[1]
+        vbl.append(LazyVarBind(data, vbstart, valueoffset, offset, vbend))
+        offset = vbend
+    return vbl
+
+def _pdu_decoder(pdu_object):
+    def _pdu_at(data, start, end):
+        request_id, offset = decode_at(data, start)
+        field1, offset = decode_at(data, offset)
+        field2, offset = decode_at(data, offset)
+        vblstart, vblend = _tlv_bounds(data, offset)
+        return pdu_object(request_id, field1, field2, _varbindlist_at(data, vblstart, vblend))
+    return _pdu_at
+
+def _v1trap_at(data, start, end):
+    fields = []
+    offset = start
+    for i in range(5):
+        obj, offset = decode_at(data, offset)
+        fields.append(obj)
+    vblstart, vblend = _tlv_bounds(data, offset)
+    fields.append(_varbindlist_at(data, vblstart, vblend))
+    return Basetypes.SNMPv1TrapPDU(*fields)
+
+def _ipv4_at(data, start, end):
+    assert end - start == 4
+    return Basetypes.IpAddress(_unsigned_at(data, start, end))
+
+def _simple(cls, func):
+    return lambda data, start, end: cls(func(data, start, end))
+
+def _string(cls):
+    return lambda data, start, end: cls(str(data[start:end]))
+
+def _constant(obj):
+    return lambda data, start, end: obj
+
+_OFFSET_DECODERS = {
+    BER_tags.BOOLEAN: lambda data, start, end: Basetypes.Boolean(data[start]),
+    BER_tags.INTEGER: _simple(Basetypes.Integer32, _signed_at),
+    BER_tags.OCTETSTRING: _string(Basetypes.OctetString),
+    BER_tags.NULL: _constant(None),
+    BER_tags.OBJID: _oid_at,
+    BER_tags.IPADDRESS: _ipv4_at,
+    BER_tags.COUNTER32: _simple(Basetypes.Counter32, _unsigned_at),
+    BER_tags.UNSIGNED32: _simple(Basetypes.Unsigned32, _unsigned_at), # same tag as GAUGE32
+    BER_tags.TIMETICKS: _simple(Basetypes.TimeTicks, _unsigned_at),
+    BER_tags.OPAQUE: _string(Basetypes.Opaque),
+    BER_tags.COUNTER64: _simple(Basetypes.Counter64, _unsigned_at),
+    BER_tags.TAGGEDSEQUENCE: _sequence_at,
+    BER_tags.GETREQUEST: _pdu_decoder(Basetypes.GetRequestPDU),
+    BER_tags.GETNEXTREQUEST: _pdu_decoder(Basetypes.GetNextRequestPDU),
+    BER_tags.GETRESPONSE: _pdu_decoder(Basetypes.ResponsePDU),
+    BER_tags.SETREQUEST: _pdu_decoder(Basetypes.SetRequestPDU),
+    BER_tags.TRAPREQUEST: _v1trap_at,
+    BER_tags.GETBULKREQUEST: _pdu_decoder(Basetypes.GetBulkRequestPDU),
+    BER_tags.INFORMREQUEST: _pdu_decoder(Basetypes.InformRequestPDU),
+    BER_tags.SNMPV2TRAP: _pdu_decoder(Basetypes.SNMPv2TrapPDU),
+    BER_tags.NOSUCHOBJECT: lambda data, start, end: Basetypes.noSuchObject(),
+    BER_tags.NOSUCHINSTANCE: lambda data, start, end: Basetypes.noSuchInstance(),
+    BER_tags.ENDOFMIBVIEW: lambda data, start, end: Basetypes.endOfMibView(),
+}
+
+
+class LazyVarBind(Basetypes.VarBind):
+    """A VarBind that decodes itself from the message when first used.
+
+    The oid attribute decodes only the OID. Anything else (the value, the
+    Object, or list access) decodes both, converting the value with the MIB
+    syntax object as _decode_a_varbindlist does.
+    """
+    def __init__(self, data, oidoffset, valueoffset, start, end):
+        # No VarBind.__init__, the list is filled in by _materialize.
+        self._data = data
+        self._oidoffset = oidoffset
+        self._valueoffset = valueoffset
+        self._span = (start, end)
+        self._oid = None
+        self._object = None
+        self._lazy = True
+
+    def _materialize(self):
+        oid = self.get_oid()
+        value = decode_at(self._data, self._valueoffset)[0]
+        obj = _find_object(oid)
+        if obj is not None and value is not None and not isinstance(value,
+                (Basetypes.noSuchInstance, Basetypes.noSuchObject, Basetypes.endOfMibView)):
+            if obj.syntaxobject:
+                value = obj.syntaxobject(value)
+            if obj.enumerations:
+                value.enumerations = obj.enumerations
+        list.extend(self, (oid, value))
+        self._object = obj
+        self._lazy = False
+        self._data = None # release the message
+
+    def get_oid(self):
+        if self._lazy:
+            if self._oid is None:
+                self._oid = decode_at(self._data, self._oidoffset)[0]
+            return self._oid
+        return list.__getitem__(self, 0)
+
+    def get_value(self):
+        if self._lazy:
+            self._materialize()
+        return list.__getitem__(self, 1)
+
+    def set_value(self, value):
+        self[1] = value
+
+    def clear(self):
+        self[1] = None
+        return self
+
+    def _get_object(self):
+        if self._lazy:
+            self._materialize()
+        return self._object
+
+    def _set_object(self, obj):
+        self._object = obj
+
+    oid = property(get_oid)
+    name = oid # alias
+    value = property(get_value, set_value, clear)
+    Object = property(_get_object, _set_object)
+
+    def _ber_(self):
+        if self._lazy: # unchanged, so the original encoding will do.
+            start, end = self._span
+            return str(self._data[start:end])
+        return super(LazyVarBind, self)._ber_()
+
+    def __getitem__(self, index):
+        if self._lazy:
+            self._materialize()
+        return list.__getitem__(self, index)
+
+    def __setitem__(self, index, value):
+        if self._lazy:
+            self._materialize()
+        list.__setitem__(self, index, value)
+
+    def __getslice__(self, i, j):
+        return self[max(0, i):max(0, j):]
+
+    def __len__(self):
+        return 2
+
+    def __iter__(self):
+        if self._lazy:
+            self._materialize()
+        return list.__iter__(self)
+
+    def __eq__(self, other):
+        if self._lazy:
+            self._materialize()
+        if isinstance(other, LazyVarBind) and other._lazy:
+            other._materialize()
+        return list.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __reduce__(self):
+        return (Basetypes.VarBind, (self.get_oid(), self.get_value()))
+
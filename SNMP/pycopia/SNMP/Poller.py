@@ -17,15 +17,388 @@
 """
 Poller is used to regularly poll SNMP devices.
 
+A Poller holds an inventory of devices, each with a set of ScalarObject and
+RowObject classes to collect at its own interval. All devices share one
+asynchronous dispatcher (one UDP socket), so many thousands of devices can be
+polled from one process without a thread per device. Due polls are found with
+a timer wheel, and the number of devices being polled at once is bounded.
+Results are handed to a sink callback as PollResult objects.
+
+Example:
+
+    def sink(result):
+        print result.target.name, result.latency, len(result.varbinds)
+
+    poller = Poller(sink)
+    for host in hosts:
+        sd = SNMP.sessionData(host)
+        sd.add_community("public", SNMP.RO)
+        poller.add_device(sd, [sysUpTime, ifEntry], interval=300)
+    poller.run()
+
 """
 
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import math
+import random
+from collections import deque
+
+from pycopia.timelib import now
+from pycopia.SMI.Basetypes import GetBulkRequestPDU, endOfMibView
+from pycopia.SMI.Objects import RowObject
+from pycopia.SNMP import SNMP
+from pycopia.SNMP import SNMPException, SNMPNoResponse
+
+# Maximum number of varbinds in one GetRequest for scalars.
+MAXBINDINGS = 32
+# Rows per GetBulk request when walking tables.
+MAXREPETITIONS = 25
+
+
+class TimerWheel(object):
+    """A hashed timer wheel.
+
+    Adding and removing an entry takes constant time, and advancing costs
+    only the entries in the slots passed over. Entries fire in the tick they
+    fall due, so times are rounded up to the resolution.
+    """
+    def __init__(self, resolution=0.1, slots=1024, start=None):
+        self.resolution = float(resolution)
+        self._slots = [[] for i in range(slots)]
+        self._tick = int((now() if start is None else start) / self.resolution)
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def add(self, when, obj):
+        """Schedule obj to be returned by advance() at time when."""
+        tick = max(self._tick + 1, int(math.ceil(when / self.resolution - 1e-6)))
+        nslots = len(self._slots)
+        entry = [(tick - self._tick - 1) // nslots, obj]
+        self._slots[tick % nslots].append(entry)
+        self._count += 1
+        return entry
+
+    def remove(self, entry):
+        entry[1] = None
+
+    def next_time(self):
+        """Time of the next tick."""
+        return (self._tick + 1) * self.resolution
+
+    def advance(self, t=None):
+        """Move the wheel to time t, returning the objects that fell due."""
+        target = int((now() if t is None else t) / self.resolution + 1e-6)
+        slots = self._slots
+        nslots = len(slots)
+        due = []
+        while self._tick < target:
+            self._tick += 1
+            slot = slots[self._tick % nslots]
+            if not slot:
+                continue
+            keep = []
+            for entry in slot:
+                if entry[1] is None:
+                    self._count -= 1
+                elif entry[0] == 0:
+                    self._count -= 1
+                    due.append(entry[1])
+                else:
+                    entry[0] -= 1
+                    keep.append(entry)
+            slots[self._tick % nslots] = keep
+        return due
+
+
+class PollTarget(object):
+    """A device in the inventory.
+
+    Holds the session, the object classes to collect, the interval, and the
+    running statistics for the device.
+    """
+    def __init__(self, session, objects, interval, name=None):
+        self.session = session
+        self.name = name or session.sessiondata.agent
+        self.interval = float(interval)
+        self.scalars = []
+        self.tables = []
+        for obj in objects:
+            if issubclass(obj, RowObject):
+                self.tables.append(obj.OID)
+            else:
+                self.scalars.append(obj.OID + [0])
+        self.polls = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.next_time = None
+        self._entry = None
+
+    def __repr__(self):
+        return "%s(%r, interval=%s)" % (self.__class__.__name__, self.name, self.interval)
+
+
+class PollResult(object):
+    """The outcome of one poll of one device.
+
+    Attributes:
+        target    -- the PollTarget.
+        scheduled -- time the poll was due.
+        start     -- time the first request was sent.
+        latency   -- seconds from start to the last response (or failure).
+        varbinds  -- list of VarBind objects collected, possibly partial.
+        timeouts  -- number of requests that got no response.
+        error     -- the last exception, or None.
+    """
+    def __init__(self, target, scheduled, start):
+        self.target = target
+        self.scheduled = scheduled
+        self.start = start
+        self.latency = None
+        self.varbinds = []
+        self.timeouts = 0
+        self.error = None
+
+    def __repr__(self):
+        return "%s(%r, latency=%s, varbinds=%d, timeouts=%d)" % (
+                self.__class__.__name__, self.target.name, self.latency,
+                len(self.varbinds), self.timeouts)
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+class _PollJob(object):
+    """Collects everything for one poll of one device."""
+    def __init__(self, poller, target, scheduled):
+        self.poller = poller
+        self.target = target
+        self.result = PollResult(target, scheduled, now())
+        self.pending = 0
 
+    def start(self):
+        # Held until all first requests are sent, as some may fail at once.
+        self.pending = 1
+        session = self.target.session
+        scalars = self.target.scalars
+        for i in range(0, len(scalars), MAXBINDINGS):
+            self._request(session.get, scalars[i:i+MAXBINDINGS], self._scalars_done)
+        for rowoid in self.target.tables:
+            self._next_rows(rowoid, rowoid)
+        self._done_one()
+
+    def _request(self, send, sendargs, handler, *args):
+        try:
+            future = send(*sendargs)
+        except (SNMPException, EnvironmentError) as exc:
+            self._failed(exc)
+            return
+        self.pending += 1
+        future.add_done_callback(lambda f: handler(f, *args))
+
+    def _next_rows(self, rowoid, fromoid):
+        session = self.target.session
+        if session.sessiondata.version >= 1:
+            bpdu = GetBulkRequestPDU()
+            bpdu.add_repeater(fromoid)
+            bpdu.set_max_repetitions(MAXREPETITIONS)
+            self._request(session.getbulk, (bpdu,), self._rows_done, rowoid)
+        else:
+            self._request(session.getnext, (fromoid,), self._rows_done, rowoid)
+
+    def _failed(self, exc):
+        result = self.result
+        if isinstance(exc, SNMPNoResponse):
+            result.timeouts += 1
+        result.error = exc
+
+    def _scalars_done(self, future):
+        exc = future.exception()
+        if exc is None:
+            self.result.varbinds.extend(future.result())
+        else:
+            self._failed(exc)
+        self._done_one()
+
+    def _rows_done(self, future, rowoid):
+        exc = future.exception()
+        if exc is not None:
+            self._failed(exc)
+        else:
+            varbinds = self.result.varbinds
+            last = None
+            for vb in future.result():
+                if not vb.oid.startswith(rowoid) or isinstance(vb.value, endOfMibView):
+                    last = None
+                    break
+                varbinds.append(vb)
+                last = vb.oid
+            if last is not None:
+                self._next_rows(rowoid, last)
+        self._done_one()
+
+    def _done_one(self):
+        self.pending -= 1
+        if not self.pending:
+            self._finish()
+
+    def _finish(self):
+        result = self.result
+        result.latency = now() - result.start
+        self.poller._job_done(self)
+
+
+class Poller(object):
+    """Polls an inventory of devices at their intervals.
+
+    sink is called with a PollResult after each poll of each device. At most
+    concurrency devices are polled at once; others that fall due wait their
+    turn. Each next poll time is the previous scheduled time plus the interval,
+    varied by up to jitter (a fraction of the interval), so that devices added
+    together spread out rather than move in lock step.
+    """
+    def __init__(self, sink, concurrency=500, jitter=0.1, dispatcher=None,
+                resolution=0.1):
+        self.sink = sink
+        self.concurrency = concurrency
+        self.jitter = jitter
+        self.dispatcher = SNMP.AsyncDispatcher() if dispatcher is None else dispatcher
+        self._wheel = TimerWheel(resolution)
+        self._ready = deque()
+        self._active = 0
+        self._targets = []
+        self._running = False
+        self._closed = False
+        self.polls = 0
+
+    def __len__(self):
+        return len(self._targets)
+
+    def __iter__(self):
+        return iter(self._targets)
+
+    def add_device(self, sessiondata, objects, interval=60.0, name=None, start=None):
+        """Add a device to the inventory.
+
+        The first poll happens at start, or at a random time within the first
+        interval if start is not given.
+        """
+        session = SNMP.new_async_session(sessiondata, self.dispatcher)
+        target = PollTarget(session, objects, interval, name)
+        if start is None:
+            start = now() + random.random() * target.interval
+        self._targets.append(target)
+        self._schedule(target, start)
+        return target
+
+    def remove_device(self, target):
+        self._targets.remove(target)
+        if target._entry is not None:
+            self._wheel.remove(target._entry)
+            target._entry = None
+        target.next_time = None # an active poll will not be rescheduled.
+
+    def _schedule(self, target, when):
+        target.next_time = when
+        target._entry = self._wheel.add(when, target)
+
+    def _reschedule(self, target, scheduled):
+        if target.next_time is None: # removed
+            return
+        interval = target.interval
+        when = scheduled + interval
+        if self.jitter:
+            when += random.uniform(-self.jitter, self.jitter) * interval
+        t = now()
+        if when < t: # fell behind, skip the missed polls.
+            when = t + random.random() * self._wheel.resolution
+        self._schedule(target, when)
+
+    def _start(self, target):
+        target._entry = None
+        job = _PollJob(self, target, target.next_time)
+        self._active += 1
+        job.start()
+
+    def _job_done(self, job):
+        self._active -= 1
+        self.polls += 1
+        result = job.result
+        target = job.target
+        target.polls += 1
+        if result.timeouts:
+            target.timeouts += 1
+        elif result.error is not None:
+            target.errors += 1
+        self.sink(result)
+        if self._closed:
+            return
+        self._reschedule(target, result.scheduled)
+        ready = self._ready
+        while ready and self._active < self.concurrency:
+            self._start(ready.popleft())
+
+    def run_once(self, timeout=None):
+        """Do one round of I/O and start the polls that are due."""
+        wait = max(0.0, self._wheel.next_time() - now())
+        if self._ready and self._active < self.concurrency:
+            wait = 0.0
+        if timeout is not None:
+            wait = min(wait, timeout)
+        self.dispatcher.poll(wait)
+        ready = self._ready
+        ready.extend(self._wheel.advance())
+        while ready and self._active < self.concurrency:
+            self._start(ready.popleft())
+
+    def run(self, duration=None):
+        """Poll until stop() is called, or for duration seconds."""
+        self._running = True
+        end = None if duration is None else now() + duration
+        while self._running:
+            if end is None:
+                self.run_once()
+            else:
+                remaining = end - now()
+                if remaining <= 0:
+                    break
+                self.run_once(remaining)
+        self._running = False
+
+    def stop(self):
+        self._running = False
+
+    def close(self):
+        """Stop, and fail any polls in progress."""
+        self.stop()
+        self._closed = True
+        self._ready.clear()
+        self.dispatcher.close()
 
 
 def _test(argv):
-    pass # XXX
+    import sys
+    from pycopia.mibs import SNMPv2_MIB
+    if len(argv) < 2:
+        print("usage: Poller.py <host> [community] [interval]", file=sys.stderr)
+        return
+    sd = SNMP.sessionData(argv[1])
+    sd.add_community(argv[2] if len(argv) > 2 else "public", SNMP.RO)
+    interval = float(argv[3]) if len(argv) > 3 else 10.0
+    poller = Poller(print)
+    poller.add_device(sd, [SNMPv2_MIB.sysUpTime, SNMPv2_MIB.sysOREntry], interval, start=now())
+    try:
+        poller.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        poller.close()
 
 if __name__ == "__main__":
     import sys
     _test(sys.argv)
-
@@ -40,6 +40,14 @@ box.add_mibs("SNMPv2_MIB", "UDP_MIB")
 print "System Name       :", box.sysName
 print "System Uptime     :", box.sysUpTime
 
+# Many requests, to many agents, may be outstanding at once with
+# asynchronous sessions. They all share one socket.
+asession = SNMP.new_async_session(sd)
+futures = [asession.get(oid) for oid in oids]
+asession.dispatcher.loop() # or just ask for a result
+for future in futures:
+    print future.result()
+
 """
 
 from __future__ import absolute_import
@@ -48,12 +56,18 @@ from __future__ import division
 
 
 import sys
+import heapq
 import select # XXX Fix this to use asyncio
-#import asyncio # XXX
+from errno import EAGAIN, EINTR
+from collections import deque
 
 from pycopia import socket
+from pycopia import asyncio
+from pycopia.timelib import now
 from pycopia.aid import Enum
 from pycopia.SMI.Basetypes import *
+from pycopia.SMI.SMICONSTANTS import (SMI_ACCESS_NOT_ACCESSIBLE, SMI_ACCESS_NOTIFY,
+        SMI_ACCESS_NOT_IMPLEMENTED)
 from pycopia.SNMP import (SNMPNoResponse, SNMPBadCommunity,
         SNMPNotConnected, SNMPBadParameters)
 
@@ -233,17 +247,30 @@ class CommunityBasedMessage(Message):
     get_VarBindList = get_varbinds
 
 
+def decode_community_message(message):
+    """Decode a raw datagram into a CommunityBasedMessage."""
+    version, community, pdu = BER_decode.decode(message)
+    return CommunityBasedMessage(community, pdu, version)
+
+
 ## User based message (SNMPv2u) - NOT IMPLEMENTED
 class UserBasedMessage(Message):
     pass
 
 # these session objects deal with OIDs, and hide authentication and message handling.
 class Session(object):
+    # Table walks start with this many repetitions per GetBulk, then size
+    # them so responses come near max_response_size bytes.
+    max_repetitions = 25
+    max_response_size = 8192
+    MAXREPETITIONS = 1000
+
     # init the session
     def __init__ (self, sessiondata=None):
         self.sessiondata = sessiondata
         self.socket = None
         self._OUTSTANDING = {}
+        self.last_response_size = 0
         if self.sessiondata:
             self.open()
 
@@ -271,7 +298,9 @@ class Session(object):
         r, w, x = [self.socket], [], []
         r, w, x = select.select(r, w, x, self.sessiondata.timeout)
         if r:
-            return self.socket.recv(4096)
+            data = self.socket.recv(65536)
+            self.last_response_size = len(data)
+            return data
         # return nothing on timeout
         return None
 
@@ -318,6 +347,8 @@ class Session(object):
 
     # note theses get_table implementations are simplified. They always get the whole table.
     def get_table(self, rowobj, insert_cb):
+        if _readable_columns(rowobj):
+            return self.walk_table(rowobj, insert_cb)
         if self.sessiondata.version >= 1:
             return self.get_table_with_bulk(rowobj, insert_cb)
         else:
@@ -367,6 +398,95 @@ class Session(object):
                 return
             gblist = None
 
+    def walk_table(self, rowobj, insert_cb, columns=None):
+        """Walk a table by rows, calling insert_cb(varbind) for each column.
+
+        The readable columns of rowobj (or the given column OIDs) are walked in
+        parallel, with one repeater per unfinished column in each GetBulk (or
+        one OID each in a GetNext for SNMPv1). Rows are passed on, in index
+        order, as soon as every column has gone past them. The max-repetitions
+        is halved on tooBig, capped at what the agent returns when it
+        truncates a response, and otherwise sized from the response size.
+        """
+        if columns is None:
+            columns = _readable_columns(rowobj)
+        columns = [ObjectIdentifier(c) for c in columns]
+        ncols = len(columns)
+        lastoid = list(columns)
+        frontier = [None] * ncols # last index seen, per column
+        active = list(range(ncols))
+        rows = {} # index tuple -> list of varbinds, by column
+        heap = [] # of row indexes not yet passed on.
+        bulk = self.sessiondata.version >= 1
+        maxrep = self.max_repetitions
+        limit = self.MAXREPETITIONS # what the agent will return
+        while active:
+            n = len(active)
+            if bulk:
+                bpdu = GetBulkRequestPDU()
+                for c in active:
+                    bpdu.add_repeater(lastoid[c])
+                bpdu.set_max_repetitions(maxrep)
+                try:
+                    vbl = self.getbulk(bpdu)
+                except SNMPtooBig:
+                    if maxrep == 1:
+                        raise
+                    maxrep = limit = max(1, maxrep // 2)
+                    continue
+            else:
+                try:
+                    vbl = self.getnext(*[lastoid[c] for c in active])
+                except SNMPnoSuchName as err: # SNMPv1 end of MIB, for one column.
+                    errindex = int(err.args[0])
+                    if not 0 < errindex <= n:
+                        raise
+                    del active[errindex - 1]
+                    continue
+            nrows = len(vbl) // n
+            if not nrows:
+                raise SNMPtooBig("Agent returned no complete row.")
+            done = set()
+            for r in range(nrows):
+                for j, c in enumerate(active):
+                    if c in done:
+                        continue
+                    vb = vbl[r * n + j]
+                    oid = vb.oid
+                    prefix = columns[c]
+                    plen = len(prefix)
+                    if not oid.startswith(prefix) or isinstance(vb.value, endOfMibView):
+                        done.add(c)
+                        continue
+                    index = tuple(oid[plen:])
+                    if frontier[c] is not None and index <= frontier[c]:
+                        done.add(c) # agent is not increasing, stop rather than loop.
+                        continue
+                    row = rows.get(index)
+                    if row is None:
+                        row = rows[index] = [None] * ncols
+                        heapq.heappush(heap, index)
+                    row[c] = vb
+                    frontier[c] = index
+                    lastoid[c] = oid
+            if done:
+                active = [c for c in active if c not in done]
+            elif bulk and nrows < maxrep: # agent truncated the response.
+                limit = nrows
+            if active:
+                bound = min(frontier[c] for c in active)
+                while heap and bound is not None and heap[0] <= bound:
+                    for vb in rows.pop(heapq.heappop(heap)):
+                        if vb is not None:
+                            insert_cb(vb)
+            if bulk and self.last_response_size:
+                rowsize = self.last_response_size / nrows
+                maxrep = max(1, min(int(self.max_response_size / rowsize), limit))
+        while heap:
+            for vb in rows.pop(heapq.heappop(heap)):
+                if vb is not None:
+                    insert_cb(vb)
+
     def get_table_row(self, index, col_oids):
         oids = []
         for oid in col_oids:
@@ -395,9 +515,7 @@ class Session(object):
 # community based session handler. (SNMPv2c)
 class CommunityBasedSession(Session):
     def _decode_message(self, message):
-        tlv = BER_decode.get_tlv(message)
-        version, community, pdu = tlv.decode()
-        return CommunityBasedMessage(community, pdu, version)
+        return decode_community_message(message)
 
     def _get_request_message(self):
         comm = self.sessiondata.get_community(RO)
@@ -497,6 +615,14 @@ Where varbindlist is a VarBindList containing VarBind objects.
         raise NotImplementedError()
 
 
+def _readable_columns(rowobj):
+    """The OIDs of the columns of a RowObject that an agent will return."""
+    columns = getattr(rowobj, "columns", None) or {}
+    return [col.OID for col in sorted(columns.values(), key=lambda col: list(col.OID))
+            if col.access not in (SMI_ACCESS_NOT_ACCESSIBLE, SMI_ACCESS_NOTIFY,
+                    SMI_ACCESS_NOT_IMPLEMENTED)]
+
+
 ### User based administrative framework session
 class UserBasedSession(Session):
     def __init__(self, sessiondata):
@@ -531,3 +657,311 @@ def get_session(host, readcommunity, writecommunity=None, version=1):
     return new_session(sd)
 
 
+
+
+### Asynchronous sessions.
+# Any number of AsyncCommunitySession objects share one AsyncDispatcher, and
+# so one UDP socket. Requests are pipelined: each returns an SNMPFuture
+# immediately and replies are matched to requests by request ID.
+
+class SNMPFuture(object):
+    """The eventual result of an asynchronous request.
+
+    The result is the response VarBindList, or an exception (SNMPNoResponse,
+    or one of the SNMPError subclasses for error-status replies).
+    """
+    def __init__(self, dispatcher):
+        self._dispatcher = dispatcher
+        self._done = False
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def __repr__(self):
+        if not self._done:
+            state = "pending"
+        elif self._exception is not None:
+            state = "raised %r" % (self._exception,)
+        else:
+            state = "returned %d varbinds" % (len(self._result),)
+        return "<%s %s>" % (self.__class__.__name__, state)
+
+    def done(self):
+        return self._done
+
+    def result(self):
+        """Return the result, running the dispatcher until it is available."""
+        if not self._done:
+            self._dispatcher.wait(self)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self):
+        if not self._done:
+            self._dispatcher.wait(self)
+        return self._exception
+
+    def add_done_callback(self, callback):
+        """Call callback(future) when done, or now if already done."""
+        if self._done:
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+    def set_result(self, result):
+        self._result = result
+        self._set_done()
+
+    def set_exception(self, exc):
+        self._exception = exc
+        self._set_done()
+
+    def _set_done(self):
+        self._done = True
+        callbacks, self._callbacks = self._callbacks, None
+        for callback in callbacks:
+            callback(self)
+
+
+class _AsyncRequest(object):
+    def __init__(self, request_id, msg, address, retries, timeout, future):
+        self.request_id = request_id
+        self.msg = msg
+        self.address = address
+        self.retries = retries
+        self.timeout = timeout
+        self.future = future
+        self.tries = 0
+        self.deadline = None
+
+
+class AsyncDispatcher(asyncio.PollerInterface):
+    """Sends requests and dispatches responses for asynchronous sessions.
+
+    Uses one unconnected UDP socket registered with an asyncio Poll object
+    (the module poller by default). Retry timers are kept in a heap, so the
+    cost of a timeout does not depend on the number of outstanding requests.
+    Use the poll() or loop() methods to run it, or just ask for the result of
+    a future.
+    """
+    RECVSIZE = 65536
+    RECVBATCH = 64 # datagrams handled per read event, so timers are not starved.
+
+    def __init__(self, poller=None):
+        self._poller = asyncio.poller if poller is None else poller
+        self._OUTSTANDING = {}
+        self._timers = [] # heap of (deadline, request_id)
+        self._sendq = deque()
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(0)
+        self._poller.register(self)
+
+    def __len__(self):
+        return len(self._OUTSTANDING)
+
+    def close(self):
+        if self.socket is not None:
+            self._poller.unregister(self)
+            self.socket.close()
+            self.socket = None
+            outstanding, self._OUTSTANDING = self._OUTSTANDING, {}
+            self._timers = []
+            self._sendq.clear()
+            for req in outstanding.values():
+                req.future.set_exception(SNMPNotConnected("Dispatcher closed."))
+
+    def send(self, msgobj, sessiondata, address):
+        """Send a message object to the (resolved) address. Return a future."""
+        if self.socket is None:
+            raise SNMPNotConnected("Dispatcher closed.")
+        msg = ber(msgobj)
+        if not msg:
+            raise SNMPBadParameters("No message")
+        future = SNMPFuture(self)
+        req = _AsyncRequest(int(msgobj.pdu.request_id), msg, address,
+                sessiondata.retries, sessiondata.timeout, future)
+        self._OUTSTANDING[req.request_id] = req
+        self._transmit(req)
+        return future
+
+    def _transmit(self, req):
+        req.tries += 1
+        req.deadline = now() + req.timeout
+        heapq.heappush(self._timers, (req.deadline, req.request_id))
+        if self._sendq or not self._sendto(req):
+            self._sendq.append(req)
+            self._poller.modify(self)
+
+    def _sendto(self, req):
+        """Send the request. Returns False if it must wait for the socket.
+        Other errors, such as an unreachable network, fail the request."""
+        try:
+            self.socket.sendto(req.msg, req.address)
+        except socket.error as err:
+            if err.errno in (EAGAIN, EINTR):
+                return False
+            if self._OUTSTANDING.pop(req.request_id, None) is not None:
+                req.future.set_exception(err)
+        return True
+
+    def next_timeout(self):
+        """Seconds until the next retry is due, or -1 if nothing is pending."""
+        if self._timers:
+            return max(0.0, self._timers[0][0] - now())
+        return -1.0
+
+    def run_timers(self):
+        """Resend, or fail, requests whose response did not arrive in time."""
+        timers = self._timers
+        if not timers:
+            return
+        t = now()
+        while timers and timers[0][0] <= t:
+            deadline, request_id = heapq.heappop(timers)
+            req = self._OUTSTANDING.get(request_id)
+            if req is None or req.deadline != deadline: # answered or resent
+                continue
+            if req.tries < req.retries:
+                self._transmit(req)
+            else:
+                del self._OUTSTANDING[request_id]
+                req.future.set_exception(
+                    SNMPNoResponse("No resonse from agent after %d tries." % (req.tries,)))
+
+    def poll(self, timeout=None):
+        """Run one round of I/O and timers.
+
+        Waits no longer than timeout, nor past the next retry time.
+        """
+        nt = self.next_timeout()
+        if timeout is None or (nt >= 0 and nt < timeout):
+            timeout = nt
+        self._poller.poll(timeout)
+        self.run_timers()
+
+    def wait(self, future):
+        while not future.done():
+            if not self._OUTSTANDING:
+                raise SNMPNotConnected("Future will never complete.")
+            self.poll()
+
+    def loop(self):
+        """Run until no requests are outstanding."""
+        while self._OUTSTANDING:
+            self.poll()
+
+    # PollerInterface
+    def fileno(self):
+        return self.socket.fileno()
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return bool(self._sendq)
+
+    def read_handler(self):
+        recvfrom = self.socket.recvfrom
+        for i in range(self.RECVBATCH):
+            try:
+                data, addr = recvfrom(self.RECVSIZE)
+            except socket.error as err:
+                if err.errno in (EAGAIN, EINTR):
+                    return
+                raise
+            try:
+                resp = decode_community_message(data)
+                request_id = int(resp.pdu.request_id)
+            except Exception: # garbage on the port, ignore it as agents do.
+                continue
+            req = self._OUTSTANDING.get(request_id)
+            if req is None or req.address[0] != addr[0]:
+                continue # late, duplicate, or spoofed response.
+            del self._OUTSTANDING[request_id]
+            if resp.pdu.error_status:
+                req.future.set_exception(
+                        EXCEPTION_MAP[resp.pdu.error_status](resp.pdu.error_index))
+            else:
+                req.future.set_result(resp.pdu.varbinds)
+
+    def write_handler(self):
+        sendq = self._sendq
+        while sendq:
+            req = sendq[0]
+            if req.request_id in self._OUTSTANDING and not self._sendto(req):
+                return
+            sendq.popleft()
+        self._poller.modify(self)
+
+
+class AsyncCommunitySession(object):
+    """Community based session (SNMPv1 and SNMPv2c) that does not block.
+
+    The get, getnext, getbulk, and set methods take the same arguments as the
+    CommunityBasedSession methods but return an SNMPFuture.
+    """
+    def __init__(self, sessiondata, dispatcher=None):
+        self.sessiondata = sessiondata
+        self.dispatcher = get_dispatcher() if dispatcher is None else dispatcher
+        self.address = (socket.gethostbyname(sessiondata.agent), sessiondata.port)
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.sessiondata)
+
+    def _get_read_community(self):
+        comm = self.sessiondata.get_community(RO)
+        if not comm: # then try to use a RW community if no RO community
+            comm = self.sessiondata.get_community(RW)
+            if not comm:
+                raise SNMPBadCommunity("No community!")
+        return comm
+
+    def _send(self, comm, pdu):
+        mo = CommunityBasedMessage(comm, pdu, self.sessiondata.version)
+        return self.dispatcher.send(mo, self.sessiondata, self.address)
+
+    def get(self, *oids):
+        pdu = GetRequestPDU()
+        for oid in oids:
+            pdu.add_varbind(VarBind(ObjectIdentifier(oid)))
+        return self._send(self._get_read_community(), pdu)
+
+    def getnext(self, *oids):
+        pdu = GetNextRequestPDU()
+        for oid in oids:
+            pdu.add_varbind(VarBind(ObjectIdentifier(oid)))
+        return self._send(self._get_read_community(), pdu)
+
+    def getbulk(self, bulkpdu):
+        # Copy with a new request ID, so the caller may reuse bulkpdu while
+        # earlier requests made with it are still outstanding.
+        pdu = GetBulkRequestPDU(0, bulkpdu.non_repeaters, bulkpdu.max_repetitions,
+                VarBindList(bulkpdu.varbinds))
+        return self._send(self._get_read_community(), pdu)
+
+    def set(self, varbindlist):
+        comm = self.sessiondata.get_community(RW)
+        if not comm:
+            raise SNMPBadCommunity("No community!")
+        pdu = SetRequestPDU()
+        for vb in varbindlist:
+            pdu.add_varbind(vb)
+        return self._send(comm, pdu)
+
+
+_dispatcher = None
+
+def get_dispatcher():
+    """Return the shared dispatcher, creating it on first use."""
+    global _dispatcher
+    if _dispatcher is None or _dispatcher.socket is None:
+        _dispatcher = AsyncDispatcher()
+    return _dispatcher
+
+def new_async_session(sessiondata, dispatcher=None):
+    if sessiondata.communities:
+        return AsyncCommunitySession(sessiondata, dispatcher)
+    else:
+        raise ValueError("new_async_session: only community based sessions are supported.")
+
@@ -33,7 +33,7 @@ from pycopia import aid
 from pycopia.SNMP import Manager
 from pycopia.mibs import SNMPv2_MIB, IF_MIB
 
-from pycopia.SMI import OIDMAP
+from pycopia.SMI import OIDTRIE
 
 
 class SNMPManagerCommands(CLI.GenericCLI):
@@ -106,13 +106,14 @@ def get_mib(name):
     return aid.Import("pycopia.mibs." + name)
 
 
-def get_oidname(soid):
-    soid = str(soid)
-    obj = OIDMAP.get(soid)
+def get_oidname(oid):
+    """Name an OID by the object it falls under, e.g. ciscoProducts.516."""
+    if isinstance(oid, basestring):
+        oid = [int(s) for s in oid.split(".") if s]
+    obj, length = OIDTRIE.longest_match(oid)
     if obj is None:
-        return soid
-    else:
-        return obj.__name__
+        return ".".join(map(str, oid))
+    return ".".join([obj.__name__] + list(map(str, oid[length:])))
 
 
 
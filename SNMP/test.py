@@ -20,21 +20,323 @@
 """
 
 import unittest
+import threading
+import operator
 
 from pycopia.SNMP import BER_tags
 from pycopia.SNMP import BER_decode
+from pycopia import asyncio
+from pycopia.timelib import now
+from pycopia.SMI import OIDTrie, OIDTRIE
+from pycopia.SMI.Basetypes import *
+from pycopia.SMI import Objects
 from pycopia.SNMP import SNMP
-#from pycopia.SNMP import Agent
+from pycopia.SNMP import Agent
+from pycopia.SNMP import SNMPNoResponse
 from pycopia.SNMP import Manager
 from pycopia.SNMP import Poller
+from pycopia.mibs import SNMPv2_MIB
 #from pycopia.SNMP import Stripcharts
 from pycopia.SNMP import traps
 #from pycopia.SNMP import trapserver
 
+IFTABLE = [1, 3, 6, 1, 2, 1, 2, 2, 1]
+
 class SNMPTests(unittest.TestCase):
     def setUp(self):
         pass
 
+    def test_oidtrie(self):
+        trie = OIDTrie()
+        trie.update({"1.3.6.1.2.1.1": "system", "1.3.6.1.2.1.1.9.1.3": "sysORDescr",
+                "1.3.6.1.2.1.1.9.1": "sysOREntry"})
+        self.assertEqual(len(trie), 3)
+        self.assertEqual(trie.get([1, 3, 6, 1, 2, 1, 1]), "system")
+        self.assertEqual(trie.get((1, 3, 6, 1, 2, 1)), None)
+        for i in range(3): # the second time around is memoized
+            self.assertEqual(trie.longest_match([1, 3, 6, 1, 2, 1, 1, 9, 1, 3, i]), ("sysORDescr", 10))
+            self.assertEqual(trie.longest_match((1, 3, 6, 1, 2, 1, 1, 9, 1, 4, i)), ("sysOREntry", 9))
+        self.assertEqual(trie.find([1, 3, 6, 1, 2, 1, 1, 3, 0]), "system")
+        self.assertEqual(trie.find([1, 3, 6, 1, 2, 1, 1, 3, 0], minlen=8), None)
+        self.assertEqual(trie.find([1, 3, 6, 1, 4]), None)
+        trie.add([1, 3, 6, 1, 2, 1, 1, 9, 1, 3, 1], "first") # invalidates memo
+        self.assertEqual(trie.find([1, 3, 6, 1, 2, 1, 1, 9, 1, 3, 1]), "first")
+        self.assertEqual(trie.find([1, 3, 6, 1, 2, 1, 1, 9, 1, 3, 2]), "sysORDescr")
+        self.assertTrue(OIDTRIE.find(SNMPv2_MIB.sysUpTime.OID + [0]) is SNMPv2_MIB.sysUpTime)
+
+    def test_oid(self):
+        oid = ObjectIdentifier("1.3.6.1.2.1.1.9.1.3.7")
+        self.assertEqual(oid, [1, 3, 6, 1, 2, 1, 1, 9, 1, 3, 7])
+        self.assertEqual(oid, (1, 3, 6, 1, 2, 1, 1, 9, 1, 3, 7))
+        self.assertEqual(str(oid), "1.3.6.1.2.1.1.9.1.3.7")
+        self.assertEqual(repr(oid), "pycopia.SMI.Basetypes.ObjectIdentifier([1, 3, 6, 1, 2, 1, 1, 9, 1, 3, 7])")
+        self.assertEqual(hash(oid), hash(ObjectIdentifier(list(oid))))
+        self.assertEqual({tuple(oid): 1}[oid], 1)
+        self.assertTrue(type(oid[:9]) is ObjectIdentifier)
+        self.assertTrue(type(oid + [1]) is ObjectIdentifier)
+        self.assertTrue(type([0] + oid) is ObjectIdentifier)
+        self.assertTrue(oid.startswith(SNMPv2_MIB.sysOREntry.OID))
+        self.assertTrue(oid.startswith(oid))
+        self.assertFalse(oid.startswith(oid + [0]))
+        self.assertFalse(oid.startswith([1, 3, 6, 1, 2, 1, 2]))
+        self.assertRaises(TypeError, operator.setitem, oid, 0, 2)
+        # lexicographic, so sorting gives walk order.
+        oids = [ObjectIdentifier(s) for s in ("1.3.6.1.2.1.2", "1.3.6.1.2.1.1.9.1.3.7",
+                "1.3.6.1.2.1.1.10", "1.3.6.1.2.1.1", "1.3.6.1.2.1.1.9.1.3.7.0")]
+        self.assertEqual([str(o) for o in sorted(oids)], ["1.3.6.1.2.1.1",
+                "1.3.6.1.2.1.1.9.1.3.7", "1.3.6.1.2.1.1.9.1.3.7.0", "1.3.6.1.2.1.1.10",
+                "1.3.6.1.2.1.2"])
+        self.assertTrue(ObjectIdentifier("1.3.6.1.2.1.1.10") > oid)
+        # index encoding round trip
+        row = SNMPv2_MIB.sysOREntry()
+        indexoid = row._make_index_oid([7])
+        self.assertTrue(type(indexoid) is ObjectIdentifier)
+        self.assertEqual(SNMPv2_MIB.sysOREntry(indexoid).get_indexvalue(), 7)
+        # An IpAddress index, like ipNetToMediaEntry's.
+        class ifIndex(Objects.ColumnObject):
+            OID = ObjectIdentifier([1, 3, 6, 1, 2, 1, 4, 22, 1, 1])
+            syntaxobject = Integer32
+        class netAddress(Objects.ColumnObject):
+            OID = ObjectIdentifier([1, 3, 6, 1, 2, 1, 4, 22, 1, 3])
+            syntaxobject = IpAddress
+        class netToMediaEntry(Objects.RowObject):
+            OID = ObjectIdentifier([1, 3, 6, 1, 2, 1, 4, 22, 1])
+            index = Objects.IndexObjects([ifIndex, netAddress], False)
+            columns = {"ifIndex": ifIndex, "netAddress": netAddress}
+        row = netToMediaEntry(ObjectIdentifier([2, 192, 168, 1, 20]))
+        ifindex, address = row.get_indexvalues()
+        self.assertEqual(ifindex, 2)
+        self.assertTrue(isinstance(address, IpAddress))
+        self.assertEqual(address.address, IpAddress("192.168.1.20").address)
+        self.assertEqual(row._make_index_oid([2, "192.168.1.20"]), row.indexoid)
+        implied = ObjectIdentifier([1, 2], implied=True)
+        self.assertEqual(implied._oid_(), [1, 2])
+        self.assertEqual(ObjectIdentifier([1, 2])._oid_(), [2, 1, 2])
+
+    def test_offset_decoder(self):
+        values = {tuple(SNMPv2_MIB.sysUpTime.OID + [0]): TimeTicks(100)}
+        for i in range(1, 51):
+            values[tuple(SNMPv2_MIB.sysOREntry.OID + [2, i])] = ObjectIdentifier([1, 3, 6, 1, 4, 1, 9, i, 300000])
+            values[tuple(SNMPv2_MIB.sysOREntry.OID + [3, i])] = OctetString("module %d" % i)
+            values[tuple(IFTABLE + [10, i])] = Counter32(2**32 - i)
+            values[tuple(IFTABLE + [99, i])] = Counter64(2**40 + i)
+            values[tuple(IFTABLE + [98, i])] = IpAddress("10.0.0.%d" % i)
+            values[tuple(IFTABLE + [97, i])] = Integer32(-i * 1000)
+        poller = asyncio.Poll()
+        agent = Agent.SimpleAgent(values, maxsize=30000, poller=poller)
+        bpdu = GetBulkRequestPDU()
+        bpdu.add_repeater([1, 3, 6, 1, 2, 1])
+        bpdu.set_max_repetitions(1000)
+        msg = ber(SNMP.CommunityBasedMessage("public", agent.handle(bpdu), 1))
+        agent.close()
+        poller.close()
+        old = BER_decode.get_tlv(msg).decode()
+        new = BER_decode.decode(memoryview(msg))
+        self.assertEqual(old[:2], new[:2])
+        self.assertEqual(old[2].request_id, new[2].request_id)
+        self.assertEqual(len(old[2].varbinds), len(values) + 1) # plus endOfMibView
+        self.assertEqual(len(old[2].varbinds), len(new[2].varbinds))
+        for ovb, nvb in zip(old[2].varbinds, new[2].varbinds):
+            self.assertEqual(ber(ovb), ber(nvb)) # lazy, re-uses the original encoding
+            self.assertEqual(ovb.oid, nvb.oid)
+            self.assertTrue(type(ovb.value) is type(nvb.value))
+            self.assertEqual(str(ovb.value), str(nvb.value))
+            self.assertTrue(ovb.Object is nvb.Object)
+            self.assertEqual(ber(ovb), ber(nvb))
+        self.assertEqual(ber(SNMP.CommunityBasedMessage("public", new[2], 1)), msg)
+
+
+class AsyncSessionTests(unittest.TestCase):
+    def setUp(self):
+        values = {}
+        for i in range(1, 101):
+            values[tuple(IFTABLE + [1, i])] = Integer32(i)
+            values[tuple(IFTABLE + [10, i])] = Counter32(i * 10)
+        self.poller = asyncio.Poll()
+        self.agent = Agent.SimpleAgent(values, poller=self.poller)
+        self.dispatcher = SNMP.AsyncDispatcher(self.poller)
+        sd = SNMP.sessionData("127.0.0.1", port=self.agent.address[1], timeout=0.5, retries=2)
+        sd.add_community("public", SNMP.RO)
+        sd.add_community("public", SNMP.RW)
+        self.session = SNMP.new_async_session(sd, self.dispatcher)
+
+    def tearDown(self):
+        self.dispatcher.close()
+        self.agent.close()
+        self.poller.close()
+
+    def test_get(self):
+        vbl = self.session.get(IFTABLE + [10, 3]).result()
+        self.assertEqual(int(vbl[0].value), 30)
+        vbl = self.session.get(IFTABLE + [10, 101]).result()
+        self.assertTrue(isinstance(vbl[0].value, noSuchInstance))
+
+    def test_pipelined(self):
+        done = []
+        futures = [self.session.get(IFTABLE + [10, i]) for i in range(1, 101)]
+        for future in futures:
+            future.add_done_callback(done.append)
+        self.assertEqual(len(self.dispatcher), 100)
+        self.dispatcher.loop()
+        self.assertEqual(len(done), 100)
+        for i, future in enumerate(futures):
+            self.assertEqual(int(future.result()[0].value), (i + 1) * 10)
+
+    def test_getnext_getbulk(self):
+        vbl = self.session.getnext(IFTABLE + [1, 100]).result()
+        self.assertEqual(list(vbl[0].oid), IFTABLE + [10, 1])
+        bpdu = GetBulkRequestPDU()
+        bpdu.add_repeater(IFTABLE + [1])
+        bpdu.add_repeater(IFTABLE + [10])
+        bpdu.set_max_repetitions(10)
+        first = self.session.getbulk(bpdu)
+        second = self.session.getbulk(bpdu) # same PDU, still gets its own reply
+        vbl = first.result()
+        self.assertEqual(len(vbl), 20)
+        self.assertEqual(list(vbl[1].oid), IFTABLE + [10, 1])
+        self.assertEqual(len(second.result()), 20)
+
+    def test_set(self):
+        vbl = VarBindList([VarBind(ObjectIdentifier(IFTABLE + [1, 1]), Integer32(42))])
+        self.session.set(vbl).result()
+        self.assertEqual(int(self.session.get(IFTABLE + [1, 1]).result()[0].value), 42)
+
+    def test_no_response(self):
+        self.agent.community = "secret" # agent now ignores us.
+        future = self.session.get(IFTABLE + [1, 1])
+        self.assertTrue(isinstance(future.exception(), SNMPNoResponse))
+        self.assertRaises(SNMPNoResponse, future.result)
+        self.assertEqual(self.agent.requests, 0)
+
+
+    def test_send_error(self):
+        # Sending to the broadcast address is not permitted.
+        sd = SNMP.sessionData("255.255.255.255", timeout=0.2, retries=2)
+        sd.add_community("public", SNMP.RO)
+        session = SNMP.new_async_session(sd, self.dispatcher)
+        future = session.get(IFTABLE + [1, 1])
+        good = self.session.get(IFTABLE + [10, 3])
+        self.assertTrue(future.done())
+        self.assertTrue(isinstance(future.exception(), EnvironmentError))
+        self.assertEqual(len(self.dispatcher), 1)
+        self.dispatcher.loop()
+        self.assertEqual(int(good.result()[0].value), 30)
+
+
+class TableWalkTests(unittest.TestCase):
+    """Blocking sessions, with the agent served from a thread."""
+
+    def setUp(self):
+        values = {}
+        for i in range(1, 301):
+            values[tuple(SNMPv2_MIB.sysOREntry.OID + [2, i])] = ObjectIdentifier([1, 3, 6, 1, 4, 1, i])
+            if i % 3: # a sparse column
+                values[tuple(SNMPv2_MIB.sysOREntry.OID + [3, i])] = OctetString("module %d" % i)
+            values[tuple(SNMPv2_MIB.sysOREntry.OID + [4, i])] = TimeTicks(i)
+        values[(1, 3, 6, 1, 2, 1, 1, 9, 2, 0)] = Integer32(1)
+        self.values = values
+        self.poller = asyncio.Poll()
+        self.agent = Agent.SimpleAgent(values, maxsize=1400, poller=self.poller)
+        self._running = True
+        self.thread = threading.Thread(target=self._serve)
+        self.thread.start()
+
+    def _serve(self):
+        while self._running:
+            self.poller.poll(0.1)
+
+    def tearDown(self):
+        self._running = False
+        self.thread.join()
+        self.agent.close()
+        self.poller.close()
+
+    def _walk(self, version):
+        sd = SNMP.sessionData("127.0.0.1", port=self.agent.address[1], version=version, timeout=2)
+        sd.add_community("public", SNMP.RO)
+        session = SNMP.new_session(sd)
+        received = []
+        requests_at_first_row = []
+        def insert_cb(vb):
+            if not received:
+                requests_at_first_row.append(self.agent.requests)
+            received.append(vb)
+        session.walk_table(SNMPv2_MIB.sysOREntry, insert_cb)
+        session.close()
+        expected = sorted(oid for oid in self.values if oid[:9] == tuple(SNMPv2_MIB.sysOREntry.OID))
+        # by rows, then columns.
+        expected.sort(key=lambda oid: (oid[10:], oid[9]))
+        self.assertEqual([tuple(vb.oid) for vb in received], expected)
+        self.assertTrue(requests_at_first_row[0] < self.agent.requests) # rows streamed.
+        return received
+
+    def test_walk_table_bulk(self):
+        self._walk(1)
+        self.assertTrue(self.agent.requests < 300 * 3 // 25)
+
+    def test_walk_table_getnext(self):
+        self._walk(0)
+
+
+class PollerTests(unittest.TestCase):
+
+    def test_timerwheel(self):
+        wheel = Poller.TimerWheel(0.1, slots=8, start=100.0)
+        wheel.add(100.25, "a")
+        wheel.add(101.0, "b") # more than once around the wheel
+        c = wheel.add(100.3, "c")
+        wheel.remove(c)
+        self.assertEqual(wheel.advance(100.2), [])
+        self.assertEqual(wheel.advance(100.3), ["a"])
+        self.assertEqual(wheel.advance(100.95), [])
+        self.assertEqual(wheel.advance(101.05), ["b"])
+        self.assertEqual(len(wheel), 0)
+
+    def test_poller(self):
+        values = {tuple(SNMPv2_MIB.sysUpTime.OID + [0]): TimeTicks(100)}
+        for i in range(1, 41):
+            values[tuple(SNMPv2_MIB.sysOREntry.OID + [3, i])] = OctetString("module")
+        poller = asyncio.Poll()
+        agents = [Agent.SimpleAgent(values, poller=poller) for i in range(3)]
+        results = []
+        p = Poller.Poller(results.append, concurrency=2,
+                dispatcher=SNMP.AsyncDispatcher(poller))
+        try:
+            for agent in agents:
+                sd = SNMP.sessionData("127.0.0.1", port=agent.address[1], timeout=0.5, retries=1)
+                sd.add_community("public", SNMP.RO)
+                p.add_device(sd, [SNMPv2_MIB.sysUpTime, SNMPv2_MIB.sysOREntry], 0.5,
+                        start=now())
+            sd = SNMP.sessionData("127.0.0.1", port=9, timeout=0.2, retries=1)
+            sd.add_community("public", SNMP.RO)
+            dead = p.add_device(sd, [SNMPv2_MIB.sysUpTime], 0.5, name="dead", start=now())
+            # Sends to the broadcast address fail at once.
+            sd = SNMP.sessionData("255.255.255.255", timeout=0.2, retries=1)
+            sd.add_community("public", SNMP.RO)
+            unreachable = p.add_device(sd, [SNMPv2_MIB.sysUpTime, SNMPv2_MIB.sysOREntry],
+                    0.5, name="unreachable", start=now())
+            p.run(1.2)
+            done = list(results) # closing fails any polls still in progress.
+        finally:
+            p.close()
+            for agent in agents:
+                agent.close()
+            poller.close()
+        self.assertTrue(len(done) >= 8)
+        for result in done:
+            if result.target is dead:
+                self.assertEqual(result.timeouts, 1)
+                self.assertEqual(result.varbinds, [])
+            elif result.target is unreachable:
+                self.assertTrue(isinstance(result.error, EnvironmentError))
+                self.assertEqual(result.timeouts, 0)
+                self.assertEqual(result.varbinds, [])
+            else:
+                self.assertTrue(result.ok)
+                self.assertEqual(len(result.varbinds), 41)
+        self.assertTrue(dead.timeouts >= 1)
+        self.assertTrue(unreachable.errors >= 2)
+        self.assertEqual(p._active, 0)
 
 
 if __name__ == '__main__':
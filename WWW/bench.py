@@ -0,0 +1,169 @@
+#!/usr/bin/python2.7
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Benchmarks for the WWW package.
+
+Usage: bench.py [-n <requests>] [-H <hosts>] [-c <connections>] [-p <perhost>]
+
+The fetch benchmark runs the server of pycopia.httpserver, answering more than
+one request per connection, in a child process. Its hosts are loopback
+addresses, 127.0.0.1 and up.
+
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import sys
+import os
+import getopt
+import signal
+
+import pycurl
+
+from pycopia import socket
+from pycopia import asyncserver
+from pycopia import protocols
+from pycopia.timelib import now
+from pycopia.clientservers.servers import http_protocols
+from pycopia.WWW import client
+
+
+class _KeepAliveHTTPServerProto(http_protocols.BasicHTTPServerProto):
+    """Answers GET requests like BasicHTTPServerProto, but keeps the
+    connection open for more."""
+
+    def _getend(self, match):
+        msg = "Got {0}\n".format(self.path)
+        self.iostream.write(
+        """{httpver} 200 OK\r\nContent-Type: text/plain\r\nContent-Length: {length}\r\n\r\n{msg}""".format(
+                        httpver=self.httpver, length=len(msg), msg=msg))
+
+
+def start_server():
+    listener = socket.tcp_listener(("", 0), 1024)
+    pid = os.fork()
+    if pid == 0:
+        try:
+            signal.signal(signal.SIGTERM, lambda sig, frame: sys.exit(0))
+            asyncserver.AsyncServerHandler(listener, asyncserver.AsyncWorkerHandler,
+                    _KeepAliveHTTPServerProto())
+            asyncserver.poller.loop()
+        finally:
+            os._exit(0)
+    port = listener.getsockname()[1]
+    listener.close()
+    return pid, port
+
+
+def _add_requests(manager, port, count, hosts):
+    for i in range(count):
+        manager.add_request(client.HTTPRequest(
+                "http://127.0.0.%d:%d/device/%d/status" % (i % hosts + 1, port, i)))
+
+
+def _all_at_once(manager):
+    """The previous HTTPConnectionManager.perform, for comparison: every
+    request added to the multi object at once, on a new Curl object, and
+    all results returned at the end."""
+    m = pycurl.CurlMulti()
+    reqs = manager._requests
+    manager._requests = []
+    for req in reqs:
+        c, resp = req.get_requester()
+        c.resp = resp
+        m.add_handle(c)
+    remaining = len(reqs)
+    start = now()
+    first = None
+    good = []
+    while remaining:
+        while 1:
+            ret, num_handles = m.perform()
+            if ret != pycurl.E_CALL_MULTI_PERFORM:
+                break
+        while 1:
+            num_q, ok_list, err_list = m.info_read()
+            for c in ok_list:
+                m.remove_handle(c)
+                c.resp.finalize(c)
+                good.append(c.resp)
+            for c, errno, errmsg in err_list:
+                m.remove_handle(c)
+                c.close()
+            remaining -= len(ok_list) + len(err_list)
+            if num_q == 0:
+                break
+        if remaining:
+            m.select(1.0)
+    m.close()
+    first = now() - start # all come back together
+    return first, len(good)
+
+
+def _fetcher(manager, connections, perhost):
+    start = now()
+    first = None
+    good = 0
+    for req, resp in manager.fetch(connections, perhost):
+        if first is None:
+            first = now() - start
+        if not resp.error:
+            good += 1
+    return first, good
+
+
+def bench_fetch(count, hosts, connections, perhost):
+    pid, port = start_server()
+    try:
+        print("{} GET requests to {} hosts".format(count, hosts))
+        for name, func in (
+                ("all at once", _all_at_once),
+                ("fetch", lambda m: _fetcher(m, connections, perhost)),
+                ):
+            manager = client.HTTPConnectionManager()
+            _add_requests(manager, port, count, hosts)
+            start = now()
+            first, good = func(manager)
+            elapsed = now() - start
+            print("{:>16s}: {:8.3f} s, {:8.0f} req/s, {:5d} ok, first after {:6.3f} s".format(
+                    name, elapsed, count / elapsed, good, first))
+    finally:
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+
+
+def main(argv):
+    count = 2000
+    hosts = 50
+    connections = client.MAX_CONNECTIONS
+    perhost = client.MAX_HOST_CONNECTIONS
+    opts, args = getopt.getopt(argv[1:], "n:H:c:p:")
+    for opt, optarg in opts:
+        if opt == "-n":
+            count = int(optarg)
+        elif opt == "-H":
+            hosts = int(optarg)
+        elif opt == "-c":
+            connections = int(optarg)
+        elif opt == "-p":
+            perhost = int(optarg)
+    bench_fetch(count, hosts, connections, perhost)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -7,6 +7,8 @@ HTTP client.
 """
 
 import itertools
+import time
+from collections import deque
 
 import pycurl
 
@@ -22,6 +24,10 @@ DEFAULT_ENCODING = "utf-8"
 DEFAULT_ACCEPT = "text/xml,application/xml,application/xhtml+xml,text/html;q=0.9"
 DEFAULT_ACCEPT_ENCODING = "identity"
 
+# Limits for HTTPConnectionManager.fetch
+MAX_CONNECTIONS = 32
+MAX_HOST_CONNECTIONS = 4
+
 
 class Error(Exception):
     pass
@@ -209,8 +215,9 @@ class HTTPResponse(object):
     def _del_savefile(self):
         self._downloadfile = None
 
-    def finalize(self, c):
-        """finalize a Curl object and extract information from it."""
+    def finalize(self, c, close=True):
+        """finalize a Curl object and extract information from it. The
+        Curl object is closed, unless close is false."""
         self._url = c.getinfo(pycurl.EFFECTIVE_URL)
         # timing info
         nt = c.getinfo(pycurl.NAMELOOKUP_TIME)
@@ -222,7 +229,8 @@ class HTTPResponse(object):
         self._timing = TimingInfo(nt, ct, pt, st, tt, rt)
         self._redirectcount = c.getinfo(pycurl.REDIRECT_COUNT)
         self._cookielist = c.getinfo(pycurl.INFO_COOKIELIST)
-        c.close()
+        if close:
+            c.close()
         self._downloadfile = None
 
     def _set_error(self, err):
@@ -344,6 +352,13 @@ class TimingInfo(object):
         }
 
 
+def _get_curl(c):
+    if c is None:
+        return pycurl.Curl()
+    c.reset()
+    return c
+
+
 class Request(object):
     """Base class for all types of URL requests.
     """
@@ -405,25 +420,32 @@ class HTTPRequest(Request):
         new.set_headers(self._headers)
         return new
 
-    def get_requester(self):
+    def get_requester(self, c=None):
+        """Initialize a Curl object for this request.
+
+        A Curl object from an earlier request may be given to be used again,
+        so that its connections and caches are kept.
+
+        Returns a tuple of initialized Curl and HTTPResponse objects.
+        """
         method = self._method
         if method == "GET":
-            return self.get_getter()
+            return self.get_getter(c)
         elif method == "POST":
-            return self.get_poster()
+            return self.get_poster(c)
         elif method == "PUT":
-            return self.get_uploader()
+            return self.get_uploader(c)
         elif method == "DELETE":
-            return self.get_deleter()
+            return self.get_deleter(c)
         else:
             raise ValueError("Invalid method type: %r" % (meth,))
 
-    def get_getter(self):
+    def get_getter(self, c=None):
         """Initialze a Curl object for a single GET request.
 
         Returns a tuple of initialized Curl and HTTPResponse objects.
         """
-        c = pycurl.Curl()
+        c = _get_curl(c)
         resp = HTTPResponse(self._encoding)
         c.setopt(pycurl.HTTPGET, 1)
         if self._query:
@@ -436,21 +458,21 @@ class HTTPRequest(Request):
         self._set_common(c)
         return c, resp
 
-    def get_poster(self):
+    def get_poster(self, c=None):
         if isinstance(self._data, HTTPForm):
-            return self.get_form_poster()
+            return self.get_form_poster(c)
         elif isinstance(self._data, (dict, list)):
-            return self.get_URLencoded_poster()
+            return self.get_URLencoded_poster(c)
         else:
-            return self.get_raw_poster()
+            return self.get_raw_poster(c)
 
-    def get_URLencoded_poster(self):
+    def get_URLencoded_poster(self, c=None):
         """Initialze a Curl object for a single POST request.
 
         Returns a tuple of initialized Curl and HTTPResponse objects.
         """
         data = urlparse.urlencode(self._data, True)
-        c = pycurl.Curl()
+        c = _get_curl(c)
         resp = HTTPResponse(self._encoding)
         c.setopt(c.URL, str(self._url))
         c.setopt(pycurl.POST, 1)
@@ -464,7 +486,7 @@ class HTTPRequest(Request):
         self._set_common(c)
         return c, resp
 
-    def get_form_poster(self):
+    def get_form_poster(self, c=None):
         """Initialze a Curl object for a single POST request.
 
         This sends a multipart/form-data, which allows you to upload files.
@@ -472,7 +494,7 @@ class HTTPRequest(Request):
         Returns a tuple of initialized Curl and HTTPResponse objects.
         """
         data = self._data.items()
-        c = pycurl.Curl()
+        c = _get_curl(c)
         resp = HTTPResponse(self._encoding)
         c.setopt(c.URL, str(self._url))
         c.setopt(pycurl.HTTPPOST, data)
@@ -481,7 +503,7 @@ class HTTPRequest(Request):
         self._set_common(c)
         return c, resp
 
-    def get_raw_poster(self):
+    def get_raw_poster(self, c=None):
         """Initialze a Curl object for a single POST request.
 
         This sends whatever data you give it, without specifying the content
@@ -490,7 +512,7 @@ class HTTPRequest(Request):
         Returns a tuple of initialized Curl and HTTPResponse objects.
         """
         ld = len(self._data)
-        c = pycurl.Curl()
+        c = _get_curl(c)
         resp = HTTPResponse(self._encoding)
         c.setopt(c.URL, str(self._url))
         c.setopt(pycurl.POST, 1)
@@ -505,12 +527,12 @@ class HTTPRequest(Request):
         self._set_common(c)
         return c, resp
 
-    def get_uploader(self):
+    def get_uploader(self, c=None):
         """Initialze a Curl object for a single PUT request.
 
         Returns a tuple of initialized Curl and HTTPResponse objects.
         """
-        c = pycurl.Curl()
+        c = _get_curl(c)
         resp = HTTPResponse(self._encoding)
         c.setopt(pycurl.UPLOAD, 1) # does an HTTP PUT
         data = self._data.get("PUT", "")
@@ -525,12 +547,12 @@ class HTTPRequest(Request):
         self._set_common(c)
         return c, resp
 
-    def get_deleter(self):
+    def get_deleter(self, c=None):
         """Initialze a Curl object for a single DELETE request.
 
         Returns a tuple of initialized Curl and HTTPResponse objects.
         """
-        c = pycurl.Curl()
+        c = _get_curl(c)
         resp = HTTPResponse(self._encoding)
         c.setopt(pycurl.CUSTOMREQUEST, "DELETE")
         c.setopt(c.URL, str(self._url))
@@ -780,55 +802,100 @@ class HTTPConnectionManager(ConnectionManager):
         Return two lists. The first list is a list of responses that
         completed. The second is list of the requests that errored.
         """
-        m = pycurl.CurlMulti()
-        requests = []
-        num_q = num_urls = len(self._requests)
-        reqs = self._requests
-        self._requests = []
-        for req in reqs:
-            c, resp = req.get_requester()
-            c.resp = resp
-            m.add_handle(c)
-            requests.append(c)
-        del reqs
-
-        while 1:
-            ret, num_handles = m.perform()
-            if ret != pycurl.E_CALL_MULTI_PERFORM:
-                break
-
-        num_handles = num_urls
-        while num_handles:
-            ret = m.select(5.0)
-            if ret == -1:
-                continue
-            while 1:
-                ret, num_handles = m.perform()
-                if ret != pycurl.E_CALL_MULTI_PERFORM:
-                    break
-
         goodlist = []
         errlist = []
-        while 1:
-            num_q, ok_list, err_list = m.info_read(num_urls)
-            for c in ok_list:
-                resp = c.resp
-                del c.resp
-                resp.error = None
-                m.remove_handle(c)
-                resp.finalize(c)
-                goodlist.append(resp)
-            for c, errno, errmsg in err_list:
-                resp = c.resp
-                del c.resp
-                resp.error = (errno, errmsg)
-                m.remove_handle(c)
+        for req, resp in self.fetch():
+            if resp.error:
                 errlist.append(resp)
-            if num_q == 0:
-                break
-        m.close()
+            else:
+                goodlist.append(resp)
         return goodlist, errlist
 
+    def fetch(self, maxconnections=MAX_CONNECTIONS, maxperhost=MAX_HOST_CONNECTIONS,
+            retries=1):
+        """Fetch all of the added Request objects, yielding (request,
+        response) pairs as each one completes.
+
+        At most maxconnections requests are in progress at a time, and at
+        most maxperhost of them to any one host and port. Curl objects are
+        kept and used again, along with their open connections, and DNS
+        and TLS session caches are shared among them. A request that fails,
+        or gets a response other than 200, is queued again at the end of its
+        host's queue, until it has been tried retries times.
+        """
+        queues = {} # (host, port) -> deque of (request, tries)
+        for req in self._requests:
+            queues.setdefault((req.url.host, req.url.port), deque()).append((req, 1))
+        self._requests = []
+        ready = deque(queues) # hosts with queued requests, and room for more
+        scheduled = set(ready)
+        active = dict.fromkeys(queues, 0)
+        idle = []
+        handles = []
+        share = pycurl.CurlShare()
+        share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+        share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+        m = pycurl.CurlMulti()
+        m.setopt(pycurl.M_MAXCONNECTS, maxconnections)
+        running = 0
+        try:
+            while running or ready:
+                while ready and running < maxconnections:
+                    host = ready.popleft()
+                    scheduled.discard(host)
+                    req, tries = queues[host].popleft()
+                    if idle:
+                        c, resp = req.get_requester(idle.pop())
+                    else:
+                        c, resp = req.get_requester()
+                        c.setopt(pycurl.SHARE, share) # kept across reset()
+                        handles.append(c)
+                    c.fetched = (req, resp, tries, host)
+                    m.add_handle(c)
+                    running += 1
+                    active[host] += 1
+                    if queues[host] and active[host] < maxperhost:
+                        ready.append(host)
+                        scheduled.add(host)
+                while 1:
+                    ret, num_handles = m.perform()
+                    if ret != pycurl.E_CALL_MULTI_PERFORM:
+                        break
+                done = []
+                while 1:
+                    num_q, ok_list, err_list = m.info_read()
+                    done.extend((c, None) for c in ok_list)
+                    done.extend((c, (errno, errmsg)) for c, errno, errmsg in err_list)
+                    if num_q == 0:
+                        break
+                for c, err in done:
+                    req, resp, tries, host = c.fetched
+                    del c.fetched
+                    m.remove_handle(c)
+                    resp.error = err
+                    resp.finalize(c, close=False)
+                    idle.append(c)
+                    running -= 1
+                    active[host] -= 1
+                    queue = queues[host]
+                    retry = tries < retries and (err is not None or
+                            resp.responseline.code != 200)
+                    if retry:
+                        queue.append((req, tries + 1))
+                    if queue and host not in scheduled:
+                        ready.append(host)
+                        scheduled.add(host)
+                    if not retry:
+                        yield req, resp
+                if running and not done:
+                    if m.select(1.0) == -1:
+                        time.sleep(0.01)
+        finally:
+            for c in handles:
+                c.close()
+            m.close()
+            share.close()
+
 
 class DocumentAdapter(object):
         def __init__(self, fp):
@@ -20,7 +20,12 @@
 """
 
 import sys
+import time
+import socket
 import unittest
+import threading
+import SocketServer
+import BaseHTTPServer
 import webbrowser
 import simplejson
 from cStringIO import StringIO
@@ -41,6 +46,7 @@ from pycopia.WWW import serverconfig
 from pycopia.WWW import urllibplus
 from pycopia.WWW import useragents
 from pycopia.WWW import json
+from pycopia.WWW import client
 
 
 XHTMLFILENAME = "/tmp/testXHTML.html"
@@ -56,6 +62,44 @@ def _JsonTest(arg1):
 def thedate():
     return unicode(datetime.now())
 
+
+class _FetchHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers /<ok|fail>/<delay>/<name> after delay seconds, counting
+    requests in progress per Host header."""
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server
+        host = self.headers.get("Host")
+        with server.lock:
+            server.active[host] = server.active.get(host, 0) + 1
+            server.maxactive[host] = max(server.maxactive.get(host, 0), server.active[host])
+            server.hits[self.path] = server.hits.get(self.path, 0) + 1
+        kind, delay, name = self.path.split("/")[1:]
+        time.sleep(float(delay))
+        with server.lock: # before the response, so never counted too high.
+            server.active[host] -= 1
+        self.send_response(200 if kind == "ok" else 500)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(name)))
+        self.end_headers()
+        self.wfile.write(name)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _FetchServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ("", 0), _FetchHandler)
+        self.lock = threading.Lock()
+        self.active = {}
+        self.maxactive = {}
+        self.hits = {}
+
+
 class WWWTests(unittest.TestCase):
 
     def test_lighttpdconfig(self):
@@ -202,6 +246,54 @@ class WWWTests(unittest.TestCase):
         self.assertEqual(path, "/selftest/part1/22/")
         self.assertTrue( m.match(path))
 
+    def test_fetch_manager(self):
+        server = _FetchServer()
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            self._fetch_manager(server, server.server_address[1])
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def _fetch_manager(self, server, port):
+        def add(manager, hostnum, path):
+            manager.add_request(client.HTTPRequest(
+                    "http://127.0.0.%d:%d%s" % (hostnum, port, path)))
+        # No more than maxperhost requests to a host at a time.
+        manager = client.HTTPConnectionManager()
+        for i in range(16):
+            add(manager, i % 2 + 1, "/ok/0.05/%d" % i)
+        results = list(manager.fetch(maxconnections=8, maxperhost=2))
+        self.assertEqual(sorted(resp.body for req, resp in results),
+                sorted(str(i) for i in range(16)))
+        self.assertEqual(sorted(server.maxactive.values()), [2, 2])
+        # Responses come as they complete.
+        manager = client.HTTPConnectionManager()
+        add(manager, 1, "/ok/0.5/slow")
+        add(manager, 2, "/ok/0/fast")
+        self.assertEqual([resp.body for req, resp in manager.fetch()], ["fast", "slow"])
+        # Failed requests are tried again, up to retries times in all.
+        manager = client.HTTPConnectionManager()
+        add(manager, 1, "/fail/0/again")
+        results = list(manager.fetch(retries=3))
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0][1].responseline.code, 500)
+        self.assertEqual(server.hits["/fail/0/again"], 3)
+        # perform() sorts out the errors.
+        closed = socket.socket()
+        closed.bind(("127.0.0.1", 0))
+        closedport = closed.getsockname()[1]
+        closed.close()
+        manager = client.HTTPConnectionManager()
+        add(manager, 1, "/ok/0/good")
+        manager.add_request(client.HTTPRequest("http://127.0.0.1:%d/" % closedport))
+        good, bad = manager.perform()
+        self.assertEqual([resp.body for resp in good], ["good"])
+        self.assertEqual(len(bad), 1)
+        self.assertTrue(bad[0].error)
+
     def test_Zfetch(self):
         doc = XHTML.get_document("http://www.pycopia.net/")
         self.assertEqual(doc.title.get_text(), "Python Application Frameworks")
@@ -0,0 +1,144 @@
+#!/usr/bin/python2.7
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Benchmarks for the XML package.
+
+Usage: bench.py [-n <nodes>] [-r <runs>]
+
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import sys
+import os
+import getopt
+import io
+import shutil
+import subprocess
+import tempfile
+
+from pycopia.timelib import now
+from pycopia.XML import POM
+from pycopia import dtds
+
+
+def make_document(nodes):
+    """An XHTML report of about the given number of nodes: rows of a
+    paragraph with text, a link and a line break."""
+    doc = POM.new_document(dtds.XHTML)
+    dtd = doc.dtd
+    body = dtd.Body()
+    doc.root.append(dtd.Head())
+    doc.root.append(body)
+    count = 0
+    while count < nodes:
+        div = dtd.Div(class_="row", id="r%d" % count)
+        body.append(div)
+        p = dtd.P(title="row %d" % count)
+        div.append(p)
+        p.add_text("Result %d: <passed> & logged" % count)
+        link = dtd.A(href="/results?row=%d&page=1" % count)
+        link.add_text("details")
+        p.append(link)
+        p.append(dtd.Br())
+        count += 7
+    return doc
+
+
+def _best(func, *args):
+    times = []
+    for i in range(3):
+        start = now()
+        func(*args)
+        times.append(now() - start)
+    return min(times)
+
+
+def bench_emit(nodes):
+    doc = make_document(nodes)
+    size = len(doc.encode())
+    print("{} nodes, {:.1f} MB, best of 3".format(nodes, size / 1e6))
+    for name, func in (
+            ("encode", lambda: doc.encode()),
+            ("emit", lambda: doc.emit(io.BytesIO())),
+            ("stream", lambda: doc.stream(io.BytesIO())),
+            ):
+        elapsed = _best(func)
+        print("{:>16s}: {:8.3f} s, {:8.1f} MB/s".format(name, elapsed, size / elapsed / 1e6))
+
+
+# Run in a new interpreter: make a small page and an SVG document, and report
+# the time taken and memory used, after the base imports.
+_STARTUP = r"""
+import time
+from pycopia.XML import POM
+from pycopia import dtds
+def rss():
+    return int([line.split()[1] for line in open("/proc/self/status")
+            if line.startswith("VmRSS")][0])
+baserss = rss()
+start = time.time()
+doc = POM.new_document(dtds.XHTML)
+body = doc.dtd.Body()
+doc.root.append(body)
+body.append(doc.dtd.P(class_="note"))
+doc.encode()
+svg = POM.new_document(dtds.SVG)
+svg.root.append(svg.dtd.Circle(r="10"))
+svg.encode()
+print("%f %d" % (time.time() - start, rss() - baserss))
+"""
+
+def _startup(cachedir):
+    env = dict(os.environ, DTDCACHE=cachedir)
+    out = subprocess.check_output([sys.executable, "-c", _STARTUP], env=env)
+    elapsed, rss = out.split()
+    return float(elapsed), int(rss)
+
+
+def bench_dtdload(runs):
+    cachedir = tempfile.mkdtemp()
+    try:
+        print("XHTML and SVG documents in a new process, best of {}".format(runs))
+        for name, directory in (
+                ("full modules", os.devnull), # no tables can be kept there.
+                ("tables", cachedir),
+                ):
+            _startup(directory) # saves the tables, and warms the page cache.
+            results = [_startup(directory) for i in range(runs)]
+            print("{:>16s}: {:8.1f} ms, {:6d} kB more RSS".format(name,
+                    min(r[0] for r in results) * 1000.0, min(r[1] for r in results)))
+    finally:
+        shutil.rmtree(cachedir)
+
+
+def main(argv):
+    nodes = 100000
+    runs = 5
+    opts, args = getopt.getopt(argv[1:], "n:r:")
+    for opt, optarg in opts:
+        if opt == "-n":
+            nodes = int(optarg)
+        elif opt == "-r":
+            runs = int(optarg)
+    bench_emit(nodes)
+    bench_dtdload(runs)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
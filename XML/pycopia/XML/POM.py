@@ -248,11 +248,12 @@ class ASIS(object):
 
 # runtime attribute object
 class POMAttribute(object):
-    __slots__ = ["name", "value", "namespace"]
+    __slots__ = ["name", "value", "namespace", "_encoded"]
     def __init__(self, name, value, namespace="", encoding=DEFAULT_ENCODING):
         self.name = to_unicode(name, encoding)
         self.value = to_unicode(value, encoding)
         self.namespace = to_unicode(namespace, encoding)
+        self._encoded = None
 
     def __hash__(self):
         return hash((self.name, self.value, self.namespace))
@@ -261,9 +262,16 @@ class POMAttribute(object):
         return '%s="%s"' % (name, value)
 
     def encode(self, encoding=DEFAULT_ENCODING):
+        # The last encoding is kept, for as long as the name and value are
+        # the same objects.
+        enc = self._encoded
+        if enc is not None and enc[0] is self.name and enc[1] is self.value and enc[2] == encoding:
+            return enc[3]
         name = self.name.encode(encoding or self.encoding)
         value = escape(self.value.encode(encoding or self.encoding))
-        return b'%s="%s"' % (name, value)
+        rv = b'%s="%s"' % (name, value)
+        self._encoded = (self.name, self.value, encoding, rv, b" " + rv)
+        return rv
 
     def __repr__(self):
         return "%s(%r, %r, %r)" % (self.__class__.__name__, self.name, self.value, self.namespace)
@@ -617,6 +625,12 @@ class ElementNode(object):
             map(lambda o: o.emit(fo, enc), self._children)
             fo.write(b"</%s%s>" % (ns, name))
 
+    def stream(self, fo, encoding=None, verify=False):
+        """Write the same markup as emit(), without recursion, to fo in
+        chunks. Use emit() for a BeautifulWriter, which needs each tag in a
+        separate write."""
+        stream_emit(self, fo, encoding, verify)
+
     def validate(self, encoding=DEFAULT_ENCODING):
         ff = FakeFile(None)
         # Will raise a ValidationError if not valid.
@@ -807,6 +821,96 @@ class Fragments(ElementNode):
 
 
 
+# Streaming emitter. Plain elements and text are written by one loop over the
+# tree; any other node, or an element class that changes how it is emitted,
+# emits itself into the same buffer.
+
+CHUNKPIECES = 4096 # buffered writes per write to the file.
+
+_ELEMENT = 1
+_TEXT = 2
+_OTHER = 3
+
+_KINDS = {}
+_TAGS = {}
+
+def _node_kind(cls):
+    kind = _OTHER
+    if cls is Text:
+        kind = _TEXT
+    elif issubclass(cls, ElementNode):
+        for name in ("emit", "_get_ns", "_empty_str", "_attr_str"):
+            if getattr(cls, name).__func__ is not getattr(ElementNode, name).__func__:
+                break
+        else:
+            kind = _ELEMENT
+    _KINDS[cls] = kind
+    return kind
+
+def _node_tags(node, encoding):
+    """Return the encoded start of the start tag, the end tag, and whether
+    the element is empty, for the class and namespace of node."""
+    cls = node.__class__
+    ns = node._namespace
+    tag = ns.encode(encoding) + cls._name.encode(encoding)
+    rv = _TAGS[(cls, ns, encoding)] = (b"<" + tag, b"</" + tag + b">",
+            not cls.CONTENTMODEL or cls.CONTENTMODEL.is_empty())
+    return rv
+
+
+class _Pieces(list):
+    """Buffer that nodes with their own emit() method can write to."""
+    write = list.append
+
+
+def stream_emit(node, fo, encoding=None, verify=False):
+    """Write node, as ElementNode.emit() does, walking the tree without
+    recursion. The writes are buffered and written to fo CHUNKPIECES at a time.
+    Encoded tags are cached by class and namespace, and attributes keep their
+    last encoding.
+    """
+    enc = encoding or node._encoding
+    if verify:
+        node._verify_attributes()
+    out = _Pieces()
+    write = out.append
+    kinds = _KINDS
+    tags = _TAGS
+    stack = [(iter((node,)), b"")]
+    while stack:
+        children, endtag = stack[-1]
+        for child in children:
+            cls = child.__class__
+            kind = kinds.get(cls) or _node_kind(cls)
+            if kind is _ELEMENT:
+                start, end, empty = tags.get((cls, child._namespace, enc)) or _node_tags(child, enc)
+                write(start)
+                for attr in child._attribs.values():
+                    cached = attr._encoded
+                    if (cached is None or cached[2] != enc or cached[0] is not attr.name or
+                            cached[1] is not attr.value):
+                        attr.encode(enc)
+                        cached = attr._encoded
+                    write(cached[4]) # with the space before it
+                if empty:
+                    write(b" />")
+                else:
+                    write(b">")
+                    stack.append((iter(child._children), end))
+                    break
+            elif kind is _TEXT:
+                write(escape(child.data.encode(enc)))
+            else:
+                child.emit(out, enc)
+            if len(out) >= CHUNKPIECES:
+                fo.write(b"".join(out))
+                del out[:]
+        else:
+            stack.pop()
+            write(endtag)
+    fo.write(b"".join(out))
+
+
 class Notation(object):
     def __init__(self, name, pubid, sysid):
         self.name = name
@@ -947,6 +1051,14 @@ class POMDocument(object):
         self.root.emit(fo, encoding)
         fo.write(b"\n")
 
+    def stream(self, fo, encoding=DEFAULT_ENCODING):
+        """Write the same document as emit(), using the streaming emitter."""
+        if encoding != self.encoding:
+            self.set_encoding(encoding)
+        fo.write(self.XMLHEADER + self.DOCTYPE)
+        stream_emit(self.root, fo, encoding)
+        fo.write(b"\n")
+
     def validate(self, encoding=DEFAULT_ENCODING):
         self.root.validate(encoding)
 
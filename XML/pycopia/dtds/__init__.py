@@ -11,6 +11,10 @@ The dtds package is where compiled DTDs go.
 
 A DTD is "compiled" to Python syntax to make usage faster.
 
+When one of these modules is first imported its classes and attributes are
+also saved as a compact table in DTDCACHE. Later imports load the table
+instead, and element classes and attributes are created only when first used.
+
 """
 
 __all__ = [ "contentxml", "google", "logml", "pomtest", "rss091", "rss2", "si", "sl",
@@ -19,12 +23,18 @@ __all__ = [ "contentxml", "google", "logml", "pomtest", "rss091", "rss2", "si",
   "xhtml_basic10", "xhtml_basic11", "xhtml_mobile10", "XMLSchema",
   ]
 
+import sys
 import os
+import imp
+import marshal
+from types import ModuleType
+
 from pycopia.aid import newclass, Import
 from pycopia.XML import ValidationError
 
 # TODO get from some config.
 USERDTDPATH = os.environ.get("USERDTDPATH", os.path.join(b"/", b"var", b"tmp", b"dtds"))
+DTDCACHE = os.environ.get("DTDCACHE", os.path.join(USERDTDPATH, b"cache"))
 
 # Add user generated dtds to path to pick up user generated dtd files.
 __path__.append(USERDTDPATH)
@@ -154,3 +164,183 @@ def get_mod_file(directory, sourcefilename):
     return (os.path.join(directory.encode("ascii"), modname + b".py"),
                 DOCTYPES.get("%s.%s" % (__name__, modname)))
 
+
+### DTD tables
+# A table holds what a generated module defines: element classes, attributes,
+# notations and entities, as built-in types that marshal can save.
+
+_TABLEMAGIC = imp.get_magic() + b"DTD1"
+_CLASSATTRS = frozenset(("ATTRIBUTES", "KWATTRIBUTES", "CONTENTMODEL", "_name",
+        "__module__", "__doc__"))
+
+
+def make_table(mod):
+    """Return the table for a compiled DTD module, or None if the module has
+    something a table cannot hold."""
+    from pycopia.XML import POM
+    if isinstance(mod, DTDModule):
+        return mod._table
+    idents = dict((id(obj), name) for name, obj in vars(mod).items()
+            if isinstance(obj, POM.XMLAttribute))
+    def attrmap(cls, name):
+        amap = cls.__dict__.get(name)
+        if amap is None:
+            return None
+        return dict((key, idents[id(attr)]) for key, attr in amap.items())
+    elements = {}
+    aliases = {}
+    attributes = {}
+    notations = {}
+    for name, obj in vars(mod).items():
+        if name.startswith("__") or name in ("pycopia", "GENERAL_ENTITIES", "_CLASSCACHE"):
+            continue
+        if isinstance(obj, type) and issubclass(obj, POM.ElementNode):
+            if obj.__name__ != name:
+                aliases[name] = obj.__name__
+                continue
+            if obj.__bases__ != (POM.ElementNode,) or set(obj.__dict__) - _CLASSATTRS:
+                return None
+            try:
+                elements[name] = (obj._name, obj.CONTENTMODEL.model,
+                        attrmap(obj, "ATTRIBUTES"), attrmap(obj, "KWATTRIBUTES"))
+            except (KeyError, AttributeError): # attribute not in module, or no model
+                return None
+        elif isinstance(obj, POM.XMLAttribute):
+            if obj.a_type is object:
+                a_type = 1
+            elif type(obj.a_type) is POM.Enumeration:
+                a_type = tuple(obj.a_type)
+            else:
+                return None
+            attributes[name] = (obj.name, a_type, obj.a_decl, obj.default)
+        elif isinstance(obj, POM.Notation):
+            notations[name] = (obj.name, obj.public, obj.system)
+        else:
+            return None
+    return {"elements": elements, "aliases": aliases, "attributes": attributes,
+            "notations": notations, "entities": getattr(mod, "GENERAL_ENTITIES", {})}
+
+
+class DTDModule(ModuleType):
+    """A compiled DTD module made from its table. Element classes and
+    attributes are created when first used, and are then module attributes
+    like any other."""
+
+    def __init__(self, name, table, filename=None):
+        import pycopia.XML.POM
+        from pycopia.XML import POM
+        ModuleType.__init__(self, str(name))
+        self.__file__ = filename
+        self._table = table
+        self.pycopia = pycopia
+        self.GENERAL_ENTITIES = table["entities"]
+        self._CLASSCACHE = {}
+        for ident, (nname, pubid, sysid) in table["notations"].items():
+            setattr(self, ident, POM.Notation(nname, pubid, sysid))
+
+    def __getattr__(self, name):
+        table = self.__dict__.get("_table")
+        if table is None or name.startswith("__"):
+            raise AttributeError(name)
+        from pycopia.XML import POM
+        if name in table["elements"]:
+            elname, model, attribs, kwattribs = table["elements"][name]
+            classdict = {"__module__": self.__name__, "__doc__": None, "_name": elname,
+                    "CONTENTMODEL": POM.ContentModel(model)}
+            if attribs is not None:
+                classdict["ATTRIBUTES"] = dict((key, getattr(self, ident))
+                        for key, ident in attribs.items())
+            if kwattribs is not None:
+                classdict["KWATTRIBUTES"] = dict((key, getattr(self, ident))
+                        for key, ident in kwattribs.items())
+            value = type(str(name), (POM.ElementNode,), classdict)
+        elif name in table["attributes"]:
+            aname, a_type, a_decl, a_def = table["attributes"][name]
+            if type(a_type) is tuple:
+                a_type = POM.Enumeration(a_type)
+            value = POM.XMLAttribute(aname, a_type, a_decl, a_def)
+        elif name in table["aliases"]:
+            value = getattr(self, table["aliases"][name])
+        else:
+            raise AttributeError("DTD module %s has no attribute %r" % (self.__name__, name))
+        setattr(self, name, value)
+        return value
+
+
+def _table_file(fullname):
+    return os.path.join(DTDCACHE, fullname + b".dtdtable")
+
+def read_table(fullname, sourcefile):
+    """Return the saved table for the module, or None if there isn't one, or
+    the module source has changed since."""
+    try:
+        st = os.stat(sourcefile)
+        with open(_table_file(fullname), "rb") as fo:
+            magic, mtime, size, table = marshal.load(fo)
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+        return None
+    if magic != _TABLEMAGIC or mtime != int(st.st_mtime) or size != st.st_size:
+        return None
+    return table
+
+def write_table(fullname, sourcefile, mod):
+    """Save the table for a module, if it can have one. Errors are ignored;
+    the module is then imported in full next time."""
+    table = make_table(mod)
+    if table is None:
+        return False
+    tablefile = _table_file(fullname)
+    tmpname = "%s.%d" % (tablefile, os.getpid())
+    try:
+        st = os.stat(sourcefile)
+        data = marshal.dumps((_TABLEMAGIC, int(st.st_mtime), st.st_size, table))
+        if not os.path.isdir(DTDCACHE):
+            os.makedirs(DTDCACHE)
+        with open(tmpname, "wb") as fo:
+            fo.write(data)
+        os.rename(tmpname, tablefile)
+    except (IOError, OSError, ValueError):
+        return False
+    return True
+
+
+class DTDImporter(object):
+    """Import hook for the modules of this package. A module is made from its
+    saved table if there is one. Otherwise it is imported normally, and its
+    table saved."""
+
+    def find_module(self, fullname, path=None):
+        pkgname, dot, modname = fullname.rpartition(".")
+        if pkgname != __name__:
+            return None
+        try:
+            fo, pathname, desc = imp.find_module(modname, __path__)
+        except ImportError:
+            return None
+        if fo is not None:
+            fo.close()
+        return self
+
+    def load_module(self, fullname):
+        try:
+            return sys.modules[fullname]
+        except KeyError:
+            pass
+        modname = fullname.rpartition(".")[2]
+        fo, pathname, desc = imp.find_module(modname, __path__)
+        try:
+            table = read_table(fullname, pathname)
+            if table is not None:
+                mod = sys.modules[fullname] = DTDModule(fullname, table, pathname)
+                mod.__loader__ = self
+                return mod
+            mod = imp.load_module(fullname, fo, pathname, desc)
+        finally:
+            if fo is not None:
+                fo.close()
+        write_table(fullname, pathname, mod)
+        return mod
+
+
+if not any(isinstance(importer, DTDImporter) for importer in sys.meta_path):
+    sys.meta_path.append(DTDImporter())
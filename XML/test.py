@@ -25,6 +25,11 @@ from __future__ import unicode_literals
 from __future__ import division
 
 import sys
+import os
+import io
+import imp
+import shutil
+import tempfile
 import unittest
 
 from pycopia.XML import POM
@@ -85,6 +90,128 @@ class XMLTests(unittest.TestCase):
         doc.set_encoding("iso-8859-1")
         self.assertEqual(doc.encoding, "iso-8859-1")
 
+    def test_streamemit(self):
+        doc = POM.new_document(pycopia.dtds.XHTML)
+        dtd = doc.dtd
+        body = dtd.Body()
+        doc.root.append(dtd.Head())
+        doc.root.append(body)
+        for i in range(3):
+            div = dtd.Div(class_="row", id="r%d" % i)
+            body.append(div)
+            p = dtd.P(title='"quoted" <title>')
+            div.append(p)
+            p.add_text("Text & <stuff> %d" % i)
+            p.append(dtd.Br())
+            div.append(POM.Comment("comment %d" % i))
+            div.add_cdata("if (a < b) {}")
+            div.add_asis("<b>asis</b>")
+            frag = POM.Fragments()
+            frag.append(dtd.Hr())
+            frag.append(POM.Text("fragment"))
+            div.append(frag)
+        def check():
+            expected = io.BytesIO()
+            doc.emit(expected)
+            streamed = io.BytesIO()
+            doc.stream(streamed)
+            self.assertEqual(streamed.getvalue(), expected.getvalue())
+        check()
+        check() # with cached encodings
+        div.set_attribute("id", "changed")
+        div.class_ = "other"
+        check()
+        doc.set_encoding("iso-8859-1")
+        check()
+        # Deeper than the recursion limit.
+        node = div
+        for i in range(sys.getrecursionlimit() + 10):
+            child = dtd.Span()
+            node.append(child)
+            node = child
+        node.add_text("bottom")
+        streamed = io.BytesIO()
+        doc.root.stream(streamed, "utf-8")
+        self.assertEqual(streamed.getvalue().count(b"<span>"), sys.getrecursionlimit() + 10)
+        self.assertTrue(b"<span>bottom</span></span>" in streamed.getvalue())
+
+    def _compare_attribute(self, attr, lazyattr):
+        self.assertEqual((attr.name, attr.a_type, attr.a_decl, attr.default, attr._is_enumeration),
+                (lazyattr.name, lazyattr.a_type, lazyattr.a_decl, lazyattr.default,
+                lazyattr._is_enumeration))
+        self.assertEqual(type(attr.a_type), type(lazyattr.a_type))
+
+    def test_dtdtable(self):
+        # Compare with the full modules, not ones from saved tables.
+        for modname in pycopia.dtds.__all__ + ["html5", "svg11_flat_20030114"]:
+            fullname = "pycopia.dtds." + modname
+            fo, pathname, desc = imp.find_module(modname, pycopia.dtds.__path__)
+            try:
+                mod = imp.load_module("_fulldtd", fo, pathname, desc)
+            finally:
+                fo.close()
+                del sys.modules["_fulldtd"]
+            table = pycopia.dtds.make_table(mod)
+            self.assertTrue(table is not None, modname)
+            lazy = pycopia.dtds.DTDModule(fullname, table, mod.__file__)
+            self.assertEqual(lazy.GENERAL_ENTITIES, mod.GENERAL_ENTITIES)
+            for name, obj in vars(mod).items():
+                if isinstance(obj, type):
+                    cls = getattr(lazy, name)
+                    self.assertEqual(cls.__name__, obj.__name__)
+                    self.assertEqual(cls.__module__, fullname)
+                    self.assertEqual(cls._name, obj._name)
+                    self.assertEqual(cls.CONTENTMODEL.model, obj.CONTENTMODEL.model)
+                    for amap in ("ATTRIBUTES", "KWATTRIBUTES"):
+                        attrs = getattr(obj, amap)
+                        lazyattrs = getattr(cls, amap)
+                        self.assertEqual(sorted(attrs), sorted(lazyattrs))
+                        for key, attr in attrs.items():
+                            self._compare_attribute(attr, lazyattrs[key])
+                elif isinstance(obj, POM.XMLAttribute):
+                    self._compare_attribute(obj, getattr(lazy, name))
+                elif isinstance(obj, POM.Notation):
+                    self.assertEqual(str(obj), str(getattr(lazy, name)))
+            if hasattr(mod, "_Root"):
+                self.assertTrue(lazy._Root is getattr(lazy, mod._Root.__name__))
+            else:
+                self.assertFalse(hasattr(lazy, "_Root"))
+        self.assertRaises(AttributeError, getattr, lazy, "NoSuchElement")
+
+    def test_dtdimport(self):
+        modname = "pycopia.dtds.rss2"
+        saved = sys.modules.pop(modname, None)
+        savedcache = pycopia.dtds.DTDCACHE
+        pycopia.dtds.DTDCACHE = tempfile.mkdtemp()
+        try:
+            mod = pycopia.dtds.get_dtd_module(modname)
+            self.assertFalse(isinstance(mod, pycopia.dtds.DTDModule))
+            self.assertTrue(os.path.exists(os.path.join(pycopia.dtds.DTDCACHE,
+                    modname + ".dtdtable")))
+            del sys.modules[modname]
+            lazy = pycopia.dtds.get_dtd_module(modname)
+            self.assertTrue(isinstance(lazy, pycopia.dtds.DTDModule))
+            self.assertTrue(sys.modules[modname] is lazy)
+            self.assertFalse("Channel" in vars(lazy))
+            channel = lazy.Channel()
+            self.assertTrue(lazy.Channel is type(channel))
+            self.assertTrue(pycopia.dtds.get_class(lazy, "Channel", (lazy.Channel,)) is
+                    pycopia.dtds.get_class(lazy, "Channel", (lazy.Channel,)))
+            doc = POM.POMDocument(dtd=lazy)
+            fulldoc = POM.POMDocument(dtd=mod)
+            for d in (doc, fulldoc):
+                channel = d.dtd.Channel()
+                channel.add_text("news")
+                d.root.append(channel)
+            self.assertEqual(doc.encode(), fulldoc.encode())
+        finally:
+            shutil.rmtree(pycopia.dtds.DTDCACHE)
+            pycopia.dtds.DTDCACHE = savedcache
+            if saved is not None:
+                sys.modules[modname] = saved
+            else:
+                sys.modules.pop(modname, None)
+
 #   import dtds.xhtml1_strict
 #   doc = POMDocument(dtds.xhtml1_strict)
 #   doc.set_root(doc.get_elementnode("html")())
@@ -112,7 +112,7 @@ class CallProgram(object):
 
     def _receive(self):
         self._timed_out = 0
-        ev = self.sched.add(60, 0, self._timeout_cb, ())
+        ev = self.sched.add(60, 0, self._timeout_cb, (), interrupt=True)
         try:
             while True:
                 try:
@@ -0,0 +1,465 @@
+#!/usr/bin/python2.7
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Benchmarks for the core package.
+
+Usage: bench.py [-n <requests>] [-c <connections>] [-w <workers>]
+                [-i <idle>] [-a <active>] [-t <seconds>] [-p <processes>]
+
+The process table benchmark starts the given number of extra processes first.
+
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import sys
+import os
+import getopt
+import signal
+import struct
+import select
+import socket
+import errno
+import subprocess
+
+from pycopia import asyncio
+from pycopia.timelib import now
+from pycopia.inet import fcgi
+from pycopia.OS import procfs
+
+
+def hello_app(environ, start_response):
+    start_response("200 OK", [("Content-Type", "text/plain")])
+    return ["Hello, world!\n"]
+
+
+def start_fcgi(path, **kwargs):
+    """Run an FCGIServer on a UNIX socket in a child process."""
+    pid = os.fork()
+    if pid == 0:
+        try:
+            fcgi.FCGIServer(hello_app, bindAddress=path, **kwargs).run(timeout=0.2)
+        finally:
+            os._exit(0)
+    for i in range(100):
+        if os.path.exists(path):
+            break
+        select.select([], [], [], 0.05)
+    return pid
+
+
+def stop_fcgi(pid):
+    os.kill(pid, signal.SIGTERM)
+    os.waitpid(pid, 0)
+
+
+def _record(rtype, reqid, content=b""):
+    padding = -len(content) & 7
+    return struct.pack(fcgi.FCGI_Header, fcgi.FCGI_VERSION_1, rtype, reqid,
+            len(content), padding) + content + b"\0" * padding
+
+
+def make_request(reqid, keep):
+    params = b"".join(fcgi.encode_pair(name, value) for name, value in
+            (("REQUEST_METHOD", "GET"), ("SCRIPT_NAME", ""), ("PATH_INFO", "/"),
+            ("SERVER_NAME", "localhost"), ("SERVER_PORT", "80"),
+            ("SERVER_PROTOCOL", "HTTP/1.1")))
+    body = struct.pack(fcgi.FCGI_BeginRequestBody, fcgi.FCGI_RESPONDER,
+            fcgi.FCGI_KEEP_CONN if keep else 0)
+    return (_record(fcgi.FCGI_BEGIN_REQUEST, reqid, body) +
+            _record(fcgi.FCGI_PARAMS, reqid, params) + _record(fcgi.FCGI_PARAMS, reqid) +
+            _record(fcgi.FCGI_STDIN, reqid))
+
+
+class _Client(object):
+    """One web server connection, with up to depth requests in flight."""
+    def __init__(self, path, keep, depth):
+        self.path = path
+        self.keep = keep
+        self.depth = depth
+        self.sock = None
+        self.buf = b""
+        self.started = {} # request id -> start time
+        self.nextid = 1
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+        self.buf = b""
+
+    def send(self, count):
+        """Start up to count requests, returns the number started."""
+        n = 0
+        if not self.keep:
+            if self.started or not count:
+                return 0
+            self.connect()
+            count = 1
+        elif self.sock is None:
+            self.connect()
+        data = []
+        while n < count and len(self.started) < self.depth:
+            reqid = self.nextid
+            self.nextid = self.nextid % 65535 + 1
+            data.append(make_request(reqid, self.keep))
+            self.started[reqid] = now()
+            n += 1
+        if data:
+            self.sock.sendall(b"".join(data))
+        return n
+
+    def receive(self, latencies):
+        """Read what is available, recording completed requests."""
+        data = self.sock.recv(65536)
+        if not data:
+            raise EOFError("connection closed by server")
+        self.buf += data
+        hlen = struct.calcsize(fcgi.FCGI_Header)
+        while len(self.buf) >= hlen:
+            version, rtype, reqid, clen, plen = struct.unpack(fcgi.FCGI_Header, self.buf[:hlen])
+            if len(self.buf) < hlen + clen + plen:
+                break
+            self.buf = self.buf[hlen + clen + plen:]
+            if rtype == fcgi.FCGI_END_REQUEST:
+                latencies.append(now() - self.started.pop(reqid))
+        if not self.keep and not self.started:
+            self.sock.close()
+            self.sock = None
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+def load(path, total, connections, keep, depth):
+    """Run total requests over the given number of concurrent connections.
+    Returns (elapsed, latencies)."""
+    clients = [_Client(path, keep, depth) for i in range(connections)]
+    latencies = []
+    sent = 0
+    start = now()
+    while len(latencies) < total:
+        for client in clients:
+            sent += client.send(total - sent)
+        socks = dict((c.sock, c) for c in clients if c.sock is not None)
+        r, w, e = select.select(list(socks), [], [], 5.0)
+        if not r:
+            raise RuntimeError("server stopped responding")
+        for sock in r:
+            try:
+                socks[sock].receive(latencies)
+            except EOFError: # retired worker, send those requests again.
+                client = socks[sock]
+                client.close()
+                sent -= len(client.started)
+                client.started.clear()
+    elapsed = now() - start
+    for client in clients:
+        client.close()
+    return elapsed, latencies
+
+
+def bench_fcgi(total, connections, workers):
+    path = "/tmp/pycopia_bench_fcgi_{}".format(os.getpid())
+    for name, kwargs, keep, depth in (
+            ("fork per connection", {}, False, 1),
+            ("{} workers".format(workers), {"workers": workers}, False, 1),
+            ("{} workers, keep-conn".format(workers), {"workers": workers}, True, 1),
+            ("{} workers, mpx 8".format(workers), {"workers": workers, "multiplexed": True}, True, 8),
+            ("{} workers, recycle 1000".format(workers), {"workers": workers, "maxrequests": 1000},
+                    True, 1),
+            ):
+        n = total // 10 if not kwargs else total
+        # A worker serves one persistent connection at a time.
+        nconn = min(connections, workers) if keep else connections
+        pid = start_fcgi(path, **kwargs)
+        try:
+            elapsed, latencies = load(path, n, nconn, keep, depth)
+        finally:
+            stop_fcgi(pid)
+        latencies.sort()
+        count = len(latencies)
+        print("{:>28s}: {:6d} requests, {:8.1f} req/s, p50 {:6.2f} ms, p99 {:6.2f} ms".format(
+                name, count, count / elapsed, latencies[count // 2] * 1000,
+                latencies[count * 99 // 100] * 1000))
+
+
+class _OldPoll(asyncio.Poll):
+    """The previous Poll, which looked up the handler and tested each flag
+    per event, and called epoll_ctl on every modify, for comparison."""
+
+    def register(self, obj):
+        flags = self._getflags(obj)
+        if flags:
+            fd = obj.fileno()
+            self.pollster.register(fd, flags)
+            self.smap[fd] = obj
+
+    def modify(self, obj):
+        fd = obj.fileno()
+        if fd in self.smap:
+            flags = self._getflags(obj)
+            self.pollster.modify(fd, flags)
+
+    def unregister(self, obj):
+        fd = obj.fileno()
+        try:
+            del self.smap[fd]
+        except KeyError:
+            return
+        self.pollster.unregister(fd)
+
+    def poll(self, timeout=-1.0):
+        while 1:
+            try:
+                rl = self.pollster.poll(timeout)
+            except IOError as why:
+                if why.errno == errno.EINTR:
+                    continue
+                else:
+                    raise
+            else:
+                break
+        for fd, flags in rl:
+            try:
+                hobj = self.smap[fd]
+            except KeyError:
+                continue
+            if hobj is None:
+                self._fd_callbacks[fd]()
+                continue
+            try:
+                if (flags & asyncio.EPOLLERR):
+                    hobj.error_handler()
+                    continue
+                if (flags & asyncio.POLLNVAL):
+                    self.unregister_fd(fd)
+                    continue
+                if (flags & asyncio.EPOLLPRI):
+                    hobj.pri_handler()
+                if (flags & asyncio.EPOLLIN):
+                    hobj.read_handler()
+                if (flags & asyncio.EPOLLOUT):
+                    hobj.write_handler()
+                if (flags & asyncio.EPOLLHUP):
+                    hobj.hangup_handler()
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except:
+                ex, val, tb = sys.exc_info()
+                hobj.exception_handler(ex, val, tb)
+
+
+class _Idle(asyncio.PollerInterface):
+    """Counts read events, and reads nothing, so stays ready."""
+
+    def __init__(self, sock, counter):
+        self._sock = sock
+        self._counter = counter
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def readable(self):
+        return True
+
+    def read_handler(self):
+        self._counter[0] += 1
+
+
+class _Echo(_Idle):
+    """Sends back what it reads, in small writes as a protocol would."""
+    edgetriggered = True
+
+    def __init__(self, sock, counter, poller):
+        super(_Echo, self).__init__(sock, counter)
+        sock.setblocking(0)
+        self._poller = poller
+        self._out = asyncio.WriteQueue()
+
+    def writable(self):
+        return bool(self._out)
+
+    def read_handler(self):
+        self._counter[0] += 1
+        while True:
+            try:
+                data = self._sock.recv(4096)
+            except socket.error as err:
+                if err.errno == errno.EAGAIN:
+                    break
+                raise
+            for i in range(0, len(data), 16):
+                self._out.append(data[i:i+16])
+                self._poller.modify(self)
+            # A short read emptied the socket. More data is a new edge.
+            if len(data) < 4096:
+                break
+
+    def write_handler(self):
+        self._counter[0] += 1
+        self._out.flush(self._sock)
+        self._poller.modify(self)
+
+
+def _cputime():
+    t = os.times()
+    return t[0] + t[1]
+
+
+def bench_poll(idle, active, seconds):
+    """Events per CPU second with idle sockets and active connections. In
+    the dispatch run every active socket is always ready and its handler does
+    nothing. In the echo run connections send messages back and forth."""
+    print("{} idle sockets, {} active connections, best of 3".format(idle, active))
+    for name, pollclass, kwargs in (("old dispatch", _OldPoll, {}), ("Poll", asyncio.Poll, {}),
+            ("Poll edge", asyncio.Poll, {"edge": True})):
+        dispatch = max(_run_poll(pollclass(**kwargs), _Idle, idle, active, seconds)
+                for i in range(3))
+        echo = max(_run_poll(pollclass(**kwargs), _Echo, idle, active, seconds)
+                for i in range(3))
+        modify = max(_run_modify(pollclass(**kwargs)) for i in range(3))
+        print("{:>16s}: dispatch {:8.0f} events/s, echo {:7.0f} events/s, "
+                "modify {:8.0f} calls/s".format(name, dispatch, echo, modify))
+
+
+def _run_poll(poller, handlerclass, idle, active, seconds):
+    counter = [0]
+    socks = []
+    for i in range(idle):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        socks.append(sock)
+        poller.register(_Idle(sock, counter))
+    for i in range(active):
+        a, b = socket.socketpair()
+        socks.extend((a, b))
+        if handlerclass is _Idle:
+            poller.register(_Idle(a, counter))
+        else:
+            poller.register(_Echo(a, counter, poller))
+            poller.register(_Echo(b, counter, poller))
+        b.send(b"x" * 64)
+    end = now() + seconds
+    start = _cputime()
+    while now() < end:
+        poller.poll(1.0)
+    elapsed = _cputime() - start
+    for sock in socks:
+        sock.close()
+    poller.close()
+    return counter[0] / elapsed
+
+
+def _run_modify(poller, count=200000):
+    a, b = socket.socketpair()
+    handler = _Echo(a, [0], poller)
+    poller.register(handler)
+    start = _cputime()
+    for i in xrange(count):
+        poller.modify(handler)
+    poller.poll(0)
+    elapsed = _cputime() - start
+    a.close()
+    b.close()
+    poller.close()
+    return count / elapsed
+
+
+### process table
+
+def _old_table():
+    """The previous ProcStatTable.read, everything read for every process."""
+    rv = {}
+    for pfile in os.listdir("/proc"):
+        try:
+            pid = int(pfile)
+        except ValueError:
+            continue
+        ps = rv[pid] = procfs.ProcStat(pid)
+        if ps:
+            ps.environment, ps.ttyname
+    return rv
+
+
+def _old_pidof(procname):
+    return [ps.pid for ps in _old_table().values() if ps and ps.command == procname]
+
+
+def _best(func, *args):
+    times = []
+    for i in range(5):
+        start = now()
+        func(*args)
+        times.append(now() - start)
+    return min(times)
+
+
+def bench_procfs(processes):
+    children = [subprocess.Popen(["sleep", "600"]) for i in range(processes)]
+    try:
+        count = len(procfs.ProcSnapshot(()).read())
+        table = procfs.ProcStatTable()
+        snap = procfs.ProcSnapshot(procfs.CPU_FIELDS).read()
+        print("{} processes, best of 5".format(count))
+        for name, func in (
+                ("old table", _old_table),
+                ("ProcStatTable", table.read),
+                ("snapshot", procfs.ProcSnapshot().read),
+                ("cpu rates", lambda: procfs.ProcSnapshot(procfs.CPU_FIELDS).read().cpu_rates(snap)),
+                ("old pidof", lambda: _old_pidof("sleep")),
+                ("pidof", lambda: procfs.pidof("sleep")),
+                ):
+            print("{:>16s}: {:8.1f} ms".format(name, _best(func) * 1000.0))
+    finally:
+        for child in children:
+            child.kill()
+            child.wait()
+
+
+def main(argv):
+    total = 20000
+    connections = 16
+    workers = 4
+    idle = 10000
+    active = 1000
+    seconds = 2.0
+    processes = 0
+    opts, args = getopt.getopt(argv[1:], "n:c:w:i:a:t:p:")
+    for opt, optarg in opts:
+        if opt == "-n":
+            total = int(optarg)
+        elif opt == "-c":
+            connections = int(optarg)
+        elif opt == "-w":
+            workers = int(optarg)
+        elif opt == "-i":
+            idle = int(optarg)
+        elif opt == "-a":
+            active = int(optarg)
+        elif opt == "-t":
+            seconds = float(optarg)
+        elif opt == "-p":
+            processes = int(optarg)
+    bench_poll(idle, active, seconds)
+    bench_fcgi(total, connections, workers)
+    bench_procfs(processes)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -17,6 +17,9 @@
 """
 Access to /proc/PID file system information.
 
+ProcStat reads one process. ProcSnapshot reads all of them at once, but only
+the fields asked for, and keeps the numbers in arrays.
+
 """
 
 from __future__ import print_function
@@ -24,10 +27,12 @@ from __future__ import division
 from __future__ import unicode_literals
 
 import os
+import re
+import time
+from array import array
 from signal import SIGTERM
 
 from pycopia import textutils
-from pycopia.aid import sortedlist
 
 _CMDTRANS = textutils.maketrans("\0\n", "  ")
 
@@ -85,13 +90,13 @@ class ProcStat(object):
     "W": "paging"
     }
     _FF = "/proc/%d/stat"
+    _environment = None
+    _ttyname = None
 
     def __init__(self, pid=None):
         self.stats = None
         self.cmdline = None
         self.pid = None
-        self.ttyname = None
-        self.environment = None
         self.read(pid)
 
     def __getstate__(self):
@@ -128,12 +133,11 @@ class ProcStat(object):
         if pid is not None:
             self.pid = int(pid)
         if self.pid is not None:
+            self._environment = self._ttyname = None
             try:
                 self.stats = tuple(map(self._toint, open(self._FF % (self.pid)).read().split()))
                 self.cmdline = self.get_cmdline()
-                self.environment = self.get_environment()
                 self.uid, self.gid = self._get_uid()
-                self.ttyname = self._get_ttyname_linux()
             except IOError: # no such process
                 self.stats = None
                 self.cmdline = None
@@ -150,6 +154,30 @@ class ProcStat(object):
         self.uid = None
         self.gid = None
 
+    # The environment and tty name are costly, so are found when first used.
+    @property
+    def environment(self):
+        if self._environment is None and self.stats:
+            try:
+                self._environment = self.get_environment()
+            except IOError: # exited, or not ours to read
+                self._environment = {}
+        return self._environment
+
+    @environment.setter
+    def environment(self, env):
+        self._environment = env
+
+    @property
+    def ttyname(self):
+        if self._ttyname is None and self.stats:
+            self._ttyname = self._get_ttyname_linux()
+        return self._ttyname
+
+    @ttyname.setter
+    def ttyname(self, name):
+        self._ttyname = name
+
     def statestr(self):
         try:
             return self._STATSTR[self.stats[self._STATINDEX["state"]]]
@@ -190,52 +218,26 @@ class ProcStat(object):
 
     def get_cmdline(self):
         try:
-            cmd = open("/proc/%d/cmdline" % (self.pid,)).read()
+            cmd = _read_cmdline(self.pid)
         except IOError as err:
             self.pid = None
             return "<unknown>"
-        cmd = cmd.translate(_CMDTRANS).strip()
         if not cmd:
             return self.command
         else:
             return cmd
 
     def get_environment(self):
-        env = {}
-        rawenv = open("/proc/%d/environ" % (self.pid,)).read()
-        for line in rawenv.split("\0"):
-            if line:
-                name, value = line.split("=", 1)
-                env[name] = value
-        return env
+        return _read_environment(self.pid)
 
     def _get_ttyname_linux(self):
-        tty_nr = self["tty_nr"]
-        if tty_nr:
-            try:
-                name = os.readlink("/proc/%d/fd/0" % (self.pid))
-            except OSError:
-                minor = tty_nr & 0xff
-                major = (tty_nr >> 8) & 0xff
-                return "%d,%d" % (major, minor) # XXX
-            else:
-                return name[5:] # chop /dev
-        else:
-            return "?"
+        return _ttyname(self.pid, self["tty_nr"])
 
     def _get_uid(self):
         try:
-            statuslines = open("/proc/%d/status" % (self.pid,)).readlines()
+            return _read_ids(self.pid)
         except IOError as err:
             return 0, 0
-        uid = 0
-        gid = 0
-        for line in statuslines:
-            if line.startswith("Uid"):
-                uid = int(line[5:].split()[0])
-            elif line.startswith("Gid"):
-                gid = int(line[5:].split()[0])
-        return uid, gid
 
     def get_stat(self, name):
         if not self.stats:
@@ -288,30 +290,294 @@ class CPUMeasurer(object):
 
 
 
+def _read_cmdline(pid):
+    return open("/proc/%d/cmdline" % (pid,)).read().translate(_CMDTRANS).strip()
+
+def _read_environment(pid):
+    env = {}
+    rawenv = open("/proc/%d/environ" % (pid,)).read()
+    for line in rawenv.split("\0"):
+        if line:
+            name, value = line.split("=", 1)
+            env[name] = value
+    return env
+
+def _read_ids(pid):
+    uid = 0
+    gid = 0
+    for line in open("/proc/%d/status" % (pid,)).readlines():
+        if line.startswith("Uid"):
+            uid = int(line[5:].split()[0])
+        elif line.startswith("Gid"):
+            gid = int(line[5:].split()[0])
+    return uid, gid
+
+def _ttyname(pid, tty_nr):
+    if tty_nr:
+        try:
+            name = os.readlink("/proc/%d/fd/0" % (pid,))
+        except OSError:
+            minor = tty_nr & 0xff
+            major = (tty_nr >> 8) & 0xff
+            return "%d,%d" % (major, minor) # XXX
+        else:
+            return name[5:] # chop /dev
+    else:
+        return "?"
+
+def _split_stat(data):
+    """Split the contents of a stat file into the command name and a list of
+    the fields after it, starting with state. The command name may itself
+    hold spaces and parentheses."""
+    close = data.rindex(")")
+    return data[data.index("(") + 1:close], data[close + 2:].split()
+
+
+# The fields after the command name, by their index in the list that
+# _split_stat returns.
+_STATFIELDS = dict((name, i - 2) for name, i in ProcStat._STATINDEX.items() if i > 1)
+# Addresses, masks and limits, which may not fit a signed long.
+_UNSIGNED = frozenset(("vsize", "rlim_cur", "mm_start_code", "mm_end_code",
+        "mm_start_stack", "esp", "eip", "sig_pending", "sig_blocked", "sig_ignore",
+        "sig_catch", "wchan"))
+# Fields that take another file per process to read.
+_EXTRAFIELDS = frozenset(("cmdline", "uid", "gid"))
+_LAZYFIELDS = frozenset(("environment", "ttyname"))
+_ALLFIELDS = frozenset(ProcStat._STATINDEX) | _EXTRAFIELDS | _LAZYFIELDS
+
+SNAPSHOT_FIELDS = ("ppid", "state", "command", "tty_nr", "tms_utime", "tms_stime",
+        "start_time", "rss")
+CPU_FIELDS = ("tms_utime", "tms_stime", "start_time")
+
+
+class ProcSnapshot(object):
+    """ProcSnapshot([fields])
+All processes running at one time, with only the given fields read. The
+numeric fields of the stat file are kept in arrays, one per field, and the
+others in lists. The "cmdline", "uid" and "gid" fields take another file per
+process and are read only if asked for. Any field not read, including
+"environment" and "ttyname", is read from /proc when an entry first asks for
+it.
+    """
+    def __init__(self, fields=SNAPSHOT_FIELDS):
+        for name in fields:
+            if name not in _ALLFIELDS:
+                raise ValueError("no attribute %s" % name)
+        self.fields = tuple(fields)
+        self.timestamp = None
+        self._pids = array(b"l")
+        self._columns = {"pid": self._pids}
+        self._index = {}
+        self._entries = {}
+
+    def read(self):
+        pids = array(b"l")
+        columns = {"pid": pids}
+        statcolumns = []
+        for name in self.fields:
+            if name in columns or name in _LAZYFIELDS:
+                continue
+            if name in ("state", "cmdline"):
+                columns[name] = []
+            elif name == "command":
+                columns[name] = []
+                continue
+            elif name in _UNSIGNED:
+                columns[name] = array(b"L")
+            else:
+                columns[name] = array(b"l")
+            if name in _STATFIELDS:
+                statcolumns.append((columns[name].append, _STATFIELDS[name],
+                        str if name == "state" else int))
+        commands = columns.get("command")
+        cmdlines = columns.get("cmdline")
+        ids = "uid" in columns or "gid" in columns
+        if ids:
+            uids = columns.setdefault("uid", array(b"l"))
+            gids = columns.setdefault("gid", array(b"l"))
+        for pfile in os.listdir("/proc"):
+            if not pfile.isdigit(): # filter out non-numeric entries in /proc
+                continue
+            pid = int(pfile)
+            try:
+                command, stats = _split_stat(open("/proc/%d/stat" % (pid,)).read())
+                if cmdlines is not None:
+                    cmdline = _read_cmdline(pid) or command
+                if ids:
+                    uid, gid = _read_ids(pid)
+            except (IOError, ValueError): # exited while being read
+                continue
+            pids.append(pid)
+            for append, i, conv in statcolumns:
+                append(conv(stats[i]))
+            if commands is not None:
+                commands.append(command)
+            if cmdlines is not None:
+                cmdlines.append(cmdline)
+            if ids:
+                uids.append(uid)
+                gids.append(gid)
+        self.timestamp = time.time()
+        self._pids = pids
+        self._columns = columns
+        self._index = dict((pid, row) for row, pid in enumerate(pids))
+        self._entries = {}
+        return self
+
+    def __len__(self):
+        return len(self._pids)
+
+    def __contains__(self, pid):
+        return pid in self._index
+
+    def __getitem__(self, pid):
+        try:
+            return self._entries[pid]
+        except KeyError:
+            pass
+        entry = self._entries[pid] = ProcEntry(self, self._index[pid], pid)
+        return entry
+
+    def __iter__(self):
+        for pid in self._pids:
+            yield self[pid]
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.fields)
+
+    def pids(self):
+        return self._pids
+
+    def column(self, name):
+        """Return the array, or list, of the values of a field that was read,
+        in the same order as pids()."""
+        try:
+            return self._columns[name]
+        except KeyError:
+            raise ValueError("field %s was not read" % name)
+
+    def cpu_rates(self, previous):
+        """Return a dictionary of PID to CPU use between the previous snapshot
+        and this one, in clock ticks per second like CPUMeasurer. Both must
+        hold the CPU_FIELDS. Processes that started in between are left out.
+        """
+        elapsed = self.timestamp - previous.timestamp
+        if elapsed <= 0:
+            raise ValueError("previous snapshot is not older")
+        utime, stime, start = (self.column(name) for name in CPU_FIELDS)
+        oldutime, oldstime, oldstart = (previous.column(name) for name in CPU_FIELDS)
+        oldindex = previous._index
+        rv = {}
+        for row, pid in enumerate(self._pids):
+            old = oldindex.get(pid)
+            if old is None or oldstart[old] != start[row]: # new, or PID reused
+                continue
+            rv[pid] = ((utime[row] + stime[row]) - (oldutime[old] + oldstime[old])) / elapsed
+        return rv
+
+
+class ProcEntry(object):
+    """One process in a ProcSnapshot. Fields are attributes, and also keys so
+    that an entry can fill a format string."""
+    def __init__(self, snapshot, row, pid):
+        self._snapshot = snapshot
+        self._row = row
+        self._loaded = {}
+        self.pid = pid
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.pid)
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        column = self._snapshot._columns.get(name)
+        if column is not None:
+            return column[self._row]
+        try:
+            return self._loaded[name]
+        except KeyError:
+            pass
+        self._load(name)
+        try:
+            return self._loaded[name]
+        except KeyError:
+            raise AttributeError("no attribute %s" % name)
+
+    def __getitem__(self, name):
+        try:
+            return getattr(self, name)
+        except AttributeError as err:
+            raise KeyError(err)
+
+    def _load(self, name):
+        pid = self.pid
+        loaded = self._loaded
+        if name in _STATFIELDS or name == "command":
+            try:
+                command, stats = _split_stat(open("/proc/%d/stat" % (pid,)).read())
+            except (IOError, ValueError): # exited
+                return
+            loaded["command"] = command
+            for field, i in _STATFIELDS.items():
+                loaded[field] = stats[i] if field == "state" else int(stats[i])
+        elif name == "cmdline":
+            try:
+                loaded[name] = _read_cmdline(pid) or self.command
+            except IOError:
+                loaded[name] = "<unknown>"
+        elif name in ("uid", "gid"):
+            try:
+                loaded["uid"], loaded["gid"] = _read_ids(pid)
+            except IOError:
+                loaded["uid"], loaded["gid"] = 0, 0
+        elif name == "environment":
+            try:
+                loaded[name] = _read_environment(pid)
+            except IOError: # exited, or not ours to read
+                loaded[name] = {}
+        elif name == "ttyname":
+            loaded[name] = _ttyname(pid, self.tty_nr)
+
+    def statestr(self):
+        return ProcStat._STATSTR.get(self.state, "?")
+
+    def RSS(self):
+        return self.rss << 3
+
+
 class ProcStatTable(object):
     """ProcStatTable()
-A collection of all processes running, like the standard 'ps' command. """
+A collection of all processes running, like the standard 'ps' command. Only
+the fields named in the format are read up front. """
     def __init__(self, fmt="%(pid)6s %(ppid)6s %(ttyname)6.6s %(cmdline).55s"):
         self.fmt = fmt
-        self._ptable = None
+        self._snapshot = None
+        self._previous = None
 
     def read(self):
-        rv = self._ptable = {}
-        for pfile in os.listdir("/proc"):
-            try:
-                pid = int(pfile) # filter out non-numeric entries in /proc
-            except ValueError:
-                continue
-            rv[pid] = ProcStat(pid)
+        fields = set(name for name in re.findall(r"%\((\w+)\)", self.fmt)
+                if name in _ALLFIELDS)
+        fields.update(CPU_FIELDS)
+        self._previous = self._snapshot
+        self._snapshot = ProcSnapshot(fields).read()
+
+    def cpu_rates(self):
+        """Read the table again and return the CPU use of each process since
+        the last read, as ProcSnapshot.cpu_rates does."""
+        self.read()
+        if self._previous is None:
+            return {}
+        return self._snapshot.cpu_rates(self._previous)
 
     def __len__(self):
-        return len(self._ptable)
+        return len(self._snapshot)
 
     def __getitem__(self, pid):
-        return self._ptable[pid]
+        return self._snapshot[pid]
 
     def __iter__(self):
-        return self._ptable.itervalues()
+        return iter(self._snapshot)
 
     def __repr__(self):
         return "%s(%r)" % (self.__class__.__name__, self.fmt)
@@ -319,37 +585,24 @@ A collection of all processes running, like the standard 'ps' command. """
     def __str__(self):
         self.read()
         s = []
-        k = self._ptable.keys()
-        k.sort()
-        for pid in k:
-            s.append(self.fmt % self._ptable[pid])
+        for pid in sorted(self._snapshot.pids()):
+            s.append(self.fmt % self._snapshot[pid])
         return "\n".join(s)
 
     def tree(self):
-        class _pholder:
-            pass
         self.read()
-        if not self._ptable.has_key(0):
-            p0 = self._ptable[0] = _pholder()
-            p0.pid = p0.ppid = 0
-            p0.cmdline = "<kernel>"
-        for p in self._ptable.values():
-            try:
-                self._ptable[p.ppid]._children.append(p.pid)
-            except AttributeError: # no child list yet
-                self._ptable[p.ppid]._children = sortedlist([p.pid])
-
-        pslist = self._tree_helper(self._ptable[0], 0, [])
+        children = {}
+        for p in self._snapshot:
+            children.setdefault(p.ppid, []).append(p.pid)
+        pslist = self._tree_helper(0, "<kernel>", children, 0, [])
         return "\n".join(pslist)
 
     # recursive helper to indent according to child depth
-    def _tree_helper(self, obj, level, rv):
-        rv.append("%s%6d %.60s" % ("  "*level, obj.pid, obj.cmdline) )
-        if not hasattr(obj, "_children"):
-            return rv
-        for cpid in obj._children:
-            if cpid != obj.pid:
-                self._tree_helper(self._ptable[cpid], level+1, rv)
+    def _tree_helper(self, pid, cmdline, children, level, rv):
+        rv.append("%s%6d %.60s" % ("  "*level, pid, cmdline) )
+        for cpid in sorted(children.get(pid, ())):
+            if cpid != pid:
+                self._tree_helper(cpid, self._snapshot[cpid].cmdline, children, level+1, rv)
         return rv
 
 
@@ -357,17 +610,9 @@ A collection of all processes running, like the standard 'ps' command. """
 
 def pidof(procname):
     """pidof(procname) Returns a list of PIDs (integers) that match the given process name."""
-    rv = []
-    ps = ProcStat() # use the ProcStat object as a parser.
-    for pfile in os.listdir("/proc"):
-        try:
-            pid = int(pfile) # also filters out non-numeric entries in /proc
-        except ValueError:
-            continue
-        ps.read(pid)
-        if ps.command == procname:
-            rv.append(ps.pid)
-    return rv
+    snapshot = ProcSnapshot(("command",)).read()
+    return [pid for pid, command in zip(snapshot.pids(), snapshot.column("command"))
+            if command == procname]
 
 def ps(argv=None):
     if not argv:
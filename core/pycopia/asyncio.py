@@ -21,6 +21,7 @@ from __future__ import print_function
 
 import sys, os
 import select, signal, fcntl, struct
+
 # the only signal module function that is exposed here. The rest are wrapped by
 # Poll.
 pause = signal.pause
@@ -30,16 +31,25 @@ EPOLLHUP = select.EPOLLHUP
 EPOLLIN = select.EPOLLIN
 EPOLLOUT = select.EPOLLOUT
 EPOLLPRI = select.EPOLLPRI
-# These are not implemented here
-#EPOLLET = select.EPOLLET
+EPOLLET = select.EPOLLET
+# This is not implemented here
 #EPOLLONESHOT = select.EPOLLONESHOT
 
 POLLNVAL = select.POLLNVAL
 
-from errno import EINTR
+from collections import deque
+from errno import EINTR, EAGAIN, EWOULDBLOCK
 
 from pycopia.aid import NULL
 
+try:
+    from pycopia import fdio
+except ImportError:
+    fdio = None
+
+if sys.version_info.major == 3:
+    unicode = str
+
 
 class AsyncIOException(Exception):
     pass
@@ -52,6 +62,9 @@ class UnregisterFDNow(AsyncIOException):
     def __init__(self, fd):
         self.filedescriptor = fd
 
+class LineTooLongError(AsyncIOException):
+    pass
+
 # fix up the os module to include more Linux/BSD constants.
 os.ACCMODE = 3
 # flag for ASYNC I/O support. Note cygwin/win32 does not support it.
@@ -71,16 +84,44 @@ except AttributeError:
 FIONREAD = TIOCINQ = SIOCINQ = 0x541B
 TIOCOUTQ = SIOCOUTQ = 0x5411
 
+def _handler(obj, name):
+    """Return the named handler of obj. Objects need not provide all of
+    the interface, so a missing one is looked up when it is called."""
+    try:
+        return getattr(obj, name)
+    except AttributeError:
+        return lambda *args: getattr(obj, name)(*args)
+
+
 class Poll(object):
     """Object oriented interface to epoll.
 
     Register objects that implement the PollerInterface in the singleton instance.
+
+    The handler methods of each registered object are looked up once, when
+    it is registered. A plain read or write event calls the handler directly.
+    The interest flags last given to epoll are kept, so modify() costs a
+    system call only when they change.
+
+    With edge=True, modify() only marks the object, and the marked objects
+    have their flags updated once, before the next wait. Objects with a true
+    edgetriggered attribute are then registered edge triggered. Their
+    read_handler must read until the descriptor would block. Other objects
+    remain level triggered.
+
+    At most maxevents events are taken from epoll per poll.
     """
-    def __init__(self):
+    def __init__(self, edge=False, maxevents=1024):
         self.smap = {}
+        self.edge = edge
+        self.maxevents = maxevents
         self._fd_callbacks = {}
+        self._dispatch = {}
+        self._flags = {}
+        self._dirty = set()
         self._idle_callbacks = {}
         self._idle_handle = 0
+        self._timers = None
         self.pollster = select.epoll()
         self.closed = False
         fd = self.pollster.fileno()
@@ -103,17 +144,44 @@ class Poll(object):
         flags = self._getflags(obj)
         if flags:
             fd = obj.fileno()
+            if self.edge and getattr(obj, "edgetriggered", False):
+                flags |= EPOLLET
             self.pollster.register(fd, flags)
             self.smap[fd] = obj
+            self._flags[fd] = flags
+            self._dispatch[fd] = (obj.read_handler, obj.write_handler,
+                    self._make_dispatch(fd, obj), _handler(obj, "exception_handler"))
 
     def is_registered(self, obj):
         return obj.fileno() in self.smap
 
     def modify(self, obj):
         fd = obj.fileno()
-        if fd in self.smap:
-            flags = self._getflags(obj)
+        try:
+            oldflags = self._flags[fd]
+        except KeyError:
+            return
+        if self.edge:
+            self._dirty.add(fd)
+            return
+        flags = self._getflags(obj) | (oldflags & EPOLLET)
+        if flags != oldflags:
             self.pollster.modify(fd, flags)
+            self._flags[fd] = flags
+
+    def _update_dirty(self):
+        dirty = self._dirty
+        smap = self.smap
+        allflags = self._flags
+        while dirty:
+            fd = dirty.pop()
+            obj = smap.get(fd)
+            if obj is not None:
+                oldflags = allflags[fd]
+                flags = self._getflags(obj) | (oldflags & EPOLLET)
+                if flags != oldflags:
+                    self.pollster.modify(fd, flags)
+                    allflags[fd] = flags
 
     def unregister(self, obj):
         fd = obj.fileno()
@@ -121,15 +189,22 @@ class Poll(object):
             del self.smap[fd]
         except KeyError:
             return
+        self._forget(fd)
         try:
             self.pollster.unregister(fd)
         except IOError:
             print("unregister of inactive fd:", fd, file=sys.stderr)
 
+    def _forget(self, fd):
+        self._dispatch.pop(fd, None)
+        self._flags.pop(fd, None)
+        self._dirty.discard(fd)
+
     def register_fd(self, fd, flags, callback):
         self.pollster.register(fd, flags)
         self.smap[fd] = None
         self._fd_callbacks[fd] = callback
+        self._dispatch[fd] = (callback, callback, lambda flags: callback(), None)
 
     def is_registered_fd(self, fd):
         return fd in self._fd_callbacks
@@ -140,6 +215,8 @@ class Poll(object):
         except KeyError:
             pass
         else:
+            self._forget(fd)
+            self._fd_callbacks.pop(fd, None)
             self.pollster.unregister(fd)
             return True
         try:
@@ -147,6 +224,7 @@ class Poll(object):
         except KeyError:
             pass
         else:
+            self._forget(fd)
             self.pollster.unregister(fd)
             return True
         return False
@@ -167,10 +245,23 @@ class Poll(object):
         for callback in self._idle_callbacks.values():
             callback()
 
+    def set_timers(self, timers):
+        """Run timed events from poll. The timers object, a
+        pycopia.scheduler.Scheduler, shortens the poll timeout to its next
+        event with poll_timeout(), and runs due events with run_timers(). Use
+        None to remove it."""
+        self._timers = timers
+
     def poll(self, timeout=-1.0):
+        timers = self._timers
+        if self._dirty:
+            self._update_dirty()
         while 1:
             try:
-                rl = self.pollster.poll(timeout)
+                if timers is None:
+                    rl = self.pollster.poll(timeout, self.maxevents)
+                else:
+                    rl = self.pollster.poll(timers.poll_timeout(timeout), self.maxevents)
             except IOError as why:
                 if why.errno == EINTR:
                     self._run_idle()
@@ -179,29 +270,59 @@ class Poll(object):
                     raise
             else:
                 break
+        getentry = self._dispatch.get
         for fd, flags in rl:
-            try:
-                hobj = self.smap[fd]
-            except KeyError: # this should never happen, but let's be safe.
+            entry = getentry(fd)
+            if entry is None: # unregistered by an earlier handler in this batch.
                 continue
-            if hobj is None: # signals simple callback
-                self._fd_callbacks[fd]()
+            if flags == EPOLLIN:
+                handler = entry[0]
+            elif flags == EPOLLOUT:
+                handler = entry[1]
+            else:
+                entry[2](flags)
                 continue
+            try:
+                handler()
+            except UnregisterNow as unr:
+                self.unregister(unr.obj)
+            except UnregisterFDNow as unr:
+                self.unregister_fd(unr.filedescriptor)
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except:
+                if entry[3] is None: # fd callbacks handle their own.
+                    raise
+                ex, val, tb = sys.exc_info()
+                entry[3](ex, val, tb)
+        if timers is not None:
+            timers.run_timers()
+
+    def _make_dispatch(self, fd, hobj):
+        """Make the function that handles any mix of events for a registered
+        object."""
+        error_handler = _handler(hobj, "error_handler")
+        pri_handler = _handler(hobj, "pri_handler")
+        read_handler = hobj.read_handler
+        write_handler = hobj.write_handler
+        hangup_handler = _handler(hobj, "hangup_handler")
+        exception_handler = _handler(hobj, "exception_handler")
+        def dispatch(flags):
             try:
                 if (flags & EPOLLERR):
-                    hobj.error_handler()
-                    continue
+                    error_handler()
+                    return
                 if (flags & POLLNVAL):
                     self.unregister_fd(fd)
-                    continue
+                    return
                 if (flags & EPOLLPRI):
-                    hobj.pri_handler()
+                    pri_handler()
                 if (flags & EPOLLIN):
-                    hobj.read_handler()
+                    read_handler()
                 if (flags & EPOLLOUT):
-                    hobj.write_handler()
+                    write_handler()
                 if (flags & EPOLLHUP):
-                    hobj.hangup_handler()
+                    hangup_handler()
             except UnregisterNow as unr:
                 self.unregister(unr.obj)
             except UnregisterFDNow as unr:
@@ -210,18 +331,21 @@ class Poll(object):
                 raise
             except:
                 ex, val, tb = sys.exc_info()
-                hobj.exception_handler(ex, val, tb)
+                exception_handler(ex, val, tb)
+        return dispatch
 
     def loop(self, timeout=5.0, callback=NULL):
-        while self.smap:
+        while self.smap or self._timers:
             self.poll(timeout)
             self._run_idle()
             callback(self)
 
     def unregister_all(self):
         for obj in self.smap.values():
-            self.unregister(obj)
-        self._fd_callbacks = {}
+            if obj is not None:
+                self.unregister(obj)
+        for fd in self._fd_callbacks.keys():
+            self.unregister_fd(fd)
         self._idle_callbacks = {}
 
     clear = unregister_all
@@ -268,6 +392,9 @@ class Poll(object):
 # Mixin for objects that only want to define a few methods for a class
 # that the Poll object needs.
 class PollerInterface(object):
+    # Set true if read_handler reads until the descriptor would block, so
+    # that a Poll in edge mode may use edge triggered events.
+    edgetriggered = False
 
     def fileno(self):
         return -1
@@ -392,6 +519,197 @@ def unregister_asyncio(obj):
 unregister = unregister_asyncio
 
 
+class _FileRegion(object):
+    __slots__ = ("fo", "offset", "count")
+
+    def __init__(self, fo, offset, count):
+        self.fo = fo
+        self.offset = offset
+        self.count = count
+
+
+class WriteQueue(object):
+    """Output waiting to go out on a non-blocking socket.
+
+    Data is queued as memoryviews, not copied, so a bytearray must not be
+    changed after it is queued. A flush writes as many queued buffers as the
+    socket will take with one writev(2), and sends queued file regions with
+    sendfile(2). Without the fdio extension it falls back to send().
+    """
+    def __init__(self):
+        self._queue = deque()
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def append(self, data):
+        """Queue data. Text is encoded with the default encoding first."""
+        if data:
+            if isinstance(data, unicode):
+                data = data.encode()
+            self._queue.append(memoryview(data))
+            self._size += len(data)
+
+    def append_file(self, fo, offset=0, count=None):
+        """Queue count bytes of the open file fo, starting at offset, to be
+        sent without reading it into memory. The default is the rest of the
+        file. The file is not closed.
+        """
+        if count is None:
+            count = os.fstat(fo.fileno()).st_size - offset
+        if count > 0:
+            self._queue.append(_FileRegion(fo, offset, count))
+            self._size += count
+
+    def clear(self):
+        self._queue.clear()
+        self._size = 0
+
+    def flush(self, sock):
+        """Write as much as sock will take without blocking. Returns the
+        number of bytes written."""
+        queue = self._queue
+        total = 0
+        while queue:
+            head = queue[0]
+            try:
+                if type(head) is _FileRegion:
+                    wanted = head.count
+                    writ = self._send_region(sock, head)
+                else:
+                    bufs = []
+                    wanted = 0
+                    for buf in queue:
+                        if type(buf) is _FileRegion or len(bufs) == _IOVMAX:
+                            break
+                        bufs.append(buf)
+                        wanted += len(buf)
+                    writ = self._send_buffers(sock, bufs)
+                    self._consume(writ)
+            except EnvironmentError as err:
+                if err.errno in (EAGAIN, EWOULDBLOCK, EINTR):
+                    break
+                raise
+            self._size -= writ
+            total += writ
+            if writ < wanted:
+                break
+        return total
+
+    def _send_buffers(self, sock, bufs):
+        if fdio is None:
+            return sock.send(bufs[0])
+        return fdio.writev(sock.fileno(), bufs)
+
+    def _send_region(self, sock, region):
+        if _sendfile is not None:
+            writ = _sendfile(sock.fileno(), region.fo.fileno(), region.offset, region.count)
+        else:
+            fd = region.fo.fileno()
+            pos = os.lseek(fd, 0, 1)
+            os.lseek(fd, region.offset, 0)
+            try:
+                writ = sock.send(os.read(fd, min(region.count, 65536)))
+            finally:
+                os.lseek(fd, pos, 0)
+        if not writ:
+            raise IOError("File truncated while sending: {!r}".format(region.fo))
+        region.offset += writ
+        region.count -= writ
+        if not region.count:
+            self._queue.popleft()
+        return writ
+
+    def _consume(self, writ):
+        queue = self._queue
+        while writ:
+            buf = queue[0]
+            if writ < len(buf):
+                queue[0] = buf[writ:]
+                break
+            queue.popleft()
+            writ -= len(buf)
+
+_IOVMAX = 1 if fdio is None else fdio.IOVMAX
+_sendfile = getattr(fdio, "sendfile", None)
+
+# Longest line a ReceiveBuffer holds, by default.
+MAX_LINE = 1 << 20
+
+
+class ReceiveBuffer(object):
+    """Reusable input buffer for a non-blocking socket.
+
+    Data is received straight into a bytearray that is kept for the life of
+    the connection, and handed out by line or by size. If a write function
+    is given the buffer can also be used as the iostream of a Protocol.
+    The buffer grows to hold a long line, up to maxline bytes.
+    """
+    def __init__(self, size=65536, write=None, maxline=MAX_LINE):
+        self._buf = bytearray(min(size, maxline))
+        self._start = self._end = 0
+        self.maxline = maxline
+        self.eof = False
+        if write is not None:
+            self.write = write
+
+    def __len__(self):
+        return self._end - self._start
+
+    def fill(self, sock):
+        """Receive what is available from sock. Returns the number of bytes
+        read, zero at end of file, or None if nothing was ready. Raises
+        LineTooLongError if the buffer is full of one line already."""
+        buf = self._buf
+        if self._start == self._end:
+            self._start = self._end = 0
+        elif self._end == len(buf):
+            if self._start:
+                buf[:self._end - self._start] = buf[self._start:self._end]
+                self._end -= self._start
+                self._start = 0
+            else: # a line longer than the buffer.
+                if len(buf) >= self.maxline:
+                    raise LineTooLongError("No end of line in {} bytes.".format(len(buf)))
+                buf.extend(bytearray(min(len(buf), self.maxline - len(buf))))
+        try:
+            count = sock.recv_into(memoryview(buf)[self._end:])
+        except EnvironmentError as err:
+            if err.errno in (EAGAIN, EWOULDBLOCK, EINTR):
+                return None
+            raise
+        if count:
+            self._end += count
+        else:
+            self.eof = True
+        return count
+
+    def hasline(self):
+        return self._buf.find(b"\n", self._start, self._end) >= 0
+
+    def readline(self):
+        """Return the next complete line, or an empty string if there is
+        none yet. At end of file the remaining data is returned."""
+        i = self._buf.find(b"\n", self._start, self._end)
+        if i < 0:
+            if not self.eof:
+                return b""
+            i = self._end - 1
+        return self._take(i + 1)
+
+    def read(self, size=-1):
+        """Return up to size bytes of what has been received."""
+        if size < 0:
+            return self._take(self._end)
+        return self._take(min(self._end, self._start + size))
+
+    def _take(self, end):
+        data = memoryview(self._buf)[self._start:end].tobytes()
+        self._start = end
+        return data
+
+
 # Socket protocol handlers
 
 CLOSED = 0
@@ -439,7 +757,7 @@ class AsyncWorkerHandler(PollerInterface):
         self._sock = sock
         self._rem_address = addr
         self._state = CONNECTED
-        self._buf = ""
+        self._buf = WriteQueue()
         self.initialize()
 
     def fileno(self):
@@ -456,10 +774,15 @@ class AsyncWorkerHandler(PollerInterface):
     closed = property(lambda self: self._state == CLOSED)
 
     def write(self, data):
-        self._buf += data
+        self._buf.append(data)
         poller.modify(self)
         return len(data)
 
+    def sendfile(self, fo, offset=0, count=None):
+        """Send part or all of an open file, without reading it in."""
+        self._buf.append_file(fo, offset, count)
+        poller.modify(self)
+
     def inq(self):
         """How many bytes are still in the kernel's input buffer?"""
         return struct.unpack("I", fcntl.ioctl(self._sock.fileno(), SIOCINQ, '\0\0\0\0'))[0]
@@ -486,8 +809,7 @@ class AsyncWorkerHandler(PollerInterface):
         poller.unregister(self)
 
     def write_handler(self):
-        writ = self._sock.send(self._buf)
-        self._buf = self._buf[writ:]
+        self._buf.flush(self._sock)
         poller.modify(self)
 
     ###### overrideable async interface  ####
@@ -510,7 +832,7 @@ class AsyncClientHandler(PollerInterface):
         self._sock = sock
         self._rem_address = addr
         self._state = CONNECTED
-        self._buf = ""
+        self._buf = WriteQueue()
         self.initialize()
         poller.register(self)
 
@@ -528,7 +850,7 @@ class AsyncClientHandler(PollerInterface):
     closed = property(lambda self: self._state == CLOSED)
 
     def write(self, data):
-        self._buf += data
+        self._buf.append(data)
         poller.modify(self)
         return len(data)
 
@@ -542,8 +864,7 @@ class AsyncClientHandler(PollerInterface):
         return self._state == CONNECTED
 
     def write_handler(self):
-        writ = self._sock.send(self._buf)
-        self._buf = self._buf[writ:]
+        self._buf.flush(self._sock)
         poller.modify(self)
 
     def hangup_handler(self):
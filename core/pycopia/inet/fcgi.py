@@ -50,6 +50,12 @@ Example usage:
 
 See the documentation for FCGIServer/Server for more information.
 
+By default a new process is forked for each connection from the web server.
+For high request rates use a pool of long lived worker processes instead:
+
+  FCGIServer(app, bindAddress=("127.0.0.1", 9000), workers=8,
+          maxrequests=10000, multiplexed=True).run()
+
 On most platforms, fcgi will fallback to regular CGI behavior if run in a
 non-FastCGI context. If you want to force CGI behavior, set the environment
 variable FCGI_FORCE_CGI to "Y" or "y".
@@ -127,7 +133,7 @@ if __debug__:
     import time
 
     # Set non-zero to write debug output to a file.
-    DEBUG = 10
+    DEBUG = 0
     DEBUGLOG = '/var/tmp/fcgi.log'
 
     def _debug(level, msg):
@@ -515,11 +521,10 @@ class Record(object):
         header = struct.pack(FCGI_Header, self.version, self.type,
                              self.requestId, self.contentLength,
                              self.paddingLength)
-        self._sendall(sock, header)
-        if self.contentLength:
-            self._sendall(sock, self.contentData)
-        if self.paddingLength:
-            self._sendall(sock, '\x00'*self.paddingLength)
+        # One send per record, rather than one each for header, content
+        # and padding.
+        self._sendall(sock, header + self.contentData[:self.contentLength] +
+                '\x00'*self.paddingLength)
 
 
 class Request(object):
@@ -585,6 +590,7 @@ class Connection(object):
         self._sock = sock
         self._addr = addr
         self.server = server
+        self._multiplexed = server.multiplexed
 
         # Active Requests for this Connection, mapped by request ID.
         self._requests = {}
@@ -634,6 +640,9 @@ class Connection(object):
                 raise EOFError
             if r: 
                 break
+            if not self.server._keepGoing and not self._requests:
+                # A pool worker told to stop, close an idle connection.
+                self._keepGoing = False
         if not self._keepGoing:
             return
         rec = Record()
@@ -681,10 +690,13 @@ class Connection(object):
 
         if remove:
             del self._requests[req.requestId]
+            retire = self.server.request_done()
+        else:
+            retire = False
 
         if __debug__: _debug(2, 'end_request: flags = %d' % req.flags)
 
-        if not (req.flags & FCGI_KEEP_CONN) and not self._requests:
+        if (retire or not (req.flags & FCGI_KEEP_CONN)) and not self._requests:
             self._cleanupSocket()
             self._keepGoing = False
 
@@ -709,6 +721,7 @@ class Connection(object):
         req = Request(self, self._inputStreamClass)
         req.requestId, req.role, req.flags = inrec.requestId, role, flags
         req.aborted = False
+        req.paramsDone = False
 
         if not self._multiplexed and self._requests:
             # Can't multiplex requests.
@@ -731,6 +744,9 @@ class Connection(object):
         Handle an FCGI_PARAMS Record.
 
         If the last FCGI_PARAMS Record is received, start the request.
+        A multiplexed connection waits for the end of FCGI_STDIN as well,
+        so that a request never blocks reading input interleaved with
+        other requests.
         """
         req = self._requests.get(inrec.requestId)
         if req is not None:
@@ -740,13 +756,17 @@ class Connection(object):
                     pos, (name, value) = decode_pair(inrec.contentData, pos)
                     req.params[name] = value
             else:
-                req.run()
+                req.paramsDone = True
+                if not self._multiplexed or req.stdin._eof:
+                    req.run()
 
     def _do_stdin(self, inrec):
         """Handle the FCGI_STDIN stream."""
         req = self._requests.get(inrec.requestId)
         if req is not None:
             req.stdin.add_data(inrec.contentData)
+            if self._multiplexed and not inrec.contentLength and req.paramsDone:
+                req.run()
 
     def _do_data(self, inrec):
         """Handle the FCGI_DATA stream."""
@@ -759,7 +779,7 @@ class Connection(object):
         outrec = Record(FCGI_UNKNOWN_TYPE)
         outrec.contentData = struct.pack(FCGI_UnknownTypeBody, inrec.type)
         outrec.contentLength = FCGI_UnknownTypeBody_LEN
-        self.writeRecord(rec)
+        self.writeRecord(outrec)
 
 
 
@@ -799,7 +819,7 @@ class FCGIServer(object):
 
     def __init__(self, application, procmanager=None, errorhandler=None, 
             environ=None, maxwrite=8192, bindAddress=None, umask=None, 
-            idle=NULL, debug=False):
+            idle=NULL, debug=False, workers=0, maxrequests=0, multiplexed=False):
         """
 
         environ, if present, must be a dictionary-like object. Its
@@ -819,10 +839,26 @@ class FCGIServer(object):
         is the interface name/IP to bind to, and the second element (an int)
         is the port number.
 
+        workers, if non-zero, runs that many long lived worker processes that
+        all accept connections on the listening socket, instead of forking a
+        process per connection. A worker that dies is replaced. If
+        maxrequests is non-zero a worker exits, and is replaced, after
+        handling that many requests.
+
+        multiplexed allows the web server to send more than one request at a
+        time on a connection. They are run in the order their input completes.
+
         """
         self.application = application # the WSGI application
         self.error_handler = errorhandler or DefaultErrorHandler # error handler
-        self._procmanager = procmanager or ProcessManager()
+        self.workers = workers
+        self.maxrequests = maxrequests
+        self.multiplexed = multiplexed
+        self._served = 0
+        if workers:
+            self._procmanager = None
+        else:
+            self._procmanager = procmanager or ProcessManager()
         self._idle_cb = idle # called in select loop when idle
         self.environ = environ or {}
         self.maxwrite = maxwrite
@@ -832,7 +868,7 @@ class FCGIServer(object):
         self.capability = {
             FCGI_MAX_CONNS: MAXCONNS,
             FCGI_MAX_REQS: MAXCONNS,
-            FCGI_MPXS_CONNS: 0
+            FCGI_MPXS_CONNS: int(bool(multiplexed))
             }
 
     def _setupSocket(self):
@@ -915,6 +951,16 @@ class FCGIServer(object):
         # Install signal handlers.
         self._installSignalHandlers()
 
+        if self.workers:
+            self._run_workers(sock, timeout)
+        else:
+            self._run_forking(sock, timeout, web_server_addrs)
+        # Restore signal handlers.
+        self._restoreSignalHandlers()
+        self._cleanupSocket(sock)
+        return self._hupReceived
+
+    def _run_forking(self, sock, timeout, web_server_addrs):
         while self._keepGoing:
             try:
                 r, w, e = select.select([sock], [], [], timeout)
@@ -943,10 +989,78 @@ class FCGIServer(object):
                     self._procmanager(conn.run)
 
             self._idle_cb()
-        # Restore signal handlers.
-        self._restoreSignalHandlers()
-        self._cleanupSocket(sock)
-        return self._hupReceived
+
+    def _run_workers(self, sock, timeout):
+        """Keep the pool of worker processes running until told to stop."""
+        from pycopia import proctools
+        pm = proctools.get_procmanager()
+        sock.setblocking(0) # workers race to accept, losers get EAGAIN.
+        workers = []
+        while self._keepGoing:
+            for proc in workers[:]:
+                if proc.exitstatus is not None:
+                    workers.remove(proc)
+            while len(workers) < self.workers and self._keepGoing:
+                workers.append(pm.submethod(self._worker, (sock, timeout)))
+            try:
+                select.select([], [], [], timeout)
+            except select.error, e:
+                if e[0] != errno.EINTR:
+                    raise
+            self._idle_cb()
+        for proc in workers:
+            if proc.exitstatus is None:
+                try:
+                    os.kill(proc.childpid, signal.SIGTERM)
+                except OSError:
+                    pass
+        for proc in workers:
+            proc.wait()
+
+    def _worker(self, sock, timeout):
+        """Body of a worker process. Accepts and runs connections until
+        signalled, or it has handled maxrequests requests."""
+        parent = os.getppid()
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.signal(signal.SIGHUP, self._intHandler)
+        signal.signal(signal.SIGINT, self._intHandler)
+        signal.signal(signal.SIGTERM, self._intHandler)
+        web_server_addrs = os.environ.get('FCGI_WEB_SERVER_ADDRS')
+        if web_server_addrs is not None:
+            web_server_addrs = [x.strip() for x in web_server_addrs.split(',')]
+        self._served = 0
+        while self._keepGoing:
+            try:
+                r, w, e = select.select([sock], [], [], timeout)
+            except select.error, e:
+                if e[0] == errno.EINTR:
+                    continue
+                raise
+            if not r:
+                if os.getppid() != parent: # orphaned, the pool is gone.
+                    break
+                continue
+            try:
+                clientSock, addr = sock.accept()
+            except socket.error, e:
+                if e[0] in (errno.EINTR, errno.EAGAIN):
+                    continue
+                raise
+            if web_server_addrs and \
+                   (len(addr) != 2 or addr[0] not in web_server_addrs):
+                clientSock.close()
+                continue
+            clientSock.setblocking(1)
+            Connection(clientSock, addr, self).run()
+        return 0
+
+    def request_done(self):
+        """Called by a Connection as each request ends. Returns True when
+        this process should stop taking requests."""
+        self._served += 1
+        if self.maxrequests and self._served >= self.maxrequests:
+            self._keepGoing = False
+        return self.workers and not self._keepGoing
 
     def _exit(self, reload=False):
         """
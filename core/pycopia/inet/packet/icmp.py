@@ -59,13 +59,13 @@ class Packet:
 						  self.id, self.seq)
 
 	def assemble(self, cksum=1):
-		idseq = struct.pack('hh', self.id, self.seq)
+		idseq = struct.pack('HH', self.id, self.seq)
 		packet = chr(self.type) + chr(self.code) + '\000\000' + idseq \
 			 + self.data
 		if cksum:
 			self.cksum = inet.cksum(packet)
 			packet = chr(self.type) + chr(self.code) \
-				 + struct.pack('h', self.cksum) + idseq + self.data
+				 + struct.pack('H', self.cksum) + idseq + self.data
 		# Don't need to do any byte-swapping, because idseq is
 		# appplication defined and others are single byte values.
 		self.__packet = packet
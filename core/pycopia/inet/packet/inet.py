@@ -14,15 +14,10 @@ from socket import htons, ntohs
 def cksum(s):
 	if len(s) & 1:
 		s = s + '\0'
-	words = array.array('h', s)
-	sum = 0
-	for word in words:
-		sum = sum + (word & 0xffff)
-		hi = sum >> 16
-		lo = sum & 0xffff
-		sum = hi + lo
-		sum = sum + (sum >> 16)
-	return (~sum) & 0xffff
+	total = sum(array.array('H', s))
+	while total >> 16:
+		total = (total & 0xffff) + (total >> 16)
+	return (~total) & 0xffff
 
 # Should generalize from the *h2net patterns
 
@@ -265,6 +265,7 @@ class Telnet(object):
             self._q = ''
             self._qi = 0
         return d
+    read1 = read # already returns only what is available
 
     def _fill_rawq(self, n=256):
         if self._irawq >= len(self._rawq):
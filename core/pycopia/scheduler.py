@@ -15,10 +15,26 @@
 # limitations under the License.
 
 """
-A library for scheduling callback functions using SIGALRM. When used,
-this module "owns" SIGALRM, and all timing functions associated with it.
-This means that you should not use the stock time.sleep() function when
-using this module.  Instead, use get_scheduler().sleep(x) to sleep.
+A library for scheduling callback functions. Events are kept in binary heaps
+ordered by absolute deadline on the monotonic clock, so adding and removing
+an event is O(log n) and only events that are due are touched.
+
+By default the scheduler uses SIGALRM, and when used this module "owns"
+SIGALRM, and all timing functions associated with it. This means that you
+should not use the stock time.sleep() function when using this module.
+Instead, use get_scheduler().sleep(x) to sleep.
+
+A program built around a pycopia.asyncio.Poll loop should attach the
+scheduler to it:
+
+    sched = get_scheduler()
+    sched.attach(asyncio.poller)
+    asyncio.poller.loop()
+
+Then events run from the poll timeout, not from a signal handler, and large
+numbers of pending events are cheap. Only the timeout() and iotimeout()
+wrappers, and events added with interrupt=True, still use SIGALRM, since
+their job is to interrupt a blocking call.
 
 """
 from __future__ import print_function
@@ -26,7 +42,9 @@ from __future__ import unicode_literals
 from __future__ import division
 
 import signal
+import itertools
 from errno import EINTR
+from heapq import heappop, heappush, heapify
 
 from pycopia import itimer
 alarm = itimer.alarm # allows subsecond precision using floats
@@ -37,29 +55,34 @@ __all__ = ["get_scheduler"]
 # Save a function call by making a simple reference.
 sleep = itimer.nanosleep
 
-def insort(a, x, lo=0, hi=None):
-    if hi is None:
-        hi = len(a)
-    while lo < hi:
-        mid = (lo+hi) // 2
-        if x < a[mid]:
-            hi = mid
-        else:
-            lo = mid+1
-    a.insert(lo, x)
-    return lo
+def now():
+    return itimer.gettime(itimer.CLOCK_MONOTONIC)
+
+# the alarm is never set for less than this, since zero disables it.
+MINDELAY = 0.0001
+
 
 class TimeoutError(Exception):
     pass
 
 class _Event(object):
-    def __init__(self, delay, callback, args, kwargs, repeat):
-        self.delay = delay # tracks actual delay needed
+    def __init__(self, delay, callback, args, kwargs, repeat, interrupt=False):
         self.interval = delay # set interval
         self.callback = callback
         self.args = args
         self.kwargs = kwargs
         self.repeat = repeat
+        self.interrupt = interrupt
+        self.deadline = None # absolute, on the monotonic clock, while queued.
+        self._seq = None
+        self._queue = None
+
+    def _get_delay(self):
+        if self.deadline is None:
+            return self.interval
+        return max(0.0, self.deadline - now())
+
+    delay = property(_get_delay, doc="Time remaining until the event runs.")
 
     def __str__(self):
         return "%s%r runs in %d seconds." % (self.callback.__name__, self.args, self.delay)
@@ -67,22 +90,6 @@ class _Event(object):
     def __repr__(self):
         return "%s(%r, %r, %r, %r)" % (self.__class__.__name__, self.interval, self.callback.__name__, self.args, self.repeat)
 
-    def __lt__(self, other):
-        return self.delay < other.delay
-
-    def __gt__(self, other):
-        return self.delay > other.delay
-
-    # to match events exactly for index()
-    def __eq__(self, other):
-        return self is other
-
-    def adjust(self, adj):
-        self.delay -= adj
-
-    def reset(self):
-        self.delay = self.interval
-
     def stop(self):
         remove(self)
 
@@ -90,132 +97,252 @@ class _Event(object):
         self.callback(*self.args, **self.kwargs)
 
 
+class _TimerQueue(object):
+    """A heap of (deadline, sequence, event) entries.
+
+    Removed events are left in place and skipped. The heap is rebuilt when
+    more than half of it is such stale entries.
+    """
+    def __init__(self):
+        self._heap = []
+        self._stale = 0
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self._heap) - self._stale
+
+    def push(self, event, deadline):
+        seq = next(self._counter)
+        event.deadline = deadline
+        event._seq = seq
+        event._queue = self
+        heappush(self._heap, (deadline, seq, event))
+
+    def cancel(self, event):
+        event._seq = None
+        event._queue = None
+        self._stale += 1
+        if self._stale > 64 and self._stale * 2 > len(self._heap):
+            self._heap = [entry for entry in self._heap if entry[2]._seq == entry[1]]
+            heapify(self._heap)
+            self._stale = 0
+
+    def first(self):
+        """The earliest deadline, or None if empty."""
+        heap = self._heap
+        while heap:
+            deadline, seq, event = heap[0]
+            if event._seq == seq:
+                return deadline
+            heappop(heap)
+            self._stale -= 1
+        return None
+
+    def pop_due(self, t):
+        """Remove and return the earliest event due at time t, or None."""
+        deadline = self.first()
+        if deadline is None or deadline > t:
+            return None
+        event = heappop(self._heap)[2]
+        event._seq = None
+        event._queue = None
+        return event
+
+    def events(self):
+        return [entry[2] for entry in sorted(self._heap) if entry[2]._seq == entry[1]]
+
+    def clear(self):
+        for deadline, seq, event in self._heap:
+            if event._seq == seq:
+                event._seq = None
+                event._queue = None
+        self._heap = []
+        self._stale = 0
+
+
 NULL = lambda: None
 
 class Scheduler(object):
-    """A Scheduler instance uses SIGALRM to schedule callback functions. It
-    does too much work in the signal handler, so it should really only be used
-    with infrequently scheduled events."""
+    """A Scheduler instance schedules callback functions, using SIGALRM or,
+    when attached, the timeout of a pycopia.asyncio.Poll instance."""
     def __init__(self, alarm=alarm):
-        self.eventq = []
         self.alarm = alarm
-        self.timeremaining = self.alarm(0)
+        self._alarmq = _TimerQueue() # events run by the SIGALRM handler
+        self._loopq = _TimerQueue() # events run by an attached Poll
+        self._poller = None
+        self.alarm(0)
         self._oldhandler = signal.signal(signal.SIGALRM, self._alarm_handler)
-        self._sleepflag = 0
-        self._timeout_flags = {}
         self._running = True
 
     def _alarm_handler(self, signum, frame):
-        d = self.eventq[0].delay
-        self._adjust(d)
-        self._run_event(self.eventq.pop(0))
-        self._runq()
-        if self.eventq:
-            self.alarm(self.eventq[0].delay)
-
-    def _adjust(self, adj):
-        for ev in self.eventq:
-            ev.adjust(adj)
-
-    def _runq(self):
-        # run any events that would be due or past due
-        while self.eventq:
-            if self.eventq[0].delay <= 0:
-                self._run_event(self.eventq.pop(0))
+        try:
+            self._run_due(self._alarmq)
+        finally:
+            self._arm()
+
+    def _arm(self):
+        if self._running:
+            deadline = self._alarmq.first()
+            if deadline is None:
+                self.alarm(0)
             else:
-                break
+                self.alarm(max(deadline - now(), MINDELAY))
 
-    def _run_event(self, ev):
-        ev()
-        if ev.repeat:
-            ev.reset()
-            insort(self.eventq, ev)
+    def _run_due(self, queue):
+        t = now()
+        while True:
+            ev = queue.pop_due(t)
+            if ev is None:
+                break
+            if ev.repeat:
+                # reschedule first, so the callback may stop it.
+                deadline = ev.deadline + ev.interval
+                if deadline <= t: # fell behind, don't try to catch up.
+                    deadline = t + ev.interval
+                queue.push(ev, deadline)
+            ev()
+
+    def _queue_for(self, event):
+        if self._poller is None or event.interrupt:
+            return self._alarmq
+        return self._loopq
 
     def __str__(self):
         i = 0
         s = ["scheduled events:"]
-        for ev in self.eventq:
+        for ev in self.getevents():
             s.append("  %2d: %s" % (i, ev))
             i += 1
         return "\n".join(s)
 
+    def __len__(self):
+        return len(self._alarmq) + len(self._loopq)
+
     def __nonzero__(self):
-        return len(self.eventq)
+        return len(self) > 0
     __bool__ = __nonzero__
 
     def add_event(self, event):
-        rem = self.alarm(0)
-        if self.eventq:
-            self._adjust(self.eventq[0].delay - rem)
-            self._runq()
-        insort(self.eventq, event)
-        self.alarm(max(0.1, self.eventq[0].delay)) # smallest delay, but not zero
+        queue = self._queue_for(event)
+        if queue is self._alarmq:
+            self.alarm(0) # no signal while the heap is changed.
+            queue.push(event, now() + event.interval)
+            self._arm()
+        else:
+            queue.push(event, now() + event.interval)
 
     def remove(self, event):
         """remove(event)
 Removes the event from the event queue. The event is an Event object as
-returned by the add or getevents methods."""
-        left = self.alarm(0)
-        try:
-            i = self.eventq.index(event)
-        except ValueError:
-            pass
+returned by the add or getevents methods. Returns True if it was pending."""
+        queue = event._queue
+        if queue is None:
+            return False
+        if queue is self._alarmq:
+            self.alarm(0)
+            queue.cancel(event)
+            self._arm()
         else:
-            if i == 0: # currently scheduled event time
-                ev = self.eventq.pop(0)
-                self._adjust(ev.delay-left)
-                self._runq()
-                if self.eventq:
-                    self.alarm(self.eventq[0].delay)
-            else:
-                del self.eventq[i]
-                self.alarm(left)
+            queue.cancel(event)
+        return True
 
     def clear(self):
         self.alarm(0)
-        del self.eventq[:]
+        self._alarmq.clear()
+        self._loopq.clear()
 
     def __delitem__(self, ind):
-        del self.eventq[ind]
+        self.remove(self.getevents()[ind])
 
     def __getitem__(self, ind):
-        return self.eventq[ind]
+        return self.getevents()[ind]
 
     def getevents(self):
-        return self.eventq[:]
+        """All pending events, in the order they will run."""
+        events = self._alarmq.events() + self._loopq.events()
+        events.sort(key=lambda ev: ev.deadline)
+        return events
 
     def stop(self):
         if self._running:
-            self.timeremaining = self.alarm(0)
+            self.alarm(0)
             signal.signal(signal.SIGALRM, self._oldhandler)
             self._running = False
 
     def start(self):
         if not self._running:
             self._oldhandler = signal.signal(signal.SIGALRM, self._alarm_handler)
-            if self.eventq:
-                self.alarm(self.timeremaining)
             self._running = True
-
-    def add(self, delay, pri=0, callback=NULL, args=None, kwargs=None, repeat=False):
+            self._arm()
+
+    def attach(self, poller):
+        """Run events from the poll loop of poller (a pycopia.asyncio.Poll)
+        rather than from SIGALRM. Pending events are moved over."""
+        self.detach()
+        self._poller = poller
+        poller.set_timers(self)
+        self._move(self._alarmq, self._loopq, lambda ev: not ev.interrupt)
+
+    def detach(self):
+        """Go back to running all events from SIGALRM."""
+        if self._poller is not None:
+            self._poller.set_timers(None)
+            self._poller = None
+            self._move(self._loopq, self._alarmq, lambda ev: True)
+
+    def _move(self, fromq, toq, select):
+        self.alarm(0)
+        for ev in fromq.events():
+            if select(ev):
+                deadline = ev.deadline
+                fromq.cancel(ev)
+                toq.push(ev, deadline)
+        self._arm()
+
+    # The interface used by an attached Poll instance.
+    def poll_timeout(self, timeout=-1.0):
+        """Return the poll timeout, in seconds, that wakes up for the next
+        event, but not later than timeout (negative meaning forever)."""
+        deadline = self._loopq.first()
+        if deadline is None:
+            return timeout
+        delay = max(0.0, deadline - now())
+        if timeout < 0:
+            return delay
+        return min(timeout, delay)
+
+    def run_timers(self):
+        """Run the events attached to the poll loop that are now due."""
+        self._run_due(self._loopq)
+
+    def add(self, delay, pri=0, callback=NULL, args=None, kwargs=None, repeat=False, interrupt=False):
         """add(delay, priority, callbackfunction, callbackargs, [repeatflag])
 Creates an Event object and adds it to the event queue. Returns the event
 object. The callback will be run with the supplied arguments, after the elapsed
-interval. If the repeat flag is given the job is rescheduled indefinitely."""
+interval. If the repeat flag is given the job is rescheduled indefinitely.
+Set interrupt if the callback must run from SIGALRM even when attached to a
+poll loop, for example to break out of a blocking read."""
         assert delay > 0
-        event = _Event(delay, callback, args or (), kwargs or {}, repeat)
+        event = _Event(delay, callback, args or (), kwargs or {}, repeat, interrupt)
         self.add_event(event)
         return event
 
-    def _sleep_cb(self):
-        self._sleepflag = 1
-
     def sleep(self, delay):
         """sleep(<secs>)
 Pause the current thread of execution for <secs> seconds. Use this
 instead of time.sleep() since it works with the scheduler, and allows
 other events to run.  """
-        itimer.nanosleep(delay)
+        if self._poller is None:
+            itimer.nanosleep(delay)
+            return
+        end = now() + delay
+        while True:
+            self.run_timers()
+            t = now()
+            if t >= end:
+                break
+            deadline = self._loopq.first()
+            itimer.nanosleep((end if deadline is None else min(end, deadline)) - t)
 
     def _timeout_cb(self):
         raise TimeoutError("timer expired")
@@ -227,7 +354,7 @@ other events to run.  """
     def timeout(self, function, args=(), kwargs={}, timeout=30):
         """Wraps a normal thread of execution. Will raise TimeoutError when the
 timeout value is reached."""
-        to = self.add(timeout, 1, self._timeout_cb)
+        to = self.add(timeout, 1, self._timeout_cb, interrupt=True)
         try:
             return function(*args, **kwargs)
         finally:
@@ -237,7 +364,7 @@ timeout value is reached."""
         """Wraps an IO function that may block in the kernel. Provides a
 timeout feature."""
         self._timed_out = 0
-        ev = self.add(timeout, 1, self._timedio_cb)
+        ev = self.add(timeout, 1, self._timedio_cb, interrupt=True)
         try:
             while 1:
                 try:
@@ -272,6 +399,7 @@ def get_scheduler():
 
 def del_scheduler():
     global scheduler
+    scheduler.detach()
     scheduler.stop()
     del scheduler
 
@@ -282,12 +410,12 @@ def timeout(*args, **kwargs):
 def iotimeout(*args, **kwargs):
     return get_scheduler().iotimeout(*args, **kwargs)
 
-def add(delay, pri=0, callback=NULL, args=(), repeat=0):
-    return get_scheduler().add(delay, pri, callback, args, repeat)
+def add(delay, pri=0, callback=NULL, args=(), repeat=0, interrupt=False):
+    return get_scheduler().add(delay, pri, callback, args, repeat=repeat, interrupt=interrupt)
 
 def remove(event):
     # scheduler must already exist if you have an event to remove.
-    scheduler.remove(event)
+    return scheduler.remove(event)
 
 def repeat(interval, method, *args):
     s = get_scheduler()
@@ -61,6 +61,7 @@ from pycopia.ISO import iso639a
 
 import pycopia.OS
 import pycopia.OS.sequencer
+from pycopia.OS import procfs
 
 
 class CoreTests(unittest.TestCase):
@@ -132,6 +133,281 @@ class CoreTests(unittest.TestCase):
         for i in range(20):
             ms = re_inverse.make_nonmatch_string(RE)
 
+    def test_scheduler(self):
+        sched = scheduler.get_scheduler()
+        hits = []
+        sched.add(0.05, callback=hits.append, args=("once",))
+        rep = sched.add(0.02, callback=hits.append, args=("repeat",), repeat=True)
+        sched.add(0.03, callback=hits.append, args=("removed",)).stop()
+        self.assertEqual(len(sched), 2)
+        sched.sleep(0.2)
+        self.assertTrue(sched.remove(rep))
+        self.assertFalse(sched.remove(rep))
+        self.assertFalse(sched)
+        self.assertEqual(hits.count("once"), 1)
+        self.assertTrue(hits.count("repeat") >= 5)
+        self.assertFalse("removed" in hits)
+        def _spin():
+            end = time.time() + 5.0
+            while time.time() < end:
+                pass
+        start = time.time()
+        self.assertRaises(scheduler.TimeoutError, sched.timeout, _spin, timeout=0.1)
+        self.assertTrue(time.time() - start < 1.0)
+
+    def test_scheduler_poll(self):
+        sched = scheduler.get_scheduler()
+        poller = asyncio.Poll()
+        sched.attach(poller)
+        try:
+            ran = []
+            events = [sched.add(0.001 * (i % 200 + 1), callback=ran.append, args=(i,))
+                    for i in range(20000)]
+            for ev in events[1::2]:
+                sched.remove(ev)
+            rep = sched.add(0.02, callback=ran.append, args=(-1,), repeat=True)
+            expected = sorted(events[::2], key=lambda ev: ev.deadline)
+            poller.loop(5.0, lambda p: sched.remove(rep) if len(sched) == 1 else None)
+            ran.remove(-1) # ran at least once, from the loop.
+            while -1 in ran:
+                ran.remove(-1)
+            self.assertEqual(ran, [ev.args[0] for ev in expected])
+            self.assertFalse(sched)
+        finally:
+            sched.detach()
+            poller.close()
+
+    def test_writequeue(self):
+        import socket, tempfile
+        a, b = socket.socketpair()
+        a.setblocking(0)
+        try:
+            q = asyncio.WriteQueue()
+            self.assertFalse(q)
+            chunks = [bytes(bytearray([i % 256])) * 1000 for i in range(3000)]
+            for chunk in chunks:
+                q.append(chunk)
+            q.append(b"")
+            with tempfile.TemporaryFile() as fo:
+                fo.write(b"0123456789" * 100000)
+                fo.flush()
+                q.append_file(fo, 5, 500000)
+                q.append(b"tail")
+                q.append(u"text")
+                self.assertRaises(UnicodeError, q.append, u"\u00e9")
+                expected = b"".join(chunks) + (b"0123456789" * 100000)[5:500005] + b"tailtext"
+                self.assertEqual(len(q), len(expected))
+                received = []
+                while q:
+                    q.flush(a) # stops when the socket buffer is full.
+                    received.append(b.recv(1 << 20))
+                self.assertEqual(fo.tell(), 1000000) # sendfile leaves it alone.
+            while True:
+                try:
+                    received.append(b.recv(1 << 20, socket.MSG_DONTWAIT))
+                except socket.error:
+                    break
+            self.assertEqual(b"".join(received), expected)
+            rb = asyncio.ReceiveBuffer(16)
+            b.sendall(b"one\ntwo\n" + b"x" * 40 + b"\nrest")
+            b.shutdown(socket.SHUT_WR)
+            lines = []
+            while not rb.eof:
+                rb.fill(a)
+                while rb.hasline():
+                    lines.append(rb.readline())
+            self.assertEqual(lines, [b"one\n", b"two\n", b"x" * 40 + b"\n"])
+            self.assertEqual(rb.readline(), b"rest")
+            self.assertEqual(rb.readline(), b"")
+            # A line may not grow the buffer past maxline.
+            a.close()
+            b.close()
+            a, b = socket.socketpair()
+            a.setblocking(0)
+            rb = asyncio.ReceiveBuffer(16, maxline=40)
+            b.sendall(b"x" * 39 + b"\n" + b"y" * 41)
+            b.shutdown(socket.SHUT_WR)
+            while not rb.hasline():
+                rb.fill(a)
+            self.assertEqual(rb.readline(), b"x" * 39 + b"\n")
+            def fill_all():
+                while not rb.eof:
+                    rb.fill(a)
+            self.assertRaises(asyncio.LineTooLongError, fill_all)
+        finally:
+            a.close()
+            b.close()
+
+    def test_poll_edge(self):
+        import socket
+        class Handler(asyncio.PollerInterface):
+            def __init__(self, sock, poller, drain):
+                sock.setblocking(0)
+                self.sock = sock
+                self.poller = poller
+                self.edgetriggered = drain
+                self.received = []
+                self.out = asyncio.WriteQueue()
+            def fileno(self):
+                return self.sock.fileno()
+            def readable(self):
+                return True
+            def writable(self):
+                return bool(self.out)
+            def read_handler(self):
+                while True:
+                    try:
+                        data = self.sock.recv(3)
+                    except socket.error:
+                        break
+                    self.received.append(data)
+                    if not self.edgetriggered or not data:
+                        break
+            def write_handler(self):
+                self.out.flush(self.sock)
+                self.poller.modify(self)
+            def send(self, data):
+                for c in data:
+                    self.out.append(c)
+                    self.poller.modify(self)
+        for edge in (False, True):
+            poller = asyncio.Poll(edge=edge, maxevents=2)
+            a, b = socket.socketpair()
+            c, d = socket.socketpair()
+            ha = Handler(a, poller, True)
+            hb = Handler(b, poller, True)
+            hc = Handler(c, poller, False) # level triggered, reads 3 bytes per event.
+            for h in (ha, hb, hc):
+                poller.register(h)
+            calls = []
+            r, w = os.pipe()
+            poller.register_fd(r, asyncio.EPOLLIN, lambda: calls.append(os.read(r, 10)))
+            ha.send(b"hello world")
+            hb.send(b"goodbye")
+            d.send(b"level triggered")
+            os.write(w, b"x")
+            if edge: # applied once, on the next poll.
+                self.assertEqual(len(poller._dirty), 2)
+            self.assertEqual(poller._flags[a.fileno()] & asyncio.EPOLLET,
+                    asyncio.EPOLLET if edge else 0)
+            self.assertEqual(poller._flags[c.fileno()] & asyncio.EPOLLET, 0)
+            for i in range(20):
+                poller.poll(0.01)
+            self.assertEqual(b"".join(hb.received), b"hello world")
+            self.assertEqual(b"".join(ha.received), b"goodbye")
+            self.assertEqual(b"".join(hc.received), b"level triggered")
+            self.assertEqual(calls, [b"x"])
+            self.assertFalse(poller._flags[a.fileno()] & asyncio.EPOLLOUT)
+            poller.unregister(hb)
+            self.assertFalse(b.fileno() in poller._dispatch)
+            poller.unregister_all()
+            self.assertFalse(poller)
+            poller.close()
+            for fd in (r, w):
+                os.close(fd)
+            for sock in (a, b, c, d):
+                sock.close()
+
+    def test_fcgi_prefork(self):
+        import signal, socket, struct
+        def app(environ, start_response):
+            start_response("200 OK", [("Content-Type", "text/plain")])
+            return [environ["PATH_INFO"], ":", str(os.getpid())]
+        path = "/tmp/pycopia_test_fcgi_{}".format(os.getpid())
+        pid = os.fork()
+        if pid == 0:
+            try:
+                fcgi.FCGIServer(app, bindAddress=path, workers=2, maxrequests=3,
+                        multiplexed=True).run(timeout=0.1)
+            finally:
+                os._exit(0)
+        def record(rtype, reqid, content=b""):
+            return struct.pack(fcgi.FCGI_Header, fcgi.FCGI_VERSION_1, rtype, reqid,
+                    len(content), 0) + content
+        def begin(reqid, pathinfo):
+            params = b"".join(fcgi.encode_pair(n, v) for n, v in (("REQUEST_METHOD", "GET"),
+                    ("PATH_INFO", pathinfo), ("SERVER_NAME", "localhost"),
+                    ("SERVER_PORT", "80"), ("SERVER_PROTOCOL", "HTTP/1.1")))
+            body = struct.pack(fcgi.FCGI_BeginRequestBody, fcgi.FCGI_RESPONDER,
+                    fcgi.FCGI_KEEP_CONN)
+            return (record(fcgi.FCGI_BEGIN_REQUEST, reqid, body) +
+                    record(fcgi.FCGI_PARAMS, reqid, params) + record(fcgi.FCGI_PARAMS, reqid))
+        def responses(sock):
+            out = {}
+            buf = b""
+            while True:
+                data = sock.recv(4096)
+                if not data:
+                    return out
+                buf += data
+                while len(buf) >= fcgi.FCGI_HEADER_LEN:
+                    v, rtype, reqid, clen, plen = struct.unpack(fcgi.FCGI_Header,
+                            buf[:fcgi.FCGI_HEADER_LEN])
+                    end = fcgi.FCGI_HEADER_LEN + clen + plen
+                    if len(buf) < end:
+                        break
+                    if rtype == fcgi.FCGI_STDOUT:
+                        out[reqid] = out.get(reqid, b"") + buf[fcgi.FCGI_HEADER_LEN:end - plen]
+                    buf = buf[end:]
+        try:
+            while not os.path.exists(path):
+                time.sleep(0.05)
+            pids = set()
+            for i in range(3):
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.connect(path)
+                # Interleave three requests on one connection, stdin last.
+                sock.sendall(begin(1, "/one") + begin(2, "/two") + begin(3, "/three") +
+                        record(fcgi.FCGI_STDIN, 3) + record(fcgi.FCGI_STDIN, 1) +
+                        record(fcgi.FCGI_STDIN, 2))
+                # The worker retires after its third request and closes the connection.
+                out = responses(sock)
+                sock.close()
+                self.assertEqual(sorted(out), [1, 2, 3])
+                workers = set()
+                for reqid, name in ((1, "/one"), (2, "/two"), (3, "/three")):
+                    body = out[reqid].split(b"\r\n\r\n", 1)[1]
+                    pathinfo, workerpid = body.split(b":")
+                    self.assertEqual(pathinfo, name)
+                    workers.add(workerpid)
+                self.assertEqual(len(workers), 1)
+                pids.update(workers)
+            self.assertEqual(len(pids), 3) # each connection got a fresh worker.
+        finally:
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+
+    def test_procfs_snapshot(self):
+        mypid = os.getpid()
+        snap = procfs.ProcSnapshot().read()
+        self.assertTrue(mypid in snap)
+        self.assertEqual(len(snap), len(snap.column("ppid")))
+        me = snap[mypid]
+        ps = procfs.ProcStat(mypid)
+        self.assertEqual(me.command, ps.command)
+        self.assertEqual(me.ppid, os.getppid())
+        self.assertEqual(me.state, "R")
+        self.assertFalse("cmdline" in snap._columns)
+        # Fields that were not read are read when first used.
+        self.assertEqual(me.cmdline, ps.cmdline)
+        self.assertEqual(me.uid, os.getuid())
+        self.assertEqual(me.environment.get("PATH"), os.environ.get("PATH"))
+        self.assertEqual(me.ttyname, ps.ttyname)
+        self.assertRaises(AttributeError, getattr, me, "nosuchfield")
+        self.assertRaises(ValueError, procfs.ProcSnapshot, ("nosuchfield",))
+        self.assertTrue(mypid in procfs.pidof(me.command))
+        table = procfs.ProcStatTable("%(pid)d %(ppid)d")
+        self.assertTrue(str(mypid) + " " in str(table))
+        self.assertEqual(table[mypid].ppid, os.getppid())
+        # CPU use of a busy loop.
+        x = 0
+        while os.times()[0] - ps.tms_utime / os.sysconf("SC_CLK_TCK") < 0.2:
+            x += 1
+        later = procfs.ProcSnapshot(procfs.CPU_FIELDS).read()
+        rates = later.cpu_rates(snap)
+        self.assertTrue(rates[mypid] > 0)
+        self.assertTrue(set(rates) <= set(snap.pids()))
+
     def test_sequencer(self):
         counters = [0, 0, 0, 0, 0]
         starttimes = [None, None, None, None, None]
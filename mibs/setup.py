@@ -11,12 +11,13 @@ VERSION = "1.0"
 setup(name=NAME, version=VERSION,
     namespace_packages = ["pycopia"],
     packages = ["pycopia", "pycopia.mibs"],
+    package_data = {"pycopia.mibs": ["OIDINDEX"]},
 #    install_requires = ['pycopia-SMI>=1.0.dev-r138,==dev'],
     dependency_links = [
             "http://www.pycopia.net/download/"
                 ],
     test_suite = "test.MibsTests",
-    zip_safe = True,
+    zip_safe = False, # OIDINDEX is memory mapped.
 
     description = "Collection of pre-compiled MIBs for Pycopia SNMP.",
     long_description = """Collection of pre-compiled MIBs for Pycopia SNMP.
@@ -3,7 +3,11 @@
 MIBs module unit tests.
 """
 
+import sys
+import os
 import unittest
+import tempfile
+import shutil
 
 # just import a basic sample
 import pycopia.mibs
@@ -14,6 +18,90 @@ class MibsTests(unittest.TestCase):
     def test_import(self):
         self.assertEqual(pycopia.SMI.OIDMAP['1.3.6.1.1'].OID, [1,3,6,1,1])
 
+    def test_oidindex(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fname = os.path.join(tmpdir, "OIDINDEX")
+            pycopia.SMI.write_oid_index(fname, [
+                    ([1, 3, 6, 1, 2, 1, 1, 9, 1, 3], "SNMPv2_MIB", "sysORDescr"),
+                    ([1, 3, 6, 1, 2, 1, 1], "SNMPv2_MIB", "system"),
+                    ([1, 3, 6, 1, 2, 1, 1, 10], "OTHER_MIB", "other"),
+                    ([1, 3, 6, 1, 4, 1, 200000], "BIG_MIB", "big"),
+                    ([1, 3, 6, 1, 2, 1, 1], "LATER_MIB", "system")])
+            index = pycopia.SMI.OIDIndex(fname)
+            self.assertEqual(len(index), 4)
+            self.assertEqual(index.get([1, 3, 6, 1, 2, 1, 1]), ("SNMPv2_MIB", "system"))
+            self.assertEqual(index.get([1, 3, 6, 1, 4, 1, 200000]), ("BIG_MIB", "big"))
+            self.assertEqual(index.get([1, 3, 6, 1, 2, 1, 1, 9]), None)
+            self.assertEqual(index.longest_match([1, 3, 6, 1, 2, 1, 1, 9, 1, 3, 4]),
+                    (("SNMPv2_MIB", "sysORDescr"), 10))
+            self.assertEqual(index.longest_match([1, 3, 6, 1, 2, 1, 1, 10, 1]),
+                    (("OTHER_MIB", "other"), 8))
+            self.assertEqual(index.longest_match([1, 3, 6, 1, 2, 1, 1, 9, 1, 3, 4], 11), (None, 0))
+            self.assertEqual(index.longest_match([1, 3, 6, 1, 2]), (None, 0))
+            self.assertEqual(index.prefix_length([1, 3, 6, 1, 2, 1, 1]), 7)
+            self.assertEqual(index.prefix_length([1, 3, 6, 1, 2, 1, 1, 9, 2, 5]), 8)
+            self.assertEqual(index.prefix_length([1, 3, 6, 1, 2, 1, 1, 11, 1]), 7)
+            self.assertEqual(index.prefix_length([1, 3, 6, 1, 4, 1, 9]), 6)
+            self.assertEqual(index.prefix_length([2]), 0)
+            index.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_oidindex_current(self):
+        # The shipped index must match the generated *_OID modules.
+        mibdir = os.path.dirname(pycopia.mibs.__file__)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for fname in os.listdir(mibdir):
+                if fname.endswith("_OID.py"):
+                    shutil.copy(os.path.join(mibdir, fname), tmpdir)
+            fname = pycopia.SMI.build_oid_index(tmpdir)
+            with open(fname, "rb") as fo:
+                new = fo.read()
+            with open(os.path.join(mibdir, pycopia.SMI.OIDINDEX_NAME), "rb") as fo:
+                self.assertEqual(fo.read(), new)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_leaf_memo(self):
+        # A leaf is not memoized while the index has OIDs below it.
+        self.assertFalse("pycopia.mibs.SNMPv2_TM" in sys.modules)
+        obj = pycopia.SMI.OIDTRIE.find([1, 3, 6, 1, 6, 1, 99999, 1])
+        self.assertEqual(obj.__name__, "snmpDomains")
+        obj = pycopia.SMI.OIDTRIE.find([1, 3, 6, 1, 6, 1, 1, 0])
+        self.assertEqual(obj.__name__, "snmpUDPDomain")
+
+    def test_lazy_import(self):
+        modname = "pycopia.mibs.SNMP_USM_AES_MIB"
+        self.assertFalse(modname in sys.modules)
+        obj = pycopia.SMI.OIDTRIE.find([1, 3, 6, 1, 6, 3, 10, 1, 2, 4, 0])
+        self.assertEqual(obj.__name__, "usmAesCfb128Protocol")
+        self.assertTrue(obj is sys.modules[modname].usmAesCfb128Protocol)
+        modname = "pycopia.mibs.SNMP_TARGET_MIB"
+        self.assertFalse(modname in sys.modules)
+        self.assertTrue("1.3.6.1.6.3.12.1.2.1.2" in pycopia.SMI.OIDMAP)
+        self.assertEqual(pycopia.SMI.OIDMAP["1.3.6.1.6.3.12.1.2.1.2"].__name__,
+                "snmpTargetAddrTDomain")
+        self.assertTrue(modname in sys.modules)
+        self.assertEqual(pycopia.SMI.OIDMAP.get("1.3.6.1.99"), None)
+        self.assertRaises(KeyError, pycopia.SMI.OIDMAP.__getitem__, "1.3.6.1.99")
+
+    def test_index_misses(self):
+        # Instances of an unknown subtree share one memoized miss.
+        misses = pycopia.SMI._indexmisses
+        misses.clear()
+        pycopia.SMI._misslengths = ()
+        for i in range(100):
+            obj = pycopia.SMI.OIDTRIE.find([1, 3, 6, 1, 4, 1, 99999999, 1, 2, i])
+            self.assertEqual(obj.__name__, "enterprises")
+        self.assertEqual(len(misses), 1)
+        self.assertFalse(pycopia.SMI._index_loader([1, 3, 6, 1, 4, 1, 99999999, 7], 7))
+        self.assertEqual(len(misses), 1)
+        # Other OIDs still load their modules.
+        obj = pycopia.SMI.OIDTRIE.find([1, 3, 6, 1, 6, 3, 10, 2, 1, 1, 0])
+        self.assertEqual(obj.__name__, "snmpEngineID")
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,295 @@
+#!/usr/bin/python2.7
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Benchmarks for the net package.
+
+Usage: bench.py [-n <requests>] [-c <chunksize>] [-f <capture>] [-s <seconds>]
+
+The capture file for the syslog benchmark holds one syslog message per line,
+as sent on the wire. Without one a synthetic stream is used.
+
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import sys
+import os
+import getopt
+import signal
+import socket
+import tempfile
+import time
+
+from pycopia import asyncio
+from pycopia import asyncserver
+from pycopia import protocols
+from pycopia import slogsink
+from pycopia.timelib import now
+
+RESPONSE_SIZE = 1024 * 1024
+
+
+class _ResponseProto(protocols.Protocol):
+    """Answers each GET line with RESPONSE_SIZE bytes, written in chunks."""
+    chunksize = 4096
+
+    def initialize(self, fsm):
+        fsm.set_default_transition(self._error, fsm.RESET)
+        fsm.add("GET\n", fsm.RESET, self._get, fsm.RESET)
+
+    def _get(self, match):
+        chunk = b"x" * self.chunksize
+        for i in range(RESPONSE_SIZE // self.chunksize):
+            self.iostream.write(chunk)
+
+    def _error(self, symbol):
+        raise protocols.ProtocolExit
+
+
+class _StringBufferWorker(asyncserver.AsyncWorkerHandler):
+    """The previous write path, a string appended to and sliced, for
+    comparison."""
+
+    def initialize(self):
+        self._strbuf = ""
+        super(_StringBufferWorker, self).initialize()
+
+    def write(self, data):
+        self._strbuf += data
+        asyncserver.poller.modify(self)
+        return len(data)
+
+    def writable(self):
+        return self._state == asyncserver.CONNECTED and bool(self._strbuf)
+
+    def write_handler(self):
+        writ = self._sock.send(self._strbuf)
+        self._strbuf = self._strbuf[writ:]
+        asyncserver.poller.modify(self)
+
+
+class _FileWorker(asyncserver.AsyncWorkerHandler):
+    """Answers each GET line with a file, using sendfile."""
+    fo = None
+
+    def read_handler(self):
+        stream = self._readbuf
+        while stream.fill(self._sock) is not None:
+            while stream.hasline():
+                stream.readline()
+                self.sendfile(self.fo)
+            if stream.eof:
+                self.close()
+                break
+
+
+def start_server(workerclass, chunksize):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(5)
+    pid = os.fork()
+    if pid == 0:
+        try:
+            signal.signal(signal.SIGTERM, lambda sig, frame: sys.exit(0))
+            proto = _ResponseProto()
+            proto.chunksize = chunksize
+            asyncserver.AsyncServerHandler(listener, workerclass, proto)
+            asyncserver.poller.loop()
+        finally:
+            os._exit(0)
+    port = listener.getsockname()[1]
+    listener.close()
+    return pid, port
+
+
+def fetch(port, count):
+    """Make count requests over one connection, returns the elapsed time."""
+    sock = socket.create_connection(("127.0.0.1", port))
+    start = now()
+    for i in range(count):
+        sock.sendall(b"GET\n")
+        remaining = RESPONSE_SIZE
+        while remaining:
+            data = sock.recv(1 << 20)
+            if not data:
+                raise EOFError("Server closed connection.")
+            remaining -= len(data)
+    elapsed = now() - start
+    sock.close()
+    return elapsed
+
+
+def bench_responses(count, chunksize):
+    with tempfile.TemporaryFile() as fo:
+        fo.write(b"x" * RESPONSE_SIZE)
+        fo.flush()
+        _FileWorker.fo = fo
+        for name, workerclass, n in (
+                ("string buffer", _StringBufferWorker, max(1, count // 10)),
+                ("write queue", asyncserver.AsyncWorkerHandler, count),
+                ("sendfile", _FileWorker, count),
+                ):
+            pid, port = start_server(workerclass, chunksize)
+            try:
+                elapsed = fetch(port, n)
+            finally:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            print("{:>16s}: {:5d} x 1 MB in {:4d} byte writes, {:8.3f} s, {:8.1f} MB/s".format(
+                    name, n, chunksize, elapsed, n / elapsed))
+
+
+### syslog ingestion
+
+class _OldSlogDispatcher(slogsink.UserSlogDispatcher):
+    """The previous receive path, for comparison: a recvfrom, regular
+    expression and IPv4 object per message."""
+
+    def __init__(self, callback, addr):
+        socket_ = slogsink.socket
+        socket_.AsyncSocket.__init__(self, socket_.AF_INET, socket_.SOCK_DGRAM)
+        self.callback = callback
+        self.bind(addr)
+
+    def read(self):
+        socket_ = slogsink.socket
+        try:
+            while 1:
+                msg, addr = self.recvfrom(4096, socket_.MSG_DONTWAIT)
+                self.callback(slogsink.parse_message(now(), slogsink.IPv4(addr[0]), msg))
+        except socket_.SocketError as err:
+            if err[0] == slogsink.EAGAIN:
+                return
+            else:
+                raise
+
+
+_HOSTS = ["sw-core-%02d" % i for i in range(1, 9)] + ["rtr-edge-%02d" % i for i in range(1, 5)]
+_EVENTS = [
+    "<189>%s: %%LINK-3-UPDOWN: Interface GigabitEthernet0/%d, changed state to up",
+    "<187>%s: %%LINEPROTO-5-UPDOWN: Line protocol on Interface Vlan%d, changed state to down",
+    "<86>%s sshd[%d]: Accepted publickey for admin from 10.20.30.40 port 51234 ssh2",
+    "<30>%s ntpd[%d]: kernel time sync status change 2001",
+    "<134>%s kernel: [%d.123456] eth0: link up, 1000Mbps, full-duplex, lpa 0x45E1",
+    "<13>%s cron[%d]: (root) CMD (/usr/lib/sa/sa1 1 1)",
+]
+
+def _load_capture(fname):
+    if fname:
+        with open(fname) as fo:
+            return [line.rstrip("\n") for line in fo if line.strip()]
+    msgs = []
+    for i in range(1000):
+        msgs.append(_EVENTS[i % len(_EVENTS)] % (_HOSTS[i % len(_HOSTS)], i))
+    return msgs
+
+
+def _run_sink(dispatcherclass, queuesize, outname, wfd):
+    signal.signal(signal.SIGTERM, lambda sig, frame: sys.exit(0))
+    sl = slogsink.Syslog(queuesize=queuesize)
+    sl.addlog(open(outname, "w"))
+    dispatcher = dispatcherclass(sl.dispatch, ("127.0.0.1", 0))
+    os.write(wfd, "%d\n" % dispatcher.getsockname()[1])
+    asyncio.poller.register(dispatcher)
+    try:
+        asyncio.poller.loop()
+    finally:
+        sl.flush()
+        sl.close()
+        os.write(wfd, "%d\n" % sl.dropped)
+
+
+def replay(messages, rate, seconds, dispatcherclass, queuesize):
+    """Send the messages, over and over, at rate per second to a sink in a
+    child process. Returns the number sent, written, and dropped by the
+    writer.
+    """
+    outname = "/tmp/pycopia_slogbench_{}".format(os.getpid())
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(rfd)
+            _run_sink(dispatcherclass, queuesize, outname, wfd)
+        finally:
+            os._exit(0)
+    os.close(wfd)
+    rfo = os.fdopen(rfd)
+    addr = ("127.0.0.1", int(rfo.readline()))
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    perms = max(1, rate // 1000)
+    sent = 0
+    start = now()
+    tick = start
+    try:
+        while tick - start < seconds:
+            for i in range(perms):
+                sock.sendto(messages[sent % len(messages)], addr)
+                sent += 1
+            tick += perms / rate
+            delay = tick - now()
+            if delay > 0:
+                time.sleep(delay)
+        time.sleep(1.0)
+    finally:
+        os.kill(pid, signal.SIGTERM)
+        dropped = int(rfo.readline() or 0)
+        os.waitpid(pid, 0)
+        rfo.close()
+    with open(outname) as fo:
+        written = sum(1 for line in fo)
+    os.unlink(outname)
+    return sent, written, dropped
+
+
+def bench_syslog(capture, seconds):
+    messages = _load_capture(capture)
+    for rate in (5000, 20000, 50000, 100000):
+        for name, dispatcherclass, queuesize in (
+                ("per message", _OldSlogDispatcher, 0),
+                ("batched", slogsink.UserSlogDispatcher, slogsink.QUEUESIZE),
+                ):
+            sent, written, dropped = replay(messages, rate, seconds, dispatcherclass, queuesize)
+            print("{:>16s}: {:6d} msg/s offered, {:7d} sent, {:6.1f}% written, {:6d} dropped by writer".format(
+                    name, rate, sent, written * 100.0 / sent, dropped))
+
+
+def main(argv):
+    count = 200
+    chunksize = 4096
+    capture = None
+    seconds = 3
+    opts, args = getopt.getopt(argv[1:], "n:c:f:s:")
+    for opt, optarg in opts:
+        if opt == "-n":
+            count = int(optarg)
+        elif opt == "-c":
+            chunksize = int(optarg)
+        elif opt == "-f":
+            capture = optarg
+        elif opt == "-s":
+            seconds = float(optarg)
+    print("writev/sendfile/recvmmsg:", asyncio.fdio is not None)
+    bench_responses(count, chunksize)
+    bench_responses(count, 65536)
+    bench_syslog(capture, seconds)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
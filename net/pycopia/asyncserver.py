@@ -34,8 +34,9 @@ from pycopia import asyncio
 
 CLOSED = 0
 CONNECTED = 1
+CLOSING = 2
 
-poller = asyncio.Poll()
+poller = asyncio.Poll(edge=True)
 
 
 class AsyncServerHandler(asyncio.PollerInterface):
@@ -86,12 +87,15 @@ class AsyncServerHandler(asyncio.PollerInterface):
 
 
 class AsyncWorkerHandler(asyncio.PollerInterface):
+    edgetriggered = True
+
     def __init__(self, sock, addr, proto):
         self.address = addr
         self._sock = sock
         self.protocol = proto
         self._state = CONNECTED
-        self._writebuf = ""
+        self._writebuf = asyncio.WriteQueue()
+        self._readbuf = asyncio.ReceiveBuffer(write=self.write)
         self.initialize()
 
     def fileno(self):
@@ -99,61 +103,77 @@ class AsyncWorkerHandler(asyncio.PollerInterface):
 
     def close(self):
         if self._sock is not None:
+            if self._writebuf and self._state == CONNECTED:
+                # Finish sending the response first, write_handler closes.
+                self._state = CLOSING
+                poller.modify(self)
+                return
             poller.unregister(self)
             s = self._sock
             self._sock = None
-            if self._writebuf:
-                s.send(self._writebuf)
-                self._writebuf = ""
+            self._writebuf.clear()
             s.close()
             self._state = CLOSED
 
     closed = property(lambda self: self._state == CLOSED)
 
     def write(self, data):
-        self._writebuf += data
+        self._writebuf.append(data)
         poller.modify(self)
         return len(data)
 
+    def sendfile(self, fo, offset=0, count=None):
+        """Send part or all of an open file, without reading it in."""
+        self._writebuf.append_file(fo, offset, count)
+        poller.modify(self)
+
     def readable(self):
         return self._state == CONNECTED
 
     def writable(self):
-        return self._state == CONNECTED and bool(self._writebuf)
+        return self._state != CLOSED and bool(self._writebuf)
 
     def priority(self):
         return self._state == CONNECTED
 
     def hangup_handler(self):
         poller.unregister(self)
+        self._writebuf.clear()
         self.close()
 
     def error_handler(self):
         poller.unregister(self)
 
     def write_handler(self):
-        writ = self._sock.send(self._writebuf)
-        self._writebuf = self._writebuf[writ:]
-        poller.modify(self)
+        self._writebuf.flush(self._sock)
+        if self._state == CLOSING and not self._writebuf:
+            self.close()
+        else:
+            poller.modify(self)
 
     def initialize(self):
         self.protocol.reset()
 
     def read_handler(self):
-        with self._sock.makefile("w+b", 0) as fo:
-            try:
-                self.protocol.step(fo, self.address)
-            except protocols.ProtocolExit:
-                self.close()
-            except protocols.ProtocolError:
-                self.close()
-                raise
+        stream = self._readbuf
+        try:
+            # Read until the socket would block, as edge triggering needs.
+            while self._state == CONNECTED and stream.fill(self._sock) is not None:
+                # The protocol only sees whole lines, or what is left at EOF.
+                while self._state == CONNECTED and (stream.hasline() or stream.eof):
+                    self.protocol.step(stream, self.address)
+        except (protocols.ProtocolExit, asyncio.LineTooLongError):
+            self.close()
+        except protocols.ProtocolError:
+            self.close()
+            raise
 
     def pri_handler(self):
         log("unhandled priority message")
 
     def exception_handler(self, ex, val, tb):
         traceback.print_exception(ex, val, tb)
+        self._writebuf.clear()
         self.close()
 
 
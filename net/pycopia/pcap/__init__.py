@@ -2,3 +2,10 @@
 Modules for dissecting, building, and reporting on packet capture (pcap) files.
 
 """
+
+try:
+    import numpy
+except ImportError:
+    raise ImportError("The pycopia.pcap modules need NumPy. Install the numpy "
+            "package, or pycopia-net with the pcap extra.")
+del numpy
@@ -0,0 +1,264 @@
+#!/usr/bin/python2.7
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Columnar access to pcap files.
+
+A capture file is memory-mapped and read in chunks of packets. For each chunk
+the fixed-offset header fields are pulled into NumPy arrays, one per field, so
+that reports can be computed with vectorized operations instead of decoding
+each packet into objects.
+
+The fields are::
+
+    ts          capture time, float seconds.
+    caplen      bytes captured.
+    length      bytes on the wire.
+    dst, src    Ethernet addresses, as integers.
+    ethertype   Ethernet type, after one 802.1Q tag if there is one.
+    vlan        802.1Q VLAN ID, 0 if untagged.
+    ipsrc       IPv4 source address, as an integer.
+    ipdst       IPv4 destination address.
+    proto       IP protocol.
+    sport       TCP or UDP source port.
+    dport       TCP or UDP destination port.
+
+A field that a packet does not have, or did not capture, is zero.
+"""
+
+import os
+import mmap
+import struct
+
+import numpy
+
+CHUNKSIZE = 1 << 20 # packets
+
+DLT_EN10MB = 1
+ETH_P_IP = 0x0800
+ETH_P_8021Q = 0x8100
+BROADCAST = 0xffffffffffff
+
+FIELDS = ("ts", "caplen", "length", "dst", "src", "ethertype", "vlan",
+        "ipsrc", "ipdst", "proto", "sport", "dport")
+_IPFIELDS = frozenset(("ipsrc", "ipdst", "proto", "sport", "dport"))
+
+_MAGIC = {
+    0xa1b2c3d4: ("<", 1e-6),
+    0xd4c3b2a1: (">", 1e-6),
+    0xa1b23c4d: ("<", 1e-9),
+    0x4d3cb2a1: (">", 1e-9),
+}
+
+
+class PcapError(Exception):
+    pass
+
+
+class PcapFile(object):
+    """A memory-mapped pcap file of Ethernet frames."""
+
+    def __init__(self, fname):
+        self.name = fname
+        self._mmap = None
+        with open(fname, "rb") as fo:
+            size = os.fstat(fo.fileno()).st_size
+            if size < 24:
+                raise PcapError("{}: not a pcap file.".format(fname))
+            self._mmap = mmap.mmap(fo.fileno(), size, access=mmap.ACCESS_READ)
+        magic = struct.unpack_from("<I", self._mmap)[0]
+        try:
+            self._endian, self._tsscale = _MAGIC[magic]
+        except KeyError:
+            self.close()
+            raise PcapError("{}: not a pcap file.".format(fname))
+        (self.version_major, self.version_minor, self.thiszone, self.sigfigs,
+                self.snaplen, self.linktype) = struct.unpack_from(self._endian + "HHiIII", self._mmap, 4)
+        if self.linktype != DLT_EN10MB:
+            self.close()
+            raise PcapError("{}: link type {} is not Ethernet.".format(fname, self.linktype))
+        self.nanosecond = self._tsscale < 1e-6
+
+    def __del__(self):
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def offsets(self, chunksize=CHUNKSIZE):
+        """Yield arrays of the file offsets of up to chunksize packet records.
+        A record cut short at the end of the file is left out.
+        """
+        mm = self._mmap
+        size = len(mm)
+        caplen = struct.Struct(self._endian + "I").unpack_from
+        pos = 24
+        last = size - 16 # last place a record header can start.
+        while pos <= last:
+            chunk = []
+            append = chunk.append
+            for i in xrange(chunksize):
+                if pos > last:
+                    break
+                end = pos + 16 + caplen(mm, pos + 8)[0]
+                if end > size:
+                    last = -1 # stop after this chunk.
+                    break
+                append(pos)
+                pos = end
+            if chunk:
+                yield numpy.array(chunk, dtype=numpy.int64)
+
+    def chunks(self, fields=FIELDS, chunksize=CHUNKSIZE):
+        """Yield a dictionary of field name to array for each chunk of
+        packets.
+        """
+        buf = numpy.frombuffer(self._mmap, dtype=numpy.uint8)
+        try:
+            for off in self.offsets(chunksize):
+                yield _decode(buf, off, fields, self._endian, self._tsscale)
+        finally:
+            del buf
+
+    def read(self, fields=FIELDS):
+        """Return a dictionary of field name to array for the whole file."""
+        parts = list(self.chunks(fields))
+        if not parts:
+            return _decode(numpy.zeros(0, dtype=numpy.uint8),
+                    numpy.zeros(0, dtype=numpy.int64), fields, self._endian, self._tsscale)
+        return dict((name, numpy.concatenate([part[name] for part in parts])) for name in fields)
+
+
+def _gather(buf, idx, width):
+    """Return a (len(idx), width) array of the bytes starting at each index.
+    Indexes past the end are clipped; the caller masks what they produce.
+    """
+    idx = numpy.clip(idx, 0, max(len(buf) - width, 0))
+    return buf[idx[:, numpy.newaxis] + numpy.arange(width)]
+
+def _be16(buf, idx):
+    b = _gather(buf, idx, 2).astype(numpy.uint16)
+    return (b[:, 0] << 8) | b[:, 1]
+
+def _be32(buf, idx):
+    return _gather(buf, idx, 4).view(">u4")[:, 0].astype(numpy.uint32)
+
+def _mac(buf, idx):
+    b = numpy.zeros((len(idx), 8), dtype=numpy.uint8)
+    b[:, 2:] = _gather(buf, idx, 6)
+    return b.view(">u8")[:, 0].astype(numpy.uint64)
+
+
+def _decode(buf, off, fields, endian, tsscale):
+    hdr = _gather(buf, off, 16).view(endian + "u4")
+    caplen = hdr[:, 2].astype(numpy.int64)
+    data = off + 16
+    cols = {}
+    cols["ts"] = hdr[:, 0] + hdr[:, 1] * tsscale
+    cols["caplen"] = caplen.astype(numpy.uint32)
+    cols["length"] = hdr[:, 3].astype(numpy.uint32)
+    iseth = caplen >= 14
+    cols["dst"] = numpy.where(iseth, _mac(buf, data), 0).astype(numpy.uint64)
+    cols["src"] = numpy.where(iseth, _mac(buf, data + 6), 0).astype(numpy.uint64)
+    ethertype = numpy.where(iseth, _be16(buf, data + 12), 0)
+    tagged = (ethertype == ETH_P_8021Q) & (caplen >= 18)
+    cols["vlan"] = numpy.where(tagged, _be16(buf, data + 14) & 0x0fff, 0).astype(numpy.uint16)
+    cols["ethertype"] = numpy.where(tagged, _be16(buf, data + 16), ethertype).astype(numpy.uint16)
+    if _IPFIELDS.intersection(fields):
+        l3 = data + 14 + 4 * tagged
+        l3len = caplen - (l3 - data)
+        isip = (cols["ethertype"] == ETH_P_IP) & (l3len >= 20)
+        zero32 = numpy.zeros(len(off), dtype=numpy.uint32)
+        cols["ipsrc"] = numpy.where(isip, _be32(buf, l3 + 12), zero32)
+        cols["ipdst"] = numpy.where(isip, _be32(buf, l3 + 16), zero32)
+        proto = numpy.where(isip, _gather(buf, l3 + 9, 1)[:, 0], 0).astype(numpy.uint8)
+        cols["proto"] = proto
+        ihl = (_gather(buf, l3, 1)[:, 0] & 0x0f).astype(numpy.int64) * 4
+        first = (_be16(buf, l3 + 6) & 0x1fff) == 0
+        hasports = isip & first & ((proto == 6) | (proto == 17)) & (l3len >= ihl + 4)
+        l4 = l3 + ihl
+        cols["sport"] = numpy.where(hasports, _be16(buf, l4), 0).astype(numpy.uint16)
+        cols["dport"] = numpy.where(hasports, _be16(buf, l4 + 2), 0).astype(numpy.uint16)
+    return dict((name, cols[name]) for name in fields)
+
+
+# Vectorized reductions. Those over files return results that can be merged,
+# so files may be done in separate processes.
+
+def count(values, weights=None):
+    """Return the unique values and how many times each occurs, or the sum
+    of the weights for each if weights are given (a group-by).
+    """
+    keys, inverse = numpy.unique(values, return_inverse=True)
+    return keys, numpy.bincount(inverse, weights, minlength=len(keys))
+
+
+def merge_counts(parts):
+    """Merge a sequence of (keys, counts) pairs into one."""
+    parts = list(parts)
+    if not parts:
+        return numpy.zeros(0), numpy.zeros(0)
+    return count(numpy.concatenate([keys for keys, counts in parts]),
+            numpy.concatenate([counts for keys, counts in parts]))
+
+
+def merge_unique(parts):
+    """Merge a sequence of arrays of unique values into one."""
+    parts = list(parts)
+    if not parts:
+        return numpy.zeros(0)
+    return numpy.unique(numpy.concatenate(parts))
+
+
+def file_unique(fname, field, chunksize=CHUNKSIZE):
+    """Return the unique values of a field over a file."""
+    with PcapFile(fname) as pf:
+        return merge_unique(numpy.unique(cols[field])
+                for cols in pf.chunks((field,), chunksize))
+
+
+def file_count(fname, field, weightfield=None, chunksize=CHUNKSIZE):
+    """Return the unique values of a field over a file, with their packet
+    counts, or the sums of weightfield (e.g. "length" for bytes).
+    """
+    fields = (field,) if weightfield is None else (field, weightfield)
+    with PcapFile(fname) as pf:
+        return merge_counts(count(cols[field], None if weightfield is None else cols[weightfield])
+                for cols in pf.chunks(fields, chunksize))
+
+
+def map_files(func, fnames, processes=0):
+    """Apply func to each file name, in that many worker processes if
+    processes is more than one. Returns the list of results.
+    """
+    if processes > 1 and len(fnames) > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(min(processes, len(fnames)))
+        try:
+            return pool.map(func, fnames)
+        finally:
+            pool.close()
+            pool.join()
+    return map(func, fnames)
+
@@ -19,32 +19,84 @@ Report on pcap files.
 
 """
 
+import socket
 import struct
 import getopt
+from itertools import izip
 
-import pcap
-import dpkt
+import numpy
+
+from pycopia.pcap import columns
 
 
 
 def get_macs(fname):
-    pc = pcap.pcap(fname)
-    for ts, pkt in pc:
-        pkt = dpkt.ethernet.Ethernet(pkt)
-        yield ts, struct.unpack("!Q", "\0\0"+pkt.src)[0], struct.unpack("!Q", "\0\0"+pkt.dst)[0]
+    with columns.PcapFile(fname) as pf:
+        for cols in pf.chunks(("ts", "src", "dst")):
+            for row in izip(cols["ts"].tolist(), cols["src"].tolist(), cols["dst"].tolist()):
+                yield row
+
+
+def _unique_macs(fname):
+    dsts, srcs = [], []
+    with columns.PcapFile(fname) as pf:
+        for cols in pf.chunks(("dst", "src")):
+            dsts.append(numpy.unique(cols["dst"]))
+            srcs.append(numpy.unique(cols["src"]))
+    dst = columns.merge_unique(dsts)
+    return dst[dst != columns.BROADCAST], columns.merge_unique(srcs)
 
 
-def get_unique_macs(namelist, dstset=None, srcset=None):
+def get_unique_macs(namelist, dstset=None, srcset=None, processes=0):
     dstset = set() if dstset is None else dstset
     srcset = set() if srcset is None else srcset
-    for fname in namelist:
-        for ts, src, dst in get_macs(fname):
-            srcset.add(MACaddress(src))
-            if dst != 0xffffffffffffL:
-                dstset.add(MACaddress(dst))
+    for dst, src in columns.map_files(_unique_macs, namelist, processes):
+        dstset.update(MACaddress(mac) for mac in dst.tolist())
+        srcset.update(MACaddress(mac) for mac in src.tolist())
     return dstset, srcset
 
 
+_GROUPS = ("ethertype", "proto", "ipsrc")
+
+def _summarize(fname):
+    """Partial counts for one file, that summarize() merges."""
+    part = {"first": [], "last": []}
+    for name in _GROUPS:
+        part[name + "_packets"] = []
+        part[name + "_bytes"] = []
+    with columns.PcapFile(fname) as pf:
+        for cols in pf.chunks(("ts", "length") + _GROUPS):
+            part["first"].append(cols["ts"].min())
+            part["last"].append(cols["ts"].max())
+            isip = cols["ethertype"] == columns.ETH_P_IP
+            for name in _GROUPS:
+                keys, length = cols[name], cols["length"]
+                if name != "ethertype":
+                    keys, length = keys[isip], length[isip]
+                part[name + "_packets"].append(columns.count(keys))
+                part[name + "_bytes"].append(columns.count(keys, length))
+    return part
+
+
+def summarize(namelist, processes=0):
+    """Return a dictionary of packet and byte totals, time span, and counts
+    of packets and bytes per ethertype, IP protocol, and IP source for the
+    files. The counts are (keys, counts) pairs of arrays.
+    """
+    parts = columns.map_files(_summarize, namelist, processes)
+    rv = {}
+    for name in _GROUPS:
+        for kind in ("_packets", "_bytes"):
+            rv[name + kind] = columns.merge_counts(c for part in parts for c in part[name + kind])
+    rv["packets"] = int(rv["ethertype_packets"][1].sum())
+    rv["bytes"] = int(rv["ethertype_bytes"][1].sum())
+    first = [t for part in parts for t in part["first"]]
+    last = [t for part in parts for t in part["last"]]
+    rv["start"] = min(first) if first else 0.0
+    rv["end"] = max(last) if last else 0.0
+    return rv
+
+
 class MACaddress(long):
 
     def to_cisco(self):
@@ -91,30 +143,56 @@ def to_hex(l):
 
 CISCO_CF_TEMPLATE = "mac-address-table static {mac} vlan {vlan} interface {interface}"
 
+_PROTOCOLS = {1: "icmp", 2: "igmp", 6: "tcp", 17: "udp", 41: "ipv6", 47: "gre",
+        50: "esp", 51: "ah", 89: "ospf", 103: "pim", 112: "vrrp", 132: "sctp"}
+
+
+def print_summary(summary, top=10):
+    print "Packets: %d  Bytes: %d  Duration: %.3f s" % (summary["packets"],
+            summary["bytes"], summary["end"] - summary["start"])
+    print "Ethertypes:"
+    keys, packets = summary["ethertype_packets"]
+    for key, npackets, nbytes in izip(keys, packets, summary["ethertype_bytes"][1]):
+        print "   0x%04x %12d packets %16d bytes" % (key, npackets, nbytes)
+    print "IP protocols:"
+    keys, packets = summary["proto_packets"]
+    for key, npackets, nbytes in izip(keys, packets, summary["proto_bytes"][1]):
+        print "   %-6s %12d packets %16d bytes" % (_PROTOCOLS.get(key, key), npackets, nbytes)
+    print "Top IP sources:"
+    keys, nbytes = summary["ipsrc_bytes"]
+    packets = summary["ipsrc_packets"][1]
+    for i in numpy.argsort(nbytes, kind="mergesort")[::-1][:top]:
+        print "   %-15s %12d packets %16d bytes" % (
+                socket.inet_ntoa(struct.pack("!I", keys[i])), packets[i], nbytes[i])
+
 
 def pcap_report(argv):
-    """pcapinfo [-h?] [-m] [-c] <pcap file>...
+    """pcapinfo [-h?] [-s] [-m] [-c] [-p <procs>] <pcap file>...
 
     Report information about pcap files.
     Where::
 
         -h (?)      Print this help.
+        -s          Report packet and byte counts by ethertype, IP protocol, and source.
         -m          Report the set of unique MAC addresses contained in the files.
+        -p <procs>  Read the files in this many processes.
         -c          Print Cisco style MAC addesses. Otherwise, hex strings.
         -C <fname>  Write Cisco config file for static mac entries.
         -v <id>     Supply VLAN ID for destination MAC when writing Cisco config.
         -i <intf>   Supply Cisco destination interface when writing Cisco config.
     """
     writecisco = False
+    reportsummary = False
     reportmacs = False
     ciscostyle = False
     fname = None
     vlan = None
     intf = None
+    processes = 0
     try:
-        optlist, args = getopt.getopt(argv[1:], "h?mcC:v:i:")
+        optlist, args = getopt.getopt(argv[1:], "h?smcC:v:i:p:")
     except getopt.GetoptError:
-            print smtpcli.__doc__
+            print pcap_report.__doc__
             return
     for opt, val in optlist:
         if opt in ("-?", "-h"):
@@ -123,8 +201,12 @@ def pcap_report(argv):
         elif opt == "-C":
             fname = val
             writecisco = True
+        elif opt == "-s":
+            reportsummary = True
         elif opt == "-m":
             reportmacs = True
+        elif opt == "-p":
+            processes = int(val)
         elif opt == "-v":
             vlan = int(val)
         elif opt == "-i":
@@ -136,8 +218,11 @@ def pcap_report(argv):
         print pcap_report.__doc__
         return
 
+    if reportsummary:
+        print_summary(summarize(args, processes))
+
     if reportmacs:
-        dst, src = get_unique_macs(args)
+        dst, src = get_unique_macs(args, processes=processes)
         if writecisco:
             if vlan is None or intf is None:
                 print "You need to supply vlan and interface options."
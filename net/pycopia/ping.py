@@ -14,10 +14,30 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+"""
+ICMP echo, and other ICMP queries, to many hosts at once.
+
+The Pinger here speaks ICMP itself. It uses an unprivileged ICMP datagram
+socket if the kernel allows it (see net.ipv4.ping_group_range on Linux), or a
+raw socket if we have the privilege for that. All probes of a request are kept
+in flight at the same time, so sweeping a whole network takes about as long as
+the timeout.  If no ICMP socket can be opened at all the PipePinger, using the
+SUID pyntping program, is used instead. It also answers the queries that need a
+raw socket, when the Pinger can't open one.
+"""
+
 import sys
+import os
+import struct
+import select
+import socket
+from errno import EAGAIN, EINTR, ENOBUFS
+from collections import deque
 
 from pycopia import scheduler
 from pycopia import proctools
+from pycopia.timelib import now
+from pycopia.inet.packet import icmp
 
 
 class Error(Exception):
@@ -27,13 +47,396 @@ class RebootDetectorError(Error):
     """Raised when the RebootDetector cannot verify a reboot."""
 
 
-class Pinger(proctools.ProcessPipe):
+# Probes sent between reads of the replies.
+BURST = 256
+
+_REPLIES = {
+    icmp.ICMP_ECHO: icmp.ICMP_ECHOREPLY,
+    icmp.ICMP_TSTAMP: icmp.ICMP_TSTAMPREPLY,
+    icmp.ICMP_MASKREQ: icmp.ICMP_MASKREPLY,
+}
+
+_FAILED = {
+    icmp.ICMP_ECHO: -1,
+    icmp.ICMP_TSTAMP: -1,
+    icmp.ICMP_MASKREQ: "0.0.0.0",
+}
+
+
+class _Probe(object):
+    """A single host (and TTL) being probed, over all its retries."""
+    __slots__ = ("host", "addr", "kind", "ttl", "tries", "result")
+
+    def __init__(self, host, addr, kind, ttl=None):
+        self.host = host
+        self.addr = addr
+        self.kind = kind
+        self.ttl = ttl
+        self.tries = 0
+        if ttl is None:
+            self.result = (host, _FAILED[kind])
+        else:
+            self.result = (None, -1)
+
+
+def _mstime():
+    """Milliseconds since midnight UT, as an ICMP timestamp."""
+    return int(now() % 86400 * 1000)
+
+
+def _resolve(host):
+    host = str(host)
+    try:
+        return socket.inet_ntoa(socket.inet_aton(host))
+    except socket.error:
+        pass
+    try:
+        return socket.gethostbyname(host)
+    except socket.error:
+        return None
+
+
+def _flatten(hosts):
+    for host in hosts:
+        if isinstance(host, (list, tuple)):
+            for hle in host:
+                yield hle
+        else:
+            yield host
+
+
+class Pinger(object):
+    """
+    Send ICMP queries to many hosts concurrently and collect the replies.
+
+    Methods are listed below. Each takes one or more hosts, or lists of hosts,
+    and returns a list of (host, value) tuples in the same order. A failed
+    query has a value of -1 (or "0.0.0.0" for mask).
+
+    Replies are matched to their probe by sequence number and the address of
+    the target, so late replies to an earlier probe or request are ignored.
+    The mask, timestamp, ttl and trace methods need a raw socket, so root
+    privilege. Without it they are passed on to a PipePinger.
+
+    The following attributes may also be adjusted:
+        retries  - number of probes sent again to a silent host.
+        timeout  - seconds to wait for a reply, over all retries.
+        delay    - milliseconds to pause between sends, zero for none.
+        size     - size of echo requests, including the ICMP header.
+        hops     - TTL for the ttl method, and maximum hops for trace.
+        maxinflight - maximum probes outstanding at once.
+    """
+
+    def __init__(self, retries=3, timeout=5, delay=0, size=64, hops=30,
+            maxinflight=65536, logfile=None):
+        self.retries = retries
+        self.timeout = timeout
+        self.delay = delay
+        self.size = size
+        self.hops = hops
+        self.maxinflight = maxinflight
+        self._ident = os.getpid() & 0xffff
+        self._seq = 0
+        self._sockets = {}
+        self._logfile = logfile
+        self._pipe = None
+        self._get_socket(False)
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        for sock, raw, ttl in self._sockets.values():
+            sock.close()
+        self._sockets = {}
+        if self._pipe is not None:
+            self._pipe.close()
+            self._pipe = None
+
+    def _get_socket(self, needraw):
+        """Return (socket, israw, default ttl). Prefers the unprivileged
+        datagram socket unless a raw one is needed.
+        """
+        if needraw:
+            kinds = (True,)
+        else:
+            kinds = (False, True)
+        for raw in kinds:
+            try:
+                return self._sockets[raw]
+            except KeyError:
+                pass
+        for raw in kinds:
+            try:
+                sock = socket.socket(socket.AF_INET,
+                        socket.SOCK_RAW if raw else socket.SOCK_DGRAM,
+                        socket.IPPROTO_ICMP)
+            except socket.error as err:
+                error = err
+                continue
+            sock.setblocking(False)
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+            except socket.error:
+                pass
+            entry = (sock, raw, sock.getsockopt(socket.IPPROTO_IP, socket.IP_TTL))
+            self._sockets[raw] = entry
+            return entry
+        if needraw:
+            raise Error("This query needs a raw ICMP socket: {}".format(error))
+        raise error
+
+    # ICMP methods
+    def echo(self, *hosts):
+        return self._query(icmp.ICMP_ECHO, hosts)
+
+    def reachablelist(self, *hosts):
+        """Return a sublist of only those hosts that are reachable.
+        """
+        rv = self._query(icmp.ICMP_ECHO, hosts)
+        return filter(lambda x: x[1] >= 0, rv)
+
+    def reachable(self, *hosts):
+        """Return a list of (host, reachable) tuples.
+        """
+        rv = self._query(icmp.ICMP_ECHO, hosts)
+        return map(lambda x: (x[0], x[1] >= 0), rv)
+
+    def ping(self, *hosts):
+        return self._query(icmp.ICMP_ECHO, hosts)
+
+    def mask(self, *hosts):
+        if not self._has_raw():
+            return self._get_pipe().mask(*hosts)
+        return self._query(icmp.ICMP_MASKREQ, hosts, needraw=True)
+
+    def timestamp(self, *hosts):
+        if not self._has_raw():
+            return self._get_pipe().timestamp(*hosts)
+        return self._query(icmp.ICMP_TSTAMP, hosts, needraw=True)
+
+    def ttl(self, *hosts):
+        """Return (responder, time) for an echo sent with a TTL of hops.
+        """
+        if not self._has_raw():
+            return self._get_pipe().ttl(*hosts)
+        return self._query(icmp.ICMP_ECHO, hosts, needraw=True, ttls=[self.hops])
+
+    def trace(self, *hosts):
+        """Return, per host, a list of (hop, time) tuples of the path to it.
+        All TTLs are probed at once. Silent hops are (None, -1).
+        """
+        if not self._has_raw():
+            return self._get_pipe().trace(*hosts)
+        hosts = list(_flatten(hosts))
+        ttls = range(1, self.hops + 1)
+        rv = self._query(icmp.ICMP_ECHO, hosts, needraw=True, ttls=ttls)
+        traces = []
+        for i, host in enumerate(hosts):
+            addr = _resolve(host)
+            path = []
+            for hop in rv[i * len(ttls):(i + 1) * len(ttls)]:
+                path.append(hop)
+                if hop[0] == addr:
+                    break
+            traces.append(path)
+        return traces
+
+    def _has_raw(self):
+        try:
+            self._get_socket(True)
+        except Error:
+            return False
+        return True
+
+    def _get_pipe(self):
+        """Return the PipePinger, with the current settings."""
+        if self._pipe is None:
+            self._pipe = _spawn_pipepinger(self._logfile)
+        pipe = self._pipe
+        pipe.retries = self.retries
+        pipe.timeout = self.timeout
+        pipe.delay = self.delay
+        pipe.size = self.size
+        pipe.hops = self.hops
+        return pipe
+
+    def _query(self, kind, hosts, needraw=False, ttls=None):
+        probes = []
+        for host in _flatten(hosts):
+            addr = _resolve(host)
+            if ttls is None:
+                probes.append(_Probe(host, addr, kind))
+            else:
+                for ttl in ttls:
+                    probes.append(_Probe(host, addr, kind, ttl))
+        self._run(probes, self._get_socket(needraw))
+        return [probe.result for probe in probes]
+
+    def _encode(self, probe, seq):
+        pkt = icmp.Packet()
+        pkt.type = probe.kind
+        pkt.id = self._ident
+        pkt.seq = seq
+        if probe.kind == icmp.ICMP_TSTAMP:
+            pkt.data = struct.pack("!III", _mstime(), 0, 0)
+        elif probe.kind == icmp.ICMP_MASKREQ:
+            pkt.data = "\0\0\0\0"
+        else:
+            pkt.data = "\xa5" * max(self.size - icmp.ICMP_MINLEN, 0)
+        return pkt.assemble()
+
+    def _decode(self, data, src, raw):
+        """Return the (target, seq) key and packet of a reply to one of our
+        probes, or None.
+        """
+        if raw:
+            data = data[(ord(data[0]) & 0x0f) << 2:]
+        try:
+            pkt = icmp.Packet(data)
+        except (ValueError, IndexError, struct.error):
+            return None
+        if pkt.type in (icmp.ICMP_ECHOREPLY, icmp.ICMP_TSTAMPREPLY,
+                icmp.ICMP_MASKREPLY):
+            # The kernel rewrites the id of datagram socket probes, and only
+            # gives us our own replies.
+            if raw and pkt.id != self._ident:
+                return None
+            return (src, pkt.seq), pkt
+        if pkt.type in (icmp.ICMP_TIMXCEED, icmp.ICMP_UNREACH):
+            inner = pkt.data
+            hl = (ord(inner[0]) & 0x0f) << 2 if inner else 0
+            if len(inner) < hl + icmp.ICMP_MINLEN:
+                return None
+            orig = icmp.Packet(inner[hl:hl + icmp.ICMP_MINLEN], 0)
+            if orig.id != self._ident or orig.type not in _REPLIES:
+                return None
+            return (socket.inet_ntoa(inner[16:20]), orig.seq), pkt
+        return None
+
+    def _run(self, probes, sockentry):
+        sock, raw, defttl = sockentry
+        wait = float(self.timeout) / (self.retries + 1)
+        spacing = self.delay / 1000.0
+        sendq = deque()
+        remaining = 0
+        for probe in probes:
+            if probe.addr is not None:
+                sendq.append(probe)
+                remaining += 1
+        inflight = {}
+        deadlines = deque() # in send order, so also in deadline order.
+        curttl = defttl
+        nextsend = 0.0
+        try:
+            while remaining:
+                # Retry, or give up on, probes whose wait is over.
+                t = now()
+                while deadlines and deadlines[0][0] <= t:
+                    entry = inflight.pop(deadlines.popleft()[1], None)
+                    if entry is not None:
+                        probe = entry[0]
+                        if probe.tries > self.retries:
+                            remaining -= 1
+                        else:
+                            sendq.append(probe)
+                blocked = False
+                sent = 0
+                while sendq and sent < BURST and len(inflight) < self.maxinflight:
+                    if spacing:
+                        if t < nextsend:
+                            break
+                        nextsend = t + spacing
+                    probe = sendq[0]
+                    ttl = defttl if probe.ttl is None else probe.ttl
+                    if ttl != curttl:
+                        sock.setsockopt(socket.IPPROTO_IP, socket.IP_TTL, ttl)
+                        curttl = ttl
+                    self._seq = seq = (self._seq + 1) & 0xffff
+                    try:
+                        sock.sendto(self._encode(probe, seq), (probe.addr, 0))
+                    except socket.error as err:
+                        if err.errno == EINTR:
+                            continue
+                        if err.errno in (EAGAIN, ENOBUFS):
+                            blocked = True
+                            break
+                        # Unroutable, and such. No use trying again.
+                        sendq.popleft()
+                        remaining -= 1
+                        continue
+                    sendq.popleft()
+                    probe.tries += 1
+                    sent += 1
+                    key = (probe.addr, seq)
+                    inflight[key] = (probe, t)
+                    deadlines.append((t + wait, key))
+                if not remaining:
+                    break
+                # Wait for replies, the next deadline, or room to send.
+                if sendq and not blocked and len(inflight) < self.maxinflight:
+                    timeout = max(nextsend - now(), 0.0) if spacing else 0.0
+                elif deadlines:
+                    timeout = max(deadlines[0][0] - now(), 0.0)
+                else:
+                    timeout = 0.001
+                if blocked:
+                    timeout = min(timeout, 0.001)
+                try:
+                    rl, wl, xl = select.select([sock], [], [], timeout)
+                except select.error as err:
+                    if err[0] == EINTR:
+                        continue
+                    raise
+                if rl:
+                    remaining -= self._receive(sock, raw, inflight)
+        finally:
+            if curttl != defttl:
+                sock.setsockopt(socket.IPPROTO_IP, socket.IP_TTL, defttl)
+
+    def _receive(self, sock, raw, inflight):
+        """Read all pending replies, returns the number of probes answered."""
+        answered = 0
+        while True:
+            try:
+                data, (src, port) = sock.recvfrom(4096)
+            except socket.error as err:
+                if err.errno == EINTR:
+                    continue
+                if err.errno == EAGAIN:
+                    return answered
+                raise
+            t = now()
+            decoded = self._decode(data, src, raw)
+            if decoded is None:
+                continue
+            key, pkt = decoded
+            entry = inflight.pop(key, None)
+            if entry is None:
+                continue
+            probe, sent = entry
+            ms = (t - sent) * 1000.0
+            if probe.ttl is not None:
+                probe.result = (src, ms)
+            elif pkt.type == icmp.ICMP_ECHOREPLY:
+                probe.result = (probe.host, ms)
+            elif pkt.type == icmp.ICMP_TSTAMPREPLY:
+                orig, recv, xmit = struct.unpack("!III", pkt.data[:12])
+                probe.result = (probe.host, recv - orig)
+            elif pkt.type == icmp.ICMP_MASKREPLY:
+                probe.result = (probe.host, socket.inet_ntoa(pkt.data[:4]))
+            # Unreachable leaves the failed result.
+            answered += 1
+
+
+class PipePinger(proctools.ProcessPipe):
     """
     This class is an interface to, and opens a pipe to, the pyntping program.
     This program actually does a bit more than ping, but pinging is the most
     common use.  The pyntping program is a C program that should be installed
     in your path, owned by root, with SUID bit set. This is necessary because
-    only root can open RAW sockets for ICMP operations.
+    only root can open RAW sockets for ICMP operations.  It is only used when
+    the Pinger cannot open an ICMP socket itself.
 
     Methods are listed below. Most methods take a single host, or multiple
     hosts when called. If a single host is given, a single value will be
@@ -115,12 +518,21 @@ class Pinger(proctools.ProcessPipe):
 #### end Ping
 
 ## some factory/utility functions
-def get_pinger(retries=3, timeout=5, delay=0, size=64, hops=30, logfile=None):
-    """Returns a Pinger process that you can call various ICMP methods
-    on."""
+def _spawn_pipepinger(logfile=None):
     pm = proctools.get_procmanager()
-    pinger = pm.spawnprocess(Pinger, "pyntping -b", logfile=logfile, env=None, callback=None,
+    return pm.spawnprocess(PipePinger, "pyntping -b", logfile=logfile, env=None, callback=None,
                 persistent=False, merge=True, pwent=None, async=False, devnull=False)
+
+
+def get_pinger(retries=3, timeout=5, delay=0, size=64, hops=30, logfile=None):
+    """Returns a Pinger that you can call various ICMP methods on.  This
+    falls back to a PipePinger process if ICMP sockets are not permitted.
+    """
+    try:
+        return Pinger(retries, timeout, delay, size, hops, logfile=logfile)
+    except socket.error:
+        pass
+    pinger = _spawn_pipepinger(logfile)
     pinger.retries = retries
     pinger.timeout = timeout
     pinger.delay = delay
@@ -134,7 +546,8 @@ def reachable_hosts(hostlist):
     """
     pinger = get_pinger()
     res = pinger.reachable(hostlist)
-    return map(lambda x: x[0], res)
+    pinger.close()
+    return map(lambda x: x[1], res)
 
 
 def reachable(target):
@@ -150,22 +563,16 @@ def scan_net(net):
     """
     pinger = get_pinger()
     res = pinger.reachablelist(net[1:-1])
+    pinger.close()
     return map(lambda x: x[0], res)
 
 def traceroute(hostip, maxhops=30):
     """traceroute(hostip, maxhops=30)
     return a list of (ipaddr, time) tuples tracing a path to the given hostip.
     """
-    tracelist = []
-    pinger = get_pinger()
-    for ttl in xrange(maxhops):
-        pinger.hops = ttl+1
-        nexthop = pinger.ttl(hostip)[0]
-        if nexthop[0] != hostip:
-            tracelist.append(nexthop)
-        else:
-            tracelist.append(nexthop)
-            return tracelist
+    pinger = get_pinger(hops=maxhops)
+    tracelist = pinger.trace(hostip)[0]
+    pinger.close()
     return tracelist
 
 
@@ -189,7 +596,7 @@ def ping(host, retries=3, timeout=5, delay=1, size=64, hops=30):
                 Nrecv = Nrecv + 1
                 _min = min(_min, rttime)
                 _max = max(_max, rttime)
-                print "%-16s  %d ms" % (host, rttime)
+                print "%-16s  %.3f ms" % (host, rttime)
             scheduler.sleep(pinger.delay)
     except KeyboardInterrupt:
         print "%d packets transmitted, %d packets received, %d%% packet loss" % (Nxmit, Nrecv, 100-(Nxmit/Nrecv*100))
@@ -225,7 +632,7 @@ class RebootDetector(object):
         self._pinger = get_pinger(retries, timeout, delay, size, hops)
 
     def __del__(self):
-        self._pinger.kill()
+        self._pinger.close()
 
     def go(self, callback=None):
         """Start the reboot detection.
@@ -306,7 +713,7 @@ class PoweroffDetector(object):
         self._pinger = get_pinger(retries, timeout, delay, size, hops)
 
     def __del__(self):
-        self._pinger.kill()
+        self._pinger.close()
 
     def go(self, callback=None):
         isreachable = False
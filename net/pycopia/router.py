@@ -17,6 +17,10 @@
 """
 Interface to the Linux network emulator and rate limiting features.
 
+Configuration changes are collected in a ConfigBatch, compared with the
+current state of the interfaces, and only the commands needed are applied,
+with one "tc -batch" and one "ip -batch" run.
+
 """
 
 # python 3 compatibility
@@ -25,9 +29,12 @@ from __future__ import print_function
 from __future__ import unicode_literals
 from __future__ import division
 
+import os
 import operator
 import functools
 import re
+import tempfile
+from collections import OrderedDict
 
 from pycopia import aid
 from pycopia import proctools
@@ -45,6 +52,16 @@ class RouterConfigError(Error):
     """
     pass
 
+class RouterBatchError(RouterConfigError):
+    """Raised if commands of a batch failed.
+
+    Carries the exit status, the output, and a list of (command, message)
+    tuples, one for each command that failed.
+    """
+    @property
+    def failures(self):
+        return self.args[2]
+
 class RouterConstructorError(Error):
     """Raised if you try to do something that's not possible."""
     pass
@@ -63,16 +80,32 @@ Up, Down, Level, Unknown = aid.Enums("up", "down", "level", "unknown")
 class ImpairmentsConfigurer(object):
     """Simplified interface to configuring network interfaces and path impairments.
 
+    Changes made inside a ``with router.batch():`` block are applied
+    together when the block ends. Outside of one each change is applied
+    by itself.
+
     Parameters
     ----------
     interfaces : list of str
         A list of the data interface names used in the path configuration.
+    dryrun : bool, optional
+        If true, no commands are run. The state of the interfaces is then
+        taken from the `state` attribute, which commits update, and the
+        commands that would have run are kept in the `history` attribute.
     """
 
-    def __init__(self, interfaces):
+    def __init__(self, interfaces, dryrun=False):
         self.interfaces = interfaces
+        self.dryrun = dryrun
+        self.state = RouterState()
+        self.history = []
+        self._batch = None
+        self._applied = {} # interface -> netem parameters we last set.
 
     def _perform(self, cmd):
+        if self.dryrun:
+            self.history.append(cmd)
+            return ""
         pm = proctools.get_procmanager()
         proc = pm.spawnpipe(cmd)
         out = proc.read()
@@ -82,6 +115,104 @@ class ImpairmentsConfigurer(object):
         else:
             raise RouterConfigError(int(es), out)
 
+    def batch(self):
+        r"""Return the batch that configuration changes are collected in.
+
+        Use it in a with statement. The changes are applied when the
+        outermost with block exits without an exception, and discarded if
+        it raises one.
+
+        Examples
+        --------
+        >>> with router.batch():
+        ...     router.delay("eth1", 100)
+        ...     router.loss("eth2", 1.0)
+        """
+        if self._batch is not None:
+            return self._batch
+        return ConfigBatch(self)
+
+    def _set_root(self, interface, params):
+        """Set the root qdisc parameters of interface, None to remove it."""
+        if self._batch is not None:
+            self._batch.set_root(interface, params)
+            return None
+        with self.batch() as batch:
+            batch.set_root(interface, params)
+        return batch.output
+
+    def _set_link(self, interface, up):
+        if self._batch is not None:
+            self._batch.set_link(interface, up)
+            return None
+        with self.batch() as batch:
+            batch.set_link(interface, up)
+        return batch.output
+
+    def read_state(self):
+        """Return the RouterState of the system, or the simulated one in
+        dry-run mode.
+        """
+        if self.dryrun:
+            return self.state
+        return parse_state(self._perform("tc qdisc show"), self._perform("ip -o link show"))
+
+    def _commit(self, batch):
+        state = self.read_state() if (batch.roots or batch.links) else RouterState()
+        tccmds, ipcmds = diff_commands(batch, state, self._applied)
+        tccmds.extend(batch.extra["tc"])
+        ipcmds.extend(batch.extra["ip"])
+        batch.commands = {"tc": tccmds, "ip": ipcmds}
+        output = []
+        failures = []
+        status = 0
+        for tool, commands in (("tc", tccmds), ("ip", ipcmds)):
+            if commands:
+                es, out, failed = self._run_batch(tool, commands)
+                output.append(out)
+                if es:
+                    status = es
+                    if not failed:
+                        # Nothing says which commands failed, so none is
+                        # taken to have worked.
+                        failed = [(cmd, out.strip()) for cmd in commands]
+                failures.extend(failed)
+        # Record what is now in place, so later batches can skip it.
+        failed = set(cmd for cmd, msg in failures)
+        for interface, params in batch.roots.items():
+            cmd = _root_command(interface, params)
+            if cmd not in failed:
+                self._applied[interface] = params
+                if self.dryrun:
+                    self.state.roots[interface] = None if params is None else ("netem", _netem_key(params))
+        if self.dryrun:
+            for interface, up in batch.links.items():
+                self.state.links[interface] = up
+        batch.output = "".join(output)
+        if failures:
+            raise RouterBatchError(status, batch.output, failures)
+        return batch.output
+
+    def _run_batch(self, tool, commands):
+        """Run the commands with one "tool -force -batch" invocation. Returns
+        the exit status, zero for success, output, and a list of (command,
+        message) of failed ones.
+        """
+        if self.dryrun:
+            self.history.extend("{} {}".format(tool, cmd) for cmd in commands)
+            return 0, "", []
+        fd, fname = tempfile.mkstemp(prefix="router", suffix=".batch")
+        try:
+            os.write(fd, "".join("{}\n".format(cmd) for cmd in commands).encode("ascii"))
+            os.close(fd)
+            pm = proctools.get_procmanager()
+            proc = pm.spawnpipe("{} -force -batch {}".format(tool, fname))
+            out = proc.read()
+            es = proc.wait()
+        finally:
+            os.unlink(fname)
+        return (0 if es else es.status or 1), out, _batch_failures(out, commands)
+
 
     def clear(self, interface):
         r"""clear the interface configuration.
@@ -106,14 +237,7 @@ class ImpairmentsConfigurer(object):
         --------
         >>> router.clear("eth1")
         """
-        cmd = "tc qdisc del dev {0} root".format(interface)
-        try:
-            self._perform(cmd)
-        except RouterConfigError as rerr:
-            if rerr.args[0] == 2: # Indicates it was already clear, which is ok.
-                return
-            else:
-                raise
+        self._set_root(interface, None)
 
     def show(self, interface):
         r"""Get the current interface configuration.
@@ -186,69 +310,48 @@ class ImpairmentsConfigurer(object):
         --------
         >>> delay("eth1", 1000)
         """
-        self.clear(interface)
-        cmd = "tc qdisc add dev {0} root netem delay {1}ms {2} {3} {4}".format(
-                    interface,
+        params = "netem delay {0}ms {1} {2} {3}".format(
                     milliseconds,
                     "{0}ms".format(jitter) if jitter else "",
                     "{0:2.1f}%".format(correlation) if correlation else "",
                     "distribution {0}".format(distribution) if distribution else "",
                     )
-        return self._perform(cmd)
+        return self._set_root(interface, params)
 
     def reorder(self, interface, percent, delay=10, correlation=0):
-        self.clear(interface)
-        cmd = "tc qdisc add dev {0} root netem delay {1:3.0d}ms reorder {2} {3}".format(
-                    interface,
+        params = "netem delay {0}ms reorder {1} {2}".format(
                     delay,
                     "{0:2.1f}%".format(float(percent)),
                     "{0:2.1f}%".format(correlation) if correlation else "",
                     )
-        return self._perform(cmd)
+        return self._set_root(interface, params)
 
     def corrupt(self, interface, percent):
-        self.clear(interface)
-        cmd = "tc qdisc add dev {0} root netem corrupt {1:2.1f}%".format(interface, percent)
-        return self._perform(cmd)
+        return self._set_root(interface, "netem corrupt {0:2.1f}%".format(percent))
 
     def duplication(self, interface, percent):
-        self.clear(interface)
-        cmd = "tc qdisc add dev {0} root netem duplicate {1:2.1f}%".format(interface, percent)
-        return self._perform(cmd)
+        return self._set_root(interface, "netem duplicate {0:2.1f}%".format(percent))
 
     def loss(self, interface, percent, correlation=None):
-        self.clear(interface)
-        cmd = "tc qdisc add dev {0} root netem loss {1:2.1f}% {2}".format(
-                interface,
+        params = "netem loss {0:2.1f}% {1}".format(
                 percent,
                 "{0:2.1f}%".format(correlation) if correlation else "",
                 )
-        return self._perform(cmd)
+        return self._set_root(interface, params)
 
+    # netem replaces all of its options on a change, so these are the same
+    # as the above.
     def add_corrupt(self, interface, percent):
-        cmd = "tc qdisc change dev {0} root netem corrupt {1:2.1f}%".format(interface, percent)
-        return self._perform(cmd)
+        return self.corrupt(interface, percent)
 
     def add_duplication(self, interface, percent):
-        cmd = "tc qdisc change dev {0} root netem duplicate {1:2.1f}%".format(interface, percent)
-        return self._perform(cmd)
+        return self.duplication(interface, percent)
 
     def add_reorder(self, interface, delay=10, percent=10, correlation=None):
-        cmd = "tc qdisc change dev {0} root netem delay {1:3.0d}ms reorder {2} {3}".format(
-                interface,
-                delay,
-                "{0:2.1f}%".format(float(percent)),
-                "{0:2.1f}%".format(correlation) if correlation else "",
-                )
-        return self._perform(cmd)
+        return self.reorder(interface, percent, delay, correlation)
 
     def add_loss(self, interface, percent, correlation=None):
-        cmd = "tc qdisc change dev {0} root netem loss {1:2.1f}% {2}".format(
-                interface,
-                percent,
-                "{0:2.1f}%".format(correlation) if correlation else "",
-                )
-        return self._perform(cmd)
+        return self.loss(interface, percent, correlation)
 
     def reset(self):
         r"""Reset the router impairments to normal operation.
@@ -266,11 +369,14 @@ class ImpairmentsConfigurer(object):
         --------
         >>> routercontroller.reset()
         """
-        for intf in self.interfaces:
-            self.clear(intf)
+        with self.batch():
+            for intf in self.interfaces:
+                self.clear(intf)
 
     def current(self):
-        impairments = map(self.show, self.interfaces)
+        res = self._perform("tc qdisc show")
+        impairments = [parse_report("\n".join(line for line in res.splitlines()
+                        if " dev {} ".format(intf) in line)) for intf in self.interfaces]
         if impairments:
             return functools.reduce(operator.add, impairments)
         else:
@@ -292,8 +398,9 @@ class ImpairmentsConfigurer(object):
         --------
         >>> routercontroller.down()
         """
-        for intf in self.interfaces:
-            self._perform("ip link set {} down".format(intf))
+        with self.batch():
+            for intf in self.interfaces:
+                self._set_link(intf, False)
 
     def up(self):
         r"""Bring up all data interfaces.
@@ -311,8 +418,9 @@ class ImpairmentsConfigurer(object):
         --------
         >>> routercontroller.up()
         """
-        for intf in self.interfaces:
-            self._perform("ip link set {} up".format(intf))
+        with self.batch():
+            for intf in self.interfaces:
+                self._set_link(intf, True)
 
     @staticmethod
     def get_impairment(latency=None, delay=None, jitter=None,
@@ -354,6 +462,139 @@ class ImpairmentsConfigurer(object):
         return imp
 
 
+class ConfigBatch(object):
+    """Configuration changes to be applied together.
+
+    Get one from ImpairmentsConfigurer.batch(). Only the last change to the
+    root qdisc or link state of an interface counts, and those already in
+    place are skipped. Other commands may be added as they are with add().
+    After a commit, the commands attribute holds the tc and ip commands that
+    were run, and output their output.
+    """
+
+    def __init__(self, router):
+        self._router = router
+        self._depth = 0
+        self.roots = OrderedDict() # interface -> qdisc parameters, None for none
+        self.links = OrderedDict() # interface -> True for up
+        self.extra = {"tc": [], "ip": []}
+        self.commands = None
+        self.output = None
+
+    def __enter__(self):
+        if self._depth == 0:
+            self._router._batch = self
+        self._depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self._depth -= 1
+        if self._depth == 0:
+            self._router._batch = None
+            if exc_type is None:
+                self.commit()
+        return False
+
+    def set_root(self, interface, params):
+        self.roots[interface] = params
+
+    def set_link(self, interface, up):
+        self.links[interface] = bool(up)
+
+    def add(self, tool, command):
+        """Add a command, without the "tc" or "ip", to run unconditionally."""
+        self.extra[tool].append(command)
+
+    def commit(self):
+        return self._router._commit(self)
+
+
+class RouterState(object):
+    """The root qdiscs and link states of interfaces.
+
+    roots maps an interface name to a (kind, key) tuple for a configured
+    root qdisc, where key identifies the parameters of a netem qdisc. Links
+    maps an interface name to True if it is administratively up.
+    """
+    def __init__(self, roots=None, links=None):
+        self.roots = {} if roots is None else roots
+        self.links = {} if links is None else links
+
+
+def parse_state(qdisctext, linktext=""):
+    """Make a RouterState from "tc qdisc show" and "ip -o link show" output.
+    """
+    state = RouterState()
+    for line in qdisctext.splitlines():
+        mo = re.match(r"qdisc (\S+) (\S+) dev (\S+) root", line)
+        if mo:
+            kind, handle, interface = mo.groups()
+            if handle == "0:": # the default qdisc
+                continue
+            state.roots[interface] = (kind, _netem_key(line) if kind == "netem" else None)
+    for line in linktext.splitlines():
+        mo = re.match(r"\d+: ([^:@]+)(?:@\S+)?: <([^>]*)>", line)
+        if mo:
+            state.links[mo.group(1)] = "UP" in mo.group(2).split(",")
+    return state
+
+
+def _netem_key(text):
+    """Identify netem parameters, as given or as reported by tc."""
+    line = text if text.startswith("qdisc") else "qdisc " + text
+    try:
+        options = tuple(str(opt) for opt in parse_report(line))
+    except Exception: # not understood, so never the same as a tc report.
+        return (text,)
+    mo = re.search(r"limit (\d+)", text)
+    return options + (int(mo.group(1)) if mo else 1000,)
+
+
+def _root_command(interface, params):
+    if params is None:
+        return "qdisc del dev {} root".format(interface)
+    return "qdisc replace dev {} root {}".format(interface, params)
+
+
+def diff_commands(batch, state, applied):
+    """Return the lists of tc and ip commands that take the interfaces from
+    state to the configuration of the batch. A netem qdisc is kept if we set
+    the same parameters last, and tc reports them still in place.
+    """
+    tccmds = []
+    for interface, params in batch.roots.items():
+        current = state.roots.get(interface)
+        if params is None:
+            if current is None:
+                continue
+        elif applied.get(interface) == params and current == ("netem", _netem_key(params)):
+            continue
+        tccmds.append(_root_command(interface, params))
+    ipcmds = []
+    for interface, up in batch.links.items():
+        if state.links.get(interface) != up:
+            ipcmds.append("link set {} {}".format(interface, "up" if up else "down"))
+    return tccmds, ipcmds
+
+
+def _batch_failures(output, commands):
+    """Map the errors in tc or ip -batch output to the commands they are
+    for. The messages for a command come before its "Command failed" line.
+    """
+    failures = []
+    messages = []
+    for line in output.splitlines():
+        mo = re.match(r"Command failed \S+:(\d+)", line)
+        if mo:
+            index = int(mo.group(1)) - 1
+            if 0 <= index < len(commands):
+                failures.append((commands[index], "\n".join(messages)))
+            messages = []
+        elif line.strip():
+            messages.append(line.strip())
+    return failures
+
+
 class Percent(float):
     _symbol = "%"
 
@@ -663,18 +904,17 @@ class Impairment(object):
         if self._parent is not None:
             raise RouterConstructorError("May only apply to root impairment.")
         oldimp = router.current()
-        router.reset()
-        if not self._impairments:
-            return
-        n = len(router.interfaces)
-        parms = self.netem_command(n)
-        if self._nodeid == "root":
-            change = "add"
-        else:
-            change = "change"
-        for intf in router.interfaces:
-            cmd = "tc qdisc {} dev {} {} {}".format(change, intf, self._nodeid, parms)
-            router._perform(cmd)
+        with router.batch() as batch:
+            router.reset()
+            if not self._impairments:
+                return
+            n = len(router.interfaces)
+            parms = self.netem_command(n)
+            for intf in router.interfaces:
+                if self._nodeid == "root":
+                    router._set_root(intf, parms)
+                else:
+                    batch.add("tc", "qdisc change dev {} {} {}".format(intf, self._nodeid, parms))
         # TODO apply child impairments
         return oldimp
 
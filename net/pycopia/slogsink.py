@@ -25,12 +25,24 @@ The slogsink C program is used because the syslog port is a privileged
 port, and requires root access to open. The slogsink program should have
 been install SUID to root.
 
+Messages are received in batches (with recvmmsg(2) when the fdio extension
+is available), and only decoded when a field of one is used. A Syslog object
+given a queue size writes its files from a separate thread, counting the
+messages it has to drop when the queue is full.
+
 """
 
 
 import os, sys, struct
 import re
-from errno import EAGAIN
+import Queue
+import threading
+from errno import EAGAIN, EINTR
+
+try:
+    from pycopia import fdio
+except ImportError:
+    fdio = None
 
 from pycopia import socket
 from pycopia import asyncio
@@ -78,6 +90,14 @@ PRIORITY = {
 _default_addr=("", 514)
 _user_default_addr = ("", 10514)
 
+# Datagrams read per system call, and the slot for each.
+BATCH = 64
+MAXMSG = 4096
+# Batches read per wakeup, so a flood does not starve the rest of the loop.
+MAXBATCHES = 16
+# Messages nmslog holds for its writer thread.
+QUEUESIZE = 65536
+
 
 class SyslogMessage(object):
     def __init__(self, msg, fac, pri, host=None, timestamp=None, tag=""):
@@ -101,6 +121,43 @@ class SyslogMessage(object):
 
 
 
+class RawSyslogMessage(SyslogMessage):
+    """A message as received. It is only decoded when its fields are used.
+    """
+    def __init__(self, rawmsg, srcip, timestamp):
+        self._raw = rawmsg
+        self._srcip = srcip
+        self.timestamp = timestamp
+        self.tag = ""
+
+    def __getattr__(self, name):
+        if name in ("message", "facility", "priority"):
+            self._decode()
+            return self.__dict__[name]
+        if name == "host":
+            self.host = IPv4(self._srcip)
+            return self.host
+        raise AttributeError(name)
+
+    def _decode(self):
+        msg = self._raw
+        # user.notice, as RFC 3164 says, if there is no valid PRI part.
+        self.facility, self.priority = 1, 5
+        if msg.startswith("<"):
+            end = msg.find(">", 1, 5)
+            if end > 1 and msg[1:end].isdigit():
+                code = int(msg[1:end])
+                self.facility, self.priority = code >> 3, code & 0x07
+                msg = msg[end + 1:]
+        end = msg.find("\n")
+        if end >= 0:
+            msg = msg[:end]
+        self.message = msg
+
+    def __str__(self):
+        return "%.2f|%s|%s: %s" % (self.timestamp, self._srcip, self.tag, self.message)
+
+
 _MSG_RE = re.compile("<(\d+?)>(.*)")
 def parse_message(timestamp, srcip, rawmsg):
     mo = _MSG_RE.search(rawmsg)
@@ -110,11 +167,16 @@ def parse_message(timestamp, srcip, rawmsg):
     return SyslogMessage(msg, fac, pri, srcip, timestamp)
 
 
+# Record from the slogsink program: IP and port in network byte-order, then
+# the message length in host byte-order, then the message.
+_RECORD = struct.Struct("=4s2si")
+
 class SlogDispatcher(socket.AsyncSocket):
     def __init__(self, callback, addr=_default_addr):
         super(SlogDispatcher, self).__init__(socket.AF_UNIX, socket.SOCK_STREAM)
         loc, port = addr
         self.callback = callback # should be a callable object
+        self._inbuf = ""
         self.connect("/tmp/.slog-%d" % (port,))
 
     def writable(self):
@@ -127,18 +189,31 @@ class SlogDispatcher(socket.AsyncSocket):
         print >> sys.stderr, "*** Dispatcher:", ex, val
 
     def read(self):
-        ip = struct.unpack("!i", self.recv(4))[0] # network byte-order
-        port = struct.unpack("!h", self.recv(2))[0] # network byte-order
-        length = struct.unpack("i", self.recv(4))[0] # host byte-order
-        msg = self.recv(length)
-        assert length == len(msg)
-        return self.callback(parse_message(now(), IPv4(ip), msg))
+        buf = self._inbuf + self.recv(65536)
+        timestamp = now()
+        callback = self.callback
+        hdrsize = _RECORD.size
+        pos = 0
+        while len(buf) - pos >= hdrsize:
+            ip, port, length = _RECORD.unpack_from(buf, pos)
+            end = pos + hdrsize + length
+            if end > len(buf):
+                break
+            callback(RawSyslogMessage(buf[pos + hdrsize:end], socket.inet_ntoa(ip), timestamp))
+            pos = end
+        self._inbuf = buf[pos:]
 
 
 class UserSlogDispatcher(socket.AsyncSocket):
     def __init__(self, callback, addr=_user_default_addr):
         super(UserSlogDispatcher, self).__init__(socket.AF_INET, socket.SOCK_DGRAM)
         self.callback = callback # should be a callable object
+        self.setblocking(0)
+        try:
+            self.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+        except socket.SocketError:
+            pass
+        self._recvbuf = bytearray(BATCH * MAXMSG)
         self.bind(addr)
 
     def writable(self):
@@ -151,24 +226,54 @@ class UserSlogDispatcher(socket.AsyncSocket):
         print "*** Dispatcher:", ex, val
 
     def read(self):
-        try:
-            while 1:
-                msg, addr = self.recvfrom(4096, socket.MSG_DONTWAIT)
-                self.callback(parse_message(now(), IPv4(addr[0]), msg))
-        except socket.SocketError, err:
-            if err[0] == EAGAIN:
+        callback = self.callback
+        for i in xrange(MAXBATCHES):
+            msgs = self.recvbatch()
+            if not msgs:
                 return
-            else:
+            timestamp = now()
+            for msg, addr in msgs:
+                callback(RawSyslogMessage(msg, addr[0], timestamp))
+
+    def recvbatch(self):
+        """Return a list of the (message, address) pairs waiting, up to
+        BATCH of them.
+        """
+        if fdio is not None:
+            return fdio.recvmmsg(self.fileno(), self._recvbuf, MAXMSG)
+        msgs = []
+        while len(msgs) < BATCH:
+            try:
+                msgs.append(self.recvfrom(MAXMSG, socket.MSG_DONTWAIT))
+            except socket.SocketError, err:
+                if err[0] == EINTR:
+                    continue
+                if err[0] == EAGAIN:
+                    break
                 raise
+        return msgs
 
 
 class Syslog(object):
-    """A syslog program object."""
-    def __init__(self, files=None):
+    """A syslog program object.
+
+    If queuesize is given messages are queued, up to that many, and written
+    to the files by a writer thread. Messages that arrive when the queue is
+    full are counted in the dropped attribute, not written.
+    """
+    def __init__(self, files=None, queuesize=0):
         self._FLIST = []
+        self.dropped = 0
+        self._queue = None
+        self._writer = None
         if files:
             assert type(files) is list
             self.openlogs(files)
+        if queuesize:
+            self._queue = Queue.Queue(queuesize)
+            self._writer = threading.Thread(target=self._write_queued, name="syslog writer")
+            self._writer.daemon = True
+            self._writer.start()
 
     logfiles = property(lambda s: s._FLIST[:])
 
@@ -197,6 +302,11 @@ class Syslog(object):
             fp.write(msg)
 
     def close(self):
+        if self._writer is not None:
+            self._queue.put(None)
+            self._writer.join()
+            self._writer = None
+            self._queue = None
         while self._FLIST:
             fn = self._FLIST.pop()
             if not fn.name.startswith("<"):
@@ -204,14 +314,42 @@ class Syslog(object):
 
     def flush(self):
         asyncio.poller.poll(0)
+        if self._queue is not None:
+            self._queue.join()
         for fp in self._FLIST:
             fp.flush()
 
     def dispatch(self, msg):
+        if self._queue is not None:
+            try:
+                self._queue.put_nowait(msg)
+            except Queue.Full:
+                self.dropped += 1
+            return
         for fp in self._FLIST:
             fp.write(str(msg)) # XXX
             fp.write("\n")
 
+    def _write_queued(self):
+        queue = self._queue
+        while True:
+            msgs = [queue.get()]
+            try:
+                while len(msgs) < 1024:
+                    msgs.append(queue.get_nowait())
+            except Queue.Empty:
+                pass
+            done = None in msgs
+            try:
+                self.write("".join(["%s\n" % (msg,) for msg in msgs if msg is not None]))
+            except: # keep writing what follows
+                ex, val, tb = sys.exc_info()
+                print >>sys.stderr, "*** Syslog writer:", ex, val
+            for msg in msgs:
+                queue.task_done()
+            if done:
+                return
+
 
 class SyslogApp(object):
     def __init__(self, syslog, ps1="%Isyslog%N> "):
@@ -248,6 +386,11 @@ class SyslogCLI(CLI.BaseCommands):
     Flush all of the log files."""
         self._obj.flush()
 
+    def dropped(self, argv):
+        """dropped
+    Show how many messages were dropped because the writer fell behind."""
+        self._print(self._obj.dropped)
+
     def ctime(self, argv):
         """ctime <timeval>
     Expand <timeval> (a float) to a readable form."""
@@ -327,7 +470,7 @@ port to listen to.
             print __doc__
             return
 
-    sl = Syslog(args)
+    sl = Syslog(args, queuesize=QUEUESIZE)
     get_dispatcher(("", port), sl.dispatch)
     sl.addlog(sys.stdout)
     print "Logging started. Listening on UDP port %d. You may type manual entries at will." % (port,)
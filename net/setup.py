@@ -30,6 +30,9 @@ setup (name=NAME, version=VERSION,
 #                        'pyopenssl>=0.13',
 #                        'iso8601>=0.1.4',
 #                        ],
+    extras_require = {
+            "pcap": ["numpy>=1.6"],
+                },
     dependency_links = [
             "http://www.pycopia.net/download/"
                 ],
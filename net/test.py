@@ -3,6 +3,8 @@
 Network package unit tests.
 """
 
+import os
+import struct
 import unittest
 
 from pycopia import clientserver
@@ -25,12 +27,232 @@ from pycopia.clientserver.servers import udp
 from pycopia.measure import Counters
 
 
+def _make_frame(i):
+    """Return a synthetic Ethernet frame, and the field values it should
+    decode to."""
+    dst = 0xffffffffffff if i % 11 == 0 else 0x020000000000 + i % 5
+    src = 0x020000000100 + i % 7
+    exp = dict(dst=dst, src=src, vlan=0, ethertype=0x0800, ipsrc=0, ipdst=0,
+            proto=0, sport=0, dport=0)
+    if i % 13 == 0: # ARP
+        exp["ethertype"] = 0x0806
+        payload = "\0" * 28
+    else:
+        exp["proto"] = (6, 17, 1)[i % 3]
+        exp["ipsrc"] = 0x0a000000 + i % 9
+        exp["ipdst"] = 0xc0a80000 + i % 4
+        options = "\x01\x01\x01\x01" if i % 4 == 0 else ""
+        frag = 0x2000 if i % 10 == 0 else 0 # more fragments, offset 0
+        if i % 17 == 0:
+            frag = 185 # not the first fragment, no ports.
+        if exp["proto"] == 1:
+            l4 = "\x08\0\0\0\0\0\0\0"
+        else:
+            l4 = struct.pack("!HH", 1024 + i, 80 + i % 3) + "\0" * 16
+            if frag & 0x1fff == 0:
+                exp["sport"], exp["dport"] = 1024 + i, 80 + i % 3
+        hl = (20 + len(options)) // 4
+        payload = struct.pack("!BBHHHBBHII", 0x40 | hl, 0, 20 + len(options) + len(l4),
+                i, frag, 64, exp["proto"], 0, exp["ipsrc"], exp["ipdst"]) + options + l4
+    if i % 6 == 0:
+        exp["vlan"] = 100 + i % 3
+        eth = struct.pack("!HHH", 0x8100, 0x2000 | exp["vlan"], exp["ethertype"])
+    else:
+        eth = struct.pack("!H", exp["ethertype"])
+    frame = struct.pack("!Q", dst)[2:] + struct.pack("!Q", src)[2:] + eth + payload
+    return frame, exp
+
+
+def _write_pcap(fname, count, endian="<", nanosecond=False, cut=None):
+    """Write a synthetic capture, returns the expected columns. Every
+    cut packets is captured only up to the IP addresses."""
+    exps = []
+    with open(fname, "wb") as fo:
+        fo.write(struct.pack(endian + "IHHiIII", 0xa1b23c4d if nanosecond else 0xa1b2c3d4,
+                2, 4, 0, 0, 65535, 1))
+        for i in range(count):
+            frame, exp = _make_frame(i)
+            data = frame
+            if cut and i % cut == 0:
+                data = frame[:30]
+                for name in ("ipsrc", "ipdst", "proto", "sport", "dport"):
+                    exp[name] = 0
+            exp["ts"] = 1000 + i + (i * 1000) * (1e-9 if nanosecond else 1e-6)
+            exp["caplen"] = len(data)
+            exp["length"] = len(frame)
+            exps.append(exp)
+            fo.write(struct.pack(endian + "IIII", 1000 + i, i * 1000, len(data), len(frame)))
+            fo.write(data)
+        fo.write(struct.pack(endian + "IIII", 0, 0, 100, 100) + "\0" * 20) # cut off
+    return exps
+
+
 class NetTests(unittest.TestCase):
 
     def test_ping(self):
         """Run a ping."""
         self.assert_(bool(ping.reachable("localhost")))
 
+    def test_ping_sweep(self):
+        """Sweep a loopback network, all probes in flight at once."""
+        from pycopia import ipv4
+        pinger = ping.get_pinger(retries=1, timeout=2)
+        hosts = [str(h) for h in ipv4.IPv4("127.4.0.0/20")[1:-1]]
+        res = pinger.reachable(hosts + ["127.4.0.1"])
+        pinger.close()
+        self.assertEqual([h for h, r in res], hosts + ["127.4.0.1"])
+        self.assert_(all(r for h, r in res))
+
+    def test_ping_sequence(self):
+        """Replies are matched to their own probe, across requests."""
+        pinger = ping.get_pinger(retries=0, timeout=1)
+        for i in range(3):
+            res = pinger.echo("127.0.0.1", ["127.0.0.2", "127.0.0.1"])
+            self.assertEqual([h for h, t in res], ["127.0.0.1", "127.0.0.2", "127.0.0.1"])
+            self.assert_(all(0 <= t < 1000 for h, t in res))
+        pinger.close()
+
+    def test_ping_raw_fallback(self):
+        """Raw queries go to the PipePinger when there is no raw socket."""
+        class NoRawPinger(ping.Pinger):
+            def _get_socket(self, needraw):
+                if needraw:
+                    raise ping.Error("This query needs a raw ICMP socket")
+                return super(NoRawPinger, self)._get_socket(needraw)
+        pinger = NoRawPinger(retries=1, timeout=2, hops=4)
+        try:
+            path = pinger.trace("127.0.0.1")[0]
+            self.assert_(isinstance(pinger._pipe, ping.PipePinger))
+            self.assertEqual(pinger._pipe.hops, 4)
+            self.assert_(path)
+        finally:
+            pinger.close()
+        self.assert_(pinger._pipe is None)
+
+    def test_slogsink_batch(self):
+        """Datagrams are read in batches and written by the writer thread."""
+        import socket, tempfile
+        out = tempfile.NamedTemporaryFile()
+        sl = slogsink.Syslog(queuesize=1000)
+        sl.addlog(out.file)
+        dispatcher = slogsink.UserSlogDispatcher(sl.dispatch, ("127.0.0.1", 0))
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for i in range(200):
+            sock.sendto("<%d>host app: message %d\n" % (i % 192, i), dispatcher.getsockname())
+        sock.sendto("no priority", dispatcher.getsockname())
+        dispatcher.read()
+        sl.flush()
+        lines = open(out.name).read().splitlines()
+        sl.close()
+        self.assertEqual(sl.dropped, 0)
+        self.assertEqual(len(lines), 201)
+        self.assert_(lines[5].endswith("|127.0.0.1|: host app: message 5"))
+        self.assert_(lines[-1].endswith(": no priority"))
+        dispatcher.close()
+        sock.close()
+
+    def test_pcap_columns(self):
+        """Columns read from synthetic captures match what was written."""
+        import tempfile, numpy
+        from pycopia.pcap import columns
+        fname = tempfile.mktemp(".pcap")
+        try:
+            for endian, nanosecond, cut in (("<", False, None), (">", True, 5)):
+                exps = _write_pcap(fname, 500, endian, nanosecond, cut)
+                with columns.PcapFile(fname) as pf:
+                    cols = pf.read()
+                    chunked = list(pf.chunks(chunksize=7))
+                for name in columns.FIELDS:
+                    expected = [exp[name] for exp in exps]
+                    if name == "ts":
+                        self.assert_(numpy.allclose(cols[name], expected, rtol=0, atol=1e-6))
+                    else:
+                        self.assertEqual(cols[name].tolist(), expected, name)
+                    self.assert_((numpy.concatenate([c[name] for c in chunked]) == cols[name]).all())
+                keys, counts = columns.file_count(fname, "ethertype", "length", chunksize=64)
+                self.assertEqual(keys.tolist(), [0x0800, 0x0806])
+                self.assertEqual(counts.sum(), sum(exp["length"] for exp in exps))
+        finally:
+            os.unlink(fname)
+
+    def test_pcap_report(self):
+        """MAC and summary reports over several files, in processes."""
+        import tempfile
+        from pycopia.pcap import report
+        fnames = [tempfile.mktemp(".pcap") for i in range(3)]
+        try:
+            exps = []
+            for fname in fnames:
+                exps.extend(_write_pcap(fname, 300))
+            dstset, srcset = report.get_unique_macs(fnames, processes=2)
+            self.assertEqual(srcset, set(exp["src"] for exp in exps))
+            self.assertEqual(dstset, set(exp["dst"] for exp in exps) - set([0xffffffffffff]))
+            self.assertEqual(str(max(srcset)), "02:00:00:00:01:06")
+            summary = report.summarize(fnames, processes=2)
+            self.assertEqual(summary["packets"], len(exps))
+            self.assertEqual(summary["bytes"], sum(exp["length"] for exp in exps))
+            keys, packets = summary["proto_packets"]
+            self.assertEqual(dict(zip(keys.tolist(), packets.tolist())),
+                    dict((p, sum(1 for exp in exps if exp["proto"] == p)) for p in (1, 6, 17)))
+        finally:
+            for fname in fnames:
+                os.unlink(fname)
+
+    def test_router_batch(self):
+        """Impairment commands are collected, diffed, and batched."""
+        from pycopia import router
+        r = router.ImpairmentsConfigurer(["eth1", "eth2", "eth3"], dryrun=True)
+        r.state = router.parse_state(
+                "qdisc noqueue 0: dev eth1 root refcnt 2\n"
+                "qdisc htb 1: dev eth2 root refcnt 2 r2q 10 default 0\n"
+                "qdisc netem 8001: dev eth3 root refcnt 2 limit 1000 delay 100.0ms  10.0ms 25%\n",
+                "2: eth1@if7: <BROADCAST,MULTICAST,UP,LOWER_UP> mtu 1500\n"
+                "3: eth2: <BROADCAST,MULTICAST> mtu 1500\n")
+        with r.batch() as batch:
+            r.loss("eth1", 5.0)
+            r.delay("eth1", 100, 10, 25) # replaces the loss.
+            r.clear("eth2")
+            r.up()
+        self.assertEqual(batch.commands["tc"], [
+                "qdisc replace dev eth1 root netem delay 100ms 10ms 25.0% ",
+                "qdisc del dev eth2 root"])
+        self.assertEqual(batch.commands["ip"], ["link set eth2 up", "link set eth3 up"])
+        # Only what differs from the state left by the last batch is done.
+        with r.batch() as batch:
+            r.delay("eth1", 100, 10, 25)
+            r.clear("eth2")
+            r.loss("eth3", 1.0)
+            r.up()
+        self.assertEqual(batch.commands, {"tc": ["qdisc replace dev eth3 root netem loss 1.0% "], "ip": []})
+        # An exception discards the batch.
+        count = len(r.history)
+        try:
+            with r.batch():
+                r.down()
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(len(r.history), count)
+        failures = router._batch_failures(
+                'Error: Specified qdisc kind is unknown.\nCommand failed /tmp/x:1\n'
+                'Cannot find device "eth9"\nCommand failed /tmp/x:3\n', ["a", "b", "c"])
+        self.assertEqual(failures, [("a", "Error: Specified qdisc kind is unknown."),
+                ("c", 'Cannot find device "eth9"')])
+        # A failed run with no "Command failed" lines fails all its commands.
+        applied = dict(r._applied)
+        r._run_batch = lambda tool, commands: (2, "RTNETLINK answers: Operation not permitted\n", [])
+        try:
+            with r.batch():
+                r.loss("eth2", 2.0)
+        except router.RouterBatchError as err:
+            self.assertEqual(err.args[0], 2)
+            self.assertEqual(err.args[1], "RTNETLINK answers: Operation not permitted\n")
+            self.assertEqual(err.failures, [("qdisc replace dev eth2 root netem loss 2.0% ",
+                    "RTNETLINK answers: Operation not permitted")])
+        else:
+            self.fail("RouterBatchError not raised")
+        self.assertEqual(r._applied, applied)
+
     def test_runningaverage(self):
         rc = Counters.RunningAverage()
         rc.update(1200)
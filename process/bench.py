@@ -0,0 +1,235 @@
+#!/usr/bin/python2.7
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Benchmarks for the process package.
+
+Usage: bench.py [-s <megabytes>] [-r <megabytes>]
+
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import sys
+import os
+import getopt
+
+from pycopia import proctools
+from pycopia import expect
+from pycopia.timelib import now
+
+LINE = b"Ethernet0/1 is up, line protocol is up, 1000 packets input\n"
+PROMPT = b"router# "
+
+
+def _make_output(kilobytes):
+    fname = "/tmp/pycopia_bench_{}".format(os.getpid())
+    count = (kilobytes * 1024) // len(LINE)
+    with open(fname, "wb") as fo:
+        block = LINE * 1000
+        for i in range(count // 1000):
+            fo.write(block)
+        fo.write(LINE * (count % 1000))
+        fo.write(PROMPT)
+    return fname
+
+
+def _bytewise_expect(exp, patt, timeout=None):
+    """The previous expect loop, for comparison."""
+    so = expect.compile_exact(patt)
+    buf = bytes()
+    while 1:
+        c = exp.read(1, timeout)
+        if not c:
+            raise expect.ExpectError("EOF during expect.")
+        buf += c
+        mo = so.search(buf)
+        if mo:
+            return mo
+
+
+def bench_expect(kilobytes, method):
+    fname = _make_output(kilobytes)
+    try:
+        proc = proctools.spawnpty("cat {}".format(fname))
+        exp = expect.Expect(proc, prompt=PROMPT, timeout=60)
+        start = now()
+        method(exp)
+        elapsed = now() - start
+        exp.close()
+        proc.wait()
+    finally:
+        os.unlink(fname)
+    print("{:>24s}: {:9d} KB in {:8.3f} s, {:9.3f} MB/s".format(
+            method.__name__, kilobytes, elapsed, kilobytes / 1024 / elapsed))
+
+
+def chunked(exp):
+    exp.expect([b"% Invalid input", PROMPT, b"--More--"])
+
+def bytewise(exp):
+    _bytewise_expect(exp, PROMPT)
+
+
+# The sort of list a device driver passes to expect.
+DRIVER_PATTERNS = [b"router# ", b"router> ", b"router(config)# ", b"router(config-if)# ",
+        b"--More--", b" --More-- ", b"[confirm]", b"(y/n)", b"[yes/no]",
+        b"Password:", b"password:", b"Username:", b"login:",
+        b"% Invalid input", b"% Incomplete command", b"% Ambiguous command",
+        b"% Unknown command", b"% Bad IP address", b"% Bad mask",
+        b"% Access denied", b"% Authorization failed",
+        b"%SYS-5-CONFIG_I", b"%SYS-3-CPUHOG", b"%LINK-3-UPDOWN",
+        b"%LINEPROTO-5-UPDOWN", b"%SYS-2-MALLOCFAIL",
+        b"Connection closed", b"Connection refused", b"Connection timed out",
+        b"Destination filename", b"Source filename", b"Address or name",
+        b"Proceed with reload?", b"System configuration has been modified",
+        b"Building configuration...", b"Translating ", b"Invalid command",
+        ]
+
+
+def _per_pattern(solist, buf, scanned):
+    """Each pattern searched on its own, for comparison."""
+    best = None
+    for i, (so, cb) in enumerate(solist):
+        mo = so.search(buf, max(0, scanned - len(so.pattern) + 1))
+        if mo and (best is None or mo.end() < best[0].end()):
+            best = (mo, i, cb)
+    return best
+
+
+def bench_patterns(count=2000):
+    solist = [(expect.compile_exact(p), None) for p in DRIVER_PATTERNS]
+    patternset = expect.PatternSet(solist)
+    buf = (LINE * (expect.CHUNKSIZE // len(LINE) + 1))[:expect.CHUNKSIZE]
+    for name, func, arg in (("per pattern", _per_pattern, solist),
+                            ("PatternSet", lambda ps, b, s: ps.search(b, s), patternset)):
+        start = now()
+        for i in range(count):
+            func(arg, buf, 0)
+        elapsed = now() - start
+        print("{:>24s}: {} patterns, {:8.3f} ms per {} byte chunk".format(
+                name, len(solist), elapsed / count * 1000, len(buf)))
+
+
+class _OldReader(object):
+    """The previous Process read methods, for comparison."""
+    def __init__(self, proc):
+        self._read = proc._read
+        self._buf = b""
+
+    def read(self, amt=2147483646):
+        bs = len(self._buf)
+        try:
+            while bs < amt:
+                c = self._read(4096)
+                if not c:
+                    break
+                self._buf += c
+                bs = len(self._buf)
+        except EOFError:
+            pass
+        data = self._buf[:amt]
+        self._buf = self._buf[amt:]
+        return data
+
+    def readline(self, amt=2147483646):
+        bufs = []
+        rs = min(100, amt)
+        while 1:
+            c = self.read(rs)
+            i = c.find(b"\n")
+            if i < 0 and len(c) > amt:
+                i = amt-1
+            elif amt <= i:
+                i = amt-1
+            if i >= 0 or c == b'':
+                bufs.append(c[:i+1])
+                self._buf = c[i+1:] + self._buf
+                return b"".join(bufs)
+            bufs.append(c)
+            amt -= len(c)
+            rs = min(amt, rs*2)
+
+
+def _read_all(reader):
+    return len(reader.read())
+
+def _read_chunks(reader):
+    total = 0
+    while 1:
+        data = reader.read(65536)
+        if not data:
+            return total
+        total += len(data)
+
+def _read_lines(reader):
+    total = 0
+    readline = reader.readline
+    while 1:
+        line = readline()
+        if not line:
+            return total
+        total += len(line)
+
+def _iter_lines(reader):
+    total = 0
+    for line in reader:
+        total += len(line)
+    return total
+
+
+# Writes about the given number of megabytes of LINE to stdout.
+_WRITER = 'import sys; [sys.stdout.write(("{}" + chr(10)) * 1000) for i in range({})]'
+
+def bench_read(megabytes, name, func, old):
+    cmd = _WRITER.format(LINE.strip(), megabytes * 1024 * 1024 // (len(LINE) * 1000))
+    proc = proctools.spawnpipe("{} -c '{}'".format(sys.executable, cmd))
+    reader = _OldReader(proc) if old else proc
+    start = now()
+    total = func(reader)
+    elapsed = now() - start
+    proc.close()
+    proc.wait()
+    print("{:>24s}: {:9d} MB in {:8.3f} s, {:9.3f} MB/s".format(
+            name + (" (old)" if old else ""), total >> 20, elapsed, total / 1e6 / elapsed))
+
+
+def main(argv):
+    megabytes = 100
+    readmegabytes = 500
+    opts, args = getopt.getopt(argv[1:], "s:r:")
+    for opt, optarg in opts:
+        if opt == "-s":
+            megabytes = int(optarg)
+        elif opt == "-r":
+            readmegabytes = int(optarg)
+    bench_expect(megabytes * 1024, chunked)
+    # The old engine is quadratic, so give it a much smaller load.
+    bench_expect(64, chunked)
+    bench_expect(64, bytewise)
+    bench_patterns()
+    for name, func in (("read(65536)", _read_chunks), ("readline", _read_lines),
+            ("read", _read_all)):
+        bench_read(readmegabytes, name, func, False)
+        # Reading everything at once was quadratic before.
+        bench_read(readmegabytes if func is not _read_all else 16, name, func, True)
+    bench_read(readmegabytes, "iteration", _iter_lines, False)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
+
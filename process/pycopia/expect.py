@@ -28,9 +28,10 @@ interacting with processes.
 import sys, os
 import re
 from errno import EINTR
+from functools import reduce
 
 from pycopia import scheduler
-from pycopia.stringmatch import compile_exact
+from pycopia.stringmatch import compile_exact, StringExpression
 
 if sys.version_info.major == 3:
     basestring = str
@@ -40,6 +41,18 @@ EXACT = 1 # string match (fastest)
 GLOB = 2 # POSIX shell style match, but really uses regular expressions
 REGEX = 3 # slow but powerful RE match
 
+# Size of the reads used when searching for patterns. The wrapped object
+# should return less than this if that is all that is available.
+CHUNKSIZE = 16384
+# Amount of already searched data that is searched again by regular
+# expressions when new data arrives. A regular expression match that takes in
+# new data must not start more than this before it. Exact strings have no such
+# limit, and the whole buffer is kept, so that anchors and lookbehind
+# assertions see the same text however it was read.
+OVERLAP = 1024
+# Exact strings that start with at least this many of the same bytes are
+# found with a single scan for the part they have in common.
+PREFIXLEN = 4
 
 
 class ExpectError(Exception):
@@ -65,6 +78,12 @@ The wrapped object need only implement the following methods:
         restart(bool)  - Turn on or off system call restart.
         dup()          - Duplicate the object and file descriptor (for cloning)
         interrupt()    - Interrupt the wrapped object (usually a process object)
+        read1(n)       - Read up to n bytes, blocking only if nothing is
+                         available. Used by expect and read_until to read
+                         in chunks. Without it they read one byte at a time.
+
+Any data read past the end of a match is kept, and returned first by
+subsequent reads.
 
 """
     def __init__(self, fo=None, prompt="$", timeout=90.0, logfile=None, engine=None):
@@ -82,7 +101,10 @@ The wrapped object need only implement the following methods:
         self.cmd_interp = None
         self._prompt = prompt.encode()
         self._patt_cache = {}
-        self._buf = ''
+        self._buf = b""
+        self._read1 = getattr(fo, "read1", None)
+        self.chunksize = CHUNKSIZE
+        self.overlap = OVERLAP
         self.eof = 0
         self.sched = scheduler.get_scheduler()
         self._engine = engine
@@ -162,17 +184,17 @@ delegates this to the wrapped Process object. Otherwise, does nothing."""
 
     def _get_re(self, patt, mtype=EXACT, callback=None):
         try:
-            return self._patt_cache[patt]
+            return self._patt_cache[patt], callback
         except KeyError:
             if mtype == EXACT:
-                self._patt_cache[patt] = p = (compile_exact(patt), callback)
-                return p
+                self._patt_cache[patt] = so = compile_exact(patt)
+                return so, callback
             elif mtype == GLOB:
-                self._patt_cache[patt] = p = (re.compile(glob_translate(patt)), callback)
-                return p
+                self._patt_cache[patt] = so = re.compile(glob_translate(patt))
+                return so, callback
             elif mtype == REGEX:
-                self._patt_cache[patt] = p = (re.compile(patt), callback)
-                return p
+                self._patt_cache[patt] = so = re.compile(patt)
+                return so, callback
 
     def _get_search_list(self, patt, mtype, callback, solist=None):
         if solist is None:
@@ -185,9 +207,25 @@ delegates this to the wrapped Process object. Otherwise, does nothing."""
         elif ptype is list:
             map(lambda p: self._get_search_list(p, mtype, callback, solist), patt)
         elif patt is None:
-            return self._patt_cache.values()
+            return [(so, callback) for so in self._patt_cache.values()
+                    if not isinstance(so, PatternSet)]
         return solist
 
+    # The cached PatternSet holds no callbacks, so that a new callback object
+    # on each call doesn't add an entry. They are bound to it per call.
+    def _get_pattern_set(self, patt, mtype, callback):
+        solist = self._get_search_list(patt, mtype, callback)
+        if patt is None:
+            return PatternSet(solist)
+        key = (_freeze(patt), mtype)
+        try:
+            ps = self._patt_cache[key]
+        except KeyError:
+            self._patt_cache[key] = ps = PatternSet([(so, None) for so, cb in solist])
+        except TypeError: # something in the list can't be a key.
+            return PatternSet(solist)
+        return ps.bind([cb for so, cb in solist])
+
     # the expect method supports a very flexible calling signature. thus,
     # the convoluted type checking, etc.  You may call with a string
     # (defaults to exact string match), or you may supply the match type
@@ -198,24 +236,30 @@ delegates this to the wrapped Process object. Otherwise, does nothing."""
     # with a match-object as a parameter.
 
     def expect(self, patt, mtype=EXACT, callback=None, timeout=None):
-        solist = self._get_search_list(patt, mtype, callback)
-        if not solist:
+        patternset = self._get_pattern_set(patt, mtype, callback)
+        if not patternset:
             raise ExpectError("Empty expect search.")
-        buf = bytes()
+        # Only new data, plus the overlap window before it, is searched on
+        # each pass.
+        buf = self._buf
+        self._buf = b""
+        scanned = 0
+        self.expectindex = -1
         while 1:
-            c = self.read(1, timeout)
-            if not c:
-                raise ExpectError("EOF during expect.")
-            buf += c
-            self.expectindex = i = -1
-            for so, cb in solist:
-                mo = so.search(buf)
-                if mo:
-                    self.expectindex = i+1 # save the list index of the match object
+            if len(buf) > scanned:
+                found = patternset.search(buf, scanned, self.overlap)
+                if found is not None:
+                    mo, i, cb = found
+                    self._buf = buf[mo.end():]
+                    self.expectindex = i # save the list index of the match object
                     if cb:
                         cb(mo)
                     return mo
-                i += 1
+                scanned = len(buf)
+            c = self._read_chunk(timeout)
+            if not c:
+                raise ExpectError("EOF during expect.")
+            buf += c
 
     def expect_exact(self, patt, callback=None, timeout=None):
         return self.expect(patt, EXACT, callback, timeout)
@@ -227,13 +271,31 @@ delegates this to the wrapped Process object. Otherwise, does nothing."""
         return self.expect(patt, REGEX, callback, timeout)
 
     def read(self, amt=-1, timeout=None):
+        if self._buf:
+            if 0 <= amt <= len(self._buf):
+                data = self._buf[:amt]
+                self._buf = self._buf[amt:]
+                return data
+            data = self._buf
+            self._buf = b""
+            if amt < 0:
+                return data + self._timed_read(self._fo.read, amt, timeout)
+            return data
+        return self._timed_read(self._fo.read, amt, timeout)
+
+    def _read_chunk(self, timeout):
+        if self._read1 is None:
+            return self._timed_read(self._fo.read, 1, timeout)
+        return self._timed_read(self._read1, self.chunksize, timeout)
+
+    def _timed_read(self, reader, amt, timeout):
         self._timed_out = 0
         timeout=timeout or self.default_timeout
-        ev = self.sched.add(timeout, 0, self._timeout_cb, ())
+        ev = self.sched.add(timeout, 0, self._timeout_cb, (), interrupt=True)
         try:
             while 1:
                 try:
-                    data = self._fo.read(amt)
+                    data = reader(amt)
                 except EnvironmentError as val:
                     if val.errno == EINTR:
                         if self._timed_out == 1:
@@ -258,15 +320,26 @@ delegates this to the wrapped Process object. Otherwise, does nothing."""
     def read_until(self, patt=None, timeout=None):
         if patt is None:
             patt = self._prompt
-        buf = ""
+        parts = []
+        buf = self._buf
+        self._buf = b""
         while 1:
-            c = self.read(1, timeout)
+            i = buf.find(patt)
+            if i >= 0:
+                parts.append(buf[:i])
+                self._buf = buf[i+len(patt):]
+                return b"".join(parts)
+            # Set aside what can no longer be part of a match.
+            keep = len(buf) - len(patt) + 1
+            if keep > 0:
+                parts.append(buf[:keep])
+                buf = buf[keep:]
+            c = self._read_chunk(timeout)
             if c == "":
+                parts.append(buf)
+                self._buf = b"".join(parts)
                 raise ExpectError("EOF during read_until({!r}).".format(patt))
             buf += c
-            i = buf.find(patt)
-            if i >= 0:
-                return buf[:i]
 
     def readline(self, timeout=None):
         return self.read_until("\n", timeout)
@@ -330,6 +403,10 @@ through a filter function.  """
             self._fo.restart(1)
         except AttributeError:
             pass
+        if self._buf:
+            sys.stdout.write(self._buf)
+            sys.stdout.flush()
+            self._buf = b""
         while 1:
             try:
                 rfd, wfd, xfd = select.select([fo_fd, stdin_fd], [], [])
@@ -442,6 +519,105 @@ through a filter function.  """
                     break
 
 
+class PatternSet(object):
+    """A list of compiled (pattern, callback) pairs that are searched together.
+
+    The search returns the match that completes earliest in the buffer, with
+    ties going to the pattern that is first in the list, along with its list
+    index and callback.  Exact strings are grouped by their first few bytes,
+    so a group is located with one scan however many strings share it.  Once a
+    match is found, the remaining exact strings are only searched for before
+    its end.
+    """
+    def __init__(self, solist):
+        self._solist = solist
+        self._regexes = []
+        strings = []
+        for i, (so, cb) in enumerate(solist):
+            if isinstance(so, StringExpression) and so.pattern:
+                strings.append((so.pattern, i))
+            else:
+                self._regexes.append((i, so))
+        # Neighbours in sorted order that share at least PREFIXLEN leading
+        # bytes form a group, found by scanning for their common prefix. The
+        # other strings are scanned for whole, since longer ones scan faster.
+        strings.sort()
+        self._groups = []
+        members = []
+        for string, i in strings:
+            if members and _common_prefix(members[0][1], string) < PREFIXLEN:
+                self._add_group(members)
+                members = []
+            members.append((i, string))
+        if members:
+            self._add_group(members)
+
+    def _add_group(self, members):
+        prefix = reduce(lambda a, b: a[:_common_prefix(a, b)], [s for i, s in members])
+        lengths = [len(s) for i, s in members]
+        members.sort()
+        self._groups.append((prefix, members, min(lengths), max(lengths)))
+
+    def __len__(self):
+        return len(self._solist)
+
+    def __repr__(self):
+        return "{0}({1!r})".format(self.__class__.__name__, self._solist)
+
+    def bind(self, callbacks):
+        """Return a PatternSet that searches the same patterns, with the given
+        callbacks in list order."""
+        new = self.__class__.__new__(self.__class__)
+        new.__dict__.update(self.__dict__)
+        new._solist = [(so, cb) for (so, old), cb in zip(self._solist, callbacks)]
+        return new
+
+    def search(self, buf, scanned=0, overlap=OVERLAP):
+        """Search buf, where nothing can match that ends before the scanned
+        offset. Regular expressions are searched from overlap bytes before
+        it. Returns a (match, index, callback) tuple, or None."""
+        limit = len(buf)
+        best = None # (end, index, start)
+        for prefix, members, shortest, longest in self._groups:
+            pos = buf.find(prefix, max(0, scanned - longest + 1), limit)
+            while pos >= 0 and pos + shortest <= limit:
+                for i, string in members:
+                    end = pos + len(string)
+                    if end <= limit and buf.startswith(string, pos):
+                        if best is None or (end, i) < best[:2]:
+                            best = (end, i, pos)
+                            limit = end
+                pos = buf.find(prefix, pos + 1, limit)
+        start = max(0, scanned - overlap)
+        for i, so in self._regexes:
+            mo = so.search(buf, start)
+            if mo and (best is None or (mo.end(), i) < best[:2]):
+                best = (mo.end(), i, mo)
+        if best is None:
+            return None
+        end, i, mo = best
+        so, cb = self._solist[i]
+        if type(mo) is int: # start of an exact match
+            mo = so.search(buf, mo)
+        return mo, i, cb
+
+
+def _common_prefix(a, b):
+    n = min(len(a), len(b))
+    i = 0
+    while i < n and a[i] == b[i]:
+        i += 1
+    return i
+
+
+def _freeze(patt):
+    if type(patt) is list:
+        return (list,) + tuple(_freeze(p) for p in patt)
+    if type(patt) is tuple: # without the callback
+        return (tuple,) + patt[:2]
+    return patt
+
+
 # swiped from the fnmatch module for efficiency
 def glob_translate(pat):
     """Translate a shell (glob style) pattern to a regular expression.
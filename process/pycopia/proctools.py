@@ -67,6 +67,141 @@ def remove_poller():
         poller = _PollerCreator()
 
 
+# Reads start at READSIZE bytes, and double while they come back full, up to
+# the default pipe capacity.
+READSIZE = 4096
+MAXREAD = 65536
+
+class _ReadBuffer(object):
+    """Bytes read from a process but not yet consumed. They are kept in a
+    bytearray, with the offset of the first unconsumed byte. The consumed
+    front is dropped only when it is more than half of the array, so each
+    byte is moved at most a few times, however the data is read off.
+
+    Iterating over lines splits off all the complete lines at once, and
+    hands them out from a list. Any other use puts back the ones left first.
+    """
+    __slots__ = ("_data", "_pos", "_readsize", "_lines")
+
+    def __init__(self):
+        self._data = bytearray()
+        self._pos = 0
+        self._readsize = READSIZE
+        self._lines = None # split lines not yet handed out, last first.
+
+    def __len__(self):
+        if self._lines:
+            self._unsplit()
+        return len(self._data) - self._pos
+
+    def fill(self, read):
+        """Read once with the read function, and keep what it returns.
+        Returns the number of bytes read, zero at end of file."""
+        size = self._readsize
+        try:
+            data = read(size)
+        except EOFError:
+            return 0
+        n = len(data)
+        if n:
+            self._data.extend(data)
+            if n == size and size < MAXREAD:
+                self._readsize = min(size * 2, MAXREAD)
+        return n
+
+    def readline(self, read, amt):
+        """Consume and return a line of up to amt bytes, filling with the read
+        function as needed."""
+        if self._lines:
+            self._unsplit()
+        data = self._data
+        pos = self._pos
+        start = pos
+        while 1:
+            limit = min(len(data), pos + amt)
+            i = data.find(b"\n", start, limit)
+            if i >= 0:
+                end = i + 1
+                break
+            if limit - pos >= amt or not self.fill(read):
+                end = min(len(data), pos + amt)
+                break
+            start = limit
+        line = bytes(data[pos:end])
+        self._consume(end - pos)
+        return line
+
+    def nextline(self, read):
+        """Consume and return the next line, filling with the read function
+        as needed. Returns an empty string at end of file."""
+        lines = self._lines
+        if lines:
+            return lines.pop()
+        data = self._data
+        pos = self._pos
+        i = data.rfind(b"\n", pos)
+        while i < 0:
+            start = len(data)
+            if not self.fill(read):
+                return self.take(len(data) - pos)
+            i = data.rfind(b"\n", start)
+        chunk = memoryview(data)[pos:i + 1].tobytes()
+        self._consume(i + 1 - pos)
+        # splitlines also breaks at a lone carriage return.
+        if chunk.count(b"\r") == chunk.count(b"\r\n"):
+            lines = chunk.splitlines(True)
+        else:
+            lines = [line + b"\n" for line in chunk.split(b"\n")]
+            lines.pop()
+        lines.reverse()
+        self._lines = lines
+        return lines.pop()
+
+    def take(self, amt):
+        """Consume and return up to amt bytes."""
+        n = min(amt, len(self))
+        rv = memoryview(self._data)[self._pos:self._pos + n].tobytes()
+        self._consume(n)
+        return rv
+
+    def takeinto(self, b):
+        """Consume up to len(b) bytes into the writable buffer b. Returns the
+        number of bytes."""
+        n = min(len(b), len(self))
+        memoryview(b)[:n] = memoryview(self._data)[self._pos:self._pos + n]
+        self._consume(n)
+        return n
+
+    def _consume(self, n):
+        end = self._pos + n
+        if end == len(self._data):
+            del self._data[:]
+            self._pos = 0
+        elif end > len(self._data) // 2:
+            del self._data[:end]
+            self._pos = 0
+        else:
+            self._pos = end
+
+    def unread(self, data):
+        """Put data back in front of the unconsumed bytes."""
+        if self._lines:
+            self._unsplit()
+        n = len(data)
+        if n <= self._pos:
+            self._pos -= n
+            self._data[self._pos:self._pos + n] = data
+        else:
+            self._data[:self._pos] = data
+            self._pos = 0
+
+    def _unsplit(self):
+        lines = self._lines
+        self._lines = None
+        lines.reverse()
+        self.unread(b"".join(lines))
+
+
 class Process(object):
     """Abstract base class for Processes. Handles all process handling, and
     some common functionality. I/O is handled in subclasses.
@@ -78,8 +213,8 @@ class Process(object):
         self.callback = callback # called at death of process
         self._log = logfile # should be file-like object
         self._restart = True # restart interrupted system calls
-        self._buf = b''
-        self._errbuf = b''
+        self._buf = _ReadBuffer()
+        self._errbuf = _ReadBuffer()
         self._writebuf = b''
         self.exitstatus = None
         self._environment = None
@@ -235,59 +370,51 @@ ProcManager uses this."""
     def read(self, amt=2147483646):
         if amt < 0:
             amt = 2147483646
-        bs = len(self._buf)
+        buf = self._buf
+        while len(buf) < amt and buf.fill(self._read):
+            pass
+        return buf.take(amt)
+
+    def read1(self, amt=16384):
+        """Read up to amt bytes. Only blocks if nothing is available."""
+        if self._buf:
+            return self._buf.take(amt)
         try:
-            while bs < amt:
-                c = self._read(4096)
-                if not c:
-                    break
-                self._buf += c
-                bs = len(self._buf)
-        except EOFError: # XXX log an error
-            pass # let it ruturn rest of buffer
-        data = self._buf[:amt]
-        self._buf = self._buf[amt:]
-        return data
+            return self._read(amt)
+        except EOFError:
+            return b""
+
+    def readinto(self, b):
+        """Read up to len(b) bytes into the writable buffer b, such as a
+        bytearray. Only blocks if nothing is available. Returns the number of
+        bytes read, zero at end of file."""
+        buf = self._buf
+        if not buf and not buf.fill(self._read):
+            return 0
+        return buf.takeinto(b)
 
     def readerr(self, amt=2147483646):
         if amt < 0:
             amt = 2147483646
-        rs = 1024
-        try:
-            while len(self._errbuf) < amt:
-                c = self._readerr(rs)
-                if not c:
-                    break
-                self._errbuf += c
-        except EOFError:
+        buf = self._errbuf
+        while len(buf) < amt and buf.fill(self._readerr):
             pass
-        amt = min(amt, len(self._errbuf))
-        data = self._errbuf[:amt]
-        self._errbuf = self._errbuf[amt:]
-        return data
+        return buf.take(amt)
 
 # extra fileobject methods.
     def readline(self, amt=2147483646):
         if amt < 0:
             amt = 2147483646
-        bufs = []
-        rs = min(100, amt)
+        return self._buf.readline(self._read, amt)
+
+    def __iter__(self):
+        nextline = self._buf.nextline
+        read = self._read
         while 1:
-            c = self.read(rs)
-            i = c.find(b"\n")
-
-            if i < 0 and len(c) > amt:
-                i = amt-1
-            elif amt <= i:
-                i = amt-1
-            if i >= 0 or c == b'':
-                bufs.append(c[:i+1])
-                self._unread(c[i+1:])
-                return b"".join(bufs)
-
-            bufs.append(c)
-            amt -= len(c)
-            rs = min(amt, rs*2)
+            line = nextline(read)
+            if not line:
+                return
+            yield line
 
     def readlines(self, sizehint=2147483646):
         if sizehint < 0:
@@ -328,7 +455,7 @@ ProcManager uses this."""
         return None
 
     def _unread(self, data):
-        self._buf = data + self._buf
+        self._buf.unread(data)
 
     # Interface for asyncio poller.
     def readable(self):
@@ -17,10 +17,18 @@
 """
 Wrapper for the ssh program.
 
-Provides get_ssh, ssh_command, and scp functions.
+Provides get_ssh, ssh_command, and scp functions, and SSHPool for running
+many commands over persistent, multiplexed connections.
 """
 
 import sys, os
+import re
+import shutil
+import select
+import hashlib
+import tempfile
+from collections import deque
+from errno import EINTR
 
 from pycopia import proctools
 from pycopia import expect
@@ -33,6 +41,9 @@ KEYSCAN = proctools.which("ssh-keyscan")
 class SSHRetry(RuntimeError):
     pass
 
+class SSHError(RuntimeError):
+    pass
+
 #                  |01234567890123456789
 TESTED_VERSIONS = ["OpenSSH_3.4p1, SSH protocols 1.5/2.0, OpenSSL 0x0090605f",
                    "OpenSSH_3.5p1, SSH protocols 1.5/2.0, OpenSSL 0x0090701f",
@@ -82,10 +93,15 @@ def _build_commandline(host, **kwargs):
     else:
         cmd = "%s %s@%s %s" %(SSH, user, host, command)
 
-def ssh_command(host, command, user=None, password=None, prompt=None, logfile=None):
-    """ssh_command(host, command, [user], [password], [prompt], [logfile])
-Runs the command on the given host via SSH, and return the result.
+def ssh_command(host, command, user=None, password=None, prompt=None, logfile=None,
+        pool=None):
+    """ssh_command(host, command, [user], [password], [prompt], [logfile], [pool])
+Runs the command on the given host via SSH, and return the result. If an
+SSHPool is given the command is run over its connection to the host.
     """
+    if pool is not None:
+        es, rv = pool.run(host, command, user, password, logfile=logfile)
+        return rv
     pm = proctools.get_procmanager()
     if user is None:
         cmd = "%s %s %s" %(SSH, host, command)
@@ -204,6 +220,271 @@ def get_procs():
     return pm.getbyname("ssh")
 
 
+##### persistent, multiplexed connections.
+
+CONTROL_PERSIST = 600 # seconds a master stays up after its last client.
+MAX_PROCS = 16 # commands that SSHPool.run_many runs at once,
+MAX_SESSIONS = 8 # and over one connection (sshd allows 10 by default).
+
+def _quote(text):
+    """Quote text as one argument for the process command splitter."""
+    return '"%s"' % re.sub(r'([\\"$])', r'\\\1', text)
+
+
+class SSHConnection(object):
+    """SSHConnection(host, controlpath, [user], [options], [persist], [ssh])
+A ControlMaster ssh process for one target, listening on controlpath.
+Commands are run by ssh clients that use its connection, without a
+handshake or login of their own.
+    """
+    def __init__(self, host, controlpath, user=None, options=SSH_OPTIONS,
+            persist=CONTROL_PERSIST, ssh=None):
+        self.host = host
+        self.user = user
+        self.options = options
+        self.controlpath = controlpath
+        self.persist = persist
+        self.isopen = False
+        self._target = location(host, user, forssh=True)
+        self._control = "%s %s -o ControlPath=%s" % (ssh or SSH, options,
+                _quote(controlpath))
+
+    def __repr__(self):
+        return "%s(%r, %r, %r, %r)" % (self.__class__.__name__, self.host,
+                self.controlpath, self.user, self.options)
+
+    def open(self, password=None, logfile=None):
+        """Start the master, which goes into the background once it has
+        logged in. Supplies the password, if one is given."""
+        proc = self._start(logfile)
+        try:
+            if password is not None:
+                SSHExpect(proc).login(password)
+            output = proc.read()
+            es = proc.wait()
+        finally:
+            proc.close()
+        self._started(es, output)
+
+    # Opening is split in two, so that SSHPool.run_many can open many at once.
+    def _start(self, logfile=None):
+        cmd = "%s -o ControlMaster=yes -o ControlPersist=%s -N -f %s" % (
+                self._control, self.persist, self._target)
+        pm = proctools.get_procmanager()
+        return pm.spawnpty(cmd, logfile=logfile)
+
+    def _started(self, es, output):
+        if not es:
+            raise SSHError("Could not connect to %s: %s %s" % (self._target, es,
+                    output.strip()))
+        self.isopen = True
+
+    def check(self):
+        """Return True if the master is running."""
+        es, output = proctools.getstatusoutput("%s -O check %s" % (self._control,
+                self._target))
+        return bool(es)
+
+    def close(self):
+        """Tell the master to exit."""
+        proctools.getstatusoutput("%s -O exit %s" % (self._control, self._target))
+        self.isopen = False
+
+    def command_line(self, command):
+        return "%s -o ControlMaster=no -o BatchMode=yes -n -T %s %s" % (
+                self._control, self._target, _quote(command))
+
+    def spawn(self, command, logfile=None):
+        """Start the command on the target. Returns the ssh client Process,
+        connected by pipes, with stderr merged into its output."""
+        pm = proctools.get_procmanager()
+        # spawnpipe would take a remote pipeline for a local one.
+        return pm.spawnprocess(proctools.ProcessPipe, self.command_line(command),
+                logfile)
+
+    def run(self, command, logfile=None):
+        """Run the command on the target. Returns the ExitStatus and output."""
+        proc = self.spawn(command, logfile)
+        try:
+            output = proc.read()
+            es = proc.wait()
+        finally:
+            proc.close()
+        return es, output
+
+
+class SSHPool(object):
+    """SSHPool([options], [persist], [ssh])
+A pool of SSHConnection objects, one for each target of host, user, and ssh
+options. A connection is opened when a command is first run on its target,
+and kept until the pool is closed.
+    """
+    def __init__(self, options=SSH_OPTIONS, persist=CONTROL_PERSIST, ssh=None):
+        self.options = options
+        self.persist = persist
+        self._ssh = ssh
+        self._dir = None
+        self._connections = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, extype, exvalue, traceback):
+        self.close()
+        return False
+
+    def __len__(self):
+        return len(self._connections)
+
+    def close(self):
+        """Close all connections."""
+        for conn in self._connections.values():
+            conn.close()
+        self._connections = {}
+        if self._dir is not None:
+            shutil.rmtree(self._dir, ignore_errors=True)
+            self._dir = None
+
+    def get_connection(self, host, user=None, password=None, options=None,
+            logfile=None):
+        """Return the open SSHConnection for the target, opening it if it is
+        not open yet."""
+        conn = self._get_connection(host, user, options)
+        if not conn.isopen:
+            conn.open(password, logfile)
+        return conn
+
+    def _get_connection(self, host, user, options):
+        if options is None:
+            options = self.options
+        key = (host, user, options)
+        conn = self._connections.get(key)
+        if conn is None:
+            if self._dir is None:
+                self._dir = tempfile.mkdtemp(prefix="pycopia-ssh-")
+            # Socket paths are short, so use a name that fits.
+            path = os.path.join(self._dir, hashlib.sha1(repr(key)).hexdigest()[:16])
+            conn = SSHConnection(host, path, user, options, self.persist, self._ssh)
+            self._connections[key] = conn
+        return conn
+
+    def run(self, host, command, user=None, password=None, options=None,
+            logfile=None):
+        """Run the command on the host. Returns the ExitStatus and output.
+        If ssh itself failed because the master has gone away, it is opened
+        again and the command run once more."""
+        conn = self.get_connection(host, user, password, options, logfile)
+        es, output = conn.run(command, logfile)
+        if es.exited() and es.status == 255 and not conn.check():
+            conn.open(password, logfile)
+            es, output = conn.run(command, logfile)
+        return es, output
+
+    def run_many(self, commands, user=None, password=None, options=None,
+            maxprocs=MAX_PROCS, maxsessions=MAX_SESSIONS, logfile=None):
+        """Run commands, a list of (host, command) pairs, in parallel. At most
+        maxprocs run at once, and at most maxsessions of them on one host.
+        Connections not open yet are opened along with them, each counting
+        as one of the maxprocs. Returns a list of (ExitStatus, output) pairs,
+        in the same order. The commands for a host that could not be
+        connected to get the ExitStatus and output of the attempt. As with
+        run, a command that failed because its master went away is run once
+        more, after opening it again."""
+        commands = list(commands)
+        results = [None] * len(commands)
+        queues = {} # connection -> deque of command indexes
+        for i, (host, command) in enumerate(commands):
+            conn = self._get_connection(host, user, options)
+            queues.setdefault(conn, deque()).append(i)
+        ready = deque(queues) # connections with queued commands, and room for more
+        scheduled = set(ready)
+        opening = set() # connections whose master is starting
+        prompted = set()
+        retried = set()
+        active = dict.fromkeys(queues, 0)
+        opened = dict.fromkeys(queues, 0) # times opened here
+        running = {} # fd -> (proc, index, connection, times opened, output chunks)
+        poller = select.poll()
+        while ready or running:
+            while ready and len(running) < maxprocs:
+                conn = ready.popleft()
+                scheduled.discard(conn)
+                if conn.isopen:
+                    i = queues[conn].popleft()
+                    proc = conn.spawn(commands[i][1], logfile)
+                    active[conn] += 1
+                    if queues[conn] and active[conn] < maxsessions:
+                        ready.append(conn)
+                        scheduled.add(conn)
+                else: # its commands are scheduled once it is open.
+                    proc = conn._start(logfile)
+                    i = None
+                    opening.add(conn)
+                running[proc.fileno()] = (proc, i, conn, opened[conn], [])
+                poller.register(proc.fileno(), select.POLLIN)
+            try:
+                events = poller.poll()
+            except select.error as err:
+                if err.args[0] == EINTR:
+                    continue
+                raise
+            for fd, event in events:
+                proc, i, conn, epoch, chunks = running[fd]
+                data = proc.read1()
+                if data:
+                    chunks.append(data)
+                    if (i is None and password is not None and conn not in prompted
+                            and b"assword:" in b"".join(chunks)):
+                        proc.write(password + "\r")
+                        prompted.add(conn)
+                    continue
+                poller.unregister(fd)
+                del running[fd]
+                try:
+                    es = proc.wait()
+                finally:
+                    proc.close()
+                output = b"".join(chunks)
+                if i is None:
+                    opening.discard(conn)
+                    prompted.discard(conn)
+                    try:
+                        conn._started(es, output)
+                    except SSHError:
+                        while queues[conn]:
+                            results[queues[conn].popleft()] = (es, output)
+                    else:
+                        opened[conn] += 1
+                else:
+                    active[conn] -= 1
+                    # Other commands may have found the master gone already.
+                    current = conn.isopen and epoch == opened[conn]
+                    if (es.exited() and es.status == 255 and i not in retried
+                            and not (current and conn.check())):
+                        retried.add(i)
+                        if current:
+                            conn.isopen = False
+                        queues[conn].appendleft(i)
+                    else:
+                        results[i] = (es, output)
+                if queues[conn] and conn not in scheduled and conn not in opening:
+                    ready.append(conn)
+                    scheduled.add(conn)
+        return results
+
+
+def get_pool():
+    """get_pool() returns the shared SSHPool, that is closed at exit."""
+    global sshpool
+    try:
+        return sshpool
+    except NameError:
+        import atexit
+        sshpool = SSHPool()
+        atexit.register(sshpool.close)
+    return sshpool
+
+
 # Support objects follow.
 # Mostly, these are for creating or modifying various ssh related files.
 class KnownHostsFile(object):
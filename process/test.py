@@ -18,6 +18,10 @@ from __future__ import print_function
 from __future__ import unicode_literals
 from __future__ import division
 
+import os
+import re
+import shutil
+import tempfile
 import unittest
 
 from pycopia import proctools
@@ -43,6 +47,62 @@ def _co_function():
     scheduler.sleep(5)
     return None
 
+# Stands in for ssh. A master is a file at the control path, and each one
+# opened is logged.
+FAKESSH = """#!/bin/sh
+while [ $# -gt 1 ]; do
+    case "$1" in
+    -o) case "$2" in
+        ControlPath=*) path="${2#ControlPath=}" ;;
+        ControlMaster=yes) master=1 ;;
+        esac
+        shift 2 ;;
+    -O) op="$2"; shift 2 ;;
+    -F) shift 2 ;;
+    -*) shift ;;
+    *) break ;;
+    esac
+done
+host="$1"
+if [ -n "$master" ]; then
+    test "$host" = unknown && { echo "no such host"; exit 255; }
+    echo "$host" >> %s
+    sleep 0.2
+    echo "$host-up" >> %s
+    touch "$path"
+    exit 0
+fi
+case "$op" in
+check) test -e "$path" || exit 255; exit 0 ;;
+exit) rm -f "$path"; exit 0 ;;
+esac
+test -e "$path" || exit 255
+exec sh -c "$2"
+"""
+
+class _Chunks(object):
+    """A file-like object that returns the given chunks from read1."""
+    def __init__(self, chunks):
+        self._chunks = list(chunks)
+
+    def read1(self, amt):
+        return self._chunks.pop(0) if self._chunks else b""
+
+    def read(self, amt=-1):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+    def write(self, data):
+        return len(data)
+
+    def fileno(self):
+        return -1
+
+    def close(self):
+        pass
+
+
 class ProcessTests(unittest.TestCase):
     def setUp(self):
         pass
@@ -74,6 +134,31 @@ class ProcessTests(unittest.TestCase):
         es = lspm.stat()
         self.assertTrue(es)
 
+    def test_buffered_reads(self):
+        # About 1 MB of numbered lines, with some data left after the last one.
+        proc = proctools.spawnpipe("python -c \"import sys; sys.stdout.write("
+                "''.join('line %d\\\\n' % i for i in range(100000)) + 'tail')\"")
+        self.assertEqual(proc.readline(), b"line 0\n")
+        self.assertEqual(proc.readline(3), b"lin")
+        proc._unread(b"X")
+        self.assertEqual(proc.read(4), b"Xe 1")
+        b = bytearray(3)
+        self.assertEqual(proc.readinto(b), 3)
+        self.assertEqual(b, bytearray(b"\nli"))
+        self.assertEqual(proc.readline(), b"ne 2\n")
+        lines = iter(proc)
+        self.assertEqual(next(lines), b"line 3\n")
+        self.assertEqual(proc.readline(), b"line 4\n")
+        lines = list(lines)
+        self.assertEqual(len(lines), 99996)
+        self.assertEqual(lines[0], b"line 5\n")
+        self.assertEqual(lines[-2], b"line 99999\n")
+        self.assertEqual(lines[-1], b"tail")
+        self.assertEqual(proc.read(), b"")
+        self.assertEqual(proc.readinto(b), 0)
+        proc.close()
+        self.assertTrue(proc.wait())
+
 #    def test_pipeline(self):
 #        ptest = proctools.spawnpipe("cat /etc/hosts | sort")
 #        hosts = ptest.read()
@@ -94,6 +179,141 @@ class ProcessTests(unittest.TestCase):
         es = sub.wait()
         self.assertTrue(es)
 
+    def _expect_on(self, text):
+        fname = "/tmp/pycopia_expect_test_{}".format(os.getpid())
+        with open(fname, "w") as fo:
+            fo.write(text)
+        self.addCleanup(os.unlink, fname)
+        proc = proctools.spawnpipe("cat {}".format(fname))
+        self.addCleanup(proc.wait)
+        return expect.Expect(proc, prompt="PROMPT> ", timeout=10)
+
+    def test_expect_index(self):
+        exp = self._expect_on(b"noise " * 5000 + b"--More--" + b" tail PROMPT> rest")
+        found = []
+        mo = exp.expect([b"PROMPT> ", (b"-*More-*", expect.REGEX, found.append)])
+        self.assertEqual(exp.expectindex, 1)
+        self.assertEqual(mo.group(0), b"--More--")
+        self.assertEqual(found, [mo])
+        self.assertEqual(exp.read_until(), b" tail ")
+        self.assertEqual(exp.read(), b"rest")
+        exp.close()
+
+    def test_expect_lines(self):
+        exp = self._expect_on(b"one\ntwo\nthree\nPROMPT> ")
+        self.assertEqual(exp.readline(), b"one")
+        self.assertEqual(exp.readlines(2), [b"two", b"three"])
+        self.assertEqual(exp.wait_for_prompt(), b"")
+        self.assertRaises(expect.ExpectError, exp.expect, b"missing")
+        exp.close()
+
+    def test_patternset(self):
+        ps = expect.PatternSet([(expect.compile_exact(s), None) for s in
+                (b"% Invalid input", b"router(config)# ", b"router# ", b"% Incomplete")])
+        mo, i, cb = ps.search(b"x% Incomplete command\n% Invalid input\nrouter# ")
+        self.assertEqual((i, mo.span()), (3, (1, 13)))
+        # earliest end wins over earliest start, then list order.
+        ps = expect.PatternSet([(expect.compile_exact(b"abcdef"), None),
+                (expect.compile_exact(b"cd"), None),
+                (re.compile(b"b?c?d"), None)])
+        mo, i, cb = ps.search(b"abcdef")
+        self.assertEqual((i, mo.group(0)), (1, b"cd"))
+        self.assertTrue(ps.search(b"abc") is None)
+
+    def test_expect_chunks(self):
+        # Anchors and lookbehinds see all of the data, not where a read ended.
+        for patt in (b"^START", b"\\ASTART", b"(?<!noise)START"):
+            exp = expect.Expect(_Chunks([b"noise" + b"STAR", b"T here"]))
+            exp.overlap = 4
+            self.assertRaises(expect.ExpectError, exp.expect, patt, expect.REGEX)
+        exp = expect.Expect(_Chunks([b"START", b" here"]))
+        self.assertEqual(exp.expect(b"^START", expect.REGEX).group(0), b"START")
+        # Regular expressions spanning reads match if they start within
+        # the overlap before the new data, exact strings if they are longer.
+        exp = expect.Expect(_Chunks([b"BEGIN" + b"x" * 90, b"xEND"]))
+        exp.overlap = 100
+        self.assertEqual(exp.expect(b"BEGIN.*END", expect.REGEX).span(), (0, 99))
+        exp = expect.Expect(_Chunks([b"BEGIN" + b"x" * 90, b"xEND"]))
+        exp.overlap = 4
+        self.assertRaises(expect.ExpectError, exp.expect, b"BEGIN.*END", expect.REGEX)
+        exp = expect.Expect(_Chunks([b"BEGIN" + b"x" * 90, b"xEND"]))
+        exp.overlap = 4
+        self.assertEqual(exp.expect(b"BEGIN" + b"x" * 91 + b"END").span(), (0, 99))
+
+    def test_expect_cache(self):
+        exp = self._expect_on(b"first PROMPT> second PROMPT> ")
+        patt = [b"first", b"second"]
+        exp.expect(patt)
+        self.assertEqual(exp.expectindex, 0)
+        exp.expect(patt)
+        self.assertEqual(exp.expectindex, 1)
+        self.assertEqual(len([p for p in exp._patt_cache.values()
+                if isinstance(p, expect.PatternSet)]), 1)
+        exp.close()
+
+    def test_expect_callbacks(self):
+        """Callbacks are not part of the cache key, each call gets its own."""
+        exp = self._expect_on(b"first PROMPT> second PROMPT> ")
+        found = []
+        for word in (b"first", b"second"):
+            exp.expect([b"first", (b"sec.nd", expect.REGEX, lambda mo: found.append(1))],
+                    callback=lambda mo, word=word: found.append(word))
+        self.assertEqual(found, [b"first", 1])
+        self.assertEqual(len([p for p in exp._patt_cache.values()
+                if isinstance(p, expect.PatternSet)]), 1)
+        exp.close()
+
+    def test_sshpool(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fakessh = os.path.join(tmpdir, "ssh")
+            logname = os.path.join(tmpdir, "masters")
+            with open(fakessh, "w") as fo:
+                fo.write(FAKESSH % (logname, logname))
+            os.chmod(fakessh, 0o755)
+            with sshlib.SSHPool(ssh=fakessh) as pool:
+                es, out = pool.run("host1", "echo hello | tr h j")
+                self.assertTrue(es)
+                self.assertEqual(out, b"jello\n")
+                es, out = pool.run("host1", "echo \"it's $((1+1))\"; exit 3")
+                self.assertEqual(es.status, 3)
+                self.assertEqual(out, b"it's 2\n")
+                commands = [("host%d" % (i % 3), "echo %d" % i) for i in range(20)]
+                results = pool.run_many(commands, maxprocs=4, maxsessions=2)
+                self.assertTrue(all(es for es, out in results))
+                self.assertEqual([out for es, out in results],
+                        ["%d\n" % i for i in range(20)])
+                self.assertEqual(len(pool), 3)
+                os.unlink(pool.get_connection("host0").controlpath) # master died
+                es, out = pool.run("host0", "echo again")
+                self.assertEqual(out, b"again\n")
+                # Masters are opened again, once, and then the commands.
+                for host in ("host0", "host2"):
+                    os.unlink(pool.get_connection(host).controlpath)
+                commands = [("host%d" % (i % 3), "echo %d" % i) for i in range(12)]
+                results = pool.run_many(commands, maxprocs=4, maxsessions=2)
+                self.assertEqual([out for es, out in results],
+                        ["%d\n" % i for i in range(12)])
+                results = pool.run_many([("host3", "echo 3"), ("host4", "echo 4")])
+                self.assertEqual([out for es, out in results], ["3\n", "4\n"])
+                (es, out), (es1, out1) = pool.run_many([("unknown", "echo 1"),
+                        ("host1", "echo 2")])
+                self.assertEqual(es.status, 255)
+                self.assertTrue(b"no such host" in out)
+                self.assertEqual(out1, b"2\n")
+            with open(logname) as fo:
+                log = fo.read().split()
+            opens = [line for line in log if not line.endswith("-up")]
+            self.assertEqual(opens[0], "host1")
+            self.assertEqual(sorted(opens[1:3]), ["host0", "host2"])
+            self.assertEqual(opens[3], "host0")
+            self.assertEqual(sorted(opens[4:6]), ["host0", "host2"])
+            self.assertEqual(sorted(opens[6:]), ["host3", "host4"])
+            # Opened at the same time.
+            self.assertEqual(sorted(log[-4:-2]), ["host3", "host4"])
+        finally:
+            shutil.rmtree(tmpdir)
+
     def XXXtest_sudo(self):
         pw = sudo.getpw()
         proc = sudo.sudo("/bin/ifconfig -a", password=pw)
@@ -0,0 +1,133 @@
+#!/usr/bin/python2.7
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Benchmarks for the storage package.
+
+Usage: bench.py [-n <lookups>] [-c <containers>]
+
+The config benchmarks use SQLite databases in a temporary directory.
+
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import sys
+import os
+import getopt
+import shutil
+import tempfile
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+from pycopia.aid import NULL
+from pycopia.timelib import now
+from pycopia.db import tables
+from pycopia.db import models
+from pycopia.db import config
+
+
+def sqlite_engine(dirname):
+    def attach(dbapi_conn, record):
+        dbapi_conn.execute("ATTACH DATABASE '{}' AS public".format(
+                os.path.join(dirname, "public.db")))
+    engine = create_engine("sqlite:///" + os.path.join(dirname, "main.db"))
+    event.listen(engine, "connect", attach)
+    return engine
+
+
+def make_config(dirname, containers, counted):
+    """A config tree like the one init_db makes, with the given number of
+    extra containers of 20 values each. The change counter table is made if
+    counted is true."""
+    engine = sqlite_engine(dirname)
+    tables.config.create(engine)
+    if counted:
+        tables.config_generation.create(engine)
+    session = sessionmaker(bind=engine, autoflush=False)()
+    root = models.create(models.Config, name="root", value=NULL, user=None)
+    session.add(root)
+    flags = models.create(models.Config, name="flags", value=NULL, container=root)
+    session.add(flags)
+    for name, value in (("VERBOSE", 0), ("DEBUG", 0), ("INTERACTIVE", False)):
+        session.add(models.create(models.Config, name=name, value=value, container=flags))
+    for name, value in (("logbasename", "testrun.log"), ("logfiledir", "/var/tmp"),
+            ("reportbasename", "-"), ("baseurl", "http://localhost")):
+        session.add(models.create(models.Config, name=name, value=value, container=root))
+    env = models.create(models.Config, name="environment", value=NULL, container=root)
+    session.add(env)
+    dut = models.create(models.Config, name="DUT", value=NULL, container=env)
+    session.add(dut)
+    session.add(models.create(models.Config, name="prompt", value="# ", container=dut))
+    for i in range(containers):
+        c = models.create(models.Config, name="area%d" % i, value=NULL, container=root)
+        session.add(c)
+        for j in range(20):
+            session.add(models.create(models.Config, name="item%d" % j,
+                    value=("value", i, j), container=c))
+    session.commit()
+    return engine
+
+
+def _lookups(cf, count):
+    start = now()
+    for i in xrange(count // 4):
+        cf.environment.DUT.prompt
+        cf["logfiledir"]
+        cf.flags.DEBUG
+        cf.get("reportbasename")
+    return now() - start
+
+
+def bench_config(count, containers):
+    print("{} lookups, {} config rows, best of 3".format(count, containers * 21 + 11))
+    for name, counted in (
+            ("row by row", False),
+            ("cached", True),
+            ):
+        dirname = tempfile.mkdtemp()
+        try:
+            engine = make_config(dirname, containers, counted)
+            session = sessionmaker(bind=engine, autoflush=False)()
+            cf = config.Container(session, config.get_root(session))
+            start = now()
+            cf["logfiledir"] # loads the cache, if there is one.
+            first = now() - start
+            elapsed = min(_lookups(cf, count) for i in range(3))
+            print("{:>16s}: {:8.3f} s, {:8.1f} us per lookup, first {:6.1f} ms".format(
+                    name, elapsed, elapsed / count * 1e6, first * 1000.0))
+            session.close()
+            engine.dispose()
+        finally:
+            shutil.rmtree(dirname)
+
+
+def main(argv):
+    count = 10000
+    containers = 50
+    opts, args = getopt.getopt(argv[1:], "n:c:")
+    for opt, optarg in opts:
+        if opt == "-n":
+            count = int(optarg)
+        elif opt == "-c":
+            containers = int(optarg)
+    bench_config(count, containers)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
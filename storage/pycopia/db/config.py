@@ -36,6 +36,15 @@ see all containers, but non-superuser users only see their own containers.  New
 containers created without a registered user inherit ownership from parent
 node.
 
+Reads are served from a copy of the whole tree kept in memory, one per database
+engine, that is loaded with one query. Before a lookup, if CHECK_INTERVAL
+seconds have passed since the last look, the change counter in the
+config_generation table is read, and the copy is loaded again if it changed.
+Changes made through a Container are also made to the copy, other changes made
+by this process make the next lookup check the counter. Values from the copy
+are copied again for the caller, unless immutable. Databases without the
+config_generation table are read row by row, as needed.
+
 """
 from __future__ import absolute_import
 from __future__ import print_function
@@ -43,17 +52,25 @@ from __future__ import unicode_literals
 from __future__ import division
 
 import re
+import copy
+import time
+import weakref
 
-from sqlalchemy import and_
+from sqlalchemy import and_, select, event
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm.exc import NoResultFound
 
 from pycopia.db import models
+from pycopia.db import tables
 # The NULL value is used to flag a container node.
 from pycopia.aid import NULL
 
 Config = models.Config
 
+# Seconds a lookup may use the in-memory tree before checking the database for
+# changes made elsewhere.
+CHECK_INTERVAL = 1.0
+
 
 class ConfigError(Exception):
   pass
@@ -65,15 +82,251 @@ def get_root(session):
     return c
 
 
+# Values of these types are returned from the cache as they are, others are
+# copied so that changing them doesn't change the cache.
+_IMMUTABLE = (type(None), bool, int, long, float, complex, basestring, frozenset)
+
+def _copy_value(value):
+    if value is NULL or isinstance(value, _IMMUTABLE):
+        return value
+    return copy.deepcopy(value)
+
+
+class _Node(object):
+    """A row of the config table, in the ConfigCache."""
+    __slots__ = ("id", "name", "value", "parent_id", "user_id", "testcase_id",
+            "testsuite_id", "children")
+
+    def __init__(self, row):
+        self.id = row.id
+        self.name = row.name
+        self.value = row.value
+        self.parent_id = row.parent_id
+        self.user_id = row.user_id
+        self.testcase_id = row.testcase_id
+        self.testsuite_id = row.testsuite_id
+        self.children = {} if row.value is NULL else None
+
+
+class ConfigCache(object):
+    """The config tree of one database, in memory.
+
+    The nodes attribute maps row id to _Node. A container node has a
+    children attribute mapping name to _Node.
+    """
+    def __init__(self):
+        self.generation = None
+        self.nodes = {}
+        self._checked = 0.0
+
+    def refresh(self, session):
+        now = time.time()
+        if now - self._checked < CHECK_INTERVAL:
+            return
+        generation = models.get_config_generation(session)
+        if generation != self.generation:
+            self.load(session, generation)
+        self._checked = now
+
+    def invalidate(self):
+        self.generation = None
+        self._checked = 0.0
+
+    def expire(self):
+        """Check the change counter on the next lookup."""
+        self._checked = 0.0
+
+    def load(self, session, generation):
+        """Load all nodes under the top-level ones, in one recursive query."""
+        config = tables.config
+        tree = select([config]).where(config.c.parent_id == None).cte("tree", recursive=True)
+        tree = tree.union_all(select([config]).where(config.c.parent_id == tree.c.id))
+        nodes = {}
+        for row in session.execute(select([tree])):
+            nodes[row.id] = _Node(row)
+        for node in nodes.values():
+            parent = nodes.get(node.parent_id)
+            if parent is not None and parent.children is not None:
+                parent.children[node.name] = node
+        self.nodes = nodes
+        self.generation = generation
+
+    # Changes made by this process are copied in, if the flush that made the
+    # change was the only one since the copy was loaded. Otherwise the copy
+    # is dropped, to be loaded again on the next lookup.
+    def _follows(self, generation):
+        if self.generation is not None and generation == self.generation + 1:
+            self.generation = generation
+            self._checked = time.time()
+            return True
+        self.invalidate()
+        return False
+
+    def _unlink(self, nodeid):
+        old = self.nodes.pop(nodeid, None)
+        if old is not None:
+            parent = self.nodes.get(old.parent_id)
+            if parent is not None and parent.children is not None:
+                parent.children.pop(old.name, None)
+        return old
+
+    def put(self, node, generation):
+        """Add or replace a node, written by the flush that made the change
+        count generation."""
+        if not self._follows(generation):
+            return
+        old = self._unlink(node.id)
+        if old is not None and old.children is not None and node.children is not None:
+            node.children = old.children
+        self.nodes[node.id] = node
+        parent = self.nodes.get(node.parent_id)
+        if parent is not None and parent.children is not None:
+            parent.children[node.name] = node
+
+    def remove(self, nodeid, generation):
+        """Remove a node, and all below it, deleted by the flush that made
+        the change count generation."""
+        if not self._follows(generation):
+            return
+        old = self._unlink(nodeid)
+        stack = [old] if old is not None else []
+        while stack:
+            for child in (stack.pop().children or {}).values():
+                self.nodes.pop(child.id, None)
+                stack.append(child)
+
+
+def _is_peer(entry, child):
+    # Same owner, test case and test suite.
+    return (child.user_id == entry.user_id and
+            child.testcase_id == entry.testcase_id and
+            child.testsuite_id == entry.testsuite_id)
+
+
+_caches = weakref.WeakKeyDictionary()
+
+def get_cache(session):
+    """Return the ConfigCache for the session's database, or None if the
+    database doesn't count its changes."""
+    engine = session.get_bind()
+    try:
+        return _caches[engine]
+    except KeyError:
+        pass
+    cache = ConfigCache() if models.has_config_generation(engine) else None
+    _caches[engine] = cache
+    return cache
+
+
+# Config rows changed by other means than a Container, in this process, make
+# the cache of their database check the change counter on the next lookup.
+# Once at flush, for the same session, and again at commit, for the others.
+# A rollback undoes changes already copied into the cache, so drops it.
+def _expire_cache(session):
+    cache = _caches.get(session.get_bind())
+    if cache is not None:
+        cache.expire()
+
+def _config_flushed(session, flush_context):
+    for obj in session.new | session.dirty | session.deleted:
+        if isinstance(obj, Config):
+            session.info["config_changed"] = True
+            _expire_cache(session)
+            return
+
+def _config_committed(session):
+    if session.info.pop("config_changed", False):
+        _expire_cache(session)
+
+def _config_rolled_back(session):
+    if session.info.pop("config_changed", False):
+        cache = _caches.get(session.get_bind())
+        if cache is not None:
+            cache.invalidate()
+
+event.listen(models.SessionBase, "after_flush", _config_flushed)
+event.listen(models.SessionBase, "after_commit", _config_committed)
+event.listen(models.SessionBase, "after_rollback", _config_rolled_back)
+
+
 class Container(object):
-    """Make a relational table quack like a dictionary."""
+    """Make a relational table quack like a dictionary.
+
+    The configrow may also be the id of the row, which is then fetched only
+    when needed.
+    """
     def __init__(self, session, configrow, user=None, testcase=None, testsuite=None):
         self.__dict__[b"session"] = session
-        self.__dict__[b"node"] = configrow
+        if isinstance(configrow, Config):
+            self.__dict__[b"_node"] = configrow
+            self.__dict__[b"_nodeid"] = configrow.id
+        else:
+            self.__dict__[b"_node"] = None
+            self.__dict__[b"_nodeid"] = configrow
         self.__dict__[b"_user"] = user
         self.__dict__[b"_testcase"] = testcase
         self.__dict__[b"_testsuite"] = testsuite
 
+    def _get_node(self):
+        node = self.__dict__[b"_node"]
+        if node is None:
+            node = self.session.query(Config).get(self.__dict__[b"_nodeid"])
+            self.__dict__[b"_node"] = node
+        return node
+
+    node = property(_get_node)
+
+    def _cached(self):
+        """Return the cached node of this container, after bringing the cache
+        up to date. None if there is no cache, or the node is not in it."""
+        session = self.__dict__[b"session"]
+        cache = get_cache(session)
+        if cache is None:
+            return None
+        cache.refresh(session)
+        return cache.nodes.get(self.__dict__[b"_nodeid"])
+
+    def _cached_child(self, entry, name, restrict=True):
+        child = entry.children.get(name) if entry.children else None
+        if child is None:
+            return None
+        if restrict:
+            userid = self._get_user_id(entry)
+            if userid is not None and child.user_id != userid:
+                return None
+        return child
+
+    def _cached_children(self, entry):
+        return [child for child in (entry.children or {}).values() if _is_peer(entry, child)]
+
+    def _wrap(self, item):
+        if item.value is NULL:
+            return Container(self.session, item if isinstance(item, Config) else item.id,
+                    user=self._user, testcase=self._testcase, testsuite=self._testsuite)
+        if isinstance(item, Config):
+            return item.value
+        return _copy_value(item.value)
+
+    # Commit a change to item, and make the same change to the cache.
+    def _commit(self, item, delete=False):
+        session = self.session
+        cache = get_cache(session)
+        if cache is None:
+            session.commit()
+            return
+        session.flush()
+        if delete:
+            node = item.id
+        else:
+            node = _Node(item)
+            node.value = _copy_value(node.value)
+        generation = models.get_config_generation(session)
+        session.commit()
+        if delete:
+            cache.remove(node, generation)
+        else:
+            cache.put(node, generation)
+
     def __str__(self):
         if self.node.value is NULL:
             s = []
@@ -85,27 +338,30 @@ class Container(object):
 
     def __setitem__(self, name, value):
         try:
-            item = self.session.query(Config).filter(and_(Config.parent_id==self.node.id,
+            item = self.session.query(Config).filter(and_(Config.parent_id==self._nodeid,
                 Config.name==name)).one()
         except NoResultFound:
             me = self.node
             item = models.create(Config, name=name, value=value, container=me, user=self._user)
             self.session.add(item)
-            self.session.commit()
+            self._commit(item)
         else:
             item.value = value
             self.session.add(item)
-            self.session.commit()
+            self._commit(item)
 
     def __getitem__(self, name):
+        entry = self._cached()
+        if entry is not None:
+            child = self._cached_child(entry, name)
+            if child is None:
+                raise KeyError(name)
+            return self._wrap(child)
         try:
             item = self.session.query(Config).filter(self._get_item_filter(name)).one()
         except NoResultFound:
             raise KeyError(name)
-        if item.value is NULL:
-            return Container(self.session, item,
-                    user=self._user, testcase=self._testcase, testsuite=self._testsuite)
-        return item.value
+        return self._wrap(item)
 
     def __delitem__(self, name):
         try:
@@ -113,7 +369,7 @@ class Container(object):
         except NoResultFound:
             raise KeyError(name)
         self.session.delete(item)
-        self.session.commit()
+        self._commit(item, delete=True)
 
     value = property(lambda s: s.node.value)
 
@@ -131,6 +387,11 @@ class Container(object):
             return default
 
     def iterkeys(self):
+        entry = self._cached()
+        if entry is not None:
+            for child in self._cached_children(entry):
+                yield child.name
+            return
         for name, in self.session.query(Config.name).filter(and_(
             Config.parent_id==self.node.id,
             Config.user==self.node.user,
@@ -142,6 +403,11 @@ class Container(object):
         return list(self.iterkeys())
 
     def iteritems(self):
+        entry = self._cached()
+        if entry is not None:
+            for child in self._cached_children(entry):
+                yield child.name, _copy_value(child.value)
+            return
         for name, value in self.session.query(Config.name, Config.value).filter(and_(
             Config.parent_id==self.node.id,
             Config.user==self.node.user,
@@ -153,6 +419,11 @@ class Container(object):
         return list(self.iteritems())
 
     def itervalues(self):
+        entry = self._cached()
+        if entry is not None:
+            for child in self._cached_children(entry):
+                yield _copy_value(child.value)
+            return
         for value, in self.session.query(Config.value).filter(and_(
             Config.parent_id==self.node.id,
             Config.user==self.node.user,
@@ -178,6 +449,15 @@ class Container(object):
         else: #inherit
             return self.node.user
 
+    def _get_user_id(self, entry):
+        if self._user:
+            if self._user.is_superuser:
+                return None
+            else:
+                return self._user.id
+        else: #inherit
+            return entry.user_id
+
     def _get_item_filter(self, name):
         user = self._get_user()
         if user is not None:
@@ -194,7 +474,7 @@ class Container(object):
                     testsuite=self._testsuite or me.testsuite)
             try:
                 self.session.add(new)
-                self.session.commit()
+                self._commit(new)
             except IntegrityError as err:
                 self.session.rollback()
                 raise ConfigError(str(err))
@@ -204,10 +484,15 @@ class Container(object):
             raise ConfigError("Cannot add container to value pair.")
 
     def get_container(self, name):
-        c = self.session.query(Config).filter(self._get_item_filter(name)).one()
+        entry = self._cached()
+        if entry is not None:
+            c = self._cached_child(entry, name)
+            if c is None:
+                raise NoResultFound("No row was found for one()")
+        else:
+            c = self.session.query(Config).filter(self._get_item_filter(name)).one()
         if c.value is NULL:
-            return Container(self.session, c,
-                    user=self._user, testcase=self._testcase, testsuite=self._testsuite)
+            return self._wrap(c)
         else:
             raise ConfigError("Container %r not found." % (name,))
 
@@ -215,18 +500,12 @@ class Container(object):
         return self.has_key(key)
 
     def __iter__(self):
-        me = self.node
-        self.__dict__[b"_set"] = iter(self.session.query(Config).filter(and_(
-            Config.parent_id==me.id,
-            Config.user==me.user,
-            Config.testcase==me.testcase,
-            Config.testsuite==me.testsuite)))
+        self.__dict__[b"_set"] = self.iterkeys()
         return self
 
     def __next__(self):
         try:
-            item = self.__dict__[b"_set"].next()
-            return item.name
+            return self.__dict__[b"_set"].next()
         except StopIteration:
             del self.__dict__[b"_set"]
             raise
@@ -236,19 +515,21 @@ class Container(object):
         try:
             return super(Container, self).__getattribute__(key)
         except AttributeError:
-            node = self.__dict__[b"node"]
-            session = self.__dict__[b"session"]
             try:
-                item = session.query(Config).filter(and_(
-                        Config.container==node, Config.name==key)).one()
-                if item.value is NULL:
-                    return Container(session, item,
-                        user=self._user, testcase=self._testcase, testsuite=self._testsuite)
-                else:
-                    return item.value
+                return self._get_attribute_item(key)
             except NoResultFound as err:
                 raise AttributeError("Container: No attribute or key '%s' found: %s" % (key, err))
 
+    def _get_attribute_item(self, key):
+        # Attribute access is not restricted to the user's items.
+        entry = self._cached()
+        if entry is not None:
+            child = self._cached_child(entry, key, restrict=False)
+            if child is None:
+                raise NoResultFound("No row was found for one()")
+            return self._wrap(child)
+        return self._wrap(get_item(self.session, self.node, key))
+
     def __setattr__(self, key, obj):
         if self.__class__.__dict__.has_key(key): # to force property access
             type.__setattr__(self.__class__, key, obj)
@@ -264,6 +545,10 @@ class Container(object):
             object.__delattr__(self, key)
 
     def has_key(self, key):
+        entry = self._cached()
+        if entry is not None:
+            child = entry.children.get(key) if entry.children else None
+            return child is not None and _is_peer(entry, child)
         me = self.node
         q = self.session.query(Config).filter(and_(
                 Config.name==key,
@@ -306,6 +591,9 @@ class Container(object):
         if self._user is not None and self._user.is_superuser:
             if self.node.container is not None:
                 self.node.set_owner(self.session, user)
+                cache = get_cache(self.session)
+                if cache is not None:
+                    cache.invalidate()
             else:
                 raise ConfigError("Root container can't be owned.")
         else:
@@ -28,12 +28,15 @@ if sys.version_info.major == 3:
     basestring = str
 
 import collections
+import weakref
 from datetime import timedelta
 from hashlib import sha1
 
-from sqlalchemy import create_engine, inspect, and_, or_, not_, func, exists
+from sqlalchemy import (create_engine, inspect, and_, or_, not_, func, exists,
+        select, event)
 from sqlalchemy.orm import (sessionmaker, mapper, relationship, class_mapper,
         backref, synonym, _mapper_registry, validates)
+from sqlalchemy.orm.session import Session as SessionBase
 from sqlalchemy.orm.properties import ColumnProperty, RelationshipProperty
 from sqlalchemy.orm.collections import column_mapped_collection
 from sqlalchemy.orm.exc import NoResultFound
@@ -1614,6 +1617,49 @@ mapper(Config, tables.config,
 )
 
 
+# The config_generation table counts flushes that change Config rows, so that
+# copies of the config tree kept in memory (see pycopia.db.config) can tell when
+# they are out of date. Databases made before it existed don't have it, and
+# are left alone.
+
+_has_generation = weakref.WeakKeyDictionary()
+
+def has_config_generation(engine):
+    try:
+        return _has_generation[engine]
+    except KeyError:
+        pass
+    with engine.connect() as conn:
+        rv = engine.dialect.has_table(conn, tables.config_generation.name,
+                schema=tables.config_generation.schema)
+    _has_generation[engine] = rv
+    return rv
+
+
+def get_config_generation(session):
+    gen = tables.config_generation
+    rv = session.execute(select([gen.c.generation]).where(gen.c.id == 1)).scalar()
+    return rv or 0
+
+
+def _bump_config_generation(session, flush_context):
+    for obj in session.new | session.dirty | session.deleted:
+        if isinstance(obj, Config):
+            break
+    else:
+        return
+    conn = session.connection()
+    if not has_config_generation(conn.engine):
+        return
+    gen = tables.config_generation
+    res = conn.execute(gen.update().where(gen.c.id == 1).values(
+            generation=gen.c.generation + 1))
+    if res.rowcount == 0:
+        conn.execute(gen.insert().values(id=1, generation=1))
+
+event.listen(SessionBase, "after_flush", _bump_config_generation)
+
+
 
 #######################################
 ## Utility functions
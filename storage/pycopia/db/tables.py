@@ -89,6 +89,12 @@ Index('index_config_parent_id', config.c.parent_id, unique=False)
 Index('index_config_user_id', config.c.user_id, unique=False)
 Index('index_config_testsuite_id', config.c.testsuite_id, unique=False)
 
+# One row, counting the changes made to the config table.
+config_generation =  Table('config_generation', metadata,
+    Column('id', INTEGER(), primary_key=True, nullable=False),
+            Column('generation', INTEGER(), primary_key=False, nullable=False, default=default_obj(0)),
+    schema='public')
+
 
 contacts =  Table('contacts', metadata,
     Column('id', INTEGER(), primary_key=True, nullable=False),
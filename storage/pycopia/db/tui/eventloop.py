@@ -34,6 +34,8 @@ class PycopiaEventLoop(object):
     def __init__(self):
         self._idle_handle = 0
         self._idle_callbacks = {}
+        # run alarms from the poll loop, not a signal handler.
+        scheduler.get_scheduler().attach(asyncio.poller)
 
     def alarm(self, seconds, callback):
         """
@@ -24,8 +24,15 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import division
 
+import os
+import shutil
+import tempfile
 import unittest
 
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+from pycopia.aid import NULL
 
 from pycopia import db
 from pycopia.db import types
@@ -36,13 +43,112 @@ from pycopia.db import config
 #from pycopia.db import webhelpers
 
 
+def sqlite_engine(dirname, transactional=False):
+    """An SQLite database in dirname, with the "public" schema attached.
+    If transactional, transactions are begun by SQLAlchemy, not pysqlite,
+    which commits before a WITH query."""
+    def attach(dbapi_conn, record):
+        if transactional:
+            dbapi_conn.isolation_level = None
+        dbapi_conn.execute("ATTACH DATABASE '{}' AS public".format(
+                os.path.join(dirname, "public.db")))
+    engine = create_engine("sqlite:///" + os.path.join(dirname, "main.db"))
+    event.listen(engine, "connect", attach)
+    if transactional:
+        event.listen(engine, "begin", lambda conn: conn.execute("BEGIN"))
+    return engine
+
+
 class StorageTests(unittest.TestCase):
 
     def setUp(self):
-        pass
+        self.dirname = tempfile.mkdtemp()
+        self.interval = config.CHECK_INTERVAL
 
     def tearDown(self):
-        pass
+        config.CHECK_INTERVAL = self.interval
+        shutil.rmtree(self.dirname)
+
+    def test_config_cache(self):
+        engine = sqlite_engine(self.dirname)
+        tables.config.create(engine)
+        tables.config_generation.create(engine)
+        session = sessionmaker(bind=engine, autoflush=False)()
+        session.add(models.create(models.Config, name="root", value=NULL, user=None))
+        session.commit()
+        cf = config.Container(session, config.get_root(session))
+        dut = cf.add_container("environment").add_container("DUT")
+        dut.prompt = "# "
+        cf["logfiledir"] = "/var/tmp"
+        # Lookups are served from memory, once loaded.
+        cache = config.get_cache(session)
+        self.assertEqual(cf["logfiledir"], "/var/tmp")
+        self.assertEqual(cache.generation, 5) # one flush per change.
+        queries = []
+        event.listen(engine, "before_cursor_execute", lambda *args: queries.append(args))
+        self.assertEqual(cf.environment.DUT.prompt, "# ")
+        self.assertEqual(sorted(cf.keys()), ["environment", "logfiledir"])
+        self.assertTrue("logfiledir" in cf)
+        self.assertRaises(KeyError, cf.__getitem__, "nothere")
+        self.assertRaises(AttributeError, getattr, cf, "nothere")
+        self.assertEqual(queries, [])
+        # Writes go through to the cache.
+        cf.environment.DUT.prompt = "$ "
+        self.assertEqual(cache.generation, 6)
+        self.assertEqual(cf.environment.DUT.prompt, "$ ")
+        del cf.environment["DUT"]
+        self.assertEqual(cf.environment.keys(), [])
+        self.assertEqual(cache.generation, 7)
+        # Changes made elsewhere are seen after CHECK_INTERVAL.
+        other = sessionmaker(bind=sqlite_engine(self.dirname))()
+        config.Container(other, config.get_root(other))["logfiledir"] = "/tmp"
+        config.CHECK_INTERVAL = 0.0
+        self.assertEqual(cf["logfiledir"], "/tmp")
+        self.assertEqual(cache.generation, 8)
+        other.close()
+        # Changes made in this process by other means are seen at once.
+        config.CHECK_INTERVAL = 60.0
+        other = sessionmaker(bind=engine)()
+        row = other.query(models.Config).filter(models.Config.name == "logfiledir").one()
+        row.value = "/var/log"
+        other.commit()
+        self.assertEqual(cf["logfiledir"], "/var/log")
+        other.close()
+        # Mutable values are copies, not the cached value.
+        cf["hosts"] = hosts = ["a"]
+        hosts.append("b")
+        cf["hosts"].append("c")
+        self.assertEqual(cf["hosts"], ["a"])
+        self.assertEqual(cf.values()[cf.keys().index("hosts")], ["a"])
+        self.assertTrue(cf.environment.value is NULL)
+        session.close()
+        # A rolled back change, seen by the cache after its flush, is dropped.
+        engine = sqlite_engine(tempfile.mkdtemp(dir=self.dirname), transactional=True)
+        tables.config.create(engine)
+        tables.config_generation.create(engine)
+        session = sessionmaker(bind=engine, autoflush=False)()
+        session.add(models.create(models.Config, name="root", value=NULL, user=None))
+        session.commit()
+        cf = config.Container(session, config.get_root(session))
+        cf["logfiledir"] = "/var/tmp"
+        row = session.query(models.Config).filter(models.Config.name == "logfiledir").one()
+        row.value = "/scratch"
+        session.flush()
+        self.assertEqual(cf["logfiledir"], "/scratch")
+        session.rollback()
+        self.assertEqual(cf["logfiledir"], "/var/tmp")
+        session.close()
+        # Without the counter, rows are read as needed.
+        engine = sqlite_engine(tempfile.mkdtemp(dir=self.dirname))
+        tables.config.create(engine)
+        session = sessionmaker(bind=engine, autoflush=False)()
+        session.add(models.create(models.Config, name="root", value=NULL, user=None))
+        session.commit()
+        cf = config.Container(session, config.get_root(session))
+        cf.add_container("environment").prompt = "# "
+        self.assertTrue(config.get_cache(session) is None)
+        self.assertEqual(cf.environment.prompt, "# ")
+        session.close()
 
 
 
@@ -0,0 +1,181 @@
+# python wrapper for writev, sendfile and recvmmsg.
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+
+# definition:
+# ssize_t writev(int fd, const struct iovec *iov, int iovcnt);
+# ssize_t sendfile(int out_fd, int in_fd, off_t *offset, size_t count);
+# int recvmmsg(int sockfd, struct mmsghdr *msgvec, unsigned int vlen,
+#              int flags, struct timespec *timeout);
+
+from cpython.buffer cimport (PyObject_GetBuffer, PyBuffer_Release, PyBUF_SIMPLE,
+        PyBUF_WRITABLE)
+from cpython.bytes cimport PyBytes_FromStringAndSize
+
+cdef extern from "Python.h":
+    int PyErr_CheckSignals() except -1
+
+cdef extern from "sys/types.h":
+    ctypedef long off_t
+    ctypedef long ssize_t
+
+cdef extern from "sys/uio.h":
+    struct iovec:
+        void *iov_base
+        size_t iov_len
+    ssize_t c_writev "writev" (int, iovec *, int) nogil
+
+cdef extern from "string.h":
+    char *strerror(int errnum)
+
+cdef extern from "errno.h":
+    int errno
+
+DEF EINTR = 4
+DEF EAGAIN = 11
+DEF IOV_MAX = 1024
+
+IOVMAX = IOV_MAX
+
+
+def writev(int fd, buffers):
+    """writev(fd, buffers)
+Write a sequence of buffer objects (strings, bytearrays, memoryviews) to the
+file descriptor in one system call, without joining them first. At most
+IOVMAX buffers are written. Returns the number of bytes written, which may be
+less than the total for a non-blocking descriptor.
+    """
+    cdef iovec iov[IOV_MAX]
+    cdef Py_buffer views[IOV_MAX]
+    cdef int count = 0
+    cdef int i
+    cdef ssize_t rv
+    try:
+        for buf in buffers:
+            if count == IOV_MAX:
+                break
+            PyObject_GetBuffer(buf, &views[count], PyBUF_SIMPLE)
+            iov[count].iov_base = views[count].buf
+            iov[count].iov_len = views[count].len
+            count += 1
+        while True:
+            with nogil:
+                rv = c_writev(fd, iov, count)
+            if rv >= 0:
+                return rv
+            if errno == EINTR:
+                PyErr_CheckSignals()
+            else:
+                raise OSError(errno, strerror(errno))
+    finally:
+        for i in range(count):
+            PyBuffer_Release(&views[i])
+
+
+IF UNAME_SYSNAME == "Linux":
+
+    cdef extern from "sys/sendfile.h":
+        ssize_t c_sendfile "sendfile" (int, int, off_t *, size_t) nogil
+
+    def sendfile(int outfd, int infd, off_t offset, size_t count):
+        """sendfile(outfd, infd, offset, count)
+Copy up to count bytes from infd, starting at offset, to outfd within the
+kernel. The file position of infd is not changed. Returns the number of bytes
+written.
+        """
+        cdef ssize_t rv
+        while True:
+            with nogil:
+                rv = c_sendfile(outfd, infd, &offset, count)
+            if rv >= 0:
+                return rv
+            if errno == EINTR:
+                PyErr_CheckSignals()
+            else:
+                raise OSError(errno, strerror(errno))
+
+    cdef extern from "sys/socket.h":
+        ctypedef unsigned int socklen_t
+        struct msghdr:
+            void *msg_name
+            socklen_t msg_namelen
+            iovec *msg_iov
+            size_t msg_iovlen
+            void *msg_control
+            size_t msg_controllen
+            int msg_flags
+        struct mmsghdr:
+            msghdr msg_hdr
+            unsigned int msg_len
+        int c_recvmmsg "recvmmsg" (int, mmsghdr *, unsigned int, int, void *) nogil
+        int MSG_DONTWAIT
+
+    cdef extern from "netinet/in.h":
+        struct in_addr:
+            unsigned int s_addr
+        struct sockaddr_in:
+            unsigned short sin_family
+            unsigned short sin_port
+            in_addr sin_addr
+        unsigned short ntohs(unsigned short)
+
+    cdef extern from "arpa/inet.h":
+        char *inet_ntoa(in_addr)
+
+    DEF MMSG_MAX = 1024
+
+    def recvmmsg(int fd, buf, size_t msgsize):
+        """recvmmsg(fd, buf, msgsize)
+Receive as many datagrams as are waiting on a non-blocking IPv4 socket, up to
+len(buf) // msgsize (at most 1024) of them, in one system call. The writable
+buffer buf is divided into slots of msgsize bytes for them, so it can be reused
+from call to call. Returns a list of (data, (address, port)) tuples, which is
+empty if nothing was waiting. Datagrams longer than msgsize are truncated.
+        """
+        cdef mmsghdr msgs[MMSG_MAX]
+        cdef iovec iov[MMSG_MAX]
+        cdef sockaddr_in addrs[MMSG_MAX]
+        cdef Py_buffer view
+        cdef unsigned int count
+        cdef unsigned int i
+        cdef int rv
+        cdef char *base
+        PyObject_GetBuffer(buf, &view, PyBUF_SIMPLE | PyBUF_WRITABLE)
+        try:
+            count = min(<size_t> view.len // msgsize, MMSG_MAX)
+            base = <char *> view.buf
+            for i in range(count):
+                iov[i].iov_base = base + i * msgsize
+                iov[i].iov_len = msgsize
+                msgs[i].msg_hdr.msg_name = &addrs[i]
+                msgs[i].msg_hdr.msg_namelen = sizeof(sockaddr_in)
+                msgs[i].msg_hdr.msg_iov = &iov[i]
+                msgs[i].msg_hdr.msg_iovlen = 1
+                msgs[i].msg_hdr.msg_control = NULL
+                msgs[i].msg_hdr.msg_controllen = 0
+                msgs[i].msg_hdr.msg_flags = 0
+            while True:
+                with nogil:
+                    rv = c_recvmmsg(fd, msgs, count, MSG_DONTWAIT, NULL)
+                if rv >= 0:
+                    break
+                if errno == EAGAIN:
+                    return []
+                if errno == EINTR:
+                    PyErr_CheckSignals()
+                else:
+                    raise OSError(errno, strerror(errno))
+            return [(PyBytes_FromStringAndSize(base + i * msgsize, msgs[i].msg_len),
+                        (inet_ntoa(addrs[i].sin_addr), ntohs(addrs[i].sin_port)))
+                    for i in range(rv)]
+        finally:
+            PyBuffer_Release(&view)
@@ -23,6 +23,7 @@ if sys.platform == "darwin":
     EXTENSIONS.append(Extension('pycopia.itimer', ['pycopia.itimer.c']))
 elif sys.platform.startswith("linux"):
     EXTENSIONS.append(Extension('pycopia.itimer', ['pycopia.itimer.pyx'], libraries=["rt"]))
+    EXTENSIONS.append(Extension('pycopia.fdio', ['pycopia.fdio.pyx']))
     SCRIPTS = glob("bin/*")
 
 